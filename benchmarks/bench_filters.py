@@ -0,0 +1,152 @@
+"""
+过滤规则引擎基准测试：规则数量增长时的匹配吞吐量。
+
+对每个规则数量，生成一组混合规则（会话 id、发送者 id、关键词、正则和组合条件），
+分别用 handlers/rules.py 中编译后的 RuleEngine 和逐条检查规则的朴素实现匹配同一批合成消息，
+输出编译耗时和每秒匹配的消息数。两种实现的匹配结果会互相校验。
+
+用法（在项目根目录下运行）：
+
+    python -m benchmarks.bench_filters
+    python -m benchmarks.bench_filters --rules 10 100 1000 10000 --messages 20000
+"""
+
+import argparse
+import random
+import re
+import time
+from typing import List
+
+from handlers.rules import RuleEngine
+from utils.config import Config
+
+WORDS = [
+    "hello", "world", "价格", "通知", "空投", "转发", "比特币", "以太坊", "招聘", "广告",
+    "telegram", "channel", "bot", "crypto", "sale", "免费", "领取", "活动", "抽奖", "公告",
+]
+
+
+class SyntheticMessage:
+    def __init__(self, text: str):
+        self.raw_text = text
+        self.media = None
+        self.fwd_from = None
+
+
+class SyntheticEvent:
+    def __init__(self, chat_id: int, sender_id: int, text: str):
+        self.chat_id = chat_id
+        self.sender_id = sender_id
+        self.message = SyntheticMessage(text)
+
+
+def make_rules(count: int, rng: random.Random, id_space: int) -> List[dict]:
+    """生成 count 条混合规则。"""
+    rules = []
+    for i in range(count):
+        kind = rng.random()
+        conditions = {}
+        if kind < 0.35:
+            conditions['chat_ids'] = {-1000000000000 - rng.randrange(id_space) for _ in range(rng.randint(1, 5))}
+        elif kind < 0.55:
+            conditions['sender_ids'] = {rng.randrange(id_space) for _ in range(rng.randint(1, 5))}
+        elif kind < 0.85:
+            conditions['keywords'] = [
+                f"{rng.choice(WORDS)}{rng.randrange(count * 2)}" for _ in range(rng.randint(1, 3))
+            ]
+        elif kind < 0.95:
+            conditions['regexes'] = [rf"{rng.choice(WORDS)}\d{{2}}{rng.randrange(count)}\b"]
+        else:
+            conditions['chat_ids'] = {-1000000000000 - rng.randrange(id_space)}
+            conditions['keywords'] = [rng.choice(WORDS)]
+        action = 'include' if rng.random() < 0.3 else 'exclude'
+        rules.append(Config._make_rule(f"r{i}", action=action, **conditions))
+    return rules
+
+
+def make_events(count: int, rng: random.Random, id_space: int, rule_count: int) -> List[SyntheticEvent]:
+    """生成 count 条合成消息，正文中的词尾数字让一部分消息命中关键词和正则。"""
+    events = []
+    for _ in range(count):
+        text = " ".join(
+            f"{rng.choice(WORDS)}{rng.randrange(rule_count * 2)}" if rng.random() < 0.3 else rng.choice(WORDS)
+            for _ in range(rng.randint(5, 40))
+        )
+        events.append(SyntheticEvent(-1000000000000 - rng.randrange(id_space), rng.randrange(id_space), text))
+    return events
+
+
+class NaiveMatcher:
+    """逐条检查每条规则的朴素实现，作为对照组。"""
+    def __init__(self, definitions: List[dict]):
+        self.rules = []
+        for definition in definitions:
+            self.rules.append((
+                definition['name'],
+                set(definition['chat_ids']),
+                set(definition['sender_ids']),
+                definition['keywords'],
+                [re.compile(p) for p in definition['regexes']],
+            ))
+
+    def match(self, event) -> List[str]:
+        chat_id = event.chat_id
+        sender_id = event.sender_id
+        text = event.message.raw_text
+        lowered = text.lower()
+        matched = []
+        for name, chat_ids, sender_ids, keywords, regexes in self.rules:
+            if chat_ids and chat_id not in chat_ids:
+                continue
+            if sender_ids and sender_id not in sender_ids:
+                continue
+            if keywords and not any(keyword in lowered for keyword in keywords):
+                continue
+            if regexes and not any(regex.search(text) for regex in regexes):
+                continue
+            matched.append(name)
+        return matched
+
+
+def bench(rule_count: int, message_count: int, seed: int):
+    rng = random.Random(seed)
+    id_space = max(rule_count * 2, 1000)
+    definitions = make_rules(rule_count, rng, id_space)
+    events = make_events(message_count, rng, id_space, rule_count)
+
+    start = time.perf_counter()
+    engine = RuleEngine(definitions, default_target=0)
+    compile_ms = (time.perf_counter() - start) * 1000
+    naive = NaiveMatcher(definitions)
+
+    start = time.perf_counter()
+    engine_results = [[rule.name for rule in engine.match(event)] for event in events]
+    engine_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    naive_results = [naive.match(event) for event in events]
+    naive_elapsed = time.perf_counter() - start
+
+    mismatches = sum(1 for a, b in zip(engine_results, naive_results) if sorted(a) != sorted(b))
+    matched = sum(1 for result in engine_results if result)
+    print(
+        f"{rule_count:>8}{compile_ms:>12.1f}{message_count / engine_elapsed:>14,.0f}"
+        f"{message_count / naive_elapsed:>14,.0f}{naive_elapsed / engine_elapsed:>9.1f}x"
+        f"{matched:>10}{mismatches:>8}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="过滤规则引擎基准测试")
+    parser.add_argument("--rules", type=int, nargs="+", default=[10, 100, 1000, 5000], help="规则数量")
+    parser.add_argument("--messages", type=int, default=10000, help="每轮匹配的消息数量")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"{'规则数':>8}{'编译(ms)':>12}{'引擎 条/秒':>14}{'朴素 条/秒':>14}{'加速':>10}{'命中消息':>10}{'不一致':>8}")
+    for rule_count in args.rules:
+        bench(rule_count, args.messages, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+索引基准测试：对比迁移前后仪表盘查询的耗时。
+
+在一个合成的数据库上（默认 1000 万行）分别在只有 v1 表结构和升级到最新结构之后，
+运行 web/api/data.py 中的各个查询，输出每个查询的耗时和加速比。
+
+用法（在项目根目录下运行）：
+
+    python -m benchmarks.bench_indexes --rows 10000000
+    python -m benchmarks.bench_indexes --rows 200000 --db /tmp/bench.db --keep
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import aiosqlite
+
+from handlers.migrations import LATEST_VERSION, migrate
+
+# 与 web/api/data.py 中的查询保持一致
+QUERIES = {
+    "top_chats_7_days": (
+        """
+        SELECT chat_title, COUNT(*) as message_count
+        FROM messages
+        WHERE date >= ? AND chat_type IN ('Group', 'Channel')
+        GROUP BY chat_title
+        ORDER BY message_count DESC
+        LIMIT 10
+        """,
+        lambda now: (now - timedelta(days=7),),
+    ),
+    "hourly_activity_30_days": (
+        """
+        SELECT
+            STRFTIME('%Y-%m-%d', date) as day,
+            STRFTIME('%H', date, '+8 hours') as hour,
+            COUNT(*) as message_count
+        FROM messages
+        WHERE date >= ?
+        GROUP BY day, hour
+        """,
+        lambda now: (now - timedelta(days=30),),
+    ),
+    "total_messages_7_days": (
+        """
+        SELECT STRFTIME('%Y-%m-%d', date) as day, COUNT(*) as message_count
+        FROM messages
+        WHERE date >= ?
+        GROUP BY day
+        ORDER BY day
+        """,
+        lambda now: (now.date() - timedelta(days=7),),
+    ),
+    "top_users_7_days": (
+        """
+        SELECT sender_name, COUNT(*) as message_count
+        FROM messages
+        WHERE sender_name IS NOT 'Unknown'
+        AND date >= ?
+        GROUP BY sender_name
+        ORDER BY message_count DESC
+        LIMIT 10
+        """,
+        lambda now: (now - timedelta(days=7),),
+    ),
+    "top_chats_today": (
+        """
+        SELECT chat_title, COUNT(*) as message_count
+        FROM messages
+        WHERE date >= ? AND chat_type IN ('Group', 'Channel')
+        GROUP BY chat_title
+        ORDER BY message_count DESC
+        LIMIT 10
+        """,
+        lambda now: (now.date(),),
+    ),
+    "search_latest": (
+        """
+        SELECT chat_title, sender_name, text, date
+        FROM messages
+        WHERE text LIKE ?
+        ORDER BY date DESC
+        LIMIT 20
+        """,
+        lambda now: ("%hello%",),
+    ),
+    "lookup_chat_message": (
+        "SELECT id FROM messages WHERE chat_id = ? AND message_id = ?",
+        lambda now: (-1000042, 12345),
+    ),
+}
+
+# 合成数据：500 个会话、5000 个发送者，时间均匀分布在最近 180 天
+POPULATE_SQL = """
+WITH RECURSIVE seq(n) AS (
+    SELECT ? UNION ALL SELECT n + 1 FROM seq WHERE n < ?
+)
+INSERT INTO messages (
+    message_id, chat_id, chat_type, chat_title, sender_id, sender_name,
+    sender_username, text, raw_text, date, is_reply, reply_to_message_id
+)
+SELECT
+    n,
+    -1000000 - (n % 500),
+    CASE n % 10 WHEN 0 THEN 'User' WHEN 1 THEN 'Group' ELSE 'Channel' END,
+    'chat ' || (n % 500),
+    n % 5000,
+    'sender ' || (n % 5000),
+    'user' || (n % 5000),
+    CASE WHEN n % 97 = 0 THEN 'hello world ' || n ELSE 'message body ' || n END,
+    'message body ' || n,
+    STRFTIME('%Y-%m-%d %H:%M:%S', ?, '-' || (ABS(RANDOM()) % 15552000) || ' seconds') || '+00:00',
+    0,
+    NULL
+FROM seq
+"""
+
+
+async def populate(conn: aiosqlite.Connection, rows: int, chunk: int = 500000):
+    """分块插入合成数据。"""
+    now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    start = time.perf_counter()
+    for first in range(1, rows + 1, chunk):
+        last = min(first + chunk - 1, rows)
+        await conn.execute(POPULATE_SQL, (first, last, now))
+        await conn.commit()
+        print(f"  已生成 {last:,}/{rows:,} 行 ({time.perf_counter() - start:.1f}s)", flush=True)
+
+
+async def run_queries(conn: aiosqlite.Connection, repeat: int) -> dict:
+    """运行所有查询，返回每个查询 repeat 次中的最短耗时（毫秒）。"""
+    now = datetime.utcnow()
+    timings = {}
+    for name, (sql, params) in QUERIES.items():
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            async with conn.execute(sql, params(now)) as cursor:
+                await cursor.fetchall()
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best * 1000
+    return timings
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="对比索引迁移前后仪表盘查询的耗时")
+    parser.add_argument("--rows", type=int, default=10_000_000, help="合成数据的行数")
+    parser.add_argument("--db", default=None, help="基准数据库路径（默认使用临时文件）")
+    parser.add_argument("--repeat", type=int, default=3, help="每个查询重复次数，取最短耗时")
+    parser.add_argument("--keep", action="store_true", help="结束后保留数据库文件")
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="listentg-bench-"), "bench.db")
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    conn = await aiosqlite.connect(db_path)
+    try:
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA synchronous=OFF")
+        await conn.execute("PRAGMA cache_size=-262144")
+
+        print(f"创建 v1 表结构并生成 {args.rows:,} 行合成数据: {db_path}")
+        await migrate(conn, target_version=1)
+        await populate(conn, args.rows)
+
+        print("运行迁移前的查询 ...")
+        before = await run_queries(conn, args.repeat)
+
+        print(f"升级到 v{LATEST_VERSION} ...")
+        start = time.perf_counter()
+        await migrate(conn)
+        print(f"  迁移耗时 {time.perf_counter() - start:.1f}s")
+
+        print("运行迁移后的查询 ...")
+        after = await run_queries(conn, args.repeat)
+    finally:
+        await conn.close()
+        if not args.keep:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+
+    print()
+    print(f"{'查询':<26}{'迁移前 (ms)':>14}{'迁移后 (ms)':>14}{'加速比':>10}")
+    for name in QUERIES:
+        speedup = before[name] / after[name] if after[name] else float("inf")
+        print(f"{name:<26}{before[name]:>14.1f}{after[name]:>14.1f}{speedup:>9.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,201 @@
+"""
+消息处理流水线基准测试：不连接 Telegram，用合成事件回放消息处理流程。
+
+对比两种处理方式在同一批合成消息上的耗时：
+
+- inline：旧的做法，在事件回调中依次 await 已读回执、实体解析、过滤、入库、格式化和入队；
+- pipeline：handlers/pipeline.py 中的分阶段流水线，事件回调只负责交给流水线，
+  已读回执由 ReadReceiptAggregator 按会话合并发送。
+
+已读回执和实体解析的网络往返用 --read-latency-ms / --resolve-latency-ms 模拟，
+入库和转发队列使用临时目录中真实的 SQLite 数据库。
+需要在项目根目录（有 config.ini）下运行：
+
+    python -m benchmarks.bench_pipeline --events 5000 --skip-inline
+    python -m benchmarks.bench_pipeline --events 5000 --chats 50 --read-latency-ms 30
+"""
+
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from telethon.tl.types import Channel, User
+
+from handlers.database import DatabaseManager
+from handlers.forward_queue import ForwardQueue
+from handlers.pipeline import IngestPipeline
+from handlers.read_receipts import ReadReceiptAggregator
+from handlers.rules import RuleEngine
+from utils.config import PIPELINE_STAGE_DEFAULTS
+from utils.entity_cache import EntityCache
+from utils.formatter import format_message
+
+_message_ids = itertools.count(1)
+
+
+class SyntheticMessage:
+    """模拟 Telethon Message 中流水线用到的属性。"""
+    def __init__(self, chat_id: int, text: str):
+        self.id = next(_message_ids)
+        self.chat_id = chat_id
+        self.text = text
+        self.raw_text = text
+        self.media = self.fwd_from = None
+        self.photo = self.sticker = self.video = self.document = None
+        self.date = datetime.now(timezone.utc)
+        self.is_reply = False
+        self.reply_to_msg_id = None
+
+
+class SyntheticEvent:
+    """模拟 NewMessage 事件；mark_read 和未附带实体时的解析用 sleep 模拟网络往返。"""
+    def __init__(self, chat: Channel, sender: User, text: str, read_latency: float, resolve_latency: float):
+        self.message = SyntheticMessage(-1000000000000 - chat.id, text)
+        self.chat_id = self.message.chat_id
+        self.sender_id = sender.id
+        # 真实的更新大多自带实体；这里让事件都不带实体，以体现解析的开销
+        self.chat = None
+        self.sender = None
+        self._chat = chat
+        self._sender = sender
+        self._read_latency = read_latency
+        self._resolve_latency = resolve_latency
+
+    async def mark_read(self):
+        await asyncio.sleep(self._read_latency)
+
+    async def get_chat(self):
+        await asyncio.sleep(self._resolve_latency)
+        return self._chat
+
+    async def get_sender(self):
+        await asyncio.sleep(self._resolve_latency)
+        return self._sender
+
+
+class SyntheticClient:
+    """模拟 ReadReceiptAggregator 用到的客户端方法，每次请求 sleep 一次往返时间。"""
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def get_input_entity(self, chat_id: int):
+        return chat_id
+
+    async def send_read_acknowledge(self, entity, max_id: int, clear_mentions: bool = False):
+        await asyncio.sleep(self.latency)
+
+
+def make_events(args) -> list:
+    """生成合成事件。"""
+    rng = random.Random(42)
+    chats = [Channel(id=i + 1, title=f"群组 {i}", photo=None, date=None) for i in range(args.chats)]
+    senders = [User(id=100000 + i, first_name="用户", last_name=str(i), username=f"u{i}") for i in range(args.senders)]
+    words = ["hello", "world", "转发", "测试", "消息", "telegram", "价格", "通知"]
+    return [
+        SyntheticEvent(
+            rng.choice(chats),
+            rng.choice(senders),
+            " ".join(rng.choices(words, k=rng.randint(3, 20))),
+            args.read_latency_ms / 1000,
+            args.resolve_latency_ms / 1000,
+        )
+        for _ in range(args.events)
+    ]
+
+
+async def open_stores(db_path: str):
+    """在临时数据库上创建 DatabaseManager 和 ForwardQueue。"""
+    db = DatabaseManager(db_path)
+    await db.init_db()
+    await db.start_writer()
+    queue = ForwardQueue(db_path)
+    await queue.open()
+    return db, queue
+
+
+async def close_stores(db, queue):
+    await queue.close()
+    await db.close()
+
+
+async def run_inline(events: list, db_path: str) -> float:
+    """按旧的事件回调方式依次处理每条消息，返回耗时（秒）。"""
+    db, queue = await open_stores(db_path)
+    cache = EntityCache()
+    start = time.perf_counter()
+    for event in events:
+        await event.mark_read()
+        chat, sender = await cache.resolve(event)
+        await db.save_message(event, chat, sender)
+        await format_message(event.message, chat, sender)
+        await queue.put(event.chat_id, event.message.id, 0)
+    await db.flush()
+    await queue.flush()
+    elapsed = time.perf_counter() - start
+    await close_stores(db, queue)
+    return elapsed
+
+
+async def run_pipeline(events: list, db_path: str, read_latency: float):
+    """通过流水线处理全部消息，返回耗时（秒）、各阶段统计和已读回执统计。"""
+    db, queue = await open_stores(db_path)
+    receipts = ReadReceiptAggregator(SyntheticClient(read_latency), interval=1.0)
+    pipeline = IngestPipeline(
+        db,
+        queue,
+        EntityCache(),
+        RuleEngine([], default_target=0),
+        stage_settings=PIPELINE_STAGE_DEFAULTS,
+        read_receipts=receipts,
+    )
+    pipeline.start()
+    start = time.perf_counter()
+    for event in events:
+        await pipeline.submit(event)
+    await pipeline.stop()
+    await db.flush()
+    await queue.flush()
+    elapsed = time.perf_counter() - start
+    stats = pipeline.stats()
+    await close_stores(db, queue)
+    return elapsed, stats, receipts.stats()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="消息处理流水线基准测试")
+    parser.add_argument("--events", type=int, default=5000, help="合成事件数量")
+    parser.add_argument("--chats", type=int, default=200, help="会话数量")
+    parser.add_argument("--senders", type=int, default=2000, help="发送者数量")
+    parser.add_argument("--read-latency-ms", type=float, default=20.0, help="模拟的已读回执往返耗时")
+    parser.add_argument("--resolve-latency-ms", type=float, default=50.0, help="模拟的实体解析往返耗时")
+    parser.add_argument("--skip-inline", action="store_true", help="不运行 inline 对照组")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if not args.skip_inline:
+            inline_elapsed = await run_inline(make_events(args), os.path.join(tmp, "inline.db"))
+            print(f"inline:   {args.events} 条消息，耗时 {inline_elapsed:.2f} 秒，{args.events / inline_elapsed:,.0f} 条/秒")
+
+        elapsed, stats, receipts = await run_pipeline(
+            make_events(args), os.path.join(tmp, "pipeline.db"), args.read_latency_ms / 1000
+        )
+        print(f"pipeline: {args.events} 条消息，耗时 {elapsed:.2f} 秒，{args.events / elapsed:,.0f} 条/秒")
+        print(f"已读回执: 记录 {receipts['marked']} 条，实际请求 {receipts['requests']} 次")
+
+    print()
+    print(f"{'阶段':<10}{'处理':>8}{'丢弃':>8}{'等待p50':>10}{'等待p99':>10}{'处理p50':>10}{'处理p99':>10}  (ms)")
+    for name, stage in stats.items():
+        wait, latency = stage["wait_ms"], stage["latency_ms"]
+        print(
+            f"{name:<10}{stage['processed']:>8}{stage['dropped']:>8}"
+            f"{wait['p50'] or 0:>10}{wait['p99'] or 0:>10}{latency['p50'] or 0:>10}{latency['p99'] or 0:>10}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,404 @@
+"""
+按月分区的历史消息归档。
+
+listentg_messages.db 中的 messages 表只保存最近 hot_months 个月的消息（热分区），
+更早的消息按月份搬到归档目录中的独立数据库文件 messages_YYYY_MM.db：
+
+- 每个归档文件有与主库相同结构的 messages 表和自己的全文索引 messages_fts，
+  消息的 id 保持不变，查询时可以与主库的结果直接合并；
+- 搬迁由监听进程的写连接按 id 分块完成，每块先写入归档文件、再从主库删除，
+  中途中断后重新运行不会丢失或重复消息；
+- 主库中被删除的页会被新消息复用，文件大小不再随总消息量增长；
+- 保留策略按整个文件处理：超过 retention_months 的分区直接删除或移到 export_dir，
+  不需要逐行删除，也不需要 VACUUM；
+- Web 进程按查询的日期范围只打开有重叠的分区（见 ArchiveReader）。
+
+按小时预聚合的统计表不分区，归档和删除分区都不会影响仪表盘的统计。
+"""
+
+import asyncio
+import logging
+import os
+import re
+import shutil
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, List, Optional, Set, Tuple
+
+import aiosqlite
+
+from handlers.database import ReadConnectionPool
+from utils.config import settings
+from utils.reload import config_reloader
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FILE_RE = re.compile(r"^messages_(\d{4})_(\d{2})\.db$")
+# 归档时附加的归档文件在写连接中的名称
+ARCHIVE_SCHEMA = "archive"
+MESSAGE_COLUMNS = (
+    "id, message_id, chat_id, chat_type, chat_title, sender_id, sender_name, "
+    "sender_username, text, raw_text, date, is_reply, reply_to_message_id"
+)
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def month_start(dt: datetime) -> datetime:
+    """返回 dt 所在月份的第一天零点。"""
+    return datetime(dt.year, dt.month, 1)
+
+
+def add_months(dt: datetime, months: int) -> datetime:
+    """返回 dt 所在月份加上 months 个月后的第一天零点。"""
+    index = dt.year * 12 + dt.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+class Partition:
+    """
+    一个月份的归档分区。
+
+    :param start: 分区包含的第一天零点（UTC）。
+    :param path: 归档文件的路径。
+    """
+    __slots__ = ("start", "end", "path")
+
+    def __init__(self, start: datetime, path: str):
+        self.start = start
+        self.end = add_months(start, 1)
+        self.path = path
+
+    @property
+    def name(self) -> str:
+        return self.start.strftime("%Y_%m")
+
+    def overlaps(self, since: Optional[datetime], until: Optional[datetime]) -> bool:
+        """分区是否与 [since, until) 有重叠，None 表示不限。"""
+        return (since is None or self.end > since) and (until is None or self.start < until)
+
+
+async def create_archive_schema(conn: aiosqlite.Connection, schema: str):
+    """在附加的归档文件中创建与主库相同的 messages 表、索引和全文索引。"""
+    await conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {schema}.messages (
+            id INTEGER PRIMARY KEY,
+            message_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            chat_type TEXT,
+            chat_title TEXT,
+            sender_id INTEGER,
+            sender_name TEXT,
+            sender_username TEXT,
+            text TEXT,
+            raw_text TEXT,
+            date TIMESTAMP NOT NULL,
+            is_reply BOOLEAN,
+            reply_to_message_id INTEGER
+        )
+    """)
+    await conn.execute(
+        f"CREATE INDEX IF NOT EXISTS {schema}.idx_messages_date ON messages (date)"
+    )
+    await conn.execute(
+        f"CREATE INDEX IF NOT EXISTS {schema}.idx_messages_chat_message ON messages (chat_id, message_id)"
+    )
+    await conn.execute(
+        f"CREATE INDEX IF NOT EXISTS {schema}.idx_messages_chat_date ON messages (chat_id, date)"
+    )
+    await conn.execute(
+        f"CREATE INDEX IF NOT EXISTS {schema}.idx_messages_sender_date ON messages (sender_id, date)"
+    )
+    await conn.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {schema}.messages_fts USING fts5("
+        "body, content='', tokenize='unicode61 remove_diacritics 2')"
+    )
+
+
+class MessageArchive:
+    """
+    归档目录中的按月分区，以及把主库中的旧消息搬进分区、按保留策略删除分区的操作。
+
+    :param directory: 归档文件所在目录。
+    :param hot_months: 主库保留的月数（包括当前月份）。
+    :param retention_months: 分区保留的月数，0 表示永久保留。
+    :param export_dir: 过期分区移到该目录而不是删除，为空时直接删除。
+    :param chunk_size: 搬迁时每个事务处理的消息数量。
+    """
+    def __init__(
+        self,
+        directory: str,
+        hot_months: int = 3,
+        retention_months: int = 0,
+        export_dir: str = "",
+        chunk_size: int = 50000,
+    ):
+        self.directory = directory
+        self.hot_months = hot_months
+        self.retention_months = retention_months
+        self.export_dir = export_dir
+        self.chunk_size = chunk_size
+        self._cached: Tuple[Optional[float], List[Partition]] = (None, [])
+
+    def path_for(self, start: datetime) -> str:
+        """返回某个月份的归档文件路径。"""
+        return os.path.join(self.directory, f"messages_{start.strftime('%Y_%m')}.db")
+
+    def partitions(self) -> List[Partition]:
+        """返回所有归档分区，按时间从新到旧排列（目录未变化时使用缓存）。"""
+        try:
+            mtime = os.stat(self.directory).st_mtime
+        except OSError:
+            return []
+        if self._cached[0] == mtime:
+            return self._cached[1]
+        partitions = []
+        for filename in os.listdir(self.directory):
+            match = ARCHIVE_FILE_RE.match(filename)
+            if match:
+                start = datetime(int(match.group(1)), int(match.group(2)), 1)
+                partitions.append(Partition(start, os.path.join(self.directory, filename)))
+        partitions.sort(key=lambda partition: partition.start, reverse=True)
+        self._cached = (mtime, partitions)
+        return partitions
+
+    def partitions_for(self, since: Optional[datetime] = None, until: Optional[datetime] = None) -> List[Partition]:
+        """返回与 [since, until) 有重叠的归档分区，按时间从新到旧排列。"""
+        return [partition for partition in self.partitions() if partition.overlaps(since, until)]
+
+    async def archived_messages(self, rows: Iterable[Tuple]) -> Set[Tuple[int, int]]:
+        """
+        返回 rows（DatabaseManager.message_item 生成的消息行）中已经在归档分区里的 (chat_id, message_id)。
+
+        每个有分区的月份打开一次只读连接；没有分区的月份不需要检查。
+        """
+        partitions = {partition.start: partition for partition in self.partitions()}
+        if not partitions:
+            return set()
+        months = {}
+        for row in rows:
+            message_id, chat_id, date = row[0], row[1], row[5]
+            partition = partitions.get(datetime(date.year, date.month, 1))
+            if partition is not None:
+                months.setdefault(partition.path, []).append((chat_id, message_id))
+        archived = set()
+        for path, keys in months.items():
+            uri = Path(path).resolve().as_uri() + "?mode=ro"
+            async with aiosqlite.connect(uri, uri=True) as conn:
+                async with conn.execute(
+                    "SELECT chat_id, message_id FROM messages WHERE (chat_id, message_id) IN "
+                    f"(VALUES {', '.join(['(?, ?)'] * len(keys))})",
+                    [value for key in keys for value in key],
+                ) as cursor:
+                    archived.update(await cursor.fetchall())
+        return archived
+
+    def hot_start(self, now: Optional[datetime] = None) -> datetime:
+        """主库保留的最早月份的第一天；早于它的消息会被归档。"""
+        return add_months(month_start(now or datetime.utcnow()), 1 - self.hot_months)
+
+    async def archive(self, conn: aiosqlite.Connection, lock: asyncio.Lock, now: Optional[datetime] = None) -> int:
+        """
+        把主库中早于 hot_start 的消息按月搬到归档文件。
+
+        :param conn: 主库的写连接（需已注册 fts_tokens 函数）。
+        :param lock: 写连接的写锁，每个分块持有一次，期间批量写入器等待。
+        :return: 搬迁的消息数量。
+        """
+        cutoff = self.hot_start(now)
+        async with conn.execute("SELECT MIN(date) FROM messages WHERE date < ?", (cutoff.strftime(DATE_FORMAT),)) as cursor:
+            oldest = (await cursor.fetchone())[0]
+        if oldest is None:
+            return 0
+        os.makedirs(self.directory, exist_ok=True)
+        moved = 0
+        start = month_start(datetime.strptime(oldest[:7], "%Y-%m"))
+        while start < cutoff:
+            moved += await self._archive_month(conn, lock, start)
+            start = add_months(start, 1)
+        return moved
+
+    async def _archive_month(self, conn: aiosqlite.Connection, lock: asyncio.Lock, start: datetime) -> int:
+        """把主库中某个月份的消息搬到该月的归档文件。"""
+        bounds = (start.strftime(DATE_FORMAT), add_months(start, 1).strftime(DATE_FORMAT))
+        async with conn.execute(
+            "SELECT MIN(id), MAX(id) FROM messages WHERE date >= ? AND date < ?", bounds
+        ) as cursor:
+            low, high = await cursor.fetchone()
+        if low is None:
+            return 0
+        # 尚未回填全文索引的历史消息不在主库的索引中，删除时不能对它们执行 'delete'
+        async with conn.execute(
+            "SELECT key, value FROM meta WHERE key IN ('fts_backfill_upto', 'fts_backfill_done')"
+        ) as cursor:
+            state = {key: int(value) for key, value in await cursor.fetchall()}
+        unindexed = (state.get("fts_backfill_done", 0), state.get("fts_backfill_upto", 0))
+
+        path = self.path_for(start)
+        logger.info(f"开始归档 {start.strftime('%Y-%m')} 的消息（id {low} ~ {high}）到 {path}。")
+        moved = 0
+        # 附加和建表在同一次持锁中完成，回填检查分区（archived_messages）时不会遇到没有表的新文件
+        async with lock:
+            await conn.execute(f"ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}", (path,))
+            try:
+                await create_archive_schema(conn, ARCHIVE_SCHEMA)
+                await conn.commit()
+            except Exception:
+                await conn.execute(f"DETACH DATABASE {ARCHIVE_SCHEMA}")
+                raise
+        try:
+            done = low - 1
+            while done < high:
+                end = min(done + self.chunk_size, high)
+                async with lock:
+                    moved += await self._move_chunk(conn, done, end, bounds, unindexed)
+                done = end
+            async with lock:
+                await conn.execute(f"INSERT INTO {ARCHIVE_SCHEMA}.messages_fts (messages_fts) VALUES ('optimize')")
+                await conn.commit()
+                await conn.execute(f"ANALYZE {ARCHIVE_SCHEMA}")
+                await conn.commit()
+        finally:
+            async with lock:
+                await conn.execute(f"DETACH DATABASE {ARCHIVE_SCHEMA}")
+        logger.info(f"{start.strftime('%Y-%m')} 的 {moved} 条消息已归档。")
+        return moved
+
+    @staticmethod
+    async def _move_chunk(
+        conn: aiosqlite.Connection, after_id: int, upto_id: int, bounds: Tuple[str, str], unindexed: Tuple[int, int],
+    ) -> int:
+        """
+        在一个事务中把 id 在 (after_id, upto_id] 内、日期在 bounds 内的消息搬到归档文件。
+
+        WAL 模式下跨文件的事务只对每个文件分别原子，因此先写归档文件、再删主库，
+        并跳过归档文件中已有的消息（相同的 chat_id 和 message_id）：上次在两者之间中断时，
+        重新运行只会补上主库的删除；回填导入的、已归档的旧消息也不会在归档文件中重复。
+        """
+        where = "id > ? AND id <= ? AND date >= ? AND date < ?"
+        params = (after_id, upto_id) + bounds
+        not_archived = (
+            f"NOT EXISTS (SELECT 1 FROM {ARCHIVE_SCHEMA}.messages a "
+            "WHERE a.chat_id = main.messages.chat_id AND a.message_id = main.messages.message_id)"
+        )
+        try:
+            await conn.execute(
+                f"INSERT INTO {ARCHIVE_SCHEMA}.messages_fts (rowid, body) "
+                f"SELECT id, fts_tokens(COALESCE(raw_text, text)) FROM main.messages WHERE {where} "
+                f"AND {not_archived}",
+                params,
+            )
+            cursor = await conn.execute(
+                f"INSERT OR IGNORE INTO {ARCHIVE_SCHEMA}.messages ({MESSAGE_COLUMNS}) "
+                f"SELECT {MESSAGE_COLUMNS} FROM main.messages WHERE {where} AND {not_archived}",
+                params,
+            )
+            moved = cursor.rowcount
+            await conn.execute(
+                "INSERT INTO main.messages_fts (messages_fts, rowid, body) "
+                f"SELECT 'delete', id, fts_tokens(COALESCE(raw_text, text)) FROM main.messages WHERE {where} "
+                "AND (id <= ? OR id > ?)",
+                params + unindexed,
+            )
+            await conn.execute(f"DELETE FROM main.messages WHERE {where}", params)
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+        return moved
+
+    def apply_retention(self, now: Optional[datetime] = None) -> List[str]:
+        """
+        删除（或移到 export_dir）超过保留期的分区。
+
+        :return: 被处理的分区名称。
+        """
+        if self.retention_months <= 0:
+            return []
+        oldest_kept = add_months(month_start(now or datetime.utcnow()), -self.retention_months)
+        expired = [partition for partition in self.partitions() if partition.end <= oldest_kept]
+        for partition in expired:
+            if self.export_dir:
+                os.makedirs(self.export_dir, exist_ok=True)
+                shutil.move(partition.path, os.path.join(self.export_dir, os.path.basename(partition.path)))
+                logger.info(f"分区 {partition.name} 已超过保留期，已移到 {self.export_dir}。")
+            else:
+                os.remove(partition.path)
+                logger.info(f"分区 {partition.name} 已超过保留期，已删除。")
+        return [partition.name for partition in expired]
+
+    async def run_loop(self, db_manager, interval: float):
+        """定期归档旧消息并执行保留策略。"""
+        while True:
+            try:
+                await db_manager.archive_old_messages(self)
+                self.apply_retention()
+            except Exception as e:
+                logger.error(f"归档历史消息失败: {e}", exc_info=True)
+            await asyncio.sleep(interval)
+
+
+class ArchiveReader:
+    """
+    Web 进程访问归档分区的只读连接。
+
+    每个分区一个只有一个连接的 ReadConnectionPool，最多同时打开 max_open 个分区，
+    超过时关闭最久未使用的分区；正在使用的连接在归还时关闭。
+    """
+    def __init__(self, archive: MessageArchive, max_open: int = 8):
+        self.archive = archive
+        self.max_open = max_open
+        self._pools: "OrderedDict[str, ReadConnectionPool]" = OrderedDict()
+        # 正在关闭的分区连接池，close 时等待它们完成
+        self._closing: Set[asyncio.Task] = set()
+
+    def pool(self, partition: Partition) -> ReadConnectionPool:
+        """返回分区的只读连接池。"""
+        pool = self._pools.get(partition.path)
+        if pool is None:
+            pool = self._pools[partition.path] = ReadConnectionPool(partition.path, size=1)
+            while len(self._pools) > self.max_open:
+                _, evicted = self._pools.popitem(last=False)
+                task = asyncio.create_task(self._close_pool(evicted))
+                self._closing.add(task)
+                task.add_done_callback(self._closing.discard)
+        self._pools.move_to_end(partition.path)
+        return pool
+
+    @staticmethod
+    async def _close_pool(pool: ReadConnectionPool):
+        """关闭被淘汰的分区连接池，出错时记录日志。"""
+        try:
+            await pool.close()
+        except Exception as e:
+            logger.error(f"关闭归档分区 {pool.db_path} 的连接失败: {e}", exc_info=True)
+
+    async def close(self):
+        """关闭所有分区的连接。"""
+        for pool in self._pools.values():
+            await pool.close()
+        self._pools.clear()
+        if self._closing:
+            await asyncio.gather(*self._closing)
+
+
+# 创建一个全局的归档实例
+message_archive = MessageArchive(
+    directory=settings.archive_directory,
+    hot_months=settings.archive_hot_months,
+    retention_months=settings.archive_retention_months,
+    export_dir=settings.archive_export_dir,
+    chunk_size=settings.archive_chunk_size,
+)
+
+
+async def _apply_settings(changed):
+    """热加载后更新保留策略。"""
+    if not any(name.startswith('archive_') for name in changed):
+        return
+    message_archive.hot_months = settings.archive_hot_months
+    message_archive.retention_months = settings.archive_retention_months
+    message_archive.export_dir = settings.archive_export_dir
+    message_archive.chunk_size = settings.archive_chunk_size
+
+config_reloader.subscribe(_apply_settings)
@@ -0,0 +1,243 @@
+"""
+历史消息回填：把监听程序启动之前的会话历史导入数据库。
+
+- 每个会话按从新到旧的顺序分页拉取（每页 PAGE_SIZE 条），每页在一个事务中写入，
+  回填进度（backfill_checkpoints 表）与消息在同一个事务中提交，中断后重新运行会从上次的位置继续；
+- 一轮回填开始时记下最新的消息 id（pass_top），拉取到最早的消息（或 since 之前）后，
+  把 done_upto 更新为 pass_top；之后再次运行只拉取 done_upto 之后的新消息；
+- 写入与实时消息共用写连接、写锁和插入逻辑（见 DatabaseManager.import_messages），
+  按 (chat_id, message_id) 去重，回填与实时监听同时进行也不会产生重复的行；
+  已经搬到按月归档分区（见 handlers.archive）的消息同样会被跳过；
+- 多个会话由 concurrency 个协程并发拉取，所有请求共用一个令牌桶，
+  遇到 FloodWaitError 时暂停并降速（与转发器相同的 AIMD 策略）；
+- 每条消息与实时消息一样经过过滤规则（见 handlers.rules），被 exclude 规则排除的消息不会入库；
+  回填的消息只入库，不会转发。
+"""
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import Iterable, Optional, Union
+
+from telethon import utils as telethon_utils
+from telethon.errors import FloodWaitError
+
+from tg_client import client_manager
+from handlers.archive import MessageArchive, message_archive
+from handlers.database import DatabaseManager, db_manager
+from handlers.rules import RuleEngine
+from utils.config import settings
+from utils.entity_cache import ChatInfo, SenderInfo
+from utils.metrics import counter, gauge, registry
+from utils.ratelimit import TokenBucket
+from utils.reload import config_reloader
+
+logger = logging.getLogger(__name__)
+
+# 每次请求拉取的消息数（Telegram 单次 GetHistory 的上限）
+PAGE_SIZE = 100
+
+
+class BackfillStats:
+    """回填统计：完成/失败的会话数、导入和重复的消息数、请求次数、FloodWait 次数与时长。"""
+    def __init__(self):
+        self.chats_done = 0
+        self.chats_failed = 0
+        self.fetched = 0
+        self.imported = 0
+        self.requests = 0
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+
+    def snapshot(self) -> dict:
+        """返回当前统计的快照。"""
+        return {
+            "chats_done": self.chats_done,
+            "chats_failed": self.chats_failed,
+            "fetched": self.fetched,
+            "imported": self.imported,
+            "duplicates": self.fetched - self.imported,
+            "requests": self.requests,
+            "flood_waits": self.flood_waits,
+            "flood_wait_seconds": self.flood_wait_seconds,
+        }
+
+
+class BackfillImporter:
+    """
+    并发、可续跑的历史消息导入器。
+
+    :param client: 已登录的 TelegramClient。
+    :param db: 写入消息和回填进度的数据库管理器。
+    :param rules: 过滤规则引擎，被排除的消息不入库。
+    :param archive: 归档分区，已归档的消息不会再写入主库。
+    :param rate: 所有会话共用的请求速率（次/秒）。
+    :param burst: 令牌桶的突发上限。
+    :param concurrency: 同时回填的会话数。
+    :param since: 只回填这个时间之后的消息，None 表示全部历史。
+    """
+    def __init__(
+        self,
+        client,
+        db: DatabaseManager,
+        rules: RuleEngine,
+        archive: Optional[MessageArchive] = None,
+        rate: float = 1.0,
+        burst: float = 3.0,
+        concurrency: int = 3,
+        since: Optional[datetime] = None,
+    ):
+        self.client = client
+        self.db = db
+        self.rules = rules
+        self.archive = archive
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.since = since
+        self.stats = BackfillStats()
+        self.active = 0
+
+    async def run(
+        self, chats: Iterable[Union[int, str]], reset: bool = False, since: Optional[datetime] = None,
+    ) -> dict:
+        """
+        回填一组会话（会话 id 或用户名），全部完成后返回统计快照。
+
+        :param reset: 清除这些会话的回填进度，从最新的消息开始重新回填全部历史（已有的行会被跳过）。
+        :param since: 覆盖构造时的 since。
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        for chat in chats:
+            queue.put_nowait(chat)
+        if queue.empty():
+            logger.info("没有需要回填的会话。")
+            return self.stats.snapshot()
+        since = since or self.since
+        workers = min(self.concurrency, queue.qsize())
+        logger.info(
+            f"开始回填 {queue.qsize()} 个会话的历史消息：并发 {workers}，速率 {self.bucket.max_rate:.2f} 次/秒"
+            + (f"，只回填 {since:%Y-%m-%d} 之后的消息" if since else "") + "。"
+        )
+
+        async def worker():
+            while not queue.empty():
+                chat = queue.get_nowait()
+                self.active += 1
+                try:
+                    await self._crawl(chat, reset, since)
+                    self.stats.chats_done += 1
+                except Exception as e:
+                    # 进度已按页提交，下次运行从中断的位置继续
+                    self.stats.chats_failed += 1
+                    logger.error(f"回填会话 {chat} 时出错，已保留进度: {e}", exc_info=True)
+                finally:
+                    self.active -= 1
+
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        logger.info(f"历史回填结束: {self.stats.snapshot()}")
+        return self.stats.snapshot()
+
+    async def _fetch_page(self, entity, offset_id: int, min_id: int) -> list:
+        """拉取 offset_id 之前（不含）、min_id 之后的一页消息（从新到旧），处理限速和 FloodWait。"""
+        while True:
+            await self.bucket.acquire()
+            self.stats.requests += 1
+            try:
+                page = await self.client.get_messages(entity, limit=PAGE_SIZE, offset_id=offset_id, min_id=min_id)
+            except FloodWaitError as e:
+                self.stats.flood_waits += 1
+                self.stats.flood_wait_seconds += e.seconds
+                self.bucket.penalize(e.seconds)
+                logger.warning(
+                    f"回填触发 FloodWait，暂停 {e.seconds} 秒，速率降至 {self.bucket.rate:.2f} 次/秒。"
+                )
+                continue
+            self.bucket.reward()
+            return list(page)
+
+    async def _crawl(self, chat: Union[int, str], reset: bool, since: Optional[datetime]):
+        """回填一个会话：从上次的进度继续，直到最早的消息（或 since）为止。"""
+        entity = await self.client.get_entity(chat)
+        chat_id = telethon_utils.get_peer_id(entity)
+        chat_info = ChatInfo.from_entity(entity, chat_id)
+        if reset:
+            await self.db.reset_backfill_checkpoint(chat_id)
+        done_upto, pass_top, cursor = await self.db.load_backfill_checkpoint(chat_id)
+        if pass_top is not None:
+            logger.info(f"会话 {chat_info.title} ({chat_id}) 从消息 {cursor} 处继续回填。")
+
+        imported = 0
+        while True:
+            page = await self._fetch_page(entity, cursor or 0, done_upto)
+            finished = len(page) < PAGE_SIZE
+            if since is not None and page and page[-1].date < since:
+                page = [message for message in page if message.date >= since]
+                finished = True
+            if not page:
+                break
+            if pass_top is None:
+                pass_top = page[0].id
+            cursor = page[-1].id
+            items = [
+                self.db.message_item(
+                    message, chat_info,
+                    SenderInfo.from_entity(message.sender, message.sender_id) if message.sender_id else None,
+                )
+                for message in page
+                if message.action is None and not self.rules.evaluate_message(message).excluded
+            ]
+            inserted = await self.db.import_messages(items, (chat_id, done_upto, pass_top, cursor), self.archive)
+            self.stats.fetched += len(items)
+            self.stats.imported += inserted
+            imported += inserted
+            logger.debug("会话 %s 已回填到消息 %s，本页新增 %s 条。", chat_id, cursor, inserted)
+            if finished:
+                break
+
+        if pass_top is not None:
+            # 本轮已拉取到最早的消息，之后只需回填 pass_top 之后的新消息
+            await self.db.import_messages([], (chat_id, pass_top, None, None))
+            done_upto = pass_top
+        logger.info(f"会话 {chat_info.title} ({chat_id}) 回填完成：新增 {imported} 条消息，已回填到消息 {done_upto}。")
+
+    def collect_metrics(self) -> list:
+        """导出回填的进度和限速状态。"""
+        stats = self.stats
+        return [
+            counter("listentg_backfill_chats_total", "回填完成的会话数", stats.chats_done),
+            counter("listentg_backfill_chat_failures_total", "回填出错的会话数", stats.chats_failed),
+            counter("listentg_backfill_messages_fetched_total", "回填拉取的消息数", stats.fetched),
+            counter("listentg_backfill_messages_imported_total", "回填新写入的消息数（不含重复）", stats.imported),
+            counter("listentg_backfill_requests_total", "回填发起的请求数", stats.requests),
+            counter("listentg_backfill_flood_waits_total", "回填触发 FloodWait 的次数", stats.flood_waits),
+            counter("listentg_backfill_flood_wait_seconds_total", "回填 FloodWait 要求等待的总秒数", stats.flood_wait_seconds),
+            gauge("listentg_backfill_active_chats", "正在回填的会话数", self.active),
+            gauge("listentg_backfill_rate", "当前回填请求速率（次/秒）", self.bucket.rate),
+        ]
+
+
+# 创建一个全局的历史回填实例
+backfill_importer = BackfillImporter(
+    client=client_manager.get_client(),
+    db=db_manager,
+    rules=RuleEngine(settings.rules, default_target=settings.target_group),
+    archive=message_archive,
+    rate=settings.backfill_rate,
+    burst=settings.backfill_burst,
+    concurrency=settings.backfill_concurrency,
+    since=settings.backfill_since,
+)
+registry.register(backfill_importer.collect_metrics)
+
+
+async def _apply_settings(changed):
+    """热加载后重建过滤规则（在线程池中编译），并更新回填的限速和起始时间。"""
+    if changed & {'rules', 'target_group'}:
+        backfill_importer.rules = await asyncio.to_thread(RuleEngine, settings.rules, settings.target_group)
+    if changed & {'backfill_rate', 'backfill_burst'}:
+        backfill_importer.bucket.configure(settings.backfill_rate, settings.backfill_burst)
+        logger.info(f"回填速率已更新为 {settings.backfill_rate:.2f} 次/秒，突发 {settings.backfill_burst}。")
+    if 'backfill_since' in changed:
+        backfill_importer.since = settings.backfill_since
+
+config_reloader.subscribe(_apply_settings)
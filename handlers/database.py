@@ -1,30 +1,213 @@
+import asyncio
 import aiosqlite
 import logging
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from pathlib import Path
 from telethon import events
-from telethon.tl.types import User, Chat, Channel
-from typing import Optional
+from typing import AsyncIterator, Iterable, List, Optional, Tuple
+from utils.config import settings
+from handlers.migrations import migrate
+from handlers import dedup, dimensions, rollups, search
+from utils.entity_cache import ChatInfo, SenderInfo, entity_cache
+from utils.eventbus import EventPublisher
+from utils.metrics import DEFAULT_SIZE_BUCKETS, Histogram, counter, gauge, histogram, registry
 
 logger = logging.getLogger(__name__)
 
 DB_PATH = 'listentg_messages.db'
 
+# 同一会话的同一条消息只保存一次（唯一索引见 v9 迁移），重复的行被忽略
+INSERT_MESSAGE_SQL = """
+INSERT OR IGNORE INTO messages (
+    message_id, chat_id, sender_id, text, raw_text, date, is_reply, reply_to_message_id
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# 回填进度：imported 累加每批新插入的消息数
+UPSERT_CHECKPOINT_SQL = """
+INSERT INTO backfill_checkpoints (chat_id, done_upto, pass_top, pass_cursor, imported, updated_at)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (chat_id) DO UPDATE SET
+    done_upto = excluded.done_upto, pass_top = excluded.pass_top, pass_cursor = excluded.pass_cursor,
+    imported = backfill_checkpoints.imported + excluded.imported, updated_at = excluded.updated_at
+"""
+
+# 写缓冲区中的停止标记
+_STOP = None
+
+# 每批推送给仪表盘的最新消息条数和正文截断长度
+LIVE_MESSAGES_PER_BATCH = 20
+LIVE_TEXT_LENGTH = 200
+
+
+async def apply_pragmas(conn: aiosqlite.Connection, read_only: bool = False):
+    """
+    按配置为连接设置 PRAGMA。
+
+    journal_mode 和 synchronous 只对写连接有意义（WAL 模式会持久化到数据库文件中），
+    只读连接只设置缓存、内存映射和临时存储相关的参数。
+    """
+    if not read_only:
+        async with conn.execute(f"PRAGMA journal_mode={settings.db_journal_mode}") as cursor:
+            row = await cursor.fetchone()
+        if row and row[0].upper() != settings.db_journal_mode:
+            logger.warning(f"无法将 journal_mode 设置为 {settings.db_journal_mode}，当前为 {row[0]}。")
+        await conn.execute(f"PRAGMA synchronous={settings.db_synchronous}")
+    await conn.execute(f"PRAGMA cache_size={settings.db_cache_size}")
+    await conn.execute(f"PRAGMA mmap_size={settings.db_mmap_size}")
+    await conn.execute(f"PRAGMA temp_store={settings.db_temp_store}")
+    await conn.execute(f"PRAGMA busy_timeout={settings.db_busy_timeout_ms}")
+
+
+class ReadConnectionPool:
+    """
+    有上限的只读 SQLite 连接池。
+
+    连接按需创建、长期复用，最多同时打开 size 个；
+    连接全部被占用时，acquire 会等待其他请求归还连接。
+    关闭后借出的连接在归还时关闭，之后借出的连接用完即关闭。
+    """
+    def __init__(self, db_path: str = DB_PATH, size: int = 4):
+        self.db_path = db_path
+        self.size = size
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._created = 0
+        self._closed = False
+
+    @property
+    def opened(self) -> int:
+        """已打开的连接数（包括借出的）。"""
+        return self._created
+
+    async def _open(self) -> aiosqlite.Connection:
+        """打开一个只读连接。"""
+        uri = Path(self.db_path).resolve().as_uri() + "?mode=ro"
+        conn = await aiosqlite.connect(uri, uri=True)
+        conn.row_factory = aiosqlite.Row
+        await apply_pragmas(conn, read_only=True)
+        logger.info(f"已打开只读数据库连接 ({self._created}/{self.size})。")
+        return conn
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[aiosqlite.Connection]:
+        """借出一个只读连接，使用完毕后自动归还。"""
+        if self._idle.empty() and self._created < self.size:
+            self._created += 1
+            try:
+                conn = await self._open()
+            except Exception:
+                self._created -= 1
+                raise
+        else:
+            conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            if self._closed:
+                self._created -= 1
+                await conn.close()
+            else:
+                self._idle.put_nowait(conn)
+
+    async def close(self):
+        """关闭所有空闲连接，借出的连接在归还时关闭。"""
+        self._closed = True
+        while not self._idle.empty():
+            conn = self._idle.get_nowait()
+            await conn.close()
+            self._created -= 1
+        logger.info("只读连接池已关闭。")
+
+
+class WriterStats:
+    """
+    批量写入器的统计计数器。
+    """
+    def __init__(self):
+        self.flushes = 0
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+        self.flush_ms = Histogram()
+        self.batch_sizes = Histogram(DEFAULT_SIZE_BUCKETS)
+
+    def record(self, batch_size: int, elapsed_ms: float, ok: bool):
+        """记录一次批量提交的大小和耗时。"""
+        self.flushes += 1
+        if ok:
+            self.rows_written += batch_size
+        else:
+            self.rows_failed += batch_size
+        self.last_batch_size = batch_size
+        self.max_batch_size = max(self.max_batch_size, batch_size)
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self.total_flush_ms += elapsed_ms
+        self.flush_ms.observe(elapsed_ms)
+        self.batch_sizes.observe(batch_size)
+
+    def snapshot(self) -> dict:
+        """返回当前计数器的快照。"""
+        return {
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "rows_failed": self.rows_failed,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "avg_batch_size": self.rows_written / self.flushes if self.flushes else 0.0,
+            "last_flush_ms": self.last_flush_ms,
+            "max_flush_ms": self.max_flush_ms,
+            "avg_flush_ms": self.total_flush_ms / self.flushes if self.flushes else 0.0,
+        }
+
+
 class DatabaseManager:
     """
     管理 SQLite 数据库的连接和操作。
     使用 aiosqlite 实现异步数据库访问。
+
+    消息写入采用“后写”模式：save_message 只把行放入内存缓冲区，
+    由后台写入任务在攒够 batch_size 条或等待 flush_interval_ms 毫秒后，
+    用 executemany 在一个事务中批量提交。
+
+    会话和发送者的元数据写入维度表（见 handlers.dimensions），只在发生变化时随同一批消息更新。
     """
-    def __init__(self, db_path: str = DB_PATH):
+    def __init__(
+        self,
+        db_path: str = DB_PATH,
+        batch_size: int = 500,
+        flush_interval_ms: int = 200,
+        max_buffer: int = 10000,
+    ):
         self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
         self._connection: Optional[aiosqlite.Connection] = None
+        self._buffer: asyncio.Queue = asyncio.Queue(maxsize=max_buffer)
+        self._writer_task: Optional[asyncio.Task] = None
+        # 保证同一时间只有一个批次在写入（全文索引依赖批次开始前的最大 id）
+        self._write_lock = asyncio.Lock()
+        self._publisher: Optional[EventPublisher] = None
+        self.stats = WriterStats()
+        self.dimensions = dimensions.DimensionTracker()
 
     async def connect(self):
         """建立数据库连接。"""
         if self._connection is None:
             self._connection = await aiosqlite.connect(self.db_path)
-            logger.info(f"已成功连接到数据库: {self.db_path}")
+            await apply_pragmas(self._connection)
+            await search.register_functions(self._connection)
+            logger.info(f"已成功连接到数据库: {self.db_path} (journal_mode={settings.db_journal_mode}, synchronous={settings.db_synchronous})")
 
     async def close(self):
-        """关闭数据库连接。"""
+        """关闭数据库连接（会先写完缓冲区中的消息）。"""
+        await self.stop_writer()
         if self._connection:
             await self._connection.close()
             self._connection = None
@@ -32,43 +215,340 @@ class DatabaseManager:
 
     async def init_db(self):
         """
-        初始化数据库，创建 `messages` 表（如果不存在）。
+        初始化数据库：创建表并把结构升级到最新版本。
         """
         if not self._connection:
             await self.connect()
-        
-        create_table_sql = """
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            message_id INTEGER NOT NULL,
-            chat_id INTEGER NOT NULL,
-            chat_type TEXT,
-            chat_title TEXT,
-            sender_id INTEGER,
-            sender_name TEXT,
-            sender_username TEXT,
-            text TEXT,
-            raw_text TEXT,
-            date TIMESTAMP NOT NULL,
-            is_reply BOOLEAN,
-            reply_to_message_id INTEGER
-        );
-        """
-        await self._connection.execute(create_table_sql)
-        await self._connection.commit()
-        logger.info("数据库表 'messages' 已初始化。")
-
-    async def save_message(self, event: events.NewMessage.Event):
-        """
-        从事件对象中提取信息并存入数据库。
+
+        version = await migrate(self._connection)
+        logger.info(f"数据库结构已初始化，当前版本 v{version}。")
+
+        async with self._connection.execute(
+            "SELECT (SELECT value FROM meta WHERE key = 'fts_backfill_upto') - "
+            "(SELECT value FROM meta WHERE key = 'fts_backfill_done')"
+        ) as cursor:
+            pending = (await cursor.fetchone())[0] or 0
+        if pending > 0:
+            logger.warning(f"有约 {pending} 条历史消息尚未建立全文索引，请运行 `python manage.py fts-backfill`。")
+
+        async with self._connection.execute(
+            "SELECT (SELECT value FROM meta WHERE key = 'normalize_upto') - "
+            "(SELECT value FROM meta WHERE key = 'normalize_done')"
+        ) as cursor:
+            pending = (await cursor.fetchone())[0] or 0
+        if pending > 0:
+            logger.warning(f"有约 {pending} 条历史消息仍带有重复的会话/发送者字符串，可运行 `python manage.py normalize` 清理。")
+
+        # v8 迁移只能从主库重新聚合按会话/发送者的统计，存在归档分区时需要完整重建一次
+        async with self._connection.execute(
+            "SELECT 1 FROM meta WHERE key = 'rollup_rebuild_pending'"
+        ) as cursor:
+            rebuild_pending = await cursor.fetchone() is not None
+        if rebuild_pending:
+            from handlers.archive import message_archive  # 延迟导入以避免循环依赖问题
+            archives = [partition.path for partition in message_archive.partitions()]
+            if archives:
+                await rollups.rebuild(self._connection, archives=archives)
+            await self._connection.execute("DELETE FROM meta WHERE key = 'rollup_rebuild_pending'")
+            await self._connection.commit()
+
+    async def backfill_search_index(self, chunk_size: int = 50000) -> int:
+        """为历史消息回填全文索引，返回本次索引的消息数量。"""
+        if not self._connection:
+            await self.connect()
+        return await search.backfill(self._connection, chunk_size)
+
+    async def rebuild_rollups(self, chunk_size: int = 500000, archives: Iterable[str] = ()):
+        """根据全部历史消息（包括 archives 中的归档文件）重建预聚合统计表。"""
+        if not self._connection:
+            await self.connect()
+        await rollups.rebuild(self._connection, chunk_size, archives)
+
+    async def normalize_messages(self, chunk_size: int = 50000) -> int:
+        """把历史消息中重复的会话/发送者字符串置为 NULL，返回本次处理的消息数量。"""
+        if not self._connection:
+            await self.connect()
+        return await dimensions.normalize(self._connection, chunk_size)
+
+    async def remove_duplicate_messages(self) -> int:
+        """
+        删除 (chat_id, message_id) 重复的消息（保留 id 最小的一行），返回删除的行数。
+
+        v9 迁移要创建唯一索引，已有重复行时会拒绝升级。这里先把数据库升级到 v8，
+        把重复的行原样复制到 messages_duplicates_backup 表，再从全文索引、预聚合表和 messages 中删除，
+        全部在一个事务中完成。已经是 v9 及以上的数据库不会有重复行。
+        """
+        if not self._connection:
+            await self.connect()
+        conn = self._connection
+        if await migrate(conn, target_version=8) > 8:
+            return 0
+
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            await conn.execute("""
+                CREATE TEMP TABLE duplicate_messages AS
+                SELECT id FROM messages m
+                WHERE id > (SELECT MIN(id) FROM messages o WHERE o.chat_id = m.chat_id AND o.message_id = m.message_id)
+            """)
+            async with conn.execute("SELECT COUNT(*) FROM temp.duplicate_messages") as cursor:
+                duplicates = (await cursor.fetchone())[0]
+            if duplicates:
+                where = "id IN (SELECT id FROM temp.duplicate_messages)"
+                await conn.execute("CREATE TABLE IF NOT EXISTS messages_duplicates_backup AS SELECT * FROM messages WHERE 0")
+                await conn.execute(f"INSERT INTO messages_duplicates_backup SELECT * FROM messages WHERE {where}")
+                await search.remove_messages(conn, where, ())
+                await rollups.remove_messages(conn, where, ())
+                await conn.execute(f"DELETE FROM messages WHERE {where}")
+            await conn.execute("DROP TABLE temp.duplicate_messages")
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+        if duplicates:
+            logger.info(f"已删除 {duplicates} 条重复的消息，原始行已备份到 messages_duplicates_backup 表。")
+        return duplicates
+
+    async def archive_old_messages(self, archive) -> int:
+        """把超出热分区的旧消息搬到按月归档文件（见 handlers.archive），返回搬迁的消息数量。"""
+        if not self._connection:
+            await self.connect()
+        return await archive.archive(self._connection, self._write_lock)
+
+    async def index_keywords(self, indexer) -> int:
+        """对一批新消息分词并累加词频（见 handlers.keywords），返回处理的消息数量。"""
+        if not self._connection:
+            await self.connect()
+        return await indexer.index_pending(self._connection, self._write_lock)
+
+    async def prune_keywords(self, indexer) -> int:
+        """清理过期和长尾的词频，返回删除的行数。"""
+        if not self._connection:
+            await self.connect()
+        return await indexer.prune(self._connection, self._write_lock)
+
+    async def start_writer(self):
+        """启动后台批量写入任务。"""
+        if self._writer_task is None or self._writer_task.done():
+            self._writer_task = asyncio.create_task(self._writer_loop())
+            logger.info(
+                f"批量写入器已启动 (batch_size={self.batch_size}, "
+                f"flush_interval={self.flush_interval * 1000:.0f}ms, "
+                f"max_buffer={self._buffer.maxsize})。"
+            )
+
+    async def stop_writer(self):
+        """
+        停止后台写入任务，并确保缓冲区中已有的消息全部落盘。
+        """
+        if self._writer_task is None:
+            return
+        if not self._writer_task.done():
+            await self._buffer.put(_STOP)
+            await self._writer_task
+        self._writer_task = None
+        # 写入任务退出后仍可能有残留（例如停止标记之后才入队的消息）
+        await self.flush()
+        logger.info(f"批量写入器已停止。统计: {self.stats.snapshot()}")
+
+    async def flush(self):
+        """立即把缓冲区中剩余的消息写入数据库。"""
+        rows = []
+        while True:
+            try:
+                row = self._buffer.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if row is not _STOP:
+                rows.append(row)
+        for i in range(0, len(rows), self.batch_size):
+            await self._write_rows(rows[i:i + self.batch_size])
+
+    def set_event_publisher(self, publisher: EventPublisher):
+        """设置事件发布器，每批消息提交后会把增量推送给 Web 进程。"""
+        self._publisher = publisher
+
+    def buffered(self) -> int:
+        """返回缓冲区中等待写入的消息数量。"""
+        return self._buffer.qsize()
+
+    def collect_metrics(self) -> list:
+        """导出批量写入器的指标。"""
+        return [
+            counter("listentg_db_rows_written_total", "写入数据库的消息数", self.stats.rows_written),
+            counter("listentg_db_rows_failed_total", "写入失败的消息数", self.stats.rows_failed),
+            counter("listentg_db_flushes_total", "批量提交次数", self.stats.flushes),
+            histogram("listentg_db_flush_seconds", "批量提交耗时", self.stats.flush_ms, scale=0.001),
+            histogram("listentg_db_batch_size", "每次批量提交的消息数", self.stats.batch_sizes),
+            gauge("listentg_db_buffered", "写缓冲区中等待写入的消息数", self.buffered()),
+        ]
+
+    async def _writer_loop(self):
+        """
+        后台写入循环：攒够 batch_size 条或超过 flush_interval 后提交一批。
+        """
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            row = await self._buffer.get()
+            if row is _STOP:
+                break
+            batch = [row]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    row = self._buffer.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        row = await asyncio.wait_for(self._buffer.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if row is _STOP:
+                    stopping = True
+                    break
+                batch.append(row)
+            await self._write_rows(batch)
+
+    async def _write_rows(self, items: List[Tuple], checkpoint: Optional[Tuple] = None, archive=None) -> int:
+        """
+        在一个事务中批量插入多行消息，同步更新维度表、全文索引和预聚合统计表，并记录批大小和耗时。
+
+        已存在的消息（相同的 chat_id 和 message_id）会被忽略，只有新插入的行计入索引和统计。
+
+        :param items: (消息行, 会话维度的 upsert 参数或 None, 发送者维度的 upsert 参数或 None,
+            重复消息记录的参数或 None)。
+        :param checkpoint: 历史回填的进度 (chat_id, done_upto, pass_top, pass_cursor)，与消息在同一个事务中提交；
+            为 None 时表示实时消息，提交后推送给 Web 进程。
+        :param archive: 归档分区（handlers.archive.MessageArchive），已经搬到分区中的消息不再写入主库；
+            检查和写入都在写锁内进行，期间归档不会搬走新的消息。
+        :return: 新插入的消息数量，失败时为 0。
+        """
+        if not items:
+            return 0
+        if not self._connection:
+            logger.error(f"数据库未连接，丢弃 {len(items)} 条待写入消息。")
+            return 0
+        rows = [row for row, _, _, _ in items]
+        chat_upserts = [chat for _, chat, _, _ in items if chat is not None]
+        user_upserts = [user for _, _, user, _ in items if user is not None]
+        duplicates = [duplicate for _, _, _, duplicate in items if duplicate is not None]
+        async with self._write_lock:
+            start = time.perf_counter()
+            ok = True
+            try:
+                if archive is not None:
+                    archived = await archive.archived_messages(rows)
+                    rows = [row for row in rows if (row[1], row[0]) not in archived]
+                async with self._connection.execute("SELECT COALESCE(MAX(id), 0) FROM messages") as cursor:
+                    last_id = (await cursor.fetchone())[0]
+                if chat_upserts:
+                    await self._connection.executemany(dimensions.UPSERT_CHAT_SQL, chat_upserts)
+                if user_upserts:
+                    await self._connection.executemany(dimensions.UPSERT_USER_SQL, user_upserts)
+                # 被忽略的重复行不计入 rowcount
+                inserted = (await self._connection.executemany(INSERT_MESSAGE_SQL, rows)).rowcount
+                if duplicates:
+                    await self._connection.executemany(dedup.INSERT_DUPLICATE_SQL, duplicates)
+                await search.index_new_messages(self._connection, last_id)
+                await rollups.apply_new_messages(self._connection, last_id)
+                if checkpoint is not None:
+                    await self._connection.execute(UPSERT_CHECKPOINT_SQL, checkpoint + (inserted, time.time()))
+                await self._connection.commit()
+            except Exception as e:
+                ok = False
+                inserted = 0
+                logger.error(f"向数据库批量插入 {len(rows)} 条消息时出错: {e}", exc_info=True)
+                await self._connection.rollback()
+                self.dimensions.forget(
+                    [chat[0] for chat in chat_upserts], [user[0] for user in user_upserts]
+                )
+            elapsed_ms = (time.perf_counter() - start) * 1000
+        self.stats.record(len(rows), elapsed_ms, ok)
+        if ok and checkpoint is None:
+            logger.info(f"已批量写入 {len(rows)} 条消息，耗时 {elapsed_ms:.1f} ms。缓冲区剩余: {self.buffered()}")
+            if self._publisher:
+                self._publish_batch(rows)
+        return inserted
+
+    def _publish_batch(self, rows: List[Tuple]):
+        """
+        把刚提交的一批消息转换为增量事件推送给 Web 进程：
+        各小时桶、会话、发送者的计数增量（按 id，附带当前的名字），以及最新的几条消息。
+        """
+        hourly: Counter = Counter()
+        chats: Counter = Counter()
+        senders: Counter = Counter()
+        for _, chat_id, sender_id, _, _, date, _, _ in rows:
+            hourly[rollups.bucket_of(date)] += 1
+            chats[chat_id] += 1
+            senders[sender_id or 0] += 1
+        self._publisher.publish({
+            "type": "counters",
+            "hourly": dict(hourly),
+            "chats": [[chat_id, *self.dimensions.chat(chat_id), count] for chat_id, count in chats.items()],
+            "senders": [
+                [sender_id, self.dimensions.user(sender_id)[0] or 'Unknown', count]
+                for sender_id, count in senders.items()
+            ],
+        })
+        self._publisher.publish({
+            "type": "messages",
+            "messages": [
+                {
+                    "message_id": message_id,
+                    "chat_id": chat_id,
+                    "chat_title": self.dimensions.chat(chat_id)[1],
+                    "sender_id": sender_id,
+                    "sender_name": self.dimensions.user(sender_id)[0] or 'Unknown',
+                    "text": (text or '')[:LIVE_TEXT_LENGTH],
+                    "date": date,
+                }
+                for message_id, chat_id, sender_id, text, _, date, _, _
+                in rows[-LIVE_MESSAGES_PER_BATCH:]
+            ],
+        })
+
+    async def save_message(
+        self,
+        event: events.NewMessage.Event,
+        chat: Optional[ChatInfo] = None,
+        sender: Optional[SenderInfo] = None,
+        duplicate: Optional[dedup.DuplicateMatch] = None,
+    ):
+        """
+        从事件对象中提取信息并放入写缓冲区。
         对于媒体消息，会使用'[图片]'等占位符作为内容。
+        chat 和 sender 为调用方已解析好的会话和发送者信息，省略时从实体缓存中获取。
+        duplicate 为重复检测找到的原始消息，与消息在同一个事务中写入 message_duplicates。
+
+        缓冲区已满时会等待写入任务腾出空间，从而对调用方形成背压。
+        如果写入任务未启动，则直接写入数据库。
         """
         if not self._connection:
             logger.error("数据库未连接，无法保存消息。")
             return
-        
-        message = event.message
 
+        # 提取会话和发送者信息（未由调用方提供时从实体缓存中解析）
+        if chat is None:
+            chat, sender = await entity_cache.resolve(event)
+        item = self.message_item(event.message, chat, sender, duplicate)
+
+        if self._writer_task is None or self._writer_task.done():
+            await self._write_rows([item])
+            return
+        await self._buffer.put(item)
+        logger.debug("消息 (ID: %s) 已放入写缓冲区。缓冲区大小: %s", event.message.id, self.buffered())
+
+    def message_item(
+        self, message, chat: ChatInfo, sender: Optional[SenderInfo], duplicate: Optional[dedup.DuplicateMatch] = None,
+    ) -> Tuple:
+        """
+        把一条 Telethon 消息转换为写入器的一项：(消息行, 会话维度 upsert, 发送者维度 upsert, 重复消息记录)。
+        对于媒体消息，会使用'[图片]'等占位符作为内容。
+        """
         # -- 提取和处理消息内容 --
         text_content = message.text
         raw_text_content = message.raw_text
@@ -84,60 +564,77 @@ class DatabaseManager:
                 placeholder = "[视频]"
             elif message.document:
                 placeholder = "[文件]"
-            
+
             if placeholder:
                 text_content = placeholder
                 raw_text_content = placeholder
         # -- 内容处理结束 --
-        
-        # 提取会话信息
-        chat = await message.get_chat()
-        chat_type = None
-        if isinstance(chat, User):
-            chat_type = 'User'
-        elif isinstance(chat, Chat):
-            chat_type = 'Group'
-        elif isinstance(chat, Channel):
-            chat_type = 'Channel'
-            
-        # 提取发送者信息
-        sender = await message.get_sender()
-        sender_name = "Unknown"
-        sender_username = "Unknown"
-        if sender:
-            first = getattr(sender, 'first_name', '') or ''
-            last = getattr(sender, 'last_name', '') or ''
-            sender_name = (first + ' ' + last).strip() or 'Unknown'
-            sender_username = getattr(sender, 'username', 'NoUsername')
-
-        insert_sql = """
-        INSERT INTO messages (
-            message_id, chat_id, chat_type, chat_title, sender_id, sender_name,
-            sender_username, text, raw_text, date, is_reply, reply_to_message_id
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """
-        
+
         params = (
             message.id,
             message.chat_id,
-            chat_type,
-            getattr(chat, 'title', 'Direct Message'),
-            getattr(sender, 'id', None),
-            sender_name,
-            sender_username,
+            sender.id if sender else None,
             text_content,
             raw_text_content,
             message.date,
             message.is_reply,
             message.reply_to_msg_id
         )
+        # 元数据与上次写入维度表的不同时，随这条消息一起更新维度表
+        return (
+            params,
+            self.dimensions.chat_upsert(message.chat_id, chat.type, chat.title, message.date),
+            self.dimensions.user_upsert(sender.id, sender.name, sender.username, message.date) if sender else None,
+            (
+                message.chat_id, message.id, duplicate.chat_id, duplicate.message_id,
+                duplicate.kind, duplicate.distance, message.date,
+            ) if duplicate else None,
+        )
 
-        try:
-            await self._connection.execute(insert_sql, params)
+    async def import_messages(self, items: List[Tuple], checkpoint: Tuple, archive=None) -> int:
+        """
+        历史回填的批量写入：与实时消息共用写锁和插入逻辑，按 (chat_id, message_id) 去重，
+        回填进度与消息在同一个事务中提交，不推送给 Web 进程。
+
+        主库的唯一索引只覆盖热分区，给出 archive 时还会跳过已经归档到按月分区中的消息，
+        避免它们被重新写入主库、在统计和搜索结果中出现两次。
+
+        :param checkpoint: (chat_id, done_upto, pass_top, pass_cursor)。
+        :param archive: 归档分区（handlers.archive.MessageArchive）。
+        :return: 新插入的消息数量。
+        """
+        if not self._connection:
+            await self.connect()
+        if items:
+            return await self._write_rows(items, checkpoint, archive)
+        # 没有消息时（例如一轮回填结束）只更新进度
+        async with self._write_lock:
+            await self._connection.execute(UPSERT_CHECKPOINT_SQL, checkpoint + (0, time.time()))
+            await self._connection.commit()
+        return 0
+
+    async def load_backfill_checkpoint(self, chat_id: int) -> Tuple[int, Optional[int], Optional[int]]:
+        """返回会话的回填进度 (done_upto, pass_top, pass_cursor)，从未回填时为 (0, None, None)。"""
+        if not self._connection:
+            await self.connect()
+        async with self._connection.execute(
+            "SELECT done_upto, pass_top, pass_cursor FROM backfill_checkpoints WHERE chat_id = ?", (chat_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        return tuple(row) if row else (0, None, None)
+
+    async def reset_backfill_checkpoint(self, chat_id: int):
+        """清除会话的回填进度，下次从最新消息开始重新回填全部历史。"""
+        if not self._connection:
+            await self.connect()
+        async with self._write_lock:
+            await self._connection.execute("DELETE FROM backfill_checkpoints WHERE chat_id = ?", (chat_id,))
             await self._connection.commit()
-            logger.info(f"消息 (ID: {message.id}) 已成功存入数据库。")
-        except Exception as e:
-            logger.error(f"向数据库插入消息时出错: {e}", exc_info=True)
 
 # 创建一个全局的数据库管理器实例
-db_manager = DatabaseManager()
+db_manager = DatabaseManager(
+    batch_size=settings.db_batch_size,
+    flush_interval_ms=settings.db_flush_interval_ms,
+    max_buffer=settings.db_max_buffer,
+)
+registry.register(db_manager.collect_metrics)
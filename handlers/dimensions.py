@@ -0,0 +1,151 @@
+"""
+会话和发送者的维度表。
+
+- chats：chat_id -> chat_type、chat_title。
+- users：sender_id -> sender_name、sender_username。
+
+messages 只保存整数的 chat_id 和 sender_id，不再在每一行重复类型、标题和名字；
+维度表只在元数据变化时（或进程启动后第一次见到某个会话/发送者时）更新一次。
+统计和查询按整数 id 分组，只在最终的前 N 名或一页结果上查出名字，
+群组改名不会把统计拆成两组，两个同名用户也不会被合并。
+
+v8 迁移之前写入的行仍带有这些字符串列，由 `python manage.py normalize`
+分块把它们置为 NULL（名字以维度表为准）。
+"""
+
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Tuple
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+# updated_at 取消息的时间，导入较早的消息时不会覆盖更新的元数据
+UPSERT_CHAT_SQL = """
+INSERT INTO chats (chat_id, chat_type, chat_title, updated_at) VALUES (?, ?, ?, ?)
+ON CONFLICT (chat_id) DO UPDATE SET
+    chat_type = excluded.chat_type, chat_title = excluded.chat_title, updated_at = excluded.updated_at
+WHERE excluded.updated_at >= chats.updated_at
+"""
+UPSERT_USER_SQL = """
+INSERT INTO users (sender_id, sender_name, sender_username, updated_at) VALUES (?, ?, ?, ?)
+ON CONFLICT (sender_id) DO UPDATE SET
+    sender_name = excluded.sender_name, sender_username = excluded.sender_username, updated_at = excluded.updated_at
+WHERE excluded.updated_at >= users.updated_at
+"""
+
+# 一条 IN (...) 查询中最多的 id 数量（远低于 SQLite 的参数上限）
+LOOKUP_CHUNK = 500
+# DimensionTracker 最多记住的会话/发送者数量，超过后清空重新记录（只会多执行几次 upsert）
+TRACKER_MAX_ENTRIES = 100000
+
+
+async def lookup(
+    conn: aiosqlite.Connection, chat_ids: Iterable[int] = (), sender_ids: Iterable[int] = ()
+) -> Tuple[Dict[int, Tuple[str, str]], Dict[int, Tuple[str, str]]]:
+    """
+    查出一组会话和发送者的元数据。
+
+    :return: ({chat_id: (chat_type, chat_title)}, {sender_id: (sender_name, sender_username)})，
+             维度表中没有的 id 不出现在结果中。
+    """
+    chats: Dict[int, Tuple[str, str]] = {}
+    users: Dict[int, Tuple[str, str]] = {}
+    for table, key, columns, ids, result in (
+        ("chats", "chat_id", "chat_type, chat_title", chat_ids, chats),
+        ("users", "sender_id", "sender_name, sender_username", sender_ids, users),
+    ):
+        ids = [i for i in set(ids) if i is not None]
+        for start in range(0, len(ids), LOOKUP_CHUNK):
+            chunk = ids[start:start + LOOKUP_CHUNK]
+            async with conn.execute(
+                f"SELECT {key}, {columns} FROM {table} WHERE {key} IN ({', '.join('?' * len(chunk))})", chunk
+            ) as cursor:
+                for row in await cursor.fetchall():
+                    result[row[0]] = (row[1], row[2])
+    return chats, users
+
+
+class DimensionTracker:
+    """
+    记录本进程已写入维度表的元数据，判断一条消息是否需要更新维度表。
+
+    写入器在同一个事务中执行返回的 upsert；事务失败时调用 forget，下一条消息会重新写入。
+    """
+    def __init__(self, max_entries: int = TRACKER_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._chats: Dict[int, Tuple[Optional[str], Optional[str]]] = {}
+        self._users: Dict[int, Tuple[Optional[str], Optional[str]]] = {}
+
+    def _changed(self, known: dict, key: int, value: tuple) -> bool:
+        if known.get(key) == value:
+            return False
+        if len(known) >= self.max_entries:
+            known.clear()
+        known[key] = value
+        return True
+
+    def chat_upsert(self, chat_id: int, chat_type: Optional[str], chat_title: Optional[str], date: datetime) -> Optional[tuple]:
+        """会话元数据有变化时返回 UPSERT_CHAT_SQL 的参数，否则返回 None。"""
+        if self._changed(self._chats, chat_id, (chat_type, chat_title)):
+            return (chat_id, chat_type, chat_title, date)
+        return None
+
+    def user_upsert(self, sender_id: Optional[int], name: Optional[str], username: Optional[str], date: datetime) -> Optional[tuple]:
+        """发送者元数据有变化时返回 UPSERT_USER_SQL 的参数，否则返回 None。"""
+        if sender_id is not None and self._changed(self._users, sender_id, (name, username)):
+            return (sender_id, name, username, date)
+        return None
+
+    def chat(self, chat_id: int) -> Tuple[Optional[str], Optional[str]]:
+        """返回已知的 (chat_type, chat_title)。"""
+        return self._chats.get(chat_id, (None, None))
+
+    def user(self, sender_id: Optional[int]) -> Tuple[Optional[str], Optional[str]]:
+        """返回已知的 (sender_name, sender_username)。"""
+        return self._users.get(sender_id, (None, None))
+
+    def forget(self, chat_ids: Iterable[int], sender_ids: Iterable[int]):
+        """维度表的更新没有提交时，忘掉这些 id，下次重新写入。"""
+        for chat_id in chat_ids:
+            self._chats.pop(chat_id, None)
+        for sender_id in sender_ids:
+            self._users.pop(sender_id, None)
+
+
+async def normalize(conn: aiosqlite.Connection, chunk_size: int = 50000) -> int:
+    """
+    把 v8 迁移之前写入的行中重复的字符串列置为 NULL。
+
+    进度记录在 meta 表中，每个分块单独提交，中断后重新运行会从上次的位置继续，
+    可以在监听程序运行时执行。
+
+    :return: 本次处理的消息数量。
+    """
+    async with conn.execute(
+        "SELECT key, value FROM meta WHERE key IN ('normalize_upto', 'normalize_done')"
+    ) as cursor:
+        state = {key: int(value) for key, value in await cursor.fetchall()}
+    upto = state.get("normalize_upto", 0)
+    done = state.get("normalize_done", 0)
+    if done >= upto:
+        logger.info("消息表无需规范化。")
+        return 0
+
+    logger.info(f"开始规范化消息表：消息 id {done + 1} ~ {upto}，每批 {chunk_size} 条。")
+    updated = 0
+    while done < upto:
+        end = min(done + chunk_size, upto)
+        cursor = await conn.execute(
+            "UPDATE messages SET chat_type = NULL, chat_title = NULL, sender_name = NULL, sender_username = NULL "
+            "WHERE id > ? AND id <= ?",
+            (done, end),
+        )
+        updated += cursor.rowcount
+        await conn.execute("UPDATE meta SET value = ? WHERE key = 'normalize_done'", (str(end),))
+        await conn.commit()
+        done = end
+        logger.info(f"消息表规范化进度: {done}/{upto} (本次已处理 {updated} 条)")
+    logger.info(f"消息表规范化完成，共处理 {updated} 条消息。")
+    return updated
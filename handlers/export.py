@@ -0,0 +1,297 @@
+"""
+把消息历史导出为列式文件（Parquet 或 Arrow IPC），供离线分析使用。
+
+- 导出只通过只读连接读取主库和归档分区（见 handlers.archive），不写入生产数据库，
+  分析查询在导出的文件上进行，不再与监听进程的写入竞争；
+- 按月份分块：每个月份的消息写入一个文件，按 (date, id) 的日期范围查询，可以使用日期索引；
+- 每次读取 batch_size 行转换为一个 RecordBatch 写出，内存占用与总消息量无关；
+- 会话和发送者的名字按批从主库的维度表（见 handlers.dimensions）中查出填入，导出文件不需要再关联；
+- 增量导出：导出目录中的 _export_state.json 记录已导出的最大消息 id（水位线），
+  下次只导出 id 更大的消息，文件名中带有本次导出的 id 范围，不会覆盖之前的文件；
+  以下划线开头的水位线文件会被 pyarrow.dataset 等工具跳过，导出目录可以直接作为数据集读取。
+
+pyarrow 是可选依赖，只有执行导出时才需要安装。
+"""
+
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from handlers.archive import DATE_FORMAT, MESSAGE_COLUMNS, MessageArchive, add_months, message_archive, month_start
+from handlers.database import DB_PATH, ReadConnectionPool
+from handlers.dimensions import lookup
+from utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE = "_export_state.json"
+# 导出行中各列的位置，用于填入维度表中的名字
+COLUMN_INDEX = {name.strip(): index for index, name in enumerate(MESSAGE_COLUMNS.split(","))}
+FILE_EXTENSIONS = {"parquet": "parquet", "arrow": "arrow"}
+
+
+def _import_pyarrow():
+    """导入 pyarrow，未安装时给出明确的提示。"""
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("导出 Parquet/Arrow 文件需要安装 pyarrow：pip install pyarrow") from None
+    return pyarrow
+
+
+def _message_schema(pa):
+    """导出文件的列定义，与 messages 表一一对应，date 转换为 UTC 时间戳。"""
+    return pa.schema([
+        ("id", pa.int64()),
+        ("message_id", pa.int64()),
+        ("chat_id", pa.int64()),
+        ("chat_type", pa.string()),
+        ("chat_title", pa.string()),
+        ("sender_id", pa.int64()),
+        ("sender_name", pa.string()),
+        ("sender_username", pa.string()),
+        ("text", pa.string()),
+        ("raw_text", pa.string()),
+        ("date", pa.timestamp("us", tz="UTC")),
+        ("is_reply", pa.bool_()),
+        ("reply_to_message_id", pa.int64()),
+    ])
+
+
+def _parse_date(value) -> Optional[datetime]:
+    """把数据库中的时间字符串转换为带时区的 UTC 时间（不带时区的视为 UTC）。"""
+    if value is None:
+        return None
+    dt = value if isinstance(value, datetime) else datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def _fill_names(rows: list, chats: dict, users: dict) -> list:
+    """用维度表中的元数据替换行中的会话和发送者字符串（维度表中没有时保留原值）。"""
+    chat_id, sender_id = COLUMN_INDEX["chat_id"], COLUMN_INDEX["sender_id"]
+    chat_type, chat_title = COLUMN_INDEX["chat_type"], COLUMN_INDEX["chat_title"]
+    sender_name, sender_username = COLUMN_INDEX["sender_name"], COLUMN_INDEX["sender_username"]
+    filled = []
+    for row in rows:
+        row = list(row)
+        chat = chats.get(row[chat_id])
+        if chat:
+            row[chat_type], row[chat_title] = chat
+        user = users.get(row[sender_id])
+        if user:
+            row[sender_name], row[sender_username] = user
+        filled.append(row)
+    return filled
+
+
+class _MonthWriter:
+    """一个月份的导出文件，先写入临时文件，全部写完后再改名。"""
+    def __init__(self, pa, schema, path: str, fmt: str, compression: str):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.rows = 0
+        self._pa = pa
+        self._schema = schema
+        if fmt == "parquet":
+            self._writer = pa.parquet.ParquetWriter(self.tmp_path, schema, compression=compression)
+        else:
+            options = pa.ipc.IpcWriteOptions(compression=None if compression == "none" else compression)
+            self._writer = pa.ipc.new_file(self.tmp_path, schema, options=options)
+
+    def write(self, rows: list):
+        """把一批行转换为 RecordBatch 写出（在线程池中执行）。"""
+        columns = [list(column) for column in zip(*rows)]
+        date_index = self._schema.get_field_index("date")
+        reply_index = self._schema.get_field_index("is_reply")
+        columns[date_index] = [_parse_date(value) for value in columns[date_index]]
+        columns[reply_index] = [None if value is None else bool(value) for value in columns[reply_index]]
+        batch = self._pa.record_batch(
+            [self._pa.array(column, type=field.type) for column, field in zip(columns, self._schema)],
+            schema=self._schema,
+        )
+        self._writer.write_batch(batch)
+        self.rows += len(rows)
+
+    def close(self):
+        self._writer.close()
+
+    def discard(self):
+        """放弃这个文件（导出失败时）。"""
+        self._writer.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class MessageExporter:
+    """
+    把 messages 按月导出到 directory 中的 Parquet 或 Arrow IPC 文件。
+
+    :param directory: 导出文件和水位线文件所在目录。
+    :param fmt: parquet 或 arrow。
+    :param compression: 压缩算法，none 表示不压缩。
+    :param batch_size: 每次从数据库读取并写出的行数。
+    :param archive: 同时导出其中的归档分区，None 表示只导出主库。
+    """
+    def __init__(
+        self,
+        directory: str,
+        fmt: str = "parquet",
+        compression: str = "zstd",
+        batch_size: int = 50000,
+        archive: Optional[MessageArchive] = None,
+    ):
+        self.directory = directory
+        self.fmt = fmt
+        self.compression = compression
+        self.batch_size = batch_size
+        self.archive = archive
+
+    @property
+    def state_path(self) -> str:
+        return os.path.join(self.directory, STATE_FILE)
+
+    def load_watermark(self) -> int:
+        """返回已导出的最大消息 id，从未导出时为 0。"""
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                return int(json.load(f).get("watermark", 0))
+        except FileNotFoundError:
+            return 0
+
+    def _save_watermark(self, watermark: int, files: List[str]):
+        """原子地更新水位线文件。"""
+        state = {
+            "watermark": watermark,
+            "exported_at": datetime.now(timezone.utc).isoformat(),
+            "files": [os.path.basename(path) for path in files],
+        }
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    async def export(self, full: bool = False) -> dict:
+        """
+        导出水位线之后的全部消息（full 为 True 时从头导出）。
+
+        :return: 本次导出的 {rows, files, after_id, upto_id}。
+        """
+        pa = _import_pyarrow()
+        schema = _message_schema(pa)
+        os.makedirs(self.directory, exist_ok=True)
+        after = 0 if full else self.load_watermark()
+
+        pools: Dict[str, ReadConnectionPool] = {DB_PATH: ReadConnectionPool(DB_PATH, size=1)}
+        # 查询维度表用单独的连接，读取主库的消息时也能同时查名字
+        names = ReadConnectionPool(DB_PATH, size=1)
+        if self.archive is not None:
+            for partition in self.archive.partitions():
+                pools[partition.path] = ReadConnectionPool(partition.path, size=1)
+        try:
+            # 本次导出的 id 上限固定在开始时刻，期间新写入的消息留给下一次
+            upto = after
+            ranges = {}
+            for path, pool in pools.items():
+                async with pool.acquire() as conn:
+                    async with conn.execute(
+                        "SELECT MAX(id) FROM messages WHERE id > ?", (after,)
+                    ) as cursor:
+                        upto = max(upto, (await cursor.fetchone())[0] or 0)
+            for path, pool in pools.items():
+                async with pool.acquire() as conn:
+                    async with conn.execute(
+                        "SELECT MIN(date), MAX(date) FROM messages WHERE id > ? AND id <= ?", (after, upto)
+                    ) as cursor:
+                        first, last = await cursor.fetchone()
+                if first is not None:
+                    ranges[path] = (
+                        month_start(datetime.strptime(first[:7], "%Y-%m")),
+                        month_start(datetime.strptime(last[:7], "%Y-%m")),
+                    )
+            if not ranges:
+                logger.info(f"没有新的消息需要导出（水位线 {after}）。")
+                return {"rows": 0, "files": [], "after_id": after, "upto_id": after}
+
+            logger.info(f"开始导出消息 id {after + 1} ~ {upto} 到 {self.directory}（{self.fmt}，{self.compression}）。")
+            month = min(first for first, _ in ranges.values())
+            end = max(last for _, last in ranges.values())
+            files, rows = [], 0
+            while month <= end:
+                sources = [pools[path] for path, (first, last) in ranges.items() if first <= month <= last]
+                written = await self._export_month(pa, schema, sources, names, month, after, upto)
+                if written:
+                    files.append(written.path)
+                    rows += written.rows
+                month = add_months(month, 1)
+        finally:
+            for pool in [*pools.values(), names]:
+                await pool.close()
+
+        self._save_watermark(upto, files)
+        logger.info(f"导出完成：{rows} 条消息，{len(files)} 个文件，水位线更新为 {upto}。")
+        return {"rows": rows, "files": files, "after_id": after, "upto_id": upto}
+
+    async def _export_month(
+        self, pa, schema, sources: List[ReadConnectionPool], names: ReadConnectionPool,
+        month: datetime, after: int, upto: int,
+    ):
+        """把各个来源中某个月份、id 在 (after, upto] 内的消息写入一个文件，没有消息时返回 None。"""
+        bounds = (month.strftime(DATE_FORMAT), add_months(month, 1).strftime(DATE_FORMAT))
+        filename = f"messages_{month.strftime('%Y_%m')}.{after + 1}-{upto}.{FILE_EXTENSIONS[self.fmt]}"
+        writer = None
+        try:
+            for pool in sources:
+                async with pool.acquire() as conn:
+                    async with conn.execute(
+                        f"SELECT {MESSAGE_COLUMNS} FROM messages "
+                        "WHERE date >= ? AND date < ? AND id > ? AND id <= ? ORDER BY date, id",
+                        bounds + (after, upto),
+                    ) as cursor:
+                        while True:
+                            batch = await cursor.fetchmany(self.batch_size)
+                            if not batch:
+                                break
+                            if writer is None:
+                                writer = _MonthWriter(
+                                    pa, schema, os.path.join(self.directory, filename), self.fmt, self.compression
+                                )
+                            async with names.acquire() as names_conn:
+                                chats, users = await lookup(
+                                    names_conn,
+                                    (row[COLUMN_INDEX["chat_id"]] for row in batch),
+                                    (row[COLUMN_INDEX["sender_id"]] for row in batch),
+                                )
+                            await asyncio.to_thread(writer.write, _fill_names(batch, chats, users))
+        except BaseException:
+            if writer is not None:
+                writer.discard()
+            raise
+        if writer is None:
+            return None
+        writer.close()
+        os.replace(writer.tmp_path, writer.path)
+        logger.info(f"已导出 {month.strftime('%Y-%m')} 的 {writer.rows} 条消息到 {writer.path}。")
+        return writer
+
+
+def create_exporter(directory: Optional[str] = None, fmt: Optional[str] = None, include_archive: bool = True) -> MessageExporter:
+    """按配置文件中的 [export] 设置创建导出器，参数可覆盖目录和格式。"""
+    fmt = fmt or settings.export_format
+    compression = settings.export_compression
+    # Arrow IPC 只支持 zstd 和 lz4
+    if fmt == "arrow" and compression not in ("zstd", "lz4", "none"):
+        compression = "zstd"
+    return MessageExporter(
+        directory=directory or settings.export_directory,
+        fmt=fmt,
+        compression=compression,
+        batch_size=settings.export_batch_size,
+        archive=message_archive if include_archive else None,
+    )
@@ -0,0 +1,265 @@
+"""
+持久化转发队列。
+
+待转发的消息存放在数据库的 forward_queue 表中（见迁移 v5），每行只记录
+(chat_id, message_id, target) 和投递状态，不保存 Telethon 事件对象：
+
+- 入队的消息先在内存中攒一小批，再用一个事务批量写入，内存占用与积压量无关；
+  写入数据库持续失败时，内存中最多保留 max_pending 条，之后 put 等待写入恢复，背压传回消息处理流水线；
+- 每个转发目标通过 lease 分别取出自己的一批待转发行，转发成功后 ack，重试耗尽后 fail，
+  处理过程中出错（例如 ack 时数据库出错）时 release 放回队列，稍后重新取出；
+  扇出到多个目标的消息每个目标一行，只记录 id，不复制消息内容；
+- 进程崩溃或重启时，已取出但未 ack 的行会在 open 时重新变为待转发，
+  因此投递语义是“至少一次”；唯一约束加上保留一段时间的已完成行，
+  可以避免同一条消息被重复入队和转发。
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+import aiosqlite
+
+from handlers.database import DB_PATH, apply_pragmas
+
+logger = logging.getLogger(__name__)
+
+# 内存中攒够这么多条待入队消息就立即写入数据库
+FLUSH_BATCH_SIZE = 500
+# 内存中等待写入数据库的消息上限（包括正在写入的一批）
+MAX_PENDING = 10000
+# last_error 字段保存的错误信息最大长度
+MAX_ERROR_LENGTH = 500
+
+
+class QueuedMessage:
+    """
+    从队列中取出的一条待转发消息。
+    """
+    __slots__ = ("id", "chat_id", "message_id", "target", "attempts", "created_at")
+
+    def __init__(self, id: int, chat_id: int, message_id: int, target: int, attempts: int, created_at: float):
+        self.id = id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.target = target
+        self.attempts = attempts
+        self.created_at = created_at
+
+
+class ForwardQueue:
+    """
+    基于 SQLite 的持久化转发队列，使用独立的写连接。
+
+    :param max_pending: 内存中等待写入数据库的消息上限，达到上限时 put 等待。
+    """
+    def __init__(
+        self,
+        db_path: str = DB_PATH,
+        flush_interval_ms: int = 200,
+        retention_hours: float = 24.0,
+        max_pending: int = MAX_PENDING,
+    ):
+        self.db_path = db_path
+        self.flush_interval = flush_interval_ms / 1000
+        self.retention_seconds = retention_hours * 3600
+        self.max_pending = max_pending
+        self._connection: Optional[aiosqlite.Connection] = None
+        self._incoming: List[Tuple[int, int, int, float]] = []
+        # 正在写入数据库的一批消息数
+        self._writing = 0
+        # 上一次写入是否失败；失败后只由 _flush_loop 按间隔重试，put 不再逐条触发写入
+        self._write_failed = False
+        # 写入成功后置位，唤醒因内存中待写入的消息达到上限而等待的 put
+        self._writable = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+        # 目标 -> 事件，有发往该目标的新消息入队时唤醒等待中的 lease
+        self._available: Dict[int, asyncio.Event] = {}
+        # 第一次出现的目标，由转发引擎为其创建转发通道
+        self._new_targets: asyncio.Queue = asyncio.Queue()
+        self._lock = asyncio.Lock()
+
+    async def open(self):
+        """
+        打开数据库连接，并把上次运行中已取出但未确认的消息恢复为待转发。
+
+        数据库结构由 db_manager.init_db 负责迁移，必须先调用它。
+        """
+        if self._connection is not None:
+            return
+        self._connection = await aiosqlite.connect(self.db_path)
+        await apply_pragmas(self._connection)
+        async with self._lock:
+            cursor = await self._connection.execute(
+                "UPDATE forward_queue SET leased_at = NULL WHERE status = 'pending' AND leased_at IS NOT NULL"
+            )
+            await self._connection.commit()
+        if cursor.rowcount:
+            logger.info(f"已恢复 {cursor.rowcount} 条上次未确认的待转发消息。")
+        async with self._connection.execute(
+            "SELECT DISTINCT target FROM forward_queue WHERE status = 'pending'"
+        ) as cursor:
+            for (target,) in await cursor.fetchall():
+                self._notify(target)
+        logger.info(f"持久化转发队列已打开，待转发消息: {await self.depth()}")
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """把内存中尚未写入的消息落盘并关闭连接。"""
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._connection:
+            await self.flush()
+            await self._connection.close()
+            self._connection = None
+            logger.info("持久化转发队列已关闭。")
+
+    async def put(self, chat_id: int, message_id: int, target: int):
+        """
+        把一条消息加入队列。消息先在内存中攒批，最迟 flush_interval 后写入数据库。
+
+        内存中等待写入的消息达到 max_pending 条时（数据库持续写入失败），等待写入恢复后再加入。
+        """
+        while len(self._incoming) + self._writing >= self.max_pending:
+            self._writable.clear()
+            await self._writable.wait()
+        self._incoming.append((chat_id, message_id, target, time.time()))
+        if len(self._incoming) >= FLUSH_BATCH_SIZE and not self._write_failed:
+            await self.flush()
+
+    async def flush(self):
+        """把内存中攒下的消息写入数据库，已入队过的消息会被忽略。"""
+        if not self._incoming or not self._connection:
+            return
+        rows, self._incoming = self._incoming, []
+        self._writing = len(rows)
+        async with self._lock:
+            try:
+                await self._connection.executemany(
+                    "INSERT OR IGNORE INTO forward_queue (chat_id, message_id, target, created_at) VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+                await self._connection.commit()
+            except Exception as e:
+                await self._connection.rollback()
+                # 放回内存，下次再试；put 受 max_pending 限制，内存中的消息不会无限增长
+                self._incoming = rows + self._incoming
+                self._writing = 0
+                self._write_failed = True
+                logger.error(f"写入转发队列失败，{len(rows)} 条消息将稍后重试: {e}", exc_info=True)
+                return
+        self._writing = 0
+        self._write_failed = False
+        self._writable.set()
+        for target in {row[2] for row in rows}:
+            self._notify(target)
+
+    def _notify(self, target: int):
+        """唤醒等待该目标新消息的 lease；第一次出现的目标同时交给 next_target。"""
+        event = self._available.get(target)
+        if event is None:
+            event = self._available[target] = asyncio.Event()
+            self._new_targets.put_nowait(target)
+        event.set()
+
+    async def next_target(self) -> int:
+        """等待并返回下一个第一次出现待转发消息的目标。"""
+        return await self._new_targets.get()
+
+    async def lease(self, target: int, limit: int, wait: bool = True) -> List[QueuedMessage]:
+        """
+        按入队顺序取出发往 target 的最多 limit 条待转发消息并标记为处理中。
+        没有待转发消息时，wait 为 True 则一直等待，否则返回空列表。
+        """
+        available = self._available.setdefault(target, asyncio.Event())
+        while True:
+            available.clear()
+            async with self._lock:
+                async with self._connection.execute(
+                    "SELECT id, chat_id, message_id, target, attempts, created_at FROM forward_queue "
+                    "WHERE target = ? AND status = 'pending' AND leased_at IS NULL ORDER BY id LIMIT ?",
+                    (target, limit),
+                ) as cursor:
+                    rows = await cursor.fetchall()
+                if rows:
+                    await self._connection.executemany(
+                        "UPDATE forward_queue SET leased_at = ? WHERE id = ?",
+                        [(time.time(), row[0]) for row in rows],
+                    )
+                    await self._connection.commit()
+            if rows or not wait:
+                return [QueuedMessage(*row) for row in rows]
+            await available.wait()
+
+    async def release(self, messages: List[QueuedMessage]):
+        """把一批已取出但未完成的消息放回队列（已经 ack 或 fail 的不受影响），之后会被重新取出。"""
+        async with self._lock:
+            await self._connection.executemany(
+                "UPDATE forward_queue SET leased_at = NULL WHERE id = ? AND status = 'pending'",
+                [(message.id,) for message in messages],
+            )
+            await self._connection.commit()
+        for target in {message.target for message in messages}:
+            self._notify(target)
+
+    async def ack(self, messages: List[QueuedMessage]):
+        """确认一批消息已转发成功。"""
+        await self._finish(messages, 'done', None)
+
+    async def fail(self, messages: List[QueuedMessage], error: str):
+        """把一批重试耗尽的消息标记为失败，不再转发。"""
+        await self._finish(messages, 'failed', error)
+
+    async def record_attempt(self, messages: List[QueuedMessage], error: str):
+        """记录一次失败的转发尝试（消息仍由当前进程持有并重试）。"""
+        async with self._lock:
+            await self._connection.executemany(
+                "UPDATE forward_queue SET attempts = attempts + 1, last_error = ? WHERE id = ?",
+                [(error[:MAX_ERROR_LENGTH], message.id) for message in messages],
+            )
+            await self._connection.commit()
+
+    async def _finish(self, messages: List[QueuedMessage], status: str, error: Optional[str]):
+        """把一批消息标记为已完成（done 或 failed）。"""
+        now = time.time()
+        async with self._lock:
+            await self._connection.executemany(
+                "UPDATE forward_queue SET status = ?, done_at = ?, last_error = COALESCE(?, last_error) WHERE id = ?",
+                [(status, now, error[:MAX_ERROR_LENGTH] if error else None, message.id) for message in messages],
+            )
+            await self._connection.commit()
+
+    async def depth(self) -> int:
+        """返回待转发（包括处理中）的消息数量。"""
+        async with self._connection.execute(
+            "SELECT COUNT(*) FROM forward_queue WHERE status = 'pending'"
+        ) as cursor:
+            return (await cursor.fetchone())[0] + len(self._incoming)
+
+    async def depth_by_target(self) -> Dict[int, int]:
+        """返回各目标待转发（包括处理中）的消息数量。"""
+        async with self._connection.execute(
+            "SELECT target, COUNT(*) FROM forward_queue WHERE status = 'pending' GROUP BY target"
+        ) as cursor:
+            depths = dict(await cursor.fetchall())
+        for _, _, target, _ in self._incoming:
+            depths[target] = depths.get(target, 0) + 1
+        return depths
+
+    async def purge(self) -> int:
+        """删除超过保留时间的已完成记录，返回删除的行数。"""
+        async with self._lock:
+            cursor = await self._connection.execute(
+                "DELETE FROM forward_queue WHERE status != 'pending' AND done_at < ?",
+                (time.time() - self.retention_seconds,),
+            )
+            await self._connection.commit()
+        return cursor.rowcount
+
+    async def _flush_loop(self):
+        """定期把内存中攒下的消息写入数据库。"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
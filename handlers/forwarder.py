@@ -1,35 +1,384 @@
 import asyncio
 import logging
+import random
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError
 from tg_client import client_manager
+from handlers.forward_queue import ForwardQueue, QueuedMessage
 from utils.config import settings
+from utils.logger import message_log_enabled
+from utils.metrics import DEFAULT_DELAY_BUCKETS_S, Histogram, counter, gauge, histogram, registry
+from utils.ratelimit import TokenBucket
+from utils.reload import config_reloader
 
 logger = logging.getLogger(__name__)
 
-# 从 client_manager 获取消息队列
-message_queue = client_manager.get_queue()
+# 定期输出转发统计的间隔（秒）
+STATS_INTERVAL = 60
+# 重试的最大退避时间（秒）
+MAX_BACKOFF = 60
+# 转发过程中出错时，等待这么多秒再把消息放回队列，避免持续出错时反复转发同一批消息
+RELEASE_DELAY = 5
 
-async def forwarder_task():
+
+class ForwardStats:
     """
-    一个独立的后台任务，持续从队列中获取消息并转发。
-    
-    - 以配置中指定的速率进行转发。
-    - 记录成功和失败的转发操作。
+    转发统计：成功/失败条数、批次数、FloodWait 次数与时长、排队延迟。
     """
-    logger.info(f"消息转发器已启动，将以每 {settings.forwarding_delay_seconds} 秒一次的速率转发。")
-    while True:
+    def __init__(self):
+        self.forwarded = 0
+        self.failed = 0
+        self.batches = 0
+        self.retries = 0
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.latency = Histogram(DEFAULT_DELAY_BUCKETS_S)
+
+    def record_batch(self, items: List[QueuedMessage]):
+        """记录一批成功转发的消息及其从入队到转发完成的延迟。"""
+        now = time.time()
+        self.batches += 1
+        self.forwarded += len(items)
+        for item in items:
+            latency = now - item.created_at
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            self.latency.observe(latency)
+
+    def snapshot(self) -> dict:
+        """返回当前统计的快照。"""
+        return {
+            "forwarded": self.forwarded,
+            "failed": self.failed,
+            "batches": self.batches,
+            "retries": self.retries,
+            "flood_waits": self.flood_waits,
+            "flood_wait_seconds": self.flood_wait_seconds,
+            "avg_latency_seconds": self.total_latency / self.forwarded if self.forwarded else 0.0,
+            "max_latency_seconds": self.max_latency,
+        }
+
+
+class TargetLane:
+    """
+    一个转发目标的转发通道。
+
+    每个目标有自己的取消息循环、令牌桶、工作协程和统计，
+    某个目标触发 FloodWait 或持续失败时只有该目标暂停，其他目标照常转发。
+    """
+    def __init__(self, engine: "ForwardingEngine", target: int, name: str, rate: float, burst: float, max_retries: int):
+        self.engine = engine
+        self.target = target
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.in_flight = 0
+        self.stats = ForwardStats()
+        self._workers: List[asyncio.Queue] = [asyncio.Queue(maxsize=2) for _ in range(engine.concurrency)]
+
+    async def run(self):
+        """启动工作协程，并持续把发往本目标的消息按来源会话分组后分发给它们。"""
+        workers = [asyncio.create_task(self._worker(queue)) for queue in self._workers]
+        try:
+            while True:
+                batch = await self._collect()
+                self.in_flight += len(batch)
+                batch_size = self.engine.batch_size
+                for chat_id, items in self._group(batch).items():
+                    for i in range(0, len(items), batch_size):
+                        queue = self._workers[hash(chat_id) % len(self._workers)]
+                        await queue.put((chat_id, items[i:i + batch_size]))
+        finally:
+            for task in workers:
+                task.cancel()
+
+    async def _collect(self) -> List[QueuedMessage]:
+        """等待至少一条消息；只取到少量消息时再等待 linger 时间，尽量凑成更大的批次。"""
+        queue = self.engine.queue
+        limit = self.engine.batch_size * len(self._workers)
+        batch = await queue.lease(self.target, limit)
+        if len(batch) < limit and self.engine.linger > 0:
+            await asyncio.sleep(self.engine.linger)
+            await queue.flush()
+            batch += await queue.lease(self.target, limit - len(batch), wait=False)
+        return batch
+
+    @staticmethod
+    def _group(batch: List[QueuedMessage]) -> Dict[int, List[QueuedMessage]]:
+        """按来源会话分组，组内保持入队顺序。"""
+        groups: Dict[int, List[QueuedMessage]] = OrderedDict()
+        for item in batch:
+            groups.setdefault(item.chat_id, []).append(item)
+        return groups
+
+    async def _worker(self, queue: asyncio.Queue):
+        """依次转发分配给本工作协程的分组。"""
+        while True:
+            chat_id, items = await queue.get()
+            try:
+                await self._forward_group(chat_id, items)
+            except Exception as e:
+                logger.error(f"转发消息至 {self.name} 时发生严重错误，{RELEASE_DELAY} 秒后放回队列: {e}", exc_info=True)
+                await self._release(items)
+            finally:
+                self.in_flight -= len(items)
+
+    async def _release(self, items: List[QueuedMessage]):
+        """把出错的一组消息放回队列；放回也失败时，这些消息在下次启动时恢复（见 ForwardQueue.open）。"""
+        await asyncio.sleep(RELEASE_DELAY)
         try:
-            event = await message_queue.get()
-            
-            await event.forward_to(settings.target_group)
-            
-            q_size = message_queue.qsize()
-            logger.info(f"一条消息已成功转发至 {settings.target_group}。队列剩余: {q_size}")
-            
+            await self.engine.queue.release(items)
         except Exception as e:
-            logger.error(f"转发消息时发生严重错误: {e}", exc_info=True)
-            # 即使转发失败，也继续处理下一条，避免阻塞
-            
+            logger.error(f"把 {len(items)} 条消息放回转发队列失败: {e}", exc_info=True)
+
+    async def _forward_group(self, chat_id: int, items: List[QueuedMessage]):
+        """把同一来源会话的一组消息合并转发到本目标，处理限速和重试。"""
+        client, queue = self.engine.client, self.engine.queue
+        message_ids = [item.message_id for item in items]
+        attempt = max(item.attempts for item in items)
+        while True:
+            await self.bucket.acquire()
+            try:
+                # 依赖会话文件中缓存的实体，重启后无需原始事件对象即可解析来源会话
+                from_peer = await client.get_input_entity(chat_id)
+                await client.forward_messages(self.target, message_ids, from_peer=from_peer)
+            except FloodWaitError as e:
+                self.stats.flood_waits += 1
+                self.stats.flood_wait_seconds += e.seconds
+                self.bucket.penalize(e.seconds)
+                logger.warning(
+                    f"转发至 {self.name} 触发 FloodWait，该目标暂停 {e.seconds} 秒，"
+                    f"速率降至 {self.bucket.rate:.2f} 次/秒。"
+                )
+                continue
+            except Exception as e:
+                attempt += 1
+                await queue.record_attempt(items, str(e))
+                if attempt > self.max_retries:
+                    self.stats.failed += len(items)
+                    await queue.fail(items, str(e))
+                    logger.error(
+                        f"来自 {chat_id} 的 {len(items)} 条消息转发至 {self.name} 失败，"
+                        f"已重试 {self.max_retries} 次，放弃: {e}"
+                    )
+                    return
+                self.stats.retries += 1
+                delay = min(MAX_BACKOFF, 2 ** attempt) * (0.5 + random.random() / 2)
+                logger.warning(
+                    f"转发来自 {chat_id} 的消息至 {self.name} 失败（第 {attempt} 次），{delay:.1f} 秒后重试: {e}"
+                )
+                await asyncio.sleep(delay)
+                continue
+
+            self.bucket.reward()
+            await queue.ack(items)
+            self.stats.record_batch(items)
+            if message_log_enabled(logger):
+                logger.info(f"{len(items)} 条来自 {chat_id} 的消息已成功转发至 {self.name}。")
+            return
+
+    def configure(self, name: str, rate: float, burst: float, max_retries: int):
+        """在运行中修改本目标的限速和重试次数。"""
+        self.name = name
+        if rate != self.bucket.max_rate or max(burst, 1.0) != self.bucket.burst:
+            self.bucket.configure(rate, burst)
+        self.max_retries = max_retries
+
+
+class ForwardingEngine:
+    """
+    批量、限速、可并发、按目标隔离的转发引擎。
+
+    - 每个转发目标一个 TargetLane，分别从持久化转发队列取出发往自己的消息，
+      按来源会话分组，每组用一次 forward_messages 转发多条。
+    - 每个目标有独立的令牌桶，遇到 FloodWaitError 时只暂停该目标并自适应降速。
+    - 其他错误按指数退避重试，超过最大次数后把该组标记为失败。
+    - 转发成功后才在队列中确认，进程中途退出的消息会在重启后重新转发。
+    - 同一来源会话的分组总是交给目标内同一个工作协程，保证转发顺序；
+      每个目标内不同会话之间最多 concurrency 个请求并行。
+    - 队列中出现新的目标（例如规则直接写了会话 id）时自动为其创建通道，使用默认设置。
+
+    :param targets: 会话 id -> 目标设置（settings.forward_targets），
+        未列出的目标使用 rate、burst 和 max_retries。
+    """
+    def __init__(
+        self,
+        client: TelegramClient,
+        queue: ForwardQueue,
+        rate: float,
+        burst: float,
+        concurrency: int,
+        batch_size: int,
+        linger_ms: int,
+        max_retries: int,
+        targets: Optional[Dict[int, dict]] = None,
+    ):
+        self.client = client
+        self.queue = queue
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.linger = linger_ms / 1000
+        self.max_retries = max_retries
+        self.targets = targets or {}
+        self.lanes: Dict[int, TargetLane] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    async def run(self, default_target: Optional[int] = None):
+        """为已配置的目标启动转发通道，并为队列中新出现的目标按需创建通道。"""
+        logger.info(
+            f"消息转发器已启动：{len(self.targets)} 个已配置的目标，默认速率 {self.rate:.2f} 次/秒，"
+            f"每个目标并发 {self.concurrency}，每批最多 {self.batch_size} 条。"
+        )
+        self._tasks.append(asyncio.create_task(self._report_loop()))
+        try:
+            for target in self.targets:
+                self._ensure_lane(target)
+            if default_target is not None:
+                self._ensure_lane(default_target)
+            while True:
+                self._ensure_lane(await self.queue.next_target())
         finally:
-            message_queue.task_done()
-            # 遵循配置的延迟，控制转发速率
-            await asyncio.sleep(settings.forwarding_delay_seconds) 
\ No newline at end of file
+            for task in self._tasks:
+                task.cancel()
+            self._tasks = []
+
+    def _lane_settings(self, target: int) -> dict:
+        """返回目标的设置，未配置的目标使用默认值。"""
+        return self.targets.get(target) or {
+            'name': str(target), 'rate': self.rate, 'burst': self.burst, 'max_retries': self.max_retries,
+        }
+
+    def _ensure_lane(self, target: int):
+        """目标还没有转发通道时创建并启动一个。"""
+        if target in self.lanes:
+            return
+        lane = TargetLane(self, target, **self._lane_settings(target))
+        self.lanes[target] = lane
+        self._tasks.append(asyncio.create_task(lane.run()))
+        logger.info(f"已为目标 {lane.name} ({target}) 创建转发通道，速率 {lane.bucket.rate:.2f} 次/秒。")
+
+    @property
+    def in_flight(self) -> int:
+        """所有目标已取出但尚未完成的消息数。"""
+        return sum(lane.in_flight for lane in self.lanes.values())
+
+    def configure(
+        self,
+        rate: float,
+        burst: float,
+        batch_size: int,
+        linger_ms: int,
+        max_retries: int,
+        targets: Dict[int, dict],
+    ):
+        """在运行中修改限速、批量和各目标的参数（并发数需要重启才能修改）。"""
+        self.rate = rate
+        self.burst = burst
+        self.batch_size = batch_size
+        self.linger = linger_ms / 1000
+        self.max_retries = max_retries
+        self.targets = targets
+        for target, lane in self.lanes.items():
+            lane.configure(**self._lane_settings(target))
+        if self._tasks:
+            for target in targets:
+                self._ensure_lane(target)
+        logger.info(
+            f"转发参数已更新：默认速率 {rate:.2f} 次/秒，突发 {burst}，每批最多 {batch_size} 条，"
+            f"等待 {linger_ms} ms，最多重试 {max_retries} 次，已配置目标 {len(targets)} 个。"
+        )
+
+    async def collect_metrics(self) -> list:
+        """导出各目标的转发计数、延迟分布、FloodWait 和队列深度。"""
+        depths = await self.queue.depth_by_target() if self._tasks else {}
+        samples = []
+        for target, lane in self.lanes.items():
+            stats = lane.stats
+            labels = {"target": lane.name}
+            samples += [
+                counter("listentg_forward_messages_total", "转发成功的消息数", stats.forwarded, **labels),
+                counter("listentg_forward_failed_total", "重试耗尽后放弃转发的消息数", stats.failed, **labels),
+                counter("listentg_forward_batches_total", "forward_messages 调用次数", stats.batches, **labels),
+                counter("listentg_forward_retries_total", "转发失败后的重试次数", stats.retries, **labels),
+                counter("listentg_forward_flood_waits_total", "转发触发 FloodWait 的次数", stats.flood_waits, **labels),
+                counter("listentg_forward_flood_wait_seconds_total", "FloodWait 要求等待的总秒数", stats.flood_wait_seconds, **labels),
+                histogram("listentg_forward_latency_seconds", "消息从入队到转发完成的延迟", stats.latency, **labels),
+                gauge("listentg_forward_queue_depth", "待转发（包括处理中）的消息数", depths.get(target, 0), **labels),
+                gauge("listentg_forward_in_flight", "已取出但尚未完成的消息数", lane.in_flight, **labels),
+                gauge("listentg_forward_rate", "当前转发速率（次/秒）", lane.bucket.rate, **labels),
+            ]
+        return samples
+
+    async def _report_loop(self):
+        """定期输出各目标的队列深度和转发统计，并清理过期的已完成记录。"""
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            try:
+                purged = await self.queue.purge()
+                depths = await self.queue.depth_by_target()
+            except Exception as e:
+                logger.error(f"读取转发队列状态失败: {e}", exc_info=True)
+                continue
+            logger.info(f"转发统计: 待转发 {sum(depths.values())}（处理中 {self.in_flight}），清理已完成记录 {purged} 条。")
+            for target, lane in self.lanes.items():
+                logger.info(
+                    f"目标 {lane.name}: 待转发 {depths.get(target, 0)}（处理中 {lane.in_flight}），"
+                    f"速率 {lane.bucket.rate:.2f} 次/秒，{lane.stats.snapshot()}"
+                )
+
+
+# 创建全局的持久化转发队列和转发引擎实例
+forward_queue = ForwardQueue(
+    flush_interval_ms=settings.forwarding_linger_ms,
+    retention_hours=settings.forwarding_retention_hours,
+)
+engine = ForwardingEngine(
+    client=client_manager.get_client(),
+    queue=forward_queue,
+    rate=settings.forwarding_rate,
+    burst=settings.forwarding_burst,
+    concurrency=settings.forwarding_concurrency,
+    batch_size=settings.forwarding_batch_size,
+    linger_ms=settings.forwarding_linger_ms,
+    max_retries=settings.forwarding_max_retries,
+    targets=settings.forward_targets,
+)
+registry.register(engine.collect_metrics)
+
+
+async def _apply_settings(changed):
+    """热加载后更新转发引擎和转发队列的参数。"""
+    if changed & {
+        'forwarding_rate', 'forwarding_burst', 'forwarding_batch_size', 'forwarding_linger_ms',
+        'forwarding_max_retries', 'forward_targets',
+    }:
+        engine.configure(
+            rate=settings.forwarding_rate,
+            burst=settings.forwarding_burst,
+            batch_size=settings.forwarding_batch_size,
+            linger_ms=settings.forwarding_linger_ms,
+            max_retries=settings.forwarding_max_retries,
+            targets=settings.forward_targets,
+        )
+        forward_queue.flush_interval = settings.forwarding_linger_ms / 1000
+    if 'forwarding_retention_hours' in changed:
+        forward_queue.retention_seconds = settings.forwarding_retention_hours * 3600
+
+config_reloader.subscribe(_apply_settings)
+
+
+async def forwarder_task():
+    """
+    一个独立的后台任务，持续从持久化队列中取出消息并转发。
+
+    - 每个目标独立限速和重试，同一来源会话的消息合并转发，并自适应 FloodWait。
+    - 记录成功和失败的转发操作，定期输出队列深度和延迟统计。
+    """
+    await engine.run(default_target=settings.target_group)
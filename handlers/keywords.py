@@ -0,0 +1,345 @@
+"""
+关键词统计：用 jieba 对消息分词，按小时累计每个会话的词频，供仪表盘的热词和词云使用。
+
+- 分词在进程池中进行（jieba 是纯 Python 实现，CPU 密集），不阻塞监听进程的事件循环；
+- 后台任务按消息 id 增量处理：每批读取 keywords_done 之后的消息，分词后把词频累加到
+  term_hourly，并在同一个事务中推进 keywords_done，中断后重新启动会从上次的位置继续；
+- term_hourly 以 (bucket, chat_id, term) 为主键，chat_id 为 0 的行是全部会话的合计，
+  查询全部会话时无需再按会话汇总；
+- 每个词在一条消息中只计一次；被识别为重复的消息（message_duplicates 中的行，见 handlers.dedup）
+  不参与统计，跨会话刷屏的相同内容只按原始消息计一次（未启用重复检测时不做这一步）；
+- 长尾词：超过 prune_after_days 天的按会话词频中，次数少于 prune_min_count 的行被删除，
+  全部会话的合计保留到 retention_days 天，作为热词的基线。
+
+jieba 和 wordcloud 是可选依赖，未安装时关键词统计和词云不可用，其他功能不受影响。
+"""
+
+import asyncio
+import io
+import logging
+import math
+import re
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+import aiosqlite
+
+from handlers.rollups import bucket_of
+from utils.config import settings
+from utils.metrics import counter, gauge, registry
+from utils.reload import config_reloader
+
+logger = logging.getLogger(__name__)
+
+UPSERT_TERM_SQL = """
+INSERT INTO term_hourly (bucket, chat_id, term, count) VALUES (?, ?, ?, ?)
+ON CONFLICT (bucket, chat_id, term) DO UPDATE SET count = count + excluded.count
+"""
+
+# 全部会话合计的 chat_id
+ALL_CHATS = 0
+# 每隔多少秒清理一次长尾词和过期词频
+PRUNE_INTERVAL = 3600
+
+# 媒体消息的占位符（见 DatabaseManager.message_item），不参与分词
+PLACEHOLDERS = {"[图片]", "[表情]", "[视频]", "[文件]"}
+URL_RE = re.compile(r"https?://\S+|www\.\S+|@\w+")
+# 词中至少有一个汉字或字母，纯数字和标点不计
+TERM_RE = re.compile(r"[\u4e00-\u9fff\u3400-\u4dbfa-z]")
+DEFAULT_STOPWORDS = {
+    "一个", "一些", "一下", "不是", "不会", "不要", "东西", "为了", "为什么", "也是", "了吧", "什么", "他们",
+    "以后", "但是", "你们", "出来", "可以", "可能", "因为", "如果", "就是", "已经", "应该", "怎么", "我们",
+    "所以", "所有", "时候", "是不是", "有点", "没有", "然后", "现在", "知道", "而且", "自己", "还是", "还有",
+    "这个", "这么", "这些", "这样", "这种", "那个", "那么", "那些", "那样", "觉得", "真的", "还要", "哈哈",
+    "哈哈哈", "哈哈哈哈", "图片", "表情", "视频", "文件",
+    "the", "and", "for", "are", "but", "not", "you", "your", "with", "this", "that", "have", "from",
+    "was", "were", "they", "will", "just", "what", "can", "all", "there", "their", "about", "http", "https",
+}
+
+
+def _import_jieba():
+    """导入 jieba，未安装时给出明确的提示。"""
+    try:
+        import jieba
+    except ImportError:
+        raise RuntimeError("关键词统计需要安装 jieba：pip install jieba") from None
+    return jieba
+
+
+def _import_wordcloud():
+    """导入 wordcloud，未安装时给出明确的提示。"""
+    try:
+        import wordcloud
+    except ImportError:
+        raise RuntimeError("生成词云需要安装 wordcloud：pip install wordcloud") from None
+    return wordcloud
+
+
+def load_stopwords(path: str = "") -> Set[str]:
+    """内置的停用词，加上 path 中的停用词（每行一个词）。"""
+    stopwords = set(DEFAULT_STOPWORDS)
+    if path:
+        with open(path, encoding="utf-8") as f:
+            stopwords.update(line.strip().lower() for line in f if line.strip())
+    return stopwords
+
+
+# ---- 以下在分词进程中执行 ----
+
+_stopwords: Set[str] = set()
+
+
+def _init_worker(stopwords_file: str):
+    """分词进程的初始化：加载 jieba 词典和停用词。"""
+    global _stopwords
+    jieba = _import_jieba()
+    jieba.setLogLevel(logging.WARNING)
+    jieba.initialize()
+    _stopwords = load_stopwords(stopwords_file)
+
+
+def extract_terms(text: str, stopwords: Set[str]) -> Set[str]:
+    """对一条消息分词，返回其中的关键词（去掉链接、单字、停用词、纯数字和标点）。"""
+    jieba = _import_jieba()
+    terms = set()
+    for word in jieba.cut(URL_RE.sub(" ", text)):
+        word = word.strip().lower()
+        if len(word) >= 2 and word not in stopwords and TERM_RE.search(word):
+            terms.add(word)
+    return terms
+
+
+def count_terms(rows: List[Tuple[str, int, Optional[str]]]) -> Dict[Tuple[str, int, str], int]:
+    """统计一组 (bucket, chat_id, 文本) 的词频，返回 {(bucket, chat_id, term): 消息数}。"""
+    counts: Counter = Counter()
+    for bucket, chat_id, text in rows:
+        if not text or text in PLACEHOLDERS:
+            continue
+        for term in extract_terms(text, _stopwords):
+            counts[(bucket, chat_id, term)] += 1
+    return dict(counts)
+
+# ---- 分词进程结束 ----
+
+
+def trending_score(count: int, baseline: int, hours: float, baseline_hours: float) -> float:
+    """
+    热词得分：当前窗口的次数比按基线窗口推算的期望次数高出多少个标准差（泊松近似）。
+
+    基线中从未出现的词得分约等于次数本身，突然出现的高频词排在前面。
+    """
+    expected = baseline * hours / baseline_hours
+    return (count - expected) / math.sqrt(expected + 1)
+
+
+def render_wordcloud(frequencies: Dict[str, float], font_path: str = "", width: int = 800, height: int = 400) -> bytes:
+    """把词频画成 PNG 格式的词云（在线程池中执行）。"""
+    wordcloud = _import_wordcloud()
+    image = wordcloud.WordCloud(
+        font_path=font_path or None, width=width, height=height, background_color="white",
+    ).generate_from_frequencies(frequencies).to_image()
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class KeywordStats:
+    """关键词统计：已处理的消息数、写入的词频行数、批次数和分词耗时。"""
+    def __init__(self):
+        self.messages = 0
+        self.term_rows = 0
+        self.batches = 0
+        self.pruned = 0
+        self.segment_seconds = 0.0
+        self.last_id = 0
+
+
+class KeywordIndexer:
+    """
+    增量维护 term_hourly 的后台任务。
+
+    :param workers: 分词进程数。
+    :param batch_size: 每批处理的消息数。
+    :param interval: 追上最新消息后，每隔多少秒检查一次新消息。
+    :param stopwords_file: 额外的停用词文件。
+    """
+    def __init__(
+        self,
+        workers: int = 2,
+        batch_size: int = 2000,
+        interval: float = 5.0,
+        stopwords_file: str = "",
+        prune_after_days: int = 2,
+        prune_min_count: int = 2,
+        retention_days: int = 30,
+    ):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.interval = interval
+        self.stopwords_file = stopwords_file
+        self.prune_after_days = prune_after_days
+        self.prune_min_count = prune_min_count
+        self.retention_days = retention_days
+        self.stats = KeywordStats()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        # 已清理过长尾词的小时桶上限，下次只需检查之后的桶
+        self._pruned_before: Optional[str] = None
+
+    def start(self) -> bool:
+        """创建分词进程池；jieba 未安装时返回 False。"""
+        try:
+            _import_jieba()
+        except RuntimeError as e:
+            logger.warning(f"关键词统计已停用: {e}")
+            return False
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_init_worker, initargs=(self.stopwords_file,)
+            )
+        return True
+
+    def stop(self):
+        """关闭分词进程池。"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def index_pending(self, conn: aiosqlite.Connection, lock: asyncio.Lock) -> int:
+        """
+        处理 keywords_done 之后的一批消息，返回处理的消息数量。
+
+        读取和写入各持有一次写锁，分词期间批量写入器照常写入。
+        """
+        async with lock:
+            async with conn.execute("SELECT value FROM meta WHERE key = 'keywords_done'") as cursor:
+                row = await cursor.fetchone()
+            done = int(row[0]) if row else 0
+            # 重复消息的记录与消息在同一个事务中写入，读到消息时已经可以判断
+            async with conn.execute(
+                "SELECT id, STRFTIME('%Y-%m-%d %H:00:00', date), chat_id, COALESCE(raw_text, text), "
+                "EXISTS (SELECT 1 FROM message_duplicates d WHERE d.chat_id = m.chat_id AND d.message_id = m.message_id) "
+                "FROM messages m WHERE id > ? ORDER BY id LIMIT ?",
+                (done, self.batch_size),
+            ) as cursor:
+                rows = await cursor.fetchall()
+        if not rows:
+            return 0
+
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        texts = [(bucket, chat_id, text) for _, bucket, chat_id, text, duplicate in rows if not duplicate]
+        # 按进程数切分，各个进程并行分词
+        chunks = [texts[i::self.workers] for i in range(min(self.workers, len(texts)))]
+        results = await asyncio.gather(*(loop.run_in_executor(self._pool, count_terms, chunk) for chunk in chunks))
+        counts: Counter = Counter()
+        for result in results:
+            for (bucket, chat_id, term), count in result.items():
+                counts[(bucket, chat_id, term)] += count
+                counts[(bucket, ALL_CHATS, term)] += count
+        self.stats.segment_seconds += time.perf_counter() - start
+
+        upto = rows[-1][0]
+        async with lock:
+            try:
+                await conn.executemany(UPSERT_TERM_SQL, [key + (count,) for key, count in counts.items()])
+                await conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('keywords_done', ?)", (str(upto),)
+                )
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+        self.stats.messages += len(rows)
+        self.stats.term_rows += len(counts)
+        self.stats.batches += 1
+        self.stats.last_id = upto
+        if len(rows) == self.batch_size:
+            logger.info(f"关键词统计进度: 已处理到消息 {upto}。")
+        return len(rows)
+
+    async def prune(self, conn: aiosqlite.Connection, lock: asyncio.Lock, now: Optional[datetime] = None) -> int:
+        """删除过期的词频和旧的按会话长尾词，返回删除的行数。"""
+        now = now or datetime.utcnow()
+        expire_before = bucket_of(now - timedelta(days=self.retention_days))
+        prune_before = bucket_of(now - timedelta(days=self.prune_after_days))
+        prune_after = max(self._pruned_before or expire_before, expire_before)
+        async with lock:
+            try:
+                expired = await conn.execute("DELETE FROM term_hourly WHERE bucket < ?", (expire_before,))
+                pruned = await conn.execute(
+                    "DELETE FROM term_hourly WHERE bucket >= ? AND bucket < ? AND chat_id != ? AND count < ?",
+                    (prune_after, prune_before, ALL_CHATS, self.prune_min_count),
+                )
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+        self._pruned_before = prune_before
+        deleted = expired.rowcount + pruned.rowcount
+        self.stats.pruned += deleted
+        if deleted:
+            logger.info(f"已清理 {deleted} 行过期或长尾的词频。")
+        return deleted
+
+    async def run_loop(self, db_manager):
+        """持续处理新消息的分词，并定期清理长尾词；jieba 未安装时直接返回。"""
+        if not self.start():
+            return
+        last_prune = 0.0
+        while True:
+            processed = 0
+            try:
+                processed = await db_manager.index_keywords(self)
+                if time.monotonic() - last_prune >= PRUNE_INTERVAL:
+                    await db_manager.prune_keywords(self)
+                    last_prune = time.monotonic()
+            except Exception as e:
+                logger.error(f"关键词统计失败: {e}", exc_info=True)
+            # 积压时连续处理，追上后定期检查
+            if processed < self.batch_size:
+                await asyncio.sleep(self.interval)
+
+    def collect_metrics(self) -> list:
+        """导出关键词统计的进度和耗时。"""
+        stats = self.stats
+        return [
+            counter("listentg_keywords_messages_total", "已分词的消息数", stats.messages),
+            counter("listentg_keywords_term_rows_total", "累加到词频表的行数", stats.term_rows),
+            counter("listentg_keywords_batches_total", "分词批次数", stats.batches),
+            counter("listentg_keywords_pruned_total", "清理的过期和长尾词频行数", stats.pruned),
+            counter("listentg_keywords_segment_seconds_total", "分词耗时（秒）", stats.segment_seconds),
+            gauge("listentg_keywords_last_id", "已分词的最大消息 id", stats.last_id),
+        ]
+
+
+# 创建一个全局的关键词统计实例
+keyword_indexer = KeywordIndexer(
+    workers=settings.keywords_workers,
+    batch_size=settings.keywords_batch_size,
+    interval=settings.keywords_interval_seconds,
+    stopwords_file=settings.keywords_stopwords_file,
+    prune_after_days=settings.keywords_prune_after_days,
+    prune_min_count=settings.keywords_prune_min_count,
+    retention_days=settings.keywords_retention_days,
+)
+registry.register(keyword_indexer.collect_metrics)
+
+
+async def _apply_settings(changed):
+    """热加载后更新批大小、检查间隔和长尾清理参数。"""
+    if changed & {
+        'keywords_batch_size', 'keywords_interval_seconds',
+        'keywords_prune_after_days', 'keywords_prune_min_count', 'keywords_retention_days',
+    }:
+        keyword_indexer.batch_size = settings.keywords_batch_size
+        keyword_indexer.interval = settings.keywords_interval_seconds
+        keyword_indexer.prune_after_days = settings.keywords_prune_after_days
+        keyword_indexer.prune_min_count = settings.keywords_prune_min_count
+        keyword_indexer.retention_days = settings.keywords_retention_days
+        keyword_indexer._pruned_before = None
+        logger.info("关键词统计参数已更新。")
+
+config_reloader.subscribe(_apply_settings)
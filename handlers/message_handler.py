@@ -1,51 +1,81 @@
+import asyncio
 import logging
 from telethon import events
 from tg_client import client_manager
 from utils.config import settings
-from utils.formatter import format_message
 from handlers.database import db_manager
+from handlers.dedup import duplicate_index
+from handlers.forwarder import forward_queue
+from handlers.pipeline import IngestPipeline
+from handlers.read_receipts import ReadReceiptAggregator
+from handlers.rules import RuleEngine
+from utils.entity_cache import entity_cache
+from utils.metrics import registry
+from utils.reload import config_reloader
 
 logger = logging.getLogger(__name__)
 
 # 从 client_manager 获取客户端实例
 client = client_manager.get_client()
-message_queue = client_manager.get_queue()
 
-@client.on(events.NewMessage())
+# 创建全局的已读回执聚合器和消息处理流水线实例
+read_receipts = ReadReceiptAggregator(
+    client,
+    interval=settings.read_receipts_interval_seconds,
+    max_pending_chats=settings.read_receipts_max_pending_chats,
+    exclude_chat_ids=settings.read_receipts_exclude_chat_ids,
+) if settings.read_receipts_enabled else None
+pipeline = IngestPipeline(
+    db_manager,
+    forward_queue,
+    entity_cache,
+    rules=RuleEngine(settings.rules, default_target=settings.target_group),
+    stage_settings=settings.pipeline_stages,
+    read_receipts=read_receipts,
+    dedup=duplicate_index if settings.dedup_enabled else None,
+)
+registry.register(pipeline.collect_metrics)
+
+async def _apply_settings(changed):
+    """
+    热加载后重建过滤规则并更新已读回执参数。
+
+    规则在线程池中编译，编译期间流水线继续使用旧规则，编译完成后一次性替换。
+    """
+    if changed & {'rules', 'target_group'}:
+        pipeline.rules = await asyncio.to_thread(RuleEngine, settings.rules, settings.target_group)
+    if read_receipts and changed & {
+        'read_receipts_interval_seconds', 'read_receipts_max_pending_chats', 'read_receipts_exclude_chat_ids',
+    }:
+        read_receipts.interval = settings.read_receipts_interval_seconds
+        read_receipts.max_pending_chats = settings.read_receipts_max_pending_chats
+        read_receipts.exclude_chat_ids = settings.read_receipts_exclude_chat_ids
+
+config_reloader.subscribe(_apply_settings)
+
+# 分配给 [session.<名称>] 会话进程的会话，由这些进程监听，主账号不再处理（见 handlers.sessions）
+sharded_chat_ids = {chat_id for options in settings.sessions.values() for chat_id in options['chats']}
+
+def _not_sharded(event) -> bool:
+    return event.chat_id not in sharded_chat_ids
+
+@client.on(events.NewMessage(func=_not_sharded if sharded_chat_ids else None))
 async def new_message_handler(event: events.NewMessage.Event):
     """
     处理新消息事件。
 
-    - 标记消息为已读。
-    - 根据配置过滤来自特定群组或发送者的消息。
-    - 将消息存入数据库。
-    - 格式化消息用于日志记录。
-    - 将通过过滤的消息放入转发队列。
+    只把事件交给消息处理流水线，过滤、入库、日志和转发都在流水线的各个阶段中
+    异步完成（见 handlers/pipeline.py），已读回执由聚合器合并后定期发送。
     """
     try:
-        # 第一步：执行原有的逻辑
-        await event.mark_read()
-        
-        chat = await event.get_chat()
-        chat_id = getattr(chat, 'id', event.chat_id)
-        
-        sender = await event.get_sender()
-        sender_id = getattr(sender, 'id', event.sender_id)
-        
-        if chat_id in settings.exclude_chat_ids:
-            logger.info(f"消息来自被排除的群组 {chat_id}，已忽略。")
-            return
-        if sender_id in settings.exclude_sender_ids:
-            logger.info(f"消息来自被排除的用户 {sender_id}，已忽略。")
-            return
-        # 第二步：将消息存入数据库
-        await db_manager.save_message(event)
-        formatted_message = await format_message(event.message)
-        if formatted_message:
-            logger.info(formatted_message)
-
-        await message_queue.put(event)
-        logger.info(f"消息已加入转发队列。当前队列大小: {message_queue.qsize()}")
-
+        await pipeline.submit(event)
     except Exception as e:
-        logger.error(f"处理新消息时发生错误: {e}", exc_info=True) 
\ No newline at end of file
+        logger.error(f"处理新消息时发生错误: {e}", exc_info=True)
+
+
+@client.on(events.ChatAction(func=lambda e: e.new_title is not None))
+async def chat_title_handler(event: events.ChatAction.Event):
+    """
+    群组或频道改名时刷新实体缓存中的标题。
+    """
+    entity_cache.update_chat_title(event.chat_id, event.new_title)
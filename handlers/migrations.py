@@ -0,0 +1,397 @@
+"""
+数据库结构迁移。
+
+每个迁移对应一个递增的版本号，当前版本记录在 SQLite 的 `PRAGMA user_version` 中。
+启动时 `migrate` 会按顺序执行所有尚未应用的迁移，每个迁移在独立的事务中完成，
+失败时回滚，不会留下半升级的数据库。
+
+新增迁移时只需在 MIGRATIONS 末尾追加一项，不要修改已发布的迁移。
+迁移中的建表和数据处理语句都直接写在这里，不调用其他模块的函数：
+那些模块以后的修改不能改变已发布迁移的行为。
+"""
+
+import logging
+import time
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+
+async def _v1_create_messages(conn: aiosqlite.Connection):
+    """创建 messages 表（已存在的旧数据库会跳过）。"""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            chat_type TEXT,
+            chat_title TEXT,
+            sender_id INTEGER,
+            sender_name TEXT,
+            sender_username TEXT,
+            text TEXT,
+            raw_text TEXT,
+            date TIMESTAMP NOT NULL,
+            is_reply BOOLEAN,
+            reply_to_message_id INTEGER
+        )
+    """)
+
+
+async def _v2_add_message_indexes(conn: aiosqlite.Connection):
+    """
+    为仪表盘查询添加覆盖索引。
+
+    - (date, chat_type, chat_title)：按时间范围统计群组排行、按时间倒序搜索。
+    - (date, sender_name)：按时间范围统计用户排行。
+    - (chat_id, message_id)：按会话定位单条消息。
+    """
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_date_chat ON messages (date, chat_type, chat_title)"
+    )
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_date_sender ON messages (date, sender_name)"
+    )
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat_message ON messages (chat_id, message_id)"
+    )
+    await conn.execute("ANALYZE messages")
+
+
+async def _v3_add_fulltext_index(conn: aiosqlite.Connection):
+    """
+    创建 meta 键值表和全文索引表 messages_fts。
+
+    已有的历史消息不会在启动时建立索引（对大库来说太慢），
+    只记录需要回填的 id 上限，由 `python manage.py fts-backfill` 离线完成。
+    """
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+    await conn.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+        "body, content='', tokenize='unicode61 remove_diacritics 2')"
+    )
+    await conn.execute(
+        "INSERT OR REPLACE INTO meta (key, value) "
+        "SELECT 'fts_backfill_upto', COALESCE(MAX(id), 0) FROM messages"
+    )
+    await conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('fts_backfill_done', '0')")
+
+
+async def _v4_add_rollups(conn: aiosqlite.Connection):
+    """
+    创建按小时预聚合的统计表，并用已有消息完成初始聚合。
+
+    这一版的会话和发送者统计按名字分组，v8 改为按整数 id 分组。
+    """
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS rollup_hourly (
+            bucket TEXT PRIMARY KEY,
+            message_count INTEGER NOT NULL
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS rollup_chat_hourly (
+            bucket TEXT NOT NULL,
+            chat_type TEXT NOT NULL,
+            chat_title TEXT NOT NULL,
+            message_count INTEGER NOT NULL,
+            PRIMARY KEY (bucket, chat_type, chat_title)
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS rollup_sender_hourly (
+            bucket TEXT NOT NULL,
+            sender_name TEXT NOT NULL,
+            message_count INTEGER NOT NULL,
+            PRIMARY KEY (bucket, sender_name)
+        )
+    """)
+    await conn.execute("""
+        INSERT INTO rollup_hourly
+        SELECT STRFTIME('%Y-%m-%d %H:00:00', date) AS b, COUNT(*) FROM messages GROUP BY b
+    """)
+    await conn.execute("""
+        INSERT INTO rollup_chat_hourly
+        SELECT STRFTIME('%Y-%m-%d %H:00:00', date) AS b,
+               COALESCE(chat_type, '') AS t, COALESCE(chat_title, '') AS c, COUNT(*)
+        FROM messages GROUP BY b, t, c
+    """)
+    await conn.execute("""
+        INSERT INTO rollup_sender_hourly
+        SELECT STRFTIME('%Y-%m-%d %H:00:00', date) AS b, COALESCE(sender_name, 'Unknown') AS s, COUNT(*)
+        FROM messages GROUP BY b, s
+    """)
+
+
+async def _v5_add_forward_queue(conn: aiosqlite.Connection):
+    """
+    创建持久化转发队列 forward_queue。
+
+    每行只记录 (chat_id, message_id, target) 和投递状态，
+    唯一约束保证同一条消息对同一目标只入队一次，已完成的行用于去重。
+    """
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS forward_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            target INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            leased_at REAL,
+            done_at REAL,
+            UNIQUE (chat_id, message_id, target)
+        )
+    """)
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_forward_queue_pending ON forward_queue (leased_at, id) "
+        "WHERE status = 'pending'"
+    )
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_forward_queue_done ON forward_queue (done_at) "
+        "WHERE status != 'pending'"
+    )
+
+
+async def _v6_index_forward_queue_by_target(conn: aiosqlite.Connection):
+    """
+    每个转发目标分别从队列中取消息，待转发消息的索引改为以 target 开头。
+    """
+    await conn.execute("DROP INDEX IF EXISTS idx_forward_queue_pending")
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_forward_queue_target_pending ON forward_queue (target, leased_at, id) "
+        "WHERE status = 'pending'"
+    )
+
+
+async def _v7_add_browse_indexes(conn: aiosqlite.Connection):
+    """
+    为按会话、按发送者浏览消息添加索引。
+
+    索引隐含以 rowid（即 id）结尾，按 (date, id) 的键集分页可以直接沿索引倒序扫描。
+    """
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat_date ON messages (chat_id, date)"
+    )
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_sender_date ON messages (sender_id, date)"
+    )
+    await conn.execute("ANALYZE messages")
+
+
+async def _v8_normalize_chats_and_users(conn: aiosqlite.Connection):
+    """
+    把会话和发送者的元数据移到维度表 chats / users（见 handlers.dimensions）。
+
+    - 用每个会话、每个发送者最新一条消息中的元数据填充维度表；
+    - 按字符串建立的索引改为 (date) 索引，会话和发送者的预聚合表改为按整数 id 分组；
+    - 已有行中的字符串列不在这里修改（对大库来说太慢），只记录需要处理的 id 上限，
+      由 `python manage.py normalize` 分块置为 NULL；
+    - 预聚合表只能从主库重新聚合，启动时如果存在归档分区，会再完整重建一次（见 DatabaseManager.init_db）。
+    """
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id INTEGER PRIMARY KEY,
+            chat_type TEXT,
+            chat_title TEXT,
+            updated_at TIMESTAMP
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            sender_id INTEGER PRIMARY KEY,
+            sender_name TEXT,
+            sender_username TEXT,
+            updated_at TIMESTAMP
+        )
+    """)
+    await conn.execute("""
+        INSERT OR REPLACE INTO chats (chat_id, chat_type, chat_title, updated_at)
+        SELECT chat_id, chat_type, chat_title, date FROM messages
+        WHERE id IN (SELECT MAX(id) FROM messages GROUP BY chat_id)
+    """)
+    await conn.execute("""
+        INSERT OR REPLACE INTO users (sender_id, sender_name, sender_username, updated_at)
+        SELECT sender_id, sender_name, sender_username, date FROM messages
+        WHERE id IN (SELECT MAX(id) FROM messages WHERE sender_id IS NOT NULL GROUP BY sender_id)
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_date ON messages (date)")
+    await conn.execute("DROP INDEX IF EXISTS idx_messages_date_chat")
+    await conn.execute("DROP INDEX IF EXISTS idx_messages_date_sender")
+    await conn.execute("DROP TABLE IF EXISTS rollup_chat_hourly")
+    await conn.execute("DROP TABLE IF EXISTS rollup_sender_hourly")
+    await conn.execute("""
+        CREATE TABLE rollup_chat_hourly (
+            bucket TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            PRIMARY KEY (bucket, chat_id)
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE rollup_sender_hourly (
+            bucket TEXT NOT NULL,
+            sender_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            PRIMARY KEY (bucket, sender_id)
+        )
+    """)
+    await conn.execute("""
+        INSERT INTO rollup_chat_hourly
+        SELECT STRFTIME('%Y-%m-%d %H:00:00', date) AS b, chat_id, COUNT(*) FROM messages GROUP BY b, chat_id
+    """)
+    await conn.execute("""
+        INSERT INTO rollup_sender_hourly
+        SELECT STRFTIME('%Y-%m-%d %H:00:00', date) AS b, COALESCE(sender_id, 0) AS s, COUNT(*)
+        FROM messages GROUP BY b, s
+    """)
+    await conn.execute(
+        "INSERT OR REPLACE INTO meta (key, value) "
+        "SELECT 'normalize_upto', COALESCE(MAX(id), 0) FROM messages"
+    )
+    await conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('normalize_done', '0')")
+    await conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rollup_rebuild_pending', '1')")
+    await conn.execute("ANALYZE messages")
+
+
+async def _v9_unique_chat_message(conn: aiosqlite.Connection):
+    """
+    同一会话的同一条消息只保存一次，并创建历史回填的进度表 backfill_checkpoints。
+
+    把 (chat_id, message_id) 索引改为唯一索引，写入时用 INSERT OR IGNORE 去重。
+    迁移不会删除用户数据：已有重复行时直接失败，需要先运行 `python manage.py dedupe`
+    （重复的行会先备份到 messages_duplicates_backup 表）。
+    """
+    async with conn.execute(
+        "SELECT COUNT(*) FROM (SELECT 1 FROM messages GROUP BY chat_id, message_id HAVING COUNT(*) > 1)"
+    ) as cursor:
+        duplicates = (await cursor.fetchone())[0]
+    if duplicates:
+        raise RuntimeError(
+            f"messages 表中有 {duplicates} 组重复的 (chat_id, message_id)，无法创建唯一索引。"
+            "请先运行 `python manage.py dedupe`（重复的行会备份到 messages_duplicates_backup 表）后再启动。"
+        )
+    await conn.execute("DROP INDEX IF EXISTS idx_messages_chat_message")
+    await conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_chat_message_unique ON messages (chat_id, message_id)"
+    )
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+            chat_id INTEGER PRIMARY KEY,
+            done_upto INTEGER NOT NULL DEFAULT 0,
+            pass_top INTEGER,
+            pass_cursor INTEGER,
+            imported INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL
+        )
+    """)
+
+
+async def _v10_add_term_hourly(conn: aiosqlite.Connection):
+    """
+    创建按小时的词频表 term_hourly（见 handlers.keywords）。
+
+    只为最近 7 天的消息补算词频（作为热词的基线），更早的消息不再分词。
+    """
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS term_hourly (
+            bucket TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            term TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (bucket, chat_id, term)
+        ) WITHOUT ROWID
+    """)
+    await conn.execute(
+        "INSERT OR REPLACE INTO meta (key, value) "
+        "SELECT 'keywords_done', COALESCE((SELECT MIN(id) - 1 FROM messages WHERE date >= DATETIME('now', '-7 days')), "
+        "(SELECT MAX(id) FROM messages), 0)"
+    )
+
+
+async def _v11_add_message_duplicates(conn: aiosqlite.Connection):
+    """创建重复消息表 message_duplicates（见 handlers.dedup）：每条重复消息对应的原始消息。"""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS message_duplicates (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            original_chat_id INTEGER NOT NULL,
+            original_message_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            distance INTEGER NOT NULL,
+            date TIMESTAMP,
+            PRIMARY KEY (chat_id, message_id)
+        ) WITHOUT ROWID
+    """)
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_message_duplicates_original "
+        "ON message_duplicates (original_chat_id, original_message_id)"
+    )
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_message_duplicates_date ON message_duplicates (date)")
+
+
+# (版本号, 描述, 迁移函数)
+MIGRATIONS: List[Tuple[int, str, Callable[[aiosqlite.Connection], Awaitable[None]]]] = [
+    (1, "创建 messages 表", _v1_create_messages),
+    (2, "为 messages 添加查询索引", _v2_add_message_indexes),
+    (3, "创建全文索引表 messages_fts", _v3_add_fulltext_index),
+    (4, "创建按小时预聚合的统计表", _v4_add_rollups),
+    (5, "创建持久化转发队列 forward_queue", _v5_add_forward_queue),
+    (6, "按转发目标索引待转发消息", _v6_index_forward_queue_by_target),
+    (7, "为按会话、按发送者浏览消息添加索引", _v7_add_browse_indexes),
+    (8, "把会话和发送者的元数据移到维度表", _v8_normalize_chats_and_users),
+    (9, "按 (chat_id, message_id) 去重并创建历史回填进度表", _v9_unique_chat_message),
+    (10, "创建按小时的词频表 term_hourly", _v10_add_term_hourly),
+    (11, "创建重复消息表 message_duplicates", _v11_add_message_duplicates),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+async def get_version(conn: aiosqlite.Connection) -> int:
+    """读取数据库当前的结构版本。"""
+    async with conn.execute("PRAGMA user_version") as cursor:
+        row = await cursor.fetchone()
+    return row[0]
+
+
+async def migrate(conn: aiosqlite.Connection, target_version: Optional[int] = None) -> int:
+    """
+    把数据库升级到 target_version（默认为最新版本）。
+
+    :param conn: 一个可写的数据库连接，调用时不能处于未提交的事务中。
+    :param target_version: 目标版本，None 表示最新版本。
+    :return: 升级后的版本号。
+    """
+    target = LATEST_VERSION if target_version is None else target_version
+    current = await get_version(conn)
+    if current > LATEST_VERSION:
+        logger.warning(f"数据库版本 v{current} 高于程序支持的 v{LATEST_VERSION}，跳过迁移。")
+        return current
+
+    for version, description, func in MIGRATIONS:
+        if version <= current or version > target:
+            continue
+        logger.info(f"正在执行数据库迁移 v{version}: {description} ...")
+        start = time.perf_counter()
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            await func(conn)
+            await conn.execute(f"PRAGMA user_version = {version}")
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            logger.error(f"数据库迁移 v{version} 失败，已回滚。")
+            raise
+        current = version
+        logger.info(f"数据库迁移 v{version} 完成，耗时 {time.perf_counter() - start:.2f} 秒。")
+    return current
@@ -0,0 +1,335 @@
+"""
+消息处理流水线。
+
+Telethon 的事件回调只负责把事件交给流水线，之后的各个步骤在独立的阶段中异步执行，
+阶段之间用有界队列连接，某一步变慢不会拖住其他会话的更新处理：
+
+    filter（规则过滤并解析实体） -> dedup（重复检测） -> persist（入库） -> log（格式化并输出日志）
+                                                                    -> forward（加入转发队列）
+
+已读回执不占用阶段，只在交给流水线时记入 ReadReceiptAggregator，由其合并后定期发送。
+其他会话进程转来的消息（见 handlers.sessions）通过 submit_record 进入同一条流水线。
+
+- 每个阶段有若干个工作协程，同一会话的消息总是交给同一个工作协程，保证会话内的顺序；
+- 队列满时按阶段的策略处理：block 让上游等待（背压），drop 直接丢弃并计数；
+- 每个阶段分别统计排队等待时间和处理耗时的直方图。
+
+dedup 阶段识别在多个会话中重复出现的内容（见 handlers.dedup）：重复的消息照常入库并记录对应的原始消息，
+但不再转发到原始消息已经转发过的目标。
+"""
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from telethon import events
+from handlers.dedup import DuplicateIndex, DuplicateMatch
+from handlers.read_receipts import ReadReceiptAggregator
+from handlers.rules import RuleEngine
+from utils.entity_cache import ChatInfo, EntityCache, SenderInfo
+from utils.formatter import format_message
+from utils.logger import message_log_enabled
+from utils.metrics import Histogram, counter, gauge, histogram
+
+logger = logging.getLogger(__name__)
+
+POLICY_BLOCK = 'block'
+POLICY_DROP = 'drop'
+
+# 工作协程队列中的停止标记
+_STOP = None
+
+
+class MessageContext:
+    """
+    在各阶段之间传递的一条消息及其已解析的信息。
+    """
+    __slots__ = ("event", "chat", "sender", "targets", "duplicate", "received_at", "enqueued_at")
+
+    def __init__(self, event: events.NewMessage.Event):
+        self.event = event
+        self.chat: Optional[ChatInfo] = None
+        self.sender: Optional[SenderInfo] = None
+        # 规则引擎决定的转发目标
+        self.targets: List[int] = []
+        # 重复消息对应的原始消息，不是重复消息时为 None
+        self.duplicate: Optional[DuplicateMatch] = None
+        self.received_at = time.perf_counter()
+        self.enqueued_at = self.received_at
+
+
+class Stage:
+    """
+    流水线中的一个阶段。
+
+    :param name: 阶段名称，用于日志和统计。
+    :param handler: 处理一条消息的协程函数，返回 False 表示不再交给下游阶段。
+    :param workers: 工作协程数量。
+    :param queue_size: 每个工作协程的队列上限。
+    :param policy: 队列满时的策略，'block' 或 'drop'。
+    """
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[MessageContext], Awaitable[Optional[bool]]],
+        workers: int = 1,
+        queue_size: int = 1000,
+        policy: str = POLICY_BLOCK,
+    ):
+        self.name = name
+        self.handler = handler
+        self.policy = policy
+        self.downstream: List["Stage"] = []
+        self._queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._tasks: List[asyncio.Task] = []
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.wait_ms = Histogram()
+        self.latency_ms = Histogram()
+
+    def then(self, *stages: "Stage") -> "Stage":
+        """把处理完的消息交给一个或多个下游阶段，返回自身以便链式调用。"""
+        self.downstream.extend(stages)
+        return self
+
+    async def submit(self, ctx: MessageContext) -> bool:
+        """
+        把消息放入对应工作协程的队列。
+
+        :return: 是否成功入队（drop 策略下队列已满时为 False）。
+        """
+        queue = self._queues[hash(ctx.event.chat_id) % len(self._queues)]
+        ctx.enqueued_at = time.perf_counter()
+        if self.policy == POLICY_DROP:
+            try:
+                queue.put_nowait(ctx)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                logger.debug("阶段 %s 队列已满，丢弃消息 (ID: %s)。", self.name, ctx.event.message.id)
+                return False
+            return True
+        await queue.put(ctx)
+        return True
+
+    def start(self):
+        """启动工作协程。"""
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+
+    async def stop(self):
+        """处理完队列中已有的消息后停止工作协程。"""
+        for queue in self._queues:
+            await queue.put(_STOP)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def depth(self) -> int:
+        """返回各工作协程队列中等待处理的消息总数。"""
+        return sum(queue.qsize() for queue in self._queues)
+
+    async def _worker(self, queue: asyncio.Queue):
+        """依次处理队列中的消息，并交给下游阶段。"""
+        while True:
+            ctx = await queue.get()
+            if ctx is _STOP:
+                return
+            start = time.perf_counter()
+            self.wait_ms.observe((start - ctx.enqueued_at) * 1000)
+            try:
+                result = await self.handler(ctx)
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"阶段 {self.name} 处理消息时发生错误: {e}", exc_info=True)
+                continue
+            finally:
+                self.latency_ms.observe((time.perf_counter() - start) * 1000)
+            self.processed += 1
+            if result is False:
+                continue
+            for stage in self.downstream:
+                await stage.submit(ctx)
+
+    def stats(self) -> dict:
+        """返回本阶段的计数和延迟分布（毫秒）。"""
+        return {
+            "depth": self.depth(),
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "wait_ms": self.wait_ms.snapshot(),
+            "latency_ms": self.latency_ms.snapshot(),
+        }
+
+
+class IngestPipeline:
+    """
+    新消息的处理流水线：过滤、入库、日志和转发，并记录已读回执。
+
+    :param db: 用于保存消息的 DatabaseManager。
+    :param forward_queue: 持久化转发队列。
+    :param cache: 实体缓存。
+    :param rules: 过滤规则引擎，决定消息是否入库以及转发到哪些目标。
+    :param stage_settings: 阶段名称 -> (workers, queue_size, policy)。
+    :param read_receipts: 已读回执聚合器，None 表示不发送已读回执。
+    :param dedup: 重复消息索引，None 表示不做重复检测。
+    """
+    def __init__(
+        self,
+        db,
+        forward_queue,
+        cache: EntityCache,
+        rules: RuleEngine,
+        stage_settings: Dict[str, tuple],
+        read_receipts: Optional[ReadReceiptAggregator] = None,
+        dedup: Optional[DuplicateIndex] = None,
+    ):
+        self.db = db
+        self.forward_queue = forward_queue
+        self.cache = cache
+        self.rules = rules
+        self.read_receipts = read_receipts
+        self.dedup = dedup
+        self.received = 0
+        self.excluded = 0
+        self.suppressed_forwards = 0
+
+        def stage(name, handler):
+            workers, queue_size, policy = stage_settings[name]
+            return Stage(name, handler, workers=workers, queue_size=queue_size, policy=policy)
+
+        self.filter = stage('filter', self._filter)
+        self.dedup_stage = stage('dedup', self._dedup)
+        self.persist = stage('persist', self._persist)
+        self.log = stage('log', self._log)
+        self.forward = stage('forward', self._forward)
+        self.filter.then(self.dedup_stage)
+        self.dedup_stage.then(self.persist)
+        self.persist.then(self.log, self.forward)
+        # 按停止顺序排列：上游先停，保证下游能处理完上游交来的消息
+        self.stages: List[Stage] = [self.filter, self.dedup_stage, self.persist, self.log, self.forward]
+
+    async def submit(self, event: events.NewMessage.Event):
+        """Telethon 回调的入口：只把事件交给流水线，不做其他处理。"""
+        self.received += 1
+        if self.read_receipts:
+            self.read_receipts.mark(event)
+        await self.filter.submit(MessageContext(event))
+
+    async def submit_record(self, event, chat: ChatInfo, sender: Optional[SenderInfo]):
+        """
+        接收会话进程转来的消息（见 handlers.sessions）：
+        会话和发送者信息已在该进程中解析，已读回执也由该进程发送。
+        """
+        self.received += 1
+        ctx = MessageContext(event)
+        ctx.chat, ctx.sender = chat, sender
+        await self.filter.submit(ctx)
+
+    def start(self):
+        """启动所有阶段。"""
+        for stage in self.stages:
+            stage.start()
+        if self.read_receipts:
+            self.read_receipts.start()
+        logger.info("消息处理流水线已启动。")
+
+    async def stop(self):
+        """依次停止各阶段，确保已接收的消息都处理完毕。"""
+        for stage in self.stages:
+            await stage.stop()
+        if self.read_receipts:
+            await self.read_receipts.stop()
+        logger.info(f"消息处理流水线已停止。统计: {self.stats()}")
+
+    def stats(self) -> dict:
+        """返回各阶段的统计。"""
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def collect_metrics(self) -> list:
+        """导出收到和被排除的消息数、各阶段的计数和延迟分布，以及已读回执的统计。"""
+        samples = [
+            counter("listentg_messages_received_total", "收到的新消息数", self.received),
+            counter("listentg_messages_excluded_total", "被过滤规则排除的消息数", self.excluded),
+            counter("listentg_forwards_suppressed_total", "因重复而未转发的消息数（按目标计）", self.suppressed_forwards),
+        ]
+        for stage in self.stages:
+            samples += [
+                counter("listentg_pipeline_processed_total", "阶段处理完成的消息数", stage.processed, stage=stage.name),
+                counter("listentg_pipeline_dropped_total", "阶段队列已满而丢弃的消息数", stage.dropped, stage=stage.name),
+                counter("listentg_pipeline_errors_total", "阶段处理出错的消息数", stage.errors, stage=stage.name),
+                gauge("listentg_pipeline_queue_depth", "阶段队列中等待处理的消息数", stage.depth(), stage=stage.name),
+                histogram("listentg_pipeline_wait_seconds", "消息在阶段队列中的等待时间", stage.wait_ms, scale=0.001, stage=stage.name),
+                histogram("listentg_pipeline_latency_seconds", "阶段处理一条消息的耗时", stage.latency_ms, scale=0.001, stage=stage.name),
+            ]
+        if self.read_receipts:
+            stats = self.read_receipts.stats()
+            samples += [
+                counter("listentg_read_receipts_marked_total", "记入已读回执的消息数", stats["marked"]),
+                counter("listentg_read_receipts_requests_total", "实际发送的已读回执请求数", stats["requests"]),
+                counter("listentg_read_receipts_errors_total", "发送已读回执失败次数", stats["errors"]),
+                gauge("listentg_read_receipts_pending_chats", "等待发送已读回执的会话数", stats["pending_chats"]),
+            ]
+        return samples
+
+    async def report_loop(self, interval: float = 60.0):
+        """定期输出各阶段的队列深度和延迟分位数。"""
+        while True:
+            await asyncio.sleep(interval)
+            summary = ", ".join(
+                f"{stage.name}: 深度 {stage.depth()} 丢弃 {stage.dropped} "
+                f"p50 {stage.latency_ms.percentile(0.5)}ms p99 {stage.latency_ms.percentile(0.99)}ms"
+                for stage in self.stages
+            )
+            logger.info(f"流水线统计: {summary}")
+            if self.read_receipts:
+                logger.info(f"已读回执统计: {self.read_receipts.stats()}")
+
+    async def _filter(self, ctx: MessageContext) -> bool:
+        """
+        先用规则引擎判断是否排除（只依赖消息自带的信息），
+        未被排除的消息再解析会话和发送者信息（会话进程转来的消息已经解析过）。
+        """
+        decision = self.rules.evaluate(ctx.event)
+        if decision.excluded:
+            self.excluded += 1
+            if message_log_enabled(logger):
+                logger.info(f"消息 (ID: {ctx.event.message.id}) 被规则 {', '.join(decision.rules)} 排除，已忽略。")
+            return False
+        ctx.targets = decision.targets
+        if ctx.chat is None:
+            ctx.chat, ctx.sender = await self.cache.resolve(ctx.event)
+        return True
+
+    async def _dedup(self, ctx: MessageContext):
+        """检查消息是否与最近在任意会话中出现过的内容重复。"""
+        if self.dedup is None:
+            return
+        message = ctx.event.message
+        ctx.duplicate = self.dedup.check(message.raw_text, ctx.event.chat_id, message.id, ctx.targets)
+        if ctx.duplicate is not None:
+            logger.debug(
+                "消息 (ID: %s) 与会话 %s 的消息 %s 重复 (%s, 距离 %s)。",
+                message.id, ctx.duplicate.chat_id, ctx.duplicate.message_id, ctx.duplicate.kind, ctx.duplicate.distance,
+            )
+
+    async def _persist(self, ctx: MessageContext):
+        """将消息存入数据库，重复消息同时记录对应的原始消息。"""
+        await self.db.save_message(ctx.event, ctx.chat, ctx.sender, ctx.duplicate)
+
+    async def _log(self, ctx: MessageContext):
+        """格式化消息并输出日志；日志级别未启用或被采样省略时不做格式化。"""
+        if not message_log_enabled(logger):
+            return
+        formatted_message = await format_message(ctx.event.message, ctx.chat, ctx.sender)
+        if formatted_message:
+            logger.info(formatted_message)
+
+    async def _forward(self, ctx: MessageContext):
+        """将消息加入持久化转发队列，每个目标一条；重复的消息不再转发到原始消息已经转发过的目标。"""
+        for target in ctx.targets:
+            if ctx.duplicate is not None and target in ctx.duplicate.forwarded:
+                self.suppressed_forwards += 1
+                continue
+            await self.forward_queue.put(ctx.event.chat_id, ctx.event.message.id, target)
@@ -0,0 +1,136 @@
+"""
+合并发送的已读回执。
+
+每条消息调用一次 event.mark_read() 意味着每条消息一次 API 往返，在活跃群组中
+很容易触发 FloodWait。这里只在内存中记下每个会话中最大的消息 id，
+由后台任务每隔 interval 秒为每个有新消息的会话发送一次 ReadHistoryRequest。
+"""
+
+import asyncio
+import logging
+from typing import Dict, Optional, Set
+
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError
+from telethon.utils import resolve_id
+
+logger = logging.getLogger(__name__)
+
+
+class ReadReceiptAggregator:
+    """
+    已读回执聚合器。
+
+    :param client: Telegram 客户端。
+    :param interval: 两次发送之间的间隔（秒）。
+    :param max_pending_chats: 等待发送的会话数上限，超过后提前发送，仍放不下的回执被丢弃。
+    :param exclude_chat_ids: 不发送已读回执的会话（带或不带 -100 前缀的 id 均可）。
+    """
+    def __init__(
+        self,
+        client: TelegramClient,
+        interval: float = 5.0,
+        max_pending_chats: int = 10000,
+        exclude_chat_ids: Optional[Set[int]] = None,
+    ):
+        self.client = client
+        self.interval = interval
+        self.max_pending_chats = max_pending_chats
+        self.exclude_chat_ids = exclude_chat_ids or set()
+        # 会话 id（event.chat_id）-> 待标记为已读的最大消息 id
+        self._pending: Dict[int, int] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.marked = 0
+        self.requests = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def mark(self, event) -> bool:
+        """
+        记录一条需要标记为已读的消息，不发起任何请求。
+
+        :return: 是否被记录（被排除的会话或缓冲区已满时为 False）。
+        """
+        chat_id = event.chat_id
+        if chat_id in self.exclude_chat_ids or resolve_id(chat_id)[0] in self.exclude_chat_ids:
+            return False
+        message_id = event.message.id
+        current = self._pending.get(chat_id)
+        if current is None:
+            if len(self._pending) >= self.max_pending_chats:
+                self.dropped += 1
+                self._wakeup.set()
+                return False
+            self._pending[chat_id] = message_id
+            if len(self._pending) >= self.max_pending_chats:
+                self._wakeup.set()
+        elif message_id > current:
+            self._pending[chat_id] = message_id
+        self.marked += 1
+        return True
+
+    def start(self):
+        """启动后台发送任务。"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"已读回执聚合器已启动，每 {self.interval} 秒发送一次。")
+
+    async def stop(self):
+        """停止后台任务，并发送剩余的已读回执。"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        logger.info(f"已读回执聚合器已停止。统计: {self.stats()}")
+
+    async def flush(self) -> int:
+        """
+        为每个有新消息的会话发送一次已读回执。
+
+        :return: 触发 FloodWait 时 Telegram 要求等待的秒数，否则为 0。
+        """
+        pending = list(self._pending.items())
+        self._pending = {}
+        for i, (chat_id, max_id) in enumerate(pending):
+            try:
+                entity = await self.client.get_input_entity(chat_id)
+                await self.client.send_read_acknowledge(entity, max_id=max_id, clear_mentions=False)
+                self.requests += 1
+            except FloodWaitError as e:
+                # 把未发送的回执放回去，等待 Telegram 要求的时间后再发送
+                for rest_id, rest_max in pending[i:]:
+                    if self._pending.get(rest_id, 0) < rest_max:
+                        self._pending[rest_id] = rest_max
+                logger.warning(f"发送已读回执触发 FloodWait，暂停 {e.seconds} 秒。")
+                return e.seconds
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"为会话 {chat_id} 发送已读回执失败: {e}")
+        return 0
+
+    def stats(self) -> dict:
+        """返回计数统计；marked 与 requests 之比即合并率。"""
+        return {
+            "pending_chats": len(self._pending),
+            "marked": self.marked,
+            "requests": self.requests,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+    async def _run(self):
+        """每隔 interval 秒（或待发送的会话数达到上限时）发送一次。"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                flood_wait = await self.flush()
+            except Exception as e:
+                logger.error(f"发送已读回执时发生错误: {e}", exc_info=True)
+                continue
+            if flood_wait:
+                await asyncio.sleep(flood_wait)
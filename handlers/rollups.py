@@ -0,0 +1,167 @@
+"""
+仪表盘统计用的按小时预聚合表（rollup）。
+
+- rollup_hourly：每小时的消息总数。
+- rollup_chat_hourly：每小时、每个会话（chat_id）的消息数。
+- rollup_sender_hourly：每小时、每个发送者（sender_id，未知发送者为 0）的消息数。
+
+会话和发送者按整数 id 分组，名字在查询前 N 名时再从维度表（见 handlers.dimensions）中取出。
+
+小时桶 bucket 的格式为 'YYYY-MM-DD HH:00:00'，与 messages.date 一样按 UTC 存储。
+北京时间与 UTC 相差整 8 小时，每个 UTC 小时桶恰好对应一个北京时间小时桶，
+展示时用 STRFTIME(..., '+8 hours') 换算即可。
+
+写入器每提交一批消息，就在同一个事务中把这批新行累加到各个预聚合表，
+仪表盘查询只需扫描时间窗口内的桶，耗时与消息总量无关。
+"""
+
+import logging
+from datetime import datetime
+from typing import Iterable
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+BUCKET_FORMAT = '%Y-%m-%d %H:00:00'
+
+# 预聚合表名 -> (建表语句, 从 messages 聚合的 SELECT 语句, 主键列)
+# SELECT 语句中的 {where} 会被替换为行范围条件，{sign} 为 '-' 时从预聚合表中扣除
+ROLLUP_TABLES = {
+    "rollup_hourly": (
+        """
+        CREATE TABLE IF NOT EXISTS {table} (
+            bucket TEXT PRIMARY KEY,
+            message_count INTEGER NOT NULL
+        )
+        """,
+        """
+        SELECT STRFTIME('%Y-%m-%d %H:00:00', date) AS b, {sign}COUNT(*)
+        FROM {source} WHERE {where}
+        GROUP BY b
+        """,
+        "bucket",
+    ),
+    "rollup_chat_hourly": (
+        """
+        CREATE TABLE IF NOT EXISTS {table} (
+            bucket TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            PRIMARY KEY (bucket, chat_id)
+        )
+        """,
+        """
+        SELECT STRFTIME('%Y-%m-%d %H:00:00', date) AS b, chat_id, {sign}COUNT(*)
+        FROM {source} WHERE {where}
+        GROUP BY b, chat_id
+        """,
+        "bucket, chat_id",
+    ),
+    "rollup_sender_hourly": (
+        """
+        CREATE TABLE IF NOT EXISTS {table} (
+            bucket TEXT NOT NULL,
+            sender_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            PRIMARY KEY (bucket, sender_id)
+        )
+        """,
+        """
+        SELECT STRFTIME('%Y-%m-%d %H:00:00', date) AS b, COALESCE(sender_id, 0) AS s, {sign}COUNT(*)
+        FROM {source} WHERE {where}
+        GROUP BY b, s
+        """,
+        "bucket, sender_id",
+    ),
+}
+
+
+def bucket_of(dt: datetime) -> str:
+    """返回时间所在的小时桶（传入的时间需为 UTC）。"""
+    return dt.strftime(BUCKET_FORMAT)
+
+
+async def create_tables(conn: aiosqlite.Connection, suffix: str = ""):
+    """创建预聚合表；suffix 用于重建时创建影子表。"""
+    for table, (create_sql, _, _) in ROLLUP_TABLES.items():
+        await conn.execute(create_sql.format(table=table + suffix))
+
+
+async def _accumulate(
+    conn: aiosqlite.Connection, where: str, params: tuple, suffix: str = "", source: str = "messages",
+    tables: Iterable[str] = tuple(ROLLUP_TABLES), sign: str = "",
+):
+    """把 source（默认为主库的 messages）中满足条件的行累加到（sign 为 '-' 时从中扣除）预聚合表（默认为全部预聚合表）。"""
+    for table in tables:
+        _, select_sql, key = ROLLUP_TABLES[table]
+        await conn.execute(
+            f"INSERT INTO {table + suffix} "
+            f"{select_sql.format(where=where, source=source, sign=sign)} "
+            f"ON CONFLICT ({key}) DO UPDATE SET message_count = message_count + excluded.message_count",
+            params,
+        )
+
+
+async def apply_new_messages(conn: aiosqlite.Connection, after_id: int):
+    """
+    把 id 大于 after_id 的新消息累加到预聚合表。
+
+    由写入器在插入消息的同一个事务中调用。
+    """
+    await _accumulate(conn, "id > ?", (after_id,))
+
+
+async def remove_messages(conn: aiosqlite.Connection, where: str, params: tuple):
+    """在删除 messages 中满足条件的行之前，从预聚合表中扣除它们的计数。"""
+    await _accumulate(conn, where, params, sign="-")
+    for table in ROLLUP_TABLES:
+        await conn.execute(f"DELETE FROM {table} WHERE message_count <= 0")
+
+
+async def rebuild(conn: aiosqlite.Connection, chunk_size: int = 500000, archives: Iterable[str] = ()):
+    """
+    根据全部历史消息重新计算预聚合表。
+
+    先把各个归档文件（archives，见 handlers.archive）中的消息聚合到影子表，
+    再分块把主库中截至开始时刻的消息聚合到影子表（每块单独提交，不会长时间阻塞写入器），
+    最后在一个短事务中补上期间新写入的消息，并用影子表替换正式表。
+    """
+    suffix = "_rebuild"
+    for table in ROLLUP_TABLES:
+        await conn.execute(f"DROP TABLE IF EXISTS {table + suffix}")
+    await create_tables(conn, suffix)
+    await conn.commit()
+
+    for path in archives:
+        await conn.execute("ATTACH DATABASE ? AS rollup_source", (path,))
+        try:
+            await _accumulate(conn, "1", (), suffix, source="rollup_source.messages")
+            await conn.commit()
+        finally:
+            await conn.execute("DETACH DATABASE rollup_source")
+        logger.info(f"已聚合归档文件 {path}。")
+
+    async with conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages") as cursor:
+        upto = (await cursor.fetchone())[0]
+    logger.info(f"开始重建预聚合表：消息 id 1 ~ {upto}，每批 {chunk_size} 条。")
+
+    done = 0
+    while done < upto:
+        end = min(done + chunk_size, upto)
+        await _accumulate(conn, "id > ? AND id <= ?", (done, end), suffix)
+        await conn.commit()
+        done = end
+        logger.info(f"预聚合表重建进度: {done}/{upto}")
+
+    await conn.execute("BEGIN IMMEDIATE")
+    try:
+        await _accumulate(conn, "id > ?", (upto,), suffix)
+        for table in ROLLUP_TABLES:
+            await conn.execute(f"DROP TABLE IF EXISTS {table}")
+            await conn.execute(f"ALTER TABLE {table + suffix} RENAME TO {table}")
+        await conn.commit()
+    except Exception:
+        await conn.rollback()
+        raise
+    logger.info("预聚合表重建完成。")
@@ -0,0 +1,249 @@
+"""
+过滤规则引擎。
+
+规则定义来自 config.ini 中的 [rule.<名称>] 小节（见 utils.config.Config._load_rules）。
+启动时把所有规则编译为：
+
+- 会话、发送者、转发来源 id 和消息类型的哈希索引（值 -> 规则编号）；
+- 所有关键词合并成的一个 Aho-Corasick 自动机，一次扫描正文即可找出全部命中的关键词；
+- 每个正则单独编译（不合并成一个表达式，(?i) 这样的全局标志只能出现在各自的表达式开头），
+  只对其他条件都已满足的规则执行。
+
+匹配时只用消息自带的 id、正文和媒体信息，不需要 get_chat / get_sender，
+因此被排除的消息在解析实体之前就会被丢弃。
+id 一律按 Telethon 带类型标记的写法比较（用户为正数，普通群组为负数，频道和超级群组带 -100 前缀），
+不同类型的实体即使数字相同也不会混淆。
+每条规则记录自己有几个条件，各索引命中时为规则计数，计数等于条件数即为匹配，
+耗时只与命中的规则数有关，而不是规则总数。
+"""
+
+import logging
+import re
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set
+
+from telethon.utils import get_peer_id
+
+logger = logging.getLogger(__name__)
+
+ACTION_INCLUDE = 'include'
+ACTION_EXCLUDE = 'exclude'
+
+
+def media_kind(message) -> str:
+    """返回消息的类型，取值见 utils.config.MEDIA_KINDS。"""
+    if not message.media:
+        return 'text'
+    if message.sticker:
+        return 'sticker'
+    if message.photo:
+        return 'photo'
+    if message.video:
+        return 'video'
+    if message.voice:
+        return 'voice'
+    if message.audio:
+        return 'audio'
+    if message.document:
+        return 'document'
+    return 'other'
+
+
+def forward_source(message) -> Optional[int]:
+    """返回转发消息的原始来源 id（带类型标记），不是转发消息时返回 None。"""
+    fwd_from = message.fwd_from
+    if fwd_from is None or fwd_from.from_id is None:
+        return None
+    return get_peer_id(fwd_from.from_id)
+
+
+class KeywordAutomaton:
+    """
+    多关键词匹配的 Aho-Corasick 自动机。
+
+    关键词需已转为小写，search 返回正文中出现过的关键词编号。
+    """
+    def __init__(self, keywords: List[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+        for index, keyword in enumerate(keywords):
+            state = 0
+            for ch in keyword:
+                next_state = self._goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][ch] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = next_state
+            self._out[state].append(index)
+
+        # 按广度优先顺序计算失败指针，并把失败状态的输出合并进来
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(ch, 0)
+                self._out[next_state] = self._out[next_state] + self._out[self._fail[next_state]]
+
+    def search(self, text: str) -> Set[int]:
+        """返回 text 中出现的所有关键词编号。"""
+        goto, fail, out = self._goto, self._fail, self._out
+        found: Set[int] = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class Rule:
+    """
+    一条编译后的规则。
+    """
+    __slots__ = ("name", "action", "targets", "conditions", "regexes")
+
+    def __init__(self, definition: dict):
+        self.name: str = definition['name']
+        self.action: str = definition['action']
+        self.targets: List[int] = list(definition['targets'])
+        self.regexes: List[re.Pattern] = [re.compile(pattern) for pattern in definition['regexes']]
+        # 需要满足的条件数
+        self.conditions = sum(
+            1 for key in ('chat_ids', 'sender_ids', 'forward_from', 'keywords', 'media') if definition[key]
+        ) + (1 if self.regexes else 0)
+
+
+class Decision:
+    """
+    一条消息的规则匹配结果。
+
+    :param excluded: 是否被 exclude 规则排除（不入库也不转发）。
+    :param targets: 需要转发到的目标，为空表示只入库不转发。
+    :param rules: 匹配到的规则名称。
+    """
+    __slots__ = ("excluded", "targets", "rules")
+
+    def __init__(self, excluded: bool, targets: List[int], rules: List[str]):
+        self.excluded = excluded
+        self.targets = targets
+        self.rules = rules
+
+
+class RuleEngine:
+    """
+    编译后的规则集合。
+
+    :param definitions: 规则定义列表（settings.rules）。
+    :param default_target: include 规则没有指定 targets、或没有任何 include 规则时的转发目标。
+    """
+    def __init__(self, definitions: Iterable[dict], default_target: int):
+        self.default_target = default_target
+        self.rules: List[Rule] = []
+        self._chat_index: Dict[int, List[int]] = {}
+        self._sender_index: Dict[int, List[int]] = {}
+        self._forward_index: Dict[int, List[int]] = {}
+        self._media_index: Dict[str, List[int]] = {}
+        # 关键词编号 -> 规则编号
+        self._keyword_rules: List[List[int]] = []
+        self._regex_rules: List[int] = []
+        self._unconditional: List[int] = []
+
+        keyword_ids: Dict[str, int] = {}
+        for index, definition in enumerate(definitions):
+            rule = Rule(definition)
+            self.rules.append(rule)
+            for peer_id in definition['chat_ids']:
+                self._chat_index.setdefault(peer_id, []).append(index)
+            for peer_id in definition['sender_ids']:
+                self._sender_index.setdefault(peer_id, []).append(index)
+            for peer_id in definition['forward_from']:
+                self._forward_index.setdefault(peer_id, []).append(index)
+            for kind in definition['media']:
+                self._media_index.setdefault(kind, []).append(index)
+            for keyword in definition['keywords']:
+                if keyword not in keyword_ids:
+                    keyword_ids[keyword] = len(self._keyword_rules)
+                    self._keyword_rules.append([])
+                self._keyword_rules[keyword_ids[keyword]].append(index)
+            if rule.regexes:
+                self._regex_rules.append(index)
+            if rule.conditions == 0:
+                self._unconditional.append(index)
+
+        self._automaton = KeywordAutomaton(list(keyword_ids)) if keyword_ids else None
+        self._has_include = any(rule.action == ACTION_INCLUDE for rule in self.rules)
+        logger.info(
+            f"已编译 {len(self.rules)} 条过滤规则（关键词 {len(keyword_ids)} 个，正则规则 {len(self._regex_rules)} 条）。"
+        )
+
+    def match(self, event) -> List[Rule]:
+        """返回与新消息事件匹配的全部规则。"""
+        return self._match(event.message, event.chat_id, event.sender_id)
+
+    def _match(self, message, chat_id: int, sender_id: Optional[int]) -> List[Rule]:
+        # 规则编号 -> 已满足的条件数
+        hits: Dict[int, int] = {}
+
+        def count(indexes: Iterable[int]):
+            for index in indexes:
+                hits[index] = hits.get(index, 0) + 1
+
+        count(self._chat_index.get(chat_id, ()))
+        if sender_id is not None:
+            count(self._sender_index.get(sender_id, ()))
+        if self._forward_index:
+            source = forward_source(message)
+            if source is not None:
+                count(self._forward_index.get(source, ()))
+        if self._media_index:
+            count(self._media_index.get(media_kind(message), ()))
+
+        text = message.raw_text or ''
+        if self._automaton and text:
+            matched_rules: Set[int] = set()
+            for keyword in self._automaton.search(text.lower()):
+                matched_rules.update(self._keyword_rules[keyword])
+            count(matched_rules)
+        if text:
+            for index in self._regex_rules:
+                rule = self.rules[index]
+                # 只对其他条件都已满足的规则执行正则
+                if hits.get(index, 0) == rule.conditions - 1 and any(regex.search(text) for regex in rule.regexes):
+                    hits[index] = rule.conditions
+
+        matched = [index for index, n in hits.items() if n == self.rules[index].conditions]
+        matched.extend(self._unconditional)
+        return [self.rules[index] for index in sorted(matched)]
+
+    def evaluate(self, event) -> Decision:
+        """
+        决定消息是否被排除，以及需要转发到哪些目标。
+        """
+        return self._decide(self.match(event))
+
+    def evaluate_message(self, message) -> Decision:
+        """与 evaluate 相同，但直接接受一条 Message（例如历史回填拉取的消息）。"""
+        return self._decide(self._match(message, message.chat_id, message.sender_id))
+
+    def _decide(self, matched: List[Rule]) -> Decision:
+        names = [rule.name for rule in matched]
+        if any(rule.action == ACTION_EXCLUDE for rule in matched):
+            return Decision(True, [], names)
+        if not self._has_include:
+            return Decision(False, [self.default_target], names)
+        targets: List[int] = []
+        for rule in matched:
+            for target in rule.targets or [self.default_target]:
+                if target not in targets:
+                    targets.append(target)
+        return Decision(False, targets, names)
@@ -0,0 +1,205 @@
+"""
+基于 SQLite FTS5 的全文检索。
+
+默认的 unicode61 分词器不会切分中文，整段汉字会被当成一个词。
+这里在写入索引前先做一次预处理：把连续的中日韩字符转换为重叠的二元组（bigram），
+并在每段末尾补上最后一个单字，其余文本原样交给 unicode61 处理。例如：
+
+    "今天天气不错 hello" -> "今天 天天 天气 气不 不错 错 hello"
+
+查询时用同样的规则把关键词转换成短语，因此任意长度的中文子串都能命中，
+单个汉字则用前缀查询匹配以该字开头的二元组或段末单字。
+
+索引表 messages_fts 是无内容表（content=''），只保存倒排索引，原文仍从 messages 读取。
+"""
+
+import logging
+import re
+from typing import List, Optional, Tuple
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+# 中日韩统一表意文字、扩展 A、兼容表意文字、假名和谚文音节
+_CJK_RUN_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]+")
+
+# 用户查询中的词：可带引号的短语、可带前导 - 的排除词、可带后缀 * 的前缀词
+_QUERY_TERM_RE = re.compile(r'(-?)"([^"]*)"(\*?)|(-?)([^\s"]+)')
+
+
+def _bigrams(run: str) -> List[str]:
+    """把一段连续的 CJK 字符拆成重叠二元组。"""
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def fts_tokens(text: Optional[str]) -> str:
+    """
+    把消息文本转换为写入 messages_fts 的内容。
+
+    该函数会注册为 SQLite 自定义函数，供写入器和回填命令在 SQL 中调用。
+    """
+    if not text:
+        return ""
+
+    def replace(match: "re.Match") -> str:
+        run = match.group(0)
+        return " " + " ".join(_bigrams(run) + [run[-1]]) + " "
+
+    return _CJK_RUN_RE.sub(replace, text)
+
+
+def _term_segments(term: str) -> List[Tuple[List[str], bool]]:
+    """
+    把一个查询词拆成若干段，每段是一个可以按短语匹配的词序列。
+
+    CJK 段和其他文字段分开：索引中每个 CJK 段末尾补了一个单字，
+    所以跨越两种文字的词无法作为一个完整短语匹配，需要用 NEAR 组合。
+
+    :return: [(词序列, 是否需要前缀匹配), ...]
+    """
+    segments: List[Tuple[List[str], bool]] = []
+    pos = 0
+    for match in _CJK_RUN_RE.finditer(term):
+        words = term[pos:match.start()].split()
+        if words:
+            segments.append((words, False))
+        run = match.group(0)
+        if len(run) == 1:
+            segments.append(([run], True))
+        else:
+            segments.append((_bigrams(run), False))
+        pos = match.end()
+    words = term[pos:].split()
+    if words:
+        segments.append((words, False))
+    return segments
+
+
+def _quote(tokens: List[str]) -> str:
+    """把词序列转换为 FTS5 短语字符串。"""
+    return '"' + " ".join(tokens).replace('"', '""') + '"'
+
+
+def build_match_query(query: str) -> Optional[str]:
+    """
+    把用户输入转换为 FTS5 MATCH 表达式。
+
+    支持的语法：
+    - 空格分隔的多个词：全部命中（AND）。
+    - "带引号的短语"：按顺序相邻命中。
+    - 词*：前缀匹配。
+    - -词：排除包含该词的消息。
+
+    用户输入不会被当作 FTS5 语法解析，所有词都会被加引号，避免语法错误。
+
+    :return: MATCH 表达式；如果没有可检索的词则返回 None。
+    """
+    positives: List[str] = []
+    negatives: List[str] = []
+    for match in _QUERY_TERM_RE.finditer(query):
+        if match.group(2) is not None:
+            negate, term, star = match.group(1), match.group(2), match.group(3)
+        else:
+            negate, term, star = match.group(4), match.group(5), ""
+            if term.endswith("*"):
+                term, star = term.rstrip("*"), "*"
+        segments = _term_segments(term)
+        if not segments:
+            continue
+        if star:
+            tokens, _ = segments[-1]
+            segments[-1] = (tokens, True)
+        phrases = [_quote(tokens) + ("*" if prefix else "") for tokens, prefix in segments]
+        if len(phrases) == 1:
+            expression = phrases[0]
+        else:
+            expression = f"NEAR({' '.join(phrases)}, {len(phrases) - 1})"
+        (negatives if negate else positives).append(expression)
+
+    if not positives:
+        return None
+    expression = " AND ".join(positives)
+    for negative in negatives:
+        expression = f"({expression}) NOT {negative}"
+    return expression
+
+
+async def register_functions(conn: aiosqlite.Connection):
+    """在连接上注册全文索引需要的自定义函数。"""
+    await conn.create_function("fts_tokens", 1, fts_tokens, deterministic=True)
+
+
+async def index_new_messages(conn: aiosqlite.Connection, after_id: int):
+    """
+    把 id 大于 after_id 的消息写入全文索引。
+
+    由写入器在同一个事务中调用，调用前需要已注册 fts_tokens 函数。
+    """
+    await conn.execute(
+        "INSERT INTO messages_fts (rowid, body) "
+        "SELECT id, fts_tokens(COALESCE(raw_text, text)) FROM messages WHERE id > ?",
+        (after_id,),
+    )
+
+
+async def remove_messages(conn: aiosqlite.Connection, where: str, params: tuple):
+    """
+    在删除 messages 中满足条件的行之前，把它们从全文索引中删除。
+
+    messages_fts 是无内容表，删除时需要提供原来的分词结果；
+    尚未回填索引的历史消息（见 backfill）不在索引中，会被跳过。
+    """
+    async with conn.execute(
+        "SELECT key, value FROM meta WHERE key IN ('fts_backfill_upto', 'fts_backfill_done')"
+    ) as cursor:
+        state = {key: int(value) for key, value in await cursor.fetchall()}
+    await conn.execute(
+        "INSERT INTO messages_fts (messages_fts, rowid, body) "
+        f"SELECT 'delete', id, fts_tokens(COALESCE(raw_text, text)) FROM messages WHERE {where} "
+        "AND (id <= ? OR id > ?)",
+        params + (state.get("fts_backfill_done", 0), state.get("fts_backfill_upto", 0)),
+    )
+
+
+async def backfill(conn: aiosqlite.Connection, chunk_size: int = 50000) -> int:
+    """
+    为创建索引之前已存在的历史消息建立全文索引。
+
+    进度记录在 meta 表中，中断后重新运行会从上次的位置继续；
+    每个分块单独提交，可以在监听程序运行时执行。
+
+    :return: 本次新建索引的消息数量。
+    """
+    await register_functions(conn)
+    async with conn.execute(
+        "SELECT key, value FROM meta WHERE key IN ('fts_backfill_upto', 'fts_backfill_done')"
+    ) as cursor:
+        state = {key: int(value) for key, value in await cursor.fetchall()}
+    upto = state.get("fts_backfill_upto", 0)
+    done = state.get("fts_backfill_done", 0)
+    if done >= upto:
+        logger.info("全文索引无需回填。")
+        return 0
+
+    logger.info(f"开始回填全文索引：消息 id {done + 1} ~ {upto}，每批 {chunk_size} 条。")
+    indexed = 0
+    while done < upto:
+        end = min(done + chunk_size, upto)
+        cursor = await conn.execute(
+            "INSERT INTO messages_fts (rowid, body) "
+            "SELECT id, fts_tokens(COALESCE(raw_text, text)) FROM messages WHERE id > ? AND id <= ?",
+            (done, end),
+        )
+        indexed += cursor.rowcount
+        await conn.execute(
+            "UPDATE meta SET value = ? WHERE key = 'fts_backfill_done'", (str(end),)
+        )
+        await conn.commit()
+        done = end
+        logger.info(f"全文索引回填进度: {done}/{upto} (本次已索引 {indexed} 条)")
+
+    await conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+    await conn.commit()
+    logger.info(f"全文索引回填完成，共索引 {indexed} 条消息。")
+    return indexed
@@ -0,0 +1,576 @@
+"""
+多会话分片监听：[session.<名称>] 中的每个附加会话在独立的进程中运行，只监听分配给它的会话。
+
+一个账号、一个事件循环处理全部更新时，会受到单账号的限制，MTProto 的解密和解析也只能用满一个 CPU 核心。
+分片后：
+
+- 会话进程（SessionWorker）登录自己的账号，解析会话和发送者信息、发送已读回执，
+  把每条消息规范化为一条紧凑的记录（定长位置的 JSON 数组，正文与纯文本相同时只传一份），
+  攒成一帧（4 字节长度 + JSON）通过本机 TCP 连接发给主进程；
+- 主进程（SessionSupervisor）接收记录，还原为与 Telethon 消息接口一致的对象，交给同一条消息处理流水线，
+  过滤、重复检测、入库和转发仍只在主进程中进行，数据库只有一个写入者；
+- 流水线处理不过来时主进程停止读取连接，TCP 的背压让会话进程的待发送队列积压，超过上限的消息被丢弃并计数；
+  与主进程的连接断开时会话进程不断重连，已在队列中的消息在重连后继续发送
+  （主进程异常退出时，已写入连接但尚未被读取的消息会丢失，可以用历史回填补齐）；
+- 主进程定期检查各个会话进程，退出的进程按指数退避单独重启，其他会话进程照常运行；
+  未登录的会话（退出码 EXIT_UNAUTHORIZED）不会被重启，需要先运行 python manage.py login --session <名称>。
+
+转发仍由主进程的账号完成（见 handlers.forwarder），主账号需要能访问被转发的来源会话；
+历史回填同样使用主账号。分配给会话进程的会话不再由主账号处理，避免同一条消息被处理两次。
+
+只有频道和超级群组可以分片：它们的消息 id 在所有账号看来都相同。
+私聊和普通群组的消息 id 是按账号编号的，主账号用会话进程收到的 id 转发或回填会拿到别的消息，
+配置中出现这类会话时 utils.config 会拒绝启动。
+"""
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import struct
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+from telethon import events
+
+from tg_client import ClientManager
+from handlers.read_receipts import ReadReceiptAggregator
+from handlers.rules import forward_source, media_kind
+from utils.config import settings
+from utils.entity_cache import ChatInfo, SenderInfo, entity_cache
+from utils.metrics import counter, gauge, registry
+from utils.reload import config_reloader
+
+logger = logging.getLogger(__name__)
+
+# 会话文件未登录时会话进程的退出码，监控不会重启这样的进程
+EXIT_UNAUTHORIZED = 3
+# 帧头：JSON 数据的字节数（网络字节序）
+_FRAME_HEADER = struct.Struct("!I")
+# 单帧的大小上限，超过时视为连接数据已损坏
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# 一帧最多包含的记录数
+MAX_FRAME_RECORDS = 500
+# 检查会话进程是否存活的间隔（秒）
+MONITOR_INTERVAL = 1.0
+# 会话进程连续运行超过这个秒数后再退出，重启等待时间从 restart_delay_seconds 重新开始计算
+STABLE_SECONDS = 60.0
+# 会话进程连接主进程失败后的重试间隔（秒）
+RECONNECT_DELAY = 1.0
+
+
+def encode_frame(payload) -> bytes:
+    """把一个 JSON 值编码为一帧：4 字节长度 + 紧凑的 UTF-8 JSON。"""
+    data = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+    return _FRAME_HEADER.pack(len(data)) + data
+
+
+async def read_frame(reader: asyncio.StreamReader):
+    """
+    读取一帧并解码。
+
+    :raises asyncio.IncompleteReadError: 对方关闭了连接。
+    :raises ValueError: 帧过大或不是合法的 JSON。
+    """
+    (size,) = _FRAME_HEADER.unpack(await reader.readexactly(_FRAME_HEADER.size))
+    if size > MAX_FRAME_SIZE:
+        raise ValueError(f"帧大小 {size} 字节超过上限")
+    return json.loads(await reader.readexactly(size))
+
+
+def encode_record(event, chat: ChatInfo, sender: Optional[SenderInfo]) -> list:
+    """
+    把一条新消息规范化为记录（字段位置固定，见 decode_record）。
+
+    Telegram 的消息时间精确到秒，以整数时间戳传输；纯文本与正文相同时不重复传输。
+    """
+    message = event.message
+    text = message.text
+    raw_text = message.raw_text
+    return [
+        event.chat_id,
+        message.id,
+        event.sender_id,
+        text,
+        None if raw_text == text else raw_text,
+        int(message.date.timestamp()),
+        1 if message.is_reply else 0,
+        message.reply_to_msg_id,
+        media_kind(message),
+        forward_source(message),
+        chat.id,
+        chat.type,
+        chat.title,
+        sender.id if sender else None,
+        sender.name if sender else None,
+        sender.username if sender else None,
+    ]
+
+
+class _ForwardHeader:
+    """转发来源，只保留过滤规则用到的 from_id。"""
+    __slots__ = ("from_id",)
+
+    def __init__(self, from_id: int):
+        self.from_id = from_id
+
+
+class RemoteMessage:
+    """
+    由记录还原的消息，提供流水线、过滤规则、入库和日志格式化用到的 Telethon 消息属性。
+    """
+    __slots__ = (
+        "id", "chat_id", "sender_id", "text", "raw_text", "date", "is_reply", "reply_to_msg_id",
+        "kind", "fwd_from",
+    )
+
+    def __init__(
+        self, id: int, chat_id: int, sender_id: Optional[int], text: Optional[str], raw_text: Optional[str],
+        date: datetime, is_reply: bool, reply_to_msg_id: Optional[int], kind: str, forward_from: Optional[int],
+    ):
+        self.id = id
+        self.chat_id = chat_id
+        self.sender_id = sender_id
+        self.text = text
+        self.raw_text = raw_text
+        self.date = date
+        self.is_reply = is_reply
+        self.reply_to_msg_id = reply_to_msg_id
+        self.kind = kind
+        self.fwd_from = _ForwardHeader(forward_from) if forward_from is not None else None
+
+    # 媒体类型以 media_kind 的结果传输，这里还原为各个属性的真假
+    @property
+    def media(self) -> bool:
+        return self.kind != 'text'
+
+    @property
+    def photo(self) -> bool:
+        return self.kind == 'photo'
+
+    @property
+    def sticker(self) -> bool:
+        return self.kind == 'sticker'
+
+    @property
+    def video(self) -> bool:
+        return self.kind == 'video'
+
+    @property
+    def voice(self) -> bool:
+        return self.kind == 'voice'
+
+    @property
+    def audio(self) -> bool:
+        return self.kind == 'audio'
+
+    @property
+    def document(self) -> bool:
+        return self.kind in ('document', 'voice', 'audio', 'video', 'sticker')
+
+
+class RemoteEvent:
+    """由记录还原的新消息事件，只包含流水线用到的属性。"""
+    __slots__ = ("chat_id", "sender_id", "message")
+
+    def __init__(self, message: RemoteMessage):
+        self.chat_id = message.chat_id
+        self.sender_id = message.sender_id
+        self.message = message
+
+
+def decode_record(record: list) -> Tuple[RemoteEvent, ChatInfo, Optional[SenderInfo]]:
+    """把 encode_record 生成的记录还原为事件、会话信息和发送者信息。"""
+    (
+        chat_id, message_id, sender_id, text, raw_text, date, is_reply, reply_to_msg_id, kind, forward_from,
+        chat_entity_id, chat_type, chat_title, sender_entity_id, sender_name, sender_username,
+    ) = record
+    message = RemoteMessage(
+        message_id, chat_id, sender_id, text, text if raw_text is None else raw_text,
+        datetime.fromtimestamp(date, timezone.utc), bool(is_reply), reply_to_msg_id, kind, forward_from,
+    )
+    chat = ChatInfo(chat_entity_id, chat_type, chat_title)
+    sender = SenderInfo(sender_entity_id, sender_name, sender_username) if sender_entity_id is not None else None
+    return RemoteEvent(message), chat, sender
+
+
+class SessionWorker:
+    """
+    会话进程：监听分配给本会话的会话，把消息记录发给主进程。
+
+    :param name: [session.<名称>] 中的名称。
+    :param options: settings.sessions 中的会话设置。
+    :param host: 主进程接收记录的地址。
+    :param port: 主进程接收记录的端口。
+    :param queue_size: 等待发送的记录上限，超过时丢弃新记录。
+    :param parent_pid: 主进程的 pid，主进程退出后会话进程随之退出。
+    """
+    def __init__(self, name: str, options: dict, host: str, port: int, queue_size: int, parent_pid: int):
+        self.name = name
+        self.options = options
+        self.host = host
+        self.port = port
+        self.parent_pid = parent_pid
+        self.chat_ids = set(options['chats'])
+        self.client_manager: Optional[ClientManager] = None
+        self.read_receipts: Optional[ReadReceiptAggregator] = None
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.sent = 0
+        self.dropped = 0
+
+    async def run(self) -> int:
+        """登录并监听，直到连接断开或主进程退出；返回进程的退出码。"""
+        options = self.options
+        self.client_manager = ClientManager(options['session'], options['api_id'], options['api_hash'], options['phone'])
+        client = self.client_manager.get_client()
+        if not await self.client_manager.connect_authorized():
+            logger.error(
+                f"会话 {self.name} 的会话文件 {options['session']} 尚未登录，"
+                f"请先运行 python manage.py login --session {self.name}。"
+            )
+            return EXIT_UNAUTHORIZED
+        if settings.read_receipts_enabled:
+            self.read_receipts = ReadReceiptAggregator(
+                client,
+                interval=settings.read_receipts_interval_seconds,
+                max_pending_chats=settings.read_receipts_max_pending_chats,
+                exclude_chat_ids=settings.read_receipts_exclude_chat_ids,
+            )
+            self.read_receipts.start()
+        client.add_event_handler(self._on_message, events.NewMessage(func=self._assigned))
+        client.add_event_handler(
+            self._on_title, events.ChatAction(func=lambda e: e.new_title is not None and self._assigned(e))
+        )
+        send_task = asyncio.create_task(self._send_loop())
+        logger.info(f"会话 {self.name} 开始监听 {len(self.chat_ids)} 个会话，消息发往 tcp://{self.host}:{self.port}。")
+        try:
+            await client.run_until_disconnected()
+        finally:
+            send_task.cancel()
+            if self.read_receipts:
+                await self.read_receipts.stop()
+            await client.disconnect()
+        logger.warning(f"会话 {self.name} 已断开连接（已发送 {self.sent} 条，丢弃 {self.dropped} 条）。")
+        return 1
+
+    def _assigned(self, event) -> bool:
+        return event.chat_id in self.chat_ids
+
+    async def _on_message(self, event: events.NewMessage.Event):
+        """解析会话和发送者信息，记入已读回执，并把记录放入待发送队列。"""
+        try:
+            if self.read_receipts:
+                self.read_receipts.mark(event)
+            chat, sender = await entity_cache.resolve(event)
+            self._queue.put_nowait(encode_record(event, chat, sender))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.debug("会话 %s 的待发送队列已满，丢弃消息 (ID: %s)。", self.name, event.message.id)
+        except Exception as e:
+            logger.error(f"会话 {self.name} 处理新消息时发生错误: {e}", exc_info=True)
+
+    async def _on_title(self, event: events.ChatAction.Event):
+        """群组或频道改名时刷新本进程实体缓存中的标题，之后的记录带上新标题。"""
+        entity_cache.update_chat_title(event.chat_id, event.new_title)
+
+    async def _send_loop(self):
+        """连接主进程并持续发送记录；连接断开时重连，未发送成功的一帧在重连后重新发送。"""
+        pending: Optional[bytes] = None
+        pending_count = 0
+        warned = False
+        while True:
+            if os.getppid() != self.parent_pid:
+                logger.warning(f"主进程已退出，会话 {self.name} 随之退出。")
+                await self.client_manager.get_client().disconnect()
+                return
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as e:
+                if not warned:
+                    logger.warning(f"会话 {self.name} 无法连接主进程 tcp://{self.host}:{self.port}，稍后重试: {e}")
+                    warned = True
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            warned = False
+            # 主进程不会发送数据，读到 EOF 说明连接已被关闭；空闲时也要及时发现，避免把下一帧写进已关闭的连接
+            closed = asyncio.ensure_future(reader.read(1))
+            try:
+                writer.write(encode_frame({"session": self.name, "pid": os.getpid()}))
+                while True:
+                    if pending is None:
+                        get = asyncio.ensure_future(self._queue.get())
+                        await asyncio.wait((get, closed), return_when=asyncio.FIRST_COMPLETED)
+                        if not get.done():
+                            # 只有连接关闭会让等待提前结束；此时必须重连，否则每次等待都会立即返回
+                            get.cancel()
+                            raise ConnectionResetError("主进程关闭了连接")
+                        records = [get.result()]
+                        while len(records) < MAX_FRAME_RECORDS and not self._queue.empty():
+                            records.append(self._queue.get_nowait())
+                        # 每帧附带累计丢弃数，由主进程导出为指标
+                        pending, pending_count = encode_frame([self.dropped, records]), len(records)
+                    if closed.done():
+                        # 这一帧保留在 pending 中，重连后重新发送
+                        raise ConnectionResetError("主进程关闭了连接")
+                    writer.write(pending)
+                    await writer.drain()
+                    self.sent += pending_count
+                    pending = None
+            except OSError as e:
+                logger.warning(f"会话 {self.name} 与主进程的连接已断开，正在重连: {e}")
+                await asyncio.sleep(RECONNECT_DELAY)
+            finally:
+                closed.cancel()
+                writer.close()
+
+
+def run_session_worker(name: str, options: dict, parent_pid: int):
+    """会话进程的入口（在 multiprocessing.Process 中运行）。"""
+    from utils.logger import setup_logging
+    # fork 出的子进程中没有父进程的日志输出线程，需要重新配置
+    setup_logging()
+    worker = SessionWorker(
+        name, options, settings.sessions_host, settings.sessions_port, settings.sessions_queue_size, parent_pid,
+    )
+    try:
+        code = asyncio.run(worker.run())
+    except KeyboardInterrupt:
+        code = 0
+    except Exception as e:
+        logger.critical(f"会话 {name} 遇到无法恢复的错误: {e}", exc_info=True)
+        code = 1
+    sys.exit(code)
+
+
+def _unpack_frame(frame) -> Tuple[int, list]:
+    """拆出记录帧中的 (丢弃计数, 记录列表)，格式不对时抛出 TypeError。"""
+    if not (isinstance(frame, list) and len(frame) == 2 and isinstance(frame[1], list)):
+        raise TypeError(f"帧的格式不正确: {str(frame)[:100]}")
+    return frame[0], frame[1]
+
+
+class _WorkerState:
+    """一个会话进程的运行状态和统计。"""
+    def __init__(self, name: str, options: dict, restart_delay: float):
+        self.name = name
+        self.options = options
+        self.process: Optional[multiprocessing.Process] = None
+        self.started_at = 0.0
+        # 下一次启动的时间（time.monotonic），None 表示不再启动
+        self.next_start: Optional[float] = 0.0
+        self.delay = restart_delay
+        self.restarts = 0
+        self.connections = 0
+        self.connected = False
+        self.frames = 0
+        self.received = 0
+        self.dropped = 0
+        # 无法解析或处理失败的帧和记录数
+        self.errors = 0
+
+
+class SessionSupervisor:
+    """
+    启动并监控各个会话进程，接收它们发来的记录并交给消息处理流水线。
+
+    :param sessions: 名称 -> 会话设置（settings.sessions）。
+    :param host: 接收记录的地址。
+    :param port: 接收记录的端口。
+    :param restart_delay: 会话进程退出后第一次重启前等待的秒数，连续失败时加倍。
+    :param max_restart_delay: 重启等待时间的上限。
+    """
+    def __init__(
+        self,
+        sessions: Dict[str, dict],
+        host: str,
+        port: int,
+        restart_delay: float = 1.0,
+        max_restart_delay: float = 60.0,
+    ):
+        self.host = host
+        self.port = port
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.workers: Dict[str, _WorkerState] = {
+            name: _WorkerState(name, options, restart_delay) for name, options in sessions.items()
+        }
+        self.pipeline = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._monitor_task: Optional[asyncio.Task] = None
+        # 处理连接的任务 -> 连接的写端
+        self._connections: Dict[asyncio.Task, asyncio.StreamWriter] = {}
+
+    async def start(self, pipeline):
+        """开始接收记录，启动全部会话进程和监控任务。"""
+        if self._server is not None or not self.workers:
+            return
+        self.pipeline = pipeline
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        for state in self.workers.values():
+            self._spawn(state)
+        self._monitor_task = asyncio.create_task(self._monitor())
+        logger.info(f"已启动 {len(self.workers)} 个会话进程，在 tcp://{self.host}:{self.port} 接收消息。")
+
+    async def stop(self):
+        """停止监控和全部会话进程，处理完已收到的记录后关闭连接。"""
+        if self._server is None:
+            return
+        if self._monitor_task:
+            self._monitor_task.cancel()
+        for state in self.workers.values():
+            if state.process is not None and state.process.is_alive():
+                state.process.terminate()
+        for state in self.workers.values():
+            if state.process is not None:
+                await asyncio.to_thread(state.process.join, 5)
+                if state.process.is_alive():
+                    state.process.kill()
+        self._server.close()
+        # 关闭连接后，处理连接的任务交完已读取的记录就会结束
+        for writer in self._connections.values():
+            writer.close()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        self._server = None
+        logger.info(f"会话进程已全部停止。统计: {self.stats()}")
+
+    def _spawn(self, state: _WorkerState):
+        """启动一个会话进程。"""
+        state.process = multiprocessing.Process(
+            target=run_session_worker,
+            args=(state.name, state.options, os.getpid()),
+            name=f"listentg-session-{state.name}",
+            daemon=True,
+        )
+        state.process.start()
+        state.started_at = time.monotonic()
+        state.next_start = None
+        logger.info(f"会话进程 {state.name} 已启动 (pid {state.process.pid})。")
+
+    async def _monitor(self):
+        """定期检查会话进程，退出的进程按指数退避单独重启。"""
+        while True:
+            await asyncio.sleep(MONITOR_INTERVAL)
+            now = time.monotonic()
+            for state in self.workers.values():
+                try:
+                    self._check(state, now)
+                except Exception as e:
+                    logger.error(f"检查会话进程 {state.name} 时出错: {e}", exc_info=True)
+
+    def _check(self, state: _WorkerState, now: float):
+        if state.process is None:
+            if state.next_start is not None and now >= state.next_start:
+                state.restarts += 1
+                self._spawn(state)
+            return
+        if state.process.is_alive():
+            return
+        exitcode = state.process.exitcode
+        state.process = None
+        if exitcode == EXIT_UNAUTHORIZED:
+            logger.error(f"会话进程 {state.name} 的会话文件尚未登录，不再重启。")
+            return
+        if now - state.started_at >= STABLE_SECONDS:
+            state.delay = self.restart_delay
+        state.next_start = now + state.delay
+        logger.warning(f"会话进程 {state.name} 已退出（退出码 {exitcode}），{state.delay:.1f} 秒后重启。")
+        state.delay = min(state.delay * 2, self.max_restart_delay)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        接收一个会话进程的记录，逐条交给流水线（流水线的背压会传递到连接上）。
+
+        单个帧或记录无法解析、或流水线处理出错时只记录日志并计数，连接继续保持；
+        只有帧过大（之后的数据无法再按帧切分）或连接断开时才关闭连接。
+        """
+        self._connections[asyncio.current_task()] = writer
+        state = None
+        try:
+            hello = await read_frame(reader)
+            state = self.workers.get(hello.get("session")) if isinstance(hello, dict) else None
+            if state is None:
+                logger.warning(f"收到未知会话进程的连接: {hello}")
+                return
+            state.connections += 1
+            state.connected = True
+            logger.info(f"会话进程 {state.name} (pid {hello.get('pid')}) 已连接。")
+            while True:
+                try:
+                    dropped, records = _unpack_frame(await read_frame(reader))
+                except (json.JSONDecodeError, UnicodeDecodeError, TypeError) as e:
+                    # 这一帧已完整读出，后面的数据仍能按帧切分
+                    state.errors += 1
+                    logger.warning(f"会话进程 {state.name} 发来的帧无法解析，已跳过: {e}")
+                    continue
+                state.frames += 1
+                state.dropped = dropped
+                for record in records:
+                    try:
+                        event, chat, sender = decode_record(record)
+                        await self.pipeline.submit_record(event, chat, sender)
+                    except Exception as e:
+                        state.errors += 1
+                        logger.error(f"处理会话进程 {state.name} 发来的记录时出错: {e}", exc_info=True)
+                        continue
+                    state.received += 1
+        except asyncio.IncompleteReadError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"会话进程 {state.name if state else '?'} 的连接出错，已关闭: {e}")
+        finally:
+            if state is not None:
+                state.connected = False
+            writer.close()
+            self._connections.pop(asyncio.current_task(), None)
+
+    def stats(self) -> dict:
+        """返回各会话进程的状态和计数。"""
+        return {
+            name: {
+                "alive": state.process is not None and state.process.is_alive(),
+                "connected": state.connected,
+                "restarts": state.restarts,
+                "received": state.received,
+                "dropped": state.dropped,
+                "errors": state.errors,
+            }
+            for name, state in self.workers.items()
+        }
+
+    def collect_metrics(self) -> list:
+        """导出各会话进程的存活状态、重启次数和收到的记录数。"""
+        samples = []
+        for name, state in self.workers.items():
+            alive = state.process is not None and state.process.is_alive()
+            samples += [
+                gauge("listentg_session_up", "会话进程是否在运行并已连接", int(alive and state.connected), session=name),
+                counter("listentg_session_restarts_total", "会话进程被重启的次数", state.restarts, session=name),
+                counter("listentg_session_frames_total", "从会话进程收到的帧数", state.frames, session=name),
+                counter("listentg_session_records_total", "从会话进程收到的消息数", state.received, session=name),
+                counter("listentg_session_dropped_total", "会话进程待发送队列已满而丢弃的消息数", state.dropped, session=name),
+                counter("listentg_session_errors_total", "从会话进程收到的无法解析或处理失败的帧和记录数", state.errors, session=name),
+            ]
+        return samples
+
+
+# 创建一个全局的会话进程监控实例
+session_supervisor = SessionSupervisor(
+    settings.sessions,
+    host=settings.sessions_host,
+    port=settings.sessions_port,
+    restart_delay=settings.sessions_restart_delay_seconds,
+    max_restart_delay=settings.sessions_max_restart_delay_seconds,
+)
+registry.register(session_supervisor.collect_metrics)
+
+
+async def _apply_settings(changed):
+    """热加载后更新重启等待时间（会话列表和地址需要重启才能修改）。"""
+    if changed & {'sessions_restart_delay_seconds', 'sessions_max_restart_delay_seconds'}:
+        session_supervisor.restart_delay = settings.sessions_restart_delay_seconds
+        session_supervisor.max_restart_delay = settings.sessions_max_restart_delay_seconds
+
+config_reloader.subscribe(_apply_settings)
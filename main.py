@@ -5,22 +5,36 @@ ListenTG - Telegram 消息监听和转发工具
 import asyncio
 import logging
 import multiprocessing
+import os
 import uvicorn
 
 from tg_client import client_manager
-from utils.logger import setup_logging
+from utils.logger import dropped_log_records, setup_logging, stop_logging
+from handlers.archive import message_archive
+from handlers.backfill import backfill_importer
 from handlers.database import db_manager
+from handlers.keywords import keyword_indexer
+from handlers.sessions import session_supervisor
+from utils.eventbus import event_publisher
+from utils.config import settings
+from utils.entity_cache import entity_cache
+from utils.metrics import registry
+from utils.reload import config_reloader
 
 # 导入事件处理器模块，确保 @client.on 装饰器被执行和注册
-from handlers import message_handler
-from handlers.forwarder import forwarder_task
+from handlers.message_handler import pipeline
+from handlers.forwarder import forwarder_task, forward_queue
 
 # 在所有其他模块之前优先配置日志
 setup_logging()
 logger = logging.getLogger(__name__)
 
-def run_web_server():
+def run_web_server(listener_pid: int):
     """ 在一个单独的进程中运行 FastAPI Web 服务器 """
+    # 管理接口通过这个 pid 通知监听进程重新加载配置
+    os.environ["LISTENTG_LISTENER_PID"] = str(listener_pid)
+    # fork 出的子进程中没有父进程的日志输出线程，需要重新配置
+    setup_logging()
     from web.main import app  # 延迟导入以避免循环依赖问题
     logger.info("正在启动 Web 服务器...")
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -29,26 +43,56 @@ async def main():
     """
     应用程序主入口。
     
-    - 初始化数据库。
+    - 初始化数据库并启动批量写入器，打开持久化转发队列，启动消息处理流水线。
+    - 启动附加会话的进程（如果配置了 [session.<名称>]）。
     - 初始化并启动客户端。
     - 在事件循环中创建并运行转发器任务。
     - 保持客户端持续运行。
-    - 最后关闭数据库连接。
+    - 最后写完缓冲区中的消息并关闭数据库连接。
     """
     try:
         # 初始化数据库（连接并创建表）
         await db_manager.init_db()
+        await db_manager.start_writer()
+        # 打开持久化转发队列，上次未转发完的消息会在转发器启动后继续转发
+        await forward_queue.open()
+        # 启动消息处理流水线（事件回调只负责把消息交给它）
+        pipeline.start()
+
+        # 每批消息落盘后把增量推送给 Web 进程
+        await event_publisher.start()
+        db_manager.set_event_publisher(event_publisher)
 
         # 在一个独立的进程中启动 Web 服务器
-        web_process = multiprocessing.Process(target=run_web_server)
+        web_process = multiprocessing.Process(target=run_web_server, args=(os.getpid(),))
         web_process.start()
 
+        # 在独立的进程中运行 [session.<名称>] 中的附加会话，它们收到的消息交给本进程的流水线
+        if settings.sessions:
+            await session_supervisor.start(pipeline)
+
         # 启动客户端（包含登录和设置在线状态）
         await client_manager.start()
 
         # 获取客户端的事件循环，并创建转发任务
         loop = client_manager.get_client().loop
-        loop.create_task(forwarder_task())
+        forward_task = loop.create_task(forwarder_task())
+        loop.create_task(entity_cache.report_loop())
+        loop.create_task(pipeline.report_loop())
+        # 定期把指标推送给 Web 进程，由 /metrics 导出
+        if settings.metrics_enabled:
+            loop.create_task(registry.publish_loop(event_publisher, settings.metrics_push_interval_seconds))
+        # 定期把旧消息搬到按月归档文件
+        if settings.archive_enabled:
+            loop.create_task(message_archive.run_loop(db_manager, settings.archive_interval_hours * 3600))
+        # 在进程池中对新消息分词，增量累计按小时的词频
+        if settings.keywords_enabled:
+            loop.create_task(keyword_indexer.run_loop(db_manager))
+        # 在后台回填配置的会话的历史消息（与实时监听共用同一个客户端和写连接）
+        if settings.backfill_on_start and settings.backfill_chats:
+            loop.create_task(backfill_importer.run(settings.backfill_chats))
+        # 监视 config.ini，变化时（或收到 SIGHUP 时）热加载
+        config_reloader.start()
         
         logger.info("系统已准备就绪，开始监听消息...")
         
@@ -59,6 +103,7 @@ async def main():
         logger.critical(f"应用主程序遇到无法恢复的错误，即将退出: {e}", exc_info=True)
     finally:
         logger.info("应用程序正在关闭...")
+        config_reloader.stop()
         
         # 确保 Web 服务器进程被终止
         if 'web_process' in locals() and web_process.is_alive():
@@ -66,8 +111,23 @@ async def main():
             web_process.join()
             logger.info("Web 服务器已关闭。")
 
+        # 先停止会话进程，不再接收新的消息
+        await session_supervisor.stop()
+        # 处理完流水线中已接收的消息，再停止转发器；未确认的消息会在下次启动时重新转发
+        await pipeline.stop()
+        if 'forward_task' in locals():
+            forward_task.cancel()
+        await forward_queue.close()
+        keyword_indexer.stop()
+        # 先把写缓冲区中的消息全部落盘，再关闭连接
+        await db_manager.stop_writer()
         await db_manager.close()
+        event_publisher.close()
         logger.info("数据库连接已关闭。")
+        logger.info(f"实体缓存统计: {entity_cache.stats()}")
+        if dropped_log_records():
+            logger.warning(f"日志队列已满而丢弃的日志: {dropped_log_records()} 条")
+        stop_logging()
 
 if __name__ == "__main__":
     # 确保多进程在 Windows 和其他平台上安全启动
@@ -0,0 +1,175 @@
+"""
+ListenTG 管理命令
+
+用法：
+    python manage.py fts-backfill [--chunk-size N]
+    python manage.py rollup-rebuild [--chunk-size N]
+    python manage.py normalize [--chunk-size N]
+    python manage.py dedupe
+    python manage.py archive
+    python manage.py export [--format parquet|arrow] [--output DIR] [--full] [--no-archive]
+    python manage.py backfill [--chat ID_OR_USERNAME ...] [--since YYYY-MM-DD] [--reset]
+    python manage.py login --session NAME
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+
+from utils.logger import setup_logging
+from handlers.archive import message_archive
+from handlers.database import db_manager
+from handlers.export import create_exporter
+from utils.config import settings
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+
+async def fts_backfill(args: argparse.Namespace):
+    """为历史消息回填全文索引。"""
+    await db_manager.init_db()
+    try:
+        await db_manager.backfill_search_index(chunk_size=args.chunk_size)
+    finally:
+        await db_manager.close()
+
+
+async def rollup_rebuild(args: argparse.Namespace):
+    """根据全部历史消息重建预聚合统计表。"""
+    await db_manager.init_db()
+    try:
+        archives = [partition.path for partition in message_archive.partitions()]
+        await db_manager.rebuild_rollups(chunk_size=args.chunk_size, archives=archives)
+    finally:
+        await db_manager.close()
+
+
+async def normalize(args: argparse.Namespace):
+    """把历史消息中重复的会话/发送者字符串置为 NULL（名字以维度表为准）。"""
+    await db_manager.init_db()
+    try:
+        await db_manager.normalize_messages(chunk_size=args.chunk_size)
+    finally:
+        await db_manager.close()
+
+
+async def dedupe(args: argparse.Namespace):
+    """删除重复保存的消息（先备份），之后才能升级到 v9 及以上的数据库版本。"""
+    try:
+        removed = await db_manager.remove_duplicate_messages()
+        print(f"已删除 {removed} 条重复的消息。" if removed else "没有重复的消息。")
+    finally:
+        await db_manager.close()
+
+
+async def archive(args: argparse.Namespace):
+    """把超出热分区的旧消息搬到按月归档文件，并执行保留策略。"""
+    await db_manager.init_db()
+    try:
+        moved = await db_manager.archive_old_messages(message_archive)
+    finally:
+        await db_manager.close()
+    expired = message_archive.apply_retention()
+    logger.info(f"共归档 {moved} 条消息，处理过期分区 {len(expired)} 个。")
+    for partition in message_archive.partitions():
+        size = os.path.getsize(partition.path) / 1024 / 1024
+        print(f"{partition.name}\t{size:.1f} MB\t{partition.path}")
+
+
+async def export(args: argparse.Namespace):
+    """把消息历史导出为 Parquet 或 Arrow IPC 文件。"""
+    exporter = create_exporter(args.output, args.format, include_archive=not args.no_archive)
+    summary = await exporter.export(full=args.full)
+    for path in summary["files"]:
+        print(path)
+
+
+async def backfill(args: argparse.Namespace):
+    """
+    导入会话的历史消息（可中断、可续跑）。
+
+    Telethon 的会话文件不能被两个进程同时使用，监听程序运行时请改用 [backfill] on_start。
+    """
+    from tg_client import client_manager
+    from handlers.backfill import backfill_importer
+
+    chats = [int(chat) if chat.lstrip("-").isdigit() else chat for chat in args.chat] or settings.backfill_chats
+    since = datetime.strptime(args.since, "%Y-%m-%d").replace(tzinfo=timezone.utc) if args.since else None
+    await db_manager.init_db()
+    try:
+        await client_manager.start()
+        summary = await backfill_importer.run(chats, reset=args.reset, since=since)
+        print(summary)
+    finally:
+        await client_manager.get_client().disconnect()
+        await db_manager.close()
+
+
+async def login(args: argparse.Namespace):
+    """
+    交互式登录 [session.<名称>] 中的会话，生成会话文件。
+
+    会话进程没有终端，不能输入验证码，首次使用前需要先用这个命令登录。
+    """
+    from tg_client import ClientManager
+
+    options = settings.sessions.get(args.session)
+    if options is None:
+        raise SystemExit(f"config.ini 中没有 [session.{args.session}] 小节。")
+    manager = ClientManager(options['session'], options['api_id'], options['api_hash'], options['phone'])
+    try:
+        await manager.start()
+        me = await manager.get_client().get_me()
+        print(f"会话 {args.session} 已登录: {me.first_name} (id {me.id})，会话文件 {options['session']}.session")
+    finally:
+        await manager.get_client().disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ListenTG 管理命令")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    backfill_parser = subparsers.add_parser("fts-backfill", help="为历史消息回填全文索引（可中断、可续跑）")
+    backfill_parser.add_argument("--chunk-size", type=int, default=50000, help="每个事务处理的消息数量")
+    backfill_parser.set_defaults(func=fts_backfill)
+
+    rollup_parser = subparsers.add_parser("rollup-rebuild", help="根据全部历史消息重建仪表盘预聚合统计表")
+    rollup_parser.add_argument("--chunk-size", type=int, default=500000, help="每个事务处理的消息数量")
+    rollup_parser.set_defaults(func=rollup_rebuild)
+
+    normalize_parser = subparsers.add_parser("normalize", help="清理历史消息中重复的会话/发送者字符串（可中断、可续跑）")
+    normalize_parser.add_argument("--chunk-size", type=int, default=50000, help="每个事务处理的消息数量")
+    normalize_parser.set_defaults(func=normalize)
+
+    dedupe_parser = subparsers.add_parser("dedupe", help="备份并删除重复保存的消息（升级到 v9 之前需要先运行）")
+    dedupe_parser.set_defaults(func=dedupe)
+
+    archive_parser = subparsers.add_parser("archive", help="立即归档旧消息并执行保留策略，然后列出所有归档分区")
+    archive_parser.set_defaults(func=archive)
+
+    export_parser = subparsers.add_parser("export", help="把消息历史按月导出为 Parquet/Arrow 文件（默认增量导出）")
+    export_parser.add_argument("--format", choices=["parquet", "arrow"], help="导出格式，默认取 [export] format")
+    export_parser.add_argument("--output", help="导出目录，默认取 [export] directory")
+    export_parser.add_argument("--full", action="store_true", help="忽略水位线，从头导出全部消息")
+    export_parser.add_argument("--no-archive", action="store_true", help="只导出主库，不包括归档分区")
+    export_parser.set_defaults(func=export)
+
+    history_parser = subparsers.add_parser("backfill", help="导入会话的历史消息（可中断、可续跑），默认回填 [backfill] chats")
+    history_parser.add_argument("--chat", action="append", default=[], help="会话 id 或用户名，可重复指定")
+    history_parser.add_argument("--since", help="只回填这一天（YYYY-MM-DD，UTC）之后的消息，默认取 [backfill] since")
+    history_parser.add_argument("--reset", action="store_true", help="清除回填进度，重新回填全部历史（已有的消息会被跳过）")
+    history_parser.set_defaults(func=backfill)
+
+    login_parser = subparsers.add_parser("login", help="交互式登录 [session.<名称>] 中的附加会话")
+    login_parser.add_argument("--session", required=True, help="[session.<名称>] 中的名称")
+    login_parser.set_defaults(func=login)
+
+    args = parser.parse_args()
+    asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
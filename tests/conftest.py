@@ -0,0 +1,36 @@
+"""
+测试公用的设置。
+
+utils.config 在导入时读取当前目录下的 config.ini，数据库文件也在当前目录中，
+因此在导入任何被测模块之前，先切换到一个写有最小配置的临时目录。
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CONFIG = """
+[telegram]
+api_id = 12345
+api_hash = 0123456789abcdef
+phone = +10000000000
+
+[forwarding]
+target_group = -1000000000100
+"""
+
+_workdir = tempfile.mkdtemp(prefix="listentg-tests-")
+with open(os.path.join(_workdir, "config.ini"), "w", encoding="utf-8") as f:
+    f.write(CONFIG)
+os.chdir(_workdir)
+
+
+@pytest.fixture
+def workdir():
+    """测试运行的临时目录（config.ini 和数据库文件所在的目录）。"""
+    return _workdir
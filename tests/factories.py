@@ -0,0 +1,21 @@
+"""
+规则引擎测试用的构造函数：最小事件对象和规则定义，流水线、去重和会话测试也使用它们。
+"""
+
+from types import SimpleNamespace
+
+
+def make_event(chat_id: int, text: str = "", sender_id=None, message_id: int = 1, fwd_from=None, media=None):
+    """构造规则引擎和流水线用到的最小事件对象。"""
+    message = SimpleNamespace(id=message_id, raw_text=text, text=text, fwd_from=fwd_from, media=media)
+    return SimpleNamespace(message=message, chat_id=chat_id, sender_id=sender_id)
+
+
+def make_rule(name: str, **conditions) -> dict:
+    """构造一条规则定义（格式同 settings.rules），未指定的条件为空。"""
+    definition = {
+        'name': name, 'action': 'exclude', 'chat_ids': set(), 'sender_ids': set(), 'forward_from': set(),
+        'keywords': [], 'regexes': [], 'media': set(), 'targets': [],
+    }
+    definition.update(conditions)
+    return definition
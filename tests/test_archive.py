@@ -0,0 +1,46 @@
+import asyncio
+import sqlite3
+from datetime import datetime
+
+from handlers.archive import ArchiveReader, MessageArchive, Partition
+
+
+def _partition(tmp_path, month: int) -> Partition:
+    archive = MessageArchive(str(tmp_path))
+    start = datetime(2026, month, 1)
+    path = archive.path_for(start)
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY, message_id INTEGER, chat_id INTEGER)")
+        conn.execute("INSERT INTO messages VALUES (?, ?, ?)", (month, month, -1001))
+    return Partition(start, path)
+
+
+def test_evicted_partition_closes_connection_when_it_is_returned(tmp_path):
+    first, second = _partition(tmp_path, 1), _partition(tmp_path, 2)
+
+    async def scenario():
+        reader = ArchiveReader(MessageArchive(str(tmp_path)), max_open=1)
+        evicted = reader.pool(first)
+        async with evicted.acquire() as conn:
+            # 借出连接期间分区被淘汰：连接仍可使用，归还时关闭
+            reader.pool(second)
+            await asyncio.sleep(0)
+            async with conn.execute("SELECT message_id FROM messages") as cursor:
+                rows = await cursor.fetchall()
+            assert evicted.opened == 1
+        assert evicted.opened == 0
+
+        # 已淘汰的连接池用完即关闭，不会留下空闲连接
+        async with evicted.acquire():
+            pass
+        assert evicted.opened == 0
+
+        kept = reader.pool(second)
+        async with kept.acquire():
+            pass
+        assert kept.opened == 1
+        await reader.close()
+        assert kept.opened == 0 and not reader._closing
+        return rows
+
+    assert [tuple(row) for row in asyncio.run(scenario())] == [(1,)]
@@ -0,0 +1,75 @@
+import asyncio
+from datetime import datetime, timezone
+
+import aiosqlite
+from telethon.tl.types import Channel, ChatPhotoEmpty, Message, PeerChannel, PeerUser
+
+from handlers.archive import MessageArchive, add_months, month_start
+from handlers.backfill import BackfillImporter
+from handlers.database import DatabaseManager
+from handlers.rules import RuleEngine
+
+CHANNEL = Channel(id=1001, title="News", photo=ChatPhotoEmpty(), date=None)
+
+
+class FakeClient:
+    """按 Telethon get_messages 的分页语义返回一组固定的历史消息。"""
+    def __init__(self, history):
+        self.history = history
+
+    async def get_entity(self, chat):
+        return CHANNEL
+
+    async def get_messages(self, entity, limit, offset_id, min_id):
+        page = [m for m in self.history if m.id > min_id and (not offset_id or m.id < offset_id)]
+        return sorted(page, key=lambda m: m.id, reverse=True)[:limit]
+
+
+def make_message(message_id: int, date: datetime) -> Message:
+    return Message(
+        id=message_id, peer_id=PeerChannel(1001), date=date, message=f"消息 {message_id}", from_id=PeerUser(42),
+    )
+
+
+async def _fetch(conn, sql):
+    async with conn.execute(sql) as cursor:
+        return await cursor.fetchall()
+
+
+def test_backfill_skips_messages_already_in_an_archive_partition(tmp_path):
+    now = datetime.utcnow()
+    old = add_months(month_start(now), -3).replace(day=5, tzinfo=timezone.utc)
+    recent = month_start(now).replace(day=1, hour=1, tzinfo=timezone.utc)
+    history = [make_message(1, old), make_message(2, old), make_message(3, old), make_message(10, recent)]
+
+    async def scenario():
+        db = DatabaseManager(str(tmp_path / "messages.db"))
+        archive = MessageArchive(str(tmp_path / "archive"), hot_months=1)
+        try:
+            await db.init_db()
+            importer = BackfillImporter(
+                FakeClient(history), db, RuleEngine([], default_target=-1000000000100),
+                archive=archive, rate=1000, burst=1000,
+            )
+            first = await importer.run([1001])
+            assert await db.archive_old_messages(archive) == 3
+
+            # 重新回填全部历史：已归档的 3 条不能再次写入主库，新出现的旧消息照常写入
+            history.append(make_message(4, old))
+            second = await importer.run([1001], reset=True)
+
+            conn = db._connection
+            hot = await _fetch(conn, "SELECT message_id FROM messages ORDER BY message_id")
+            total = await _fetch(conn, "SELECT SUM(message_count) FROM rollup_hourly")
+            async with aiosqlite.connect(archive.partitions()[0].path) as partition:
+                archived = await _fetch(partition, "SELECT message_id FROM messages ORDER BY message_id")
+        finally:
+            await db.close()
+        return first, second, hot, total, archived
+
+    first, second, hot, total, archived = asyncio.run(scenario())
+    assert first["imported"] == 4
+    assert second["imported"] - first["imported"] == 1
+    assert hot == [(4,), (10,)]
+    assert archived == [(1,), (2,), (3,)]
+    assert total == [(5,)]
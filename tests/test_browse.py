@@ -0,0 +1,110 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from telethon.tl.types import Message, PeerChannel, PeerUser
+
+from handlers.database import DatabaseManager, ReadConnectionPool
+from test_response_cache import make_request
+from utils.entity_cache import ChatInfo, SenderInfo
+from web.api import data
+from web.api.data import ResponseCache, _cursor_bound, _decode_cursor, _encode_cursor, browse_messages
+
+# (message_id, chat_id, 日期)；两条消息的时间相同，由 id 区分先后
+MESSAGES = [
+    (1, 1001, datetime(2026, 10, 1, 8, 0)),
+    (2, 1002, datetime(2026, 10, 1, 9, 0)),
+    (3, 1001, datetime(2026, 10, 1, 9, 0)),
+    (4, 1001, datetime(2026, 10, 1, 10, 0)),
+    (5, 1002, datetime(2026, 10, 1, 11, 0)),
+]
+
+
+def make_event(message_id: int, channel: int, date: datetime) -> SimpleNamespace:
+    message = Message(
+        id=message_id, peer_id=PeerChannel(channel), date=date.replace(tzinfo=timezone.utc),
+        message=f"消息 {message_id}", from_id=PeerUser(42),
+    )
+    return SimpleNamespace(message=message, chat_id=message.chat_id, sender_id=message.sender_id)
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    path = str(tmp_path / "messages.db")
+
+    async def populate():
+        db = DatabaseManager(path)
+        try:
+            await db.init_db()
+            for message_id, channel, date in MESSAGES:
+                await db.save_message(
+                    make_event(message_id, channel, date), ChatInfo(channel, 'Channel', 'News'), SenderInfo(42, 'Alice', 'alice'),
+                )
+        finally:
+            await db.close()
+
+    asyncio.run(populate())
+    pool = ReadConnectionPool(path, size=1)
+    monkeypatch.setattr(data, "read_pool", pool)
+    yield pool
+    asyncio.run(pool.close())
+
+
+def browse_all(limit: int, **filters) -> list:
+    async def scenario():
+        pages, after = [], None
+        while True:
+            rows, after = await browse_messages(after=after, limit=limit, **filters)
+            pages.append([row["message_id"] for row in rows])
+            if after is None:
+                return pages
+            # 游标经过编码后原样传回
+            after = _decode_cursor(_encode_cursor(after))
+
+    return asyncio.run(scenario())
+
+
+def test_keyset_pages_cover_every_message_once(pool):
+    assert browse_all(2) == [[5, 4], [3, 2], [1]]
+    assert browse_all(6) == [[5, 4, 3, 2, 1]]
+    # 最后一页恰好凑满时还有一个游标，下一页为空
+    assert browse_all(5) == [[5, 4, 3, 2, 1], []]
+    assert browse_all(2, chat_id=-1000000001001) == [[4, 3], [1]]
+
+
+def test_cursor_bound_narrows_the_time_range():
+    cursor = ["2026-10-01 09:00:00", 3]
+    assert _cursor_bound(None, cursor) == datetime(2026, 10, 1, 9, 0, 1)
+    assert _cursor_bound(datetime(2026, 9, 1), cursor) == datetime(2026, 9, 1)
+    assert _cursor_bound(None, [0.5, 3]) is None
+
+
+@pytest.mark.parametrize("cursor", ["not-base64!", _encode_cursor([1, 2, 3]), _encode_cursor({"a": 1}), "bnVsbA=="])
+def test_invalid_cursor_is_a_bad_request(cursor):
+    with pytest.raises(HTTPException) as excinfo:
+        _decode_cursor(cursor)
+    assert excinfo.value.status_code == 400
+
+
+def test_endpoint_returns_an_opaque_next_cursor(pool, monkeypatch):
+    async def watermark():
+        return 1
+
+    monkeypatch.setattr(data, "get_watermark", watermark)
+    monkeypatch.setattr(data, "response_cache", ResponseCache(ttl=60, max_entries=10))
+
+    async def scenario():
+        first = await data.list_messages_endpoint(make_request(), limit=3)
+        cursor = json.loads(first.body)["next_cursor"]
+        second = await data.list_messages_endpoint(make_request(), cursor=cursor, limit=3)
+        with pytest.raises(HTTPException) as excinfo:
+            await data.list_messages_endpoint(make_request(), cursor="garbage", limit=3)
+        return json.loads(first.body), json.loads(second.body), excinfo.value.status_code
+
+    first, second, status = asyncio.run(scenario())
+    assert [row["message_id"] for row in first["results"]] == [5, 4, 3]
+    assert [row["message_id"] for row in second["results"]] == [2, 1]
+    assert second["next_cursor"] is None and status == 400
@@ -0,0 +1,154 @@
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import aiosqlite
+import pytest
+from telethon.tl.types import Message, PeerChannel, PeerUser
+
+from conftest import CONFIG
+from handlers.database import DatabaseManager, ReadConnectionPool
+from utils.config import Config, ConfigError
+from utils.entity_cache import ChatInfo, SenderInfo
+
+DATE = datetime(2026, 10, 1, 8, 30, tzinfo=timezone.utc)
+CHAT = ChatInfo(1001, 'Channel', 'News')
+SENDER = SenderInfo(42, 'Alice', 'alice')
+
+
+def make_event(message_id: int, text: str = "hello") -> SimpleNamespace:
+    message = Message(id=message_id, peer_id=PeerChannel(1001), date=DATE, message=text, from_id=PeerUser(42))
+    return SimpleNamespace(message=message, chat_id=message.chat_id, sender_id=message.sender_id)
+
+
+async def _fetch(path, sql):
+    async with aiosqlite.connect(path) as conn:
+        async with conn.execute(sql) as cursor:
+            return await cursor.fetchall()
+
+
+def test_writer_commits_full_batches_and_flushes_the_rest_on_close(tmp_path):
+    path = str(tmp_path / "messages.db")
+
+    async def scenario():
+        db = DatabaseManager(path, batch_size=3, flush_interval_ms=60000, max_buffer=100)
+        try:
+            await db.init_db()
+            await db.start_writer()
+            for message_id in range(1, 8):
+                await db.save_message(make_event(message_id), CHAT, SENDER)
+            # 凑满 batch_size 的两批立即提交，剩下的一条等待 flush_interval
+            for _ in range(100):
+                if db.stats.flushes == 2:
+                    break
+                await asyncio.sleep(0.01)
+            written_before_close = (await _fetch(path, "SELECT COUNT(*) FROM messages"))[0][0]
+        finally:
+            await db.close()
+        return written_before_close, db.stats.snapshot()
+
+    written_before_close, stats = asyncio.run(scenario())
+    assert written_before_close == 6
+    assert (stats["flushes"], stats["rows_written"], stats["max_batch_size"]) == (3, 7, 3)
+    assert asyncio.run(_fetch(path, "SELECT message_id FROM messages ORDER BY id")) == [(i,) for i in range(1, 8)]
+
+
+def test_failed_batch_is_rolled_back_and_counted(tmp_path):
+    path = str(tmp_path / "messages.db")
+
+    async def scenario():
+        db = DatabaseManager(path)
+        try:
+            await db.init_db()
+            good = db.message_item(make_event(1).message, CHAT, SENDER)
+            # 无法绑定为 SQL 参数的正文会让整批写入失败
+            row = list(db.message_item(make_event(2).message, CHAT, SENDER)[0])
+            row[3] = object()
+            bad = (tuple(row), None, None, None)
+            failed = await db._write_rows([good, bad])
+            retried = await db._write_rows([good])
+            duplicate = await db._write_rows([good])
+            return failed, retried, duplicate, db.stats.snapshot()
+        finally:
+            await db.close()
+
+    failed, retried, duplicate, stats = asyncio.run(scenario())
+    assert (failed, retried, duplicate) == (0, 1, 0)
+    assert (stats["rows_failed"], stats["rows_written"]) == (2, 2)
+    assert asyncio.run(_fetch(path, "SELECT COUNT(*) FROM messages")) == [(1,)]
+    assert asyncio.run(_fetch(path, "SELECT SUM(message_count) FROM rollup_hourly")) == [(1,)]
+
+
+def test_save_without_writer_task_writes_directly(tmp_path):
+    path = str(tmp_path / "messages.db")
+
+    async def scenario():
+        db = DatabaseManager(path)
+        try:
+            await db.init_db()
+            await db.save_message(make_event(1), CHAT, SENDER)
+            return db.buffered()
+        finally:
+            await db.close()
+
+    assert asyncio.run(scenario()) == 0
+    assert asyncio.run(_fetch(path, "SELECT message_id, chat_id, sender_id FROM messages")) == [
+        (1, -1000000001001, 42),
+    ]
+
+
+def test_writer_uses_wal_and_read_pool_is_read_only(tmp_path):
+    path = str(tmp_path / "messages.db")
+
+    async def scenario():
+        db = DatabaseManager(path)
+        pool = ReadConnectionPool(path, size=1)
+        try:
+            await db.init_db()
+            async with db._connection.execute("PRAGMA journal_mode") as cursor:
+                journal_mode = (await cursor.fetchone())[0]
+            async with pool.acquire() as conn:
+                with pytest.raises(aiosqlite.OperationalError, match="readonly"):
+                    await conn.execute("DELETE FROM messages")
+            return journal_mode
+        finally:
+            await pool.close()
+            await db.close()
+
+    assert asyncio.run(scenario()) == "wal"
+
+
+def test_read_pool_waits_for_a_returned_connection_when_full(tmp_path):
+    path = str(tmp_path / "messages.db")
+
+    async def scenario():
+        db = DatabaseManager(path)
+        pool = ReadConnectionPool(path, size=1)
+        async def borrow():
+            async with pool.acquire() as conn:
+                return conn
+
+        try:
+            await db.init_db()
+            async with pool.acquire() as first:
+                waiting = asyncio.create_task(borrow())
+                await asyncio.sleep(0.05)
+                # 连接已达上限，第二个请求等待归还的连接
+                assert not waiting.done() and pool.opened == 1
+            second = await asyncio.wait_for(waiting, 1)
+            return first is second, pool.opened
+        finally:
+            await pool.close()
+            await db.close()
+
+    assert asyncio.run(scenario()) == (True, 1)
+
+
+def test_invalid_pragma_setting_is_a_config_error(tmp_path):
+    path = tmp_path / "config.ini"
+    path.write_text(CONFIG + "\n[database]\njournal_mode = wal\nsynchronous = sometimes\n", encoding="utf-8")
+    with pytest.raises(ConfigError, match="synchronous"):
+        Config(str(path))
+    path.write_text(CONFIG + "\n[database]\njournal_mode = wal\nread_pool_size = 2\n", encoding="utf-8")
+    config = Config(str(path))
+    assert (config.db_journal_mode, config.db_read_pool_size) == ("WAL", 2)
@@ -0,0 +1,104 @@
+import asyncio
+
+from factories import make_event, make_rule
+from handlers.dedup import KIND_EXACT, KIND_NEAR, DuplicateIndex, normalize, simhash
+from handlers.pipeline import MessageContext, IngestPipeline
+from handlers.rules import RuleEngine
+from utils.entity_cache import ChatInfo
+
+TEXT = "限时优惠！加入我们的频道领取免费会员，名额有限，先到先得，详情请私信管理员咨询"
+
+
+def test_normalize_strips_punctuation_and_width():
+    assert normalize("Ｈｅｌｌｏ, World！ 🎉") == "helloworld"
+
+
+def test_first_message_is_original():
+    index = DuplicateIndex(min_length=5)
+    assert index.check(TEXT, -1001, 1, now=0) is None
+    assert len(index) == 1
+
+
+def test_exact_duplicate_after_normalization():
+    index = DuplicateIndex(min_length=5)
+    index.check(TEXT, -1001, 1, now=0)
+    match = index.check(TEXT.replace("，", " , ") + "!!!", -1002, 7, now=1)
+    assert (match.chat_id, match.message_id, match.kind, match.distance) == (-1001, 1, KIND_EXACT, 0)
+
+
+def test_near_duplicate_within_distance():
+    index = DuplicateIndex(min_length=5, max_distance=6)
+    index.check(TEXT, -1001, 1, now=0)
+    variant = TEXT + "哦"
+    distance = (simhash(normalize(TEXT)) ^ simhash(normalize(variant))).bit_count()
+    assert 0 < distance <= 6
+    match = index.check(variant, -1002, 2, now=1)
+    assert (match.chat_id, match.message_id, match.kind, match.distance) == (-1001, 1, KIND_NEAR, distance)
+
+
+def test_near_duplicate_beyond_distance_is_new_original():
+    index = DuplicateIndex(min_length=5, max_distance=2)
+    index.check(TEXT, -1001, 1, now=0)
+    assert index.check(TEXT.replace("管理员", "管理"), -1002, 2, now=1) is None
+    assert len(index) == 2
+
+
+def test_short_and_empty_text_are_skipped():
+    index = DuplicateIndex(min_length=20)
+    assert index.check("好的", -1001, 1, now=0) is None
+    assert index.check("好的", -1002, 2, now=1) is None
+    assert index.check(None, -1001, 3, now=2) is None
+    assert index.checked == 0
+
+
+def test_entries_expire_after_window():
+    index = DuplicateIndex(window_seconds=10, min_length=5)
+    index.check(TEXT, -1001, 1, now=0)
+    assert index.check(TEXT, -1002, 2, now=5) is not None
+    # 命中后从最后一次命中算起
+    assert index.check(TEXT, -1003, 3, now=14) is not None
+    assert index.check(TEXT, -1004, 4, now=30) is None
+
+
+def test_forwarded_targets_accumulate():
+    index = DuplicateIndex(min_length=5)
+    index.check(TEXT, -1001, 1, targets=[10], now=0)
+    first = index.check(TEXT, -1002, 2, targets=[10, 20], now=1)
+    assert first.forwarded == {10}
+    second = index.check(TEXT, -1003, 3, targets=[20], now=2)
+    assert second.forwarded == {10, 20}
+
+
+class _RecordingQueue:
+    def __init__(self):
+        self.items = []
+
+    async def put(self, chat_id, message_id, target):
+        self.items.append((chat_id, message_id, target))
+
+
+def test_duplicate_forwarded_only_to_new_targets():
+    """副本被另一条 include 规则转发到新的目标时，只跳过原始消息已经转发过的目标。"""
+    rules = RuleEngine([
+        make_rule('ads', action='include', keywords=['免费会员'], targets=[10]),
+        make_rule('watch', action='include', chat_ids={-1000000000002}, targets=[20]),
+    ], default_target=-1000000000100)
+    queue = _RecordingQueue()
+    stages = {name: (1, 10, 'block') for name in ('filter', 'dedup', 'persist', 'log', 'forward')}
+    pipeline = IngestPipeline(None, queue, None, rules, stages, dedup=DuplicateIndex(min_length=5))
+
+    async def handle(event):
+        ctx = MessageContext(event)
+        ctx.chat = ChatInfo(event.chat_id, 'Channel', 'test')
+        assert await pipeline._filter(ctx)
+        await pipeline._dedup(ctx)
+        await pipeline._forward(ctx)
+
+    async def scenario():
+        await handle(make_event(-1000000000001, TEXT, message_id=1))
+        await handle(make_event(-1000000000002, TEXT, message_id=2))
+        await handle(make_event(-1000000000003, TEXT, message_id=3))
+
+    asyncio.run(scenario())
+    assert queue.items == [(-1000000000001, 1, 10), (-1000000000002, 2, 20)]
+    assert pipeline.suppressed_forwards == 2
@@ -0,0 +1,87 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from telethon.tl.types import Message, PeerChannel, PeerUser
+
+from handlers.database import DatabaseManager
+from handlers.dimensions import DimensionTracker, lookup, normalize
+from handlers.migrations import migrate
+from test_migrations import _baseline_db, _fetch
+from utils.entity_cache import ChatInfo, SenderInfo
+
+DATE = datetime(2026, 10, 1, 8, 30, tzinfo=timezone.utc)
+
+
+def make_event(message_id: int, date: datetime = DATE) -> SimpleNamespace:
+    message = Message(id=message_id, peer_id=PeerChannel(1001), date=date, message="hello", from_id=PeerUser(42))
+    return SimpleNamespace(message=message, chat_id=message.chat_id, sender_id=message.sender_id)
+
+
+def test_tracker_upserts_only_when_metadata_changes():
+    tracker = DimensionTracker(max_entries=2)
+    assert tracker.chat_upsert(-1, 'Group', 'A', DATE) == (-1, 'Group', 'A', DATE)
+    assert tracker.chat_upsert(-1, 'Group', 'A', DATE) is None
+    assert tracker.chat_upsert(-1, 'Group', 'B', DATE) is not None
+    assert tracker.user_upsert(None, 'Unknown', None, DATE) is None
+    assert tracker.user_upsert(42, 'Alice', 'alice', DATE) is not None
+    assert tracker.user_upsert(42, 'Alice', 'alice', DATE) is None
+
+    # 事务失败后忘掉，下一条消息重新写入
+    tracker.forget([-1], [42])
+    assert tracker.chat(-1) == (None, None)
+    assert tracker.user_upsert(42, 'Alice', 'alice', DATE) is not None
+
+    # 超过上限后清空重新记录
+    tracker.chat_upsert(-1, 'Group', 'B', DATE)
+    tracker.chat_upsert(-2, 'Group', 'C', DATE)
+    tracker.chat_upsert(-3, 'Group', 'D', DATE)
+    assert (tracker.chat(-1), tracker.chat(-3)) == ((None, None), ('Group', 'D'))
+
+
+def test_writer_keeps_the_newest_metadata(tmp_path):
+    path = str(tmp_path / "messages.db")
+
+    async def scenario():
+        db = DatabaseManager(path)
+        try:
+            await db.init_db()
+            await db.save_message(make_event(1), ChatInfo(1001, 'Channel', 'News'), SenderInfo(42, 'Alice', 'alice'))
+            await db.save_message(make_event(2), ChatInfo(1001, 'Channel', 'News'), SenderInfo(42, 'Alice', 'alice'))
+            await db.save_message(
+                make_event(3, DATE + timedelta(hours=1)), ChatInfo(1001, 'Channel', 'Breaking'), SenderInfo(42, 'Alice', 'alice'),
+            )
+            # 回填较早的消息时带着旧标题，不能覆盖维度表中更新的元数据
+            await db.save_message(
+                make_event(0, DATE - timedelta(days=1)), ChatInfo(1001, 'Channel', 'Old'), SenderInfo(42, 'Alice', 'alice'),
+            )
+            chats, users = await lookup(db._connection, [-1000000001001], [42, None])
+            columns = await _fetch(db._connection, "SELECT DISTINCT chat_title, sender_name FROM messages")
+            return chats, users, columns
+        finally:
+            await db.close()
+
+    chats, users, columns = asyncio.run(scenario())
+    assert chats == {-1000000001001: ('Channel', 'Breaking')}
+    assert users == {42: ('Alice', 'alice')}
+    # 新写入的消息不再重复保存名字
+    assert columns == [(None, None)]
+
+
+def test_normalize_clears_legacy_strings_and_resumes(tmp_path):
+    async def scenario():
+        conn = await _baseline_db(str(tmp_path / "baseline.db"))
+        try:
+            await migrate(conn)
+            first = await normalize(conn, chunk_size=3)
+            again = await normalize(conn)
+            names = await _fetch(conn, "SELECT DISTINCT chat_type, chat_title, sender_name, sender_username FROM messages")
+            meta = dict(await _fetch(conn, "SELECT key, value FROM meta WHERE key LIKE 'normalize_%'"))
+            return first, again, names, meta
+        finally:
+            await conn.close()
+
+    first, again, names, meta = asyncio.run(scenario())
+    assert (first, again) == (4, 0)
+    assert names == [(None, None, None, None)]
+    assert meta == {'normalize_upto': '4', 'normalize_done': '4'}
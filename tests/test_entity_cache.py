@@ -0,0 +1,76 @@
+import asyncio
+
+from telethon.tl.types import Channel, ChatPhotoEmpty, User
+
+from utils.entity_cache import EntityCache
+
+CHANNEL = Channel(id=1001, title="News", photo=ChatPhotoEmpty(), date=None)
+ALICE = User(id=42, first_name="Alice", last_name="B", username="alice")
+
+
+class FakeEvent:
+    """新消息事件：chat/sender 为事件附带的实体，get_chat/get_sender 模拟请求 Telegram。"""
+    def __init__(self, chat_id=-1000000001001, sender_id=42, chat=None, sender=None):
+        self.chat_id = chat_id
+        self.sender_id = sender_id
+        self.chat = chat
+        self.sender = sender
+        self.requests = 0
+
+    async def get_chat(self):
+        self.requests += 1
+        return CHANNEL
+
+    async def get_sender(self):
+        self.requests += 1
+        return ALICE if self.sender_id == 42 else None
+
+
+def test_entities_are_resolved_once_per_chat_and_sender():
+    cache = EntityCache(max_size=10, ttl_seconds=60)
+    first, second = FakeEvent(), FakeEvent()
+    chat, sender = asyncio.run(cache.resolve(first))
+    assert asyncio.run(cache.resolve(second)) == (chat, sender)
+    assert (first.requests, second.requests) == (2, 0)
+    assert (chat.id, chat.type, chat.title) == (1001, 'Channel', 'News')
+    assert (sender.id, sender.name, sender.username) == (42, 'Alice B', 'alice')
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["api_calls"]) == (2, 2, 2)
+
+
+def test_attached_entities_need_no_request_and_missing_sender_is_none():
+    cache = EntityCache()
+    event = FakeEvent(chat=CHANNEL, sender_id=None)
+    chat, sender = asyncio.run(cache.resolve(event))
+    assert chat.title == "News" and sender is None
+    assert event.requests == 0 and cache.stats()["api_calls"] == 0
+    # 发送者无法解析时不缓存，下次重新解析
+    unknown = FakeEvent(sender_id=7)
+    assert asyncio.run(cache.get_sender(unknown)) is None
+    assert asyncio.run(cache.get_sender(unknown)) is None
+    assert unknown.requests == 2
+
+
+def test_expired_and_evicted_entries_are_resolved_again():
+    cache = EntityCache(max_size=2, ttl_seconds=60)
+    for chat_id in (-1, -2, -3):
+        asyncio.run(cache.get_chat(FakeEvent(chat_id=chat_id)))
+    assert cache.stats()["evictions"] == 1 and len(cache._entries) == 2
+    event = FakeEvent(chat_id=-1)
+    asyncio.run(cache.get_chat(event))
+    assert event.requests == 1
+
+    cache.ttl = -1
+    asyncio.run(cache.get_chat(FakeEvent(chat_id=-9)))
+    again = FakeEvent(chat_id=-9)
+    asyncio.run(cache.get_chat(again))
+    assert again.requests == 1
+
+
+def test_title_update_refreshes_cached_chat():
+    cache = EntityCache()
+    asyncio.run(cache.get_chat(FakeEvent()))
+    cache.update_chat_title(-1000000001001, "News (renamed)")
+    event = FakeEvent()
+    assert asyncio.run(cache.get_chat(event)).title == "News (renamed)"
+    assert event.requests == 0
@@ -0,0 +1,84 @@
+import asyncio
+import builtins
+import json
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from telethon.tl.types import Message, PeerChannel, PeerUser
+
+from handlers import export
+from handlers.database import DatabaseManager
+from handlers.export import MessageExporter, _fill_names, _import_pyarrow, _parse_date
+from utils.entity_cache import ChatInfo, SenderInfo
+
+CHAT = ChatInfo(1001, 'Channel', 'News')
+SENDER = SenderInfo(42, 'Alice', 'alice')
+
+
+def make_event(message_id: int, month: int) -> SimpleNamespace:
+    date = datetime(2026, month, 3, 8, 30, tzinfo=timezone.utc)
+    message = Message(id=message_id, peer_id=PeerChannel(1001), date=date, message=f"消息 {message_id}", from_id=PeerUser(42))
+    return SimpleNamespace(message=message, chat_id=message.chat_id, sender_id=message.sender_id)
+
+
+async def _save(path, events):
+    db = DatabaseManager(path)
+    try:
+        await db.init_db()
+        for event in events:
+            await db.save_message(event, CHAT, SENDER)
+    finally:
+        await db.close()
+
+
+def test_missing_pyarrow_is_a_clear_error(monkeypatch):
+    real_import = builtins.__import__
+
+    def fake_import(name, *args, **kwargs):
+        if name.startswith("pyarrow"):
+            raise ImportError(name)
+        return real_import(name, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "__import__", fake_import)
+    with pytest.raises(RuntimeError, match="pip install pyarrow"):
+        _import_pyarrow()
+
+
+def test_dates_are_utc_and_names_come_from_dimensions():
+    assert _parse_date("2026-10-01 08:30:00") == datetime(2026, 10, 1, 8, 30, tzinfo=timezone.utc)
+    assert _parse_date("2026-10-01 10:30:00+02:00") == datetime(2026, 10, 1, 8, 30, tzinfo=timezone.utc)
+    index = export.COLUMN_INDEX
+    row = [None] * len(index)
+    row[index["chat_id"]], row[index["chat_title"]] = -1001, "旧名字"
+    row[index["sender_id"]], row[index["sender_name"]] = 42, "Alice"
+    filled = _fill_names([tuple(row)], {-1001: ("Channel", "新名字")}, {})[0]
+    assert (filled[index["chat_title"]], filled[index["sender_name"]]) == ("新名字", "Alice")
+
+
+def test_incremental_export_advances_the_watermark(tmp_path, monkeypatch):
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "messages.db")
+    monkeypatch.setattr(export, "DB_PATH", path)
+    exporter = MessageExporter(str(tmp_path / "export"), batch_size=2)
+
+    asyncio.run(_save(path, [make_event(1, 8), make_event(2, 9), make_event(3, 9), make_event(4, 9)]))
+    first = asyncio.run(exporter.export())
+    unchanged = asyncio.run(exporter.export())
+    asyncio.run(_save(path, [make_event(5, 9)]))
+    second = asyncio.run(exporter.export())
+
+    names = lambda result: [file.rsplit("/", 1)[-1] for file in result["files"]]
+    assert (first["rows"], first["after_id"], first["upto_id"]) == (4, 0, 4)
+    assert names(first) == ["messages_2026_08.1-4.parquet", "messages_2026_09.1-4.parquet"]
+    assert unchanged == {"rows": 0, "files": [], "after_id": 4, "upto_id": 4}
+    assert (second["rows"], names(second)) == (1, ["messages_2026_09.5-5.parquet"])
+
+    with open(exporter.state_path, encoding="utf-8") as f:
+        assert json.load(f)["watermark"] == 5
+    table = pq.read_table(first["files"][1])
+    assert table.column("message_id").to_pylist() == [2, 3, 4]
+    assert set(table.column("chat_title").to_pylist()) == {"News"}
+    assert table.schema.field("date").type.tz == "UTC"
+    # 重新全量导出不受水位线影响
+    assert asyncio.run(exporter.export(full=True))["rows"] == 5
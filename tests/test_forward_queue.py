@@ -0,0 +1,64 @@
+import asyncio
+
+import aiosqlite
+
+from handlers.database import DatabaseManager
+from handlers.forward_queue import ForwardQueue
+
+
+async def _open_queue(tmp_path, **kwargs) -> ForwardQueue:
+    path = str(tmp_path / "messages.db")
+    db = DatabaseManager(path)
+    await db.init_db()
+    await db.close()
+    queue = ForwardQueue(path, flush_interval_ms=10, **kwargs)
+    await queue.open()
+    return queue
+
+
+def test_put_waits_while_writes_fail_and_retries_in_order(tmp_path):
+    async def scenario():
+        queue = await _open_queue(tmp_path, max_pending=3)
+        executemany = queue._connection.executemany
+
+        async def locked(*args):
+            raise aiosqlite.OperationalError("database is locked")
+
+        try:
+            queue._connection.executemany = locked
+            for message_id in (1, 2, 3):
+                await queue.put(-1001, message_id, 10)
+            await asyncio.sleep(0.05)
+            # 写入持续失败：内存中的消息不超过上限，第 4 条等待
+            blocked = asyncio.create_task(queue.put(-1001, 4, 10))
+            await asyncio.sleep(0.05)
+            assert not blocked.done()
+            assert len(queue._incoming) + queue._writing == 3
+            assert await queue.lease(10, 10, wait=False) == []
+
+            queue._connection.executemany = executemany
+            await asyncio.wait_for(blocked, 1)
+            await queue.flush()
+            leased = await queue.lease(10, 10, wait=False)
+            return [message.message_id for message in leased], await queue.depth()
+        finally:
+            await queue.close()
+
+    assert asyncio.run(scenario()) == ([1, 2, 3, 4], 4)
+
+
+def test_duplicates_are_ignored_and_ack_removes_from_depth(tmp_path):
+    async def scenario():
+        queue = await _open_queue(tmp_path)
+        try:
+            await queue.put(-1001, 1, 10)
+            await queue.put(-1001, 1, 10)
+            await queue.put(-1001, 1, 20)
+            await queue.flush()
+            leased = await queue.lease(10, 10, wait=False)
+            await queue.ack(leased)
+            return len(leased), await queue.depth_by_target()
+        finally:
+            await queue.close()
+
+    assert asyncio.run(scenario()) == (1, {20: 1})
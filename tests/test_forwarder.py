@@ -0,0 +1,149 @@
+import asyncio
+
+from telethon.errors import FloodWaitError
+
+from handlers import forwarder
+from handlers.forward_queue import QueuedMessage
+from handlers.forwarder import ForwardingEngine, TargetLane
+
+
+class FakeQueue:
+    """记录 ack、fail 和 record_attempt 调用的转发队列。"""
+    def __init__(self):
+        self.calls = []
+
+    async def ack(self, items):
+        self.calls.append(("ack", [item.message_id for item in items]))
+
+    async def fail(self, items, error):
+        self.calls.append(("fail", [item.message_id for item in items]))
+
+    async def record_attempt(self, items, error):
+        self.calls.append(("attempt", [item.message_id for item in items]))
+
+    async def release(self, items):
+        self.calls.append(("release", [item.message_id for item in items]))
+
+    async def lease(self, target, limit, wait=True):
+        await asyncio.Event().wait()
+
+
+class FakeClient:
+    """按顺序抛出 errors 中的异常，之后转发成功。"""
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.forwarded = []
+
+    async def get_input_entity(self, chat_id):
+        return chat_id
+
+    async def forward_messages(self, target, message_ids, from_peer):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.forwarded.append((target, from_peer, message_ids))
+
+
+def make_lane(client, max_retries=2) -> TargetLane:
+    engine = ForwardingEngine(
+        client, FakeQueue(), rate=1000, burst=10, concurrency=2, batch_size=50, linger_ms=0, max_retries=max_retries,
+    )
+    return TargetLane(engine, -1000000000100, "main", rate=1000, burst=10, max_retries=max_retries)
+
+
+def items(*message_ids, chat_id=-1001):
+    return [QueuedMessage(i, chat_id, message_id, -1000000000100, 0, 0.0) for i, message_id in enumerate(message_ids)]
+
+
+def test_group_keeps_enqueue_order_per_chat():
+    batch = items(1, 2, chat_id=-1001) + items(7, chat_id=-1002) + items(3, chat_id=-1001)
+    groups = TargetLane._group(batch)
+    assert {chat: [item.message_id for item in group] for chat, group in groups.items()} == {
+        -1001: [1, 2, 3], -1002: [7],
+    }
+
+
+def test_flood_wait_slows_the_lane_and_retries_without_counting_an_attempt():
+    client = FakeClient([FloodWaitError(request=None, capture=0)])
+    lane = make_lane(client)
+    asyncio.run(lane._forward_group(-1001, items(1, 2, 3)))
+    assert client.forwarded == [(-1000000000100, -1001, [1, 2, 3])]
+    assert lane.engine.queue.calls == [("ack", [1, 2, 3])]
+    assert (lane.stats.flood_waits, lane.stats.batches, lane.stats.forwarded) == (1, 1, 3)
+    # FloodWait 之后速率减半，成功一次恢复十分之一
+    assert lane.bucket.rate == 600
+
+
+def test_errors_back_off_and_fail_after_max_retries(monkeypatch):
+    monkeypatch.setattr(forwarder, "MAX_BACKOFF", 0)
+    client = FakeClient([RuntimeError("boom")] * 3)
+    lane = make_lane(client, max_retries=2)
+    asyncio.run(lane._forward_group(-1001, items(1, 2)))
+    assert client.forwarded == []
+    assert lane.engine.queue.calls == [("attempt", [1, 2])] * 3 + [("fail", [1, 2])]
+    assert (lane.stats.retries, lane.stats.failed) == (2, 2)
+
+
+def test_transient_error_is_retried_then_acked(monkeypatch):
+    monkeypatch.setattr(forwarder, "MAX_BACKOFF", 0)
+    client = FakeClient([RuntimeError("timeout")])
+    lane = make_lane(client)
+    asyncio.run(lane._forward_group(-1001, items(5)))
+    assert lane.engine.queue.calls == [("attempt", [5]), ("ack", [5])]
+    assert (lane.stats.retries, lane.stats.failed, lane.stats.forwarded) == (1, 0, 1)
+
+
+def test_each_target_gets_its_own_lane_and_settings():
+    alerts = {'name': 'alerts', 'rate': 5, 'burst': 2, 'max_retries': 1}
+    engine = ForwardingEngine(
+        FakeClient(), FakeQueue(), rate=1, burst=1, concurrency=2, batch_size=50, linger_ms=0, max_retries=3,
+        targets={-1000000000200: alerts},
+    )
+
+    async def scenario():
+        try:
+            for target in (-1000000000200, -1000000000300, -1000000000200):
+                engine._ensure_lane(target)
+            await asyncio.sleep(0)
+            lanes = {target: (lane.name, lane.bucket.rate, lane.max_retries) for target, lane in engine.lanes.items()}
+            # 一个目标触发 FloodWait 只影响它自己的令牌桶
+            engine.lanes[-1000000000200].bucket.penalize(0)
+            rates = [lane.bucket.rate for lane in engine.lanes.values()]
+            engine.configure(rate=2, burst=1, batch_size=50, linger_ms=0, max_retries=3,
+                             targets={-1000000000200: dict(alerts, rate=8, max_retries=2)})
+            return lanes, rates, engine.lanes[-1000000000200].max_retries, len(engine._tasks)
+        finally:
+            for task in engine._tasks:
+                task.cancel()
+
+    lanes, rates, retries, tasks = asyncio.run(scenario())
+    assert lanes == {
+        -1000000000200: ('alerts', 5, 1),
+        -1000000000300: ('-1000000000300', 1, 3),
+    }
+    assert rates == [2.5, 1]
+    assert (retries, tasks) == (2, 2)
+
+
+def test_unexpected_worker_error_releases_the_group(monkeypatch):
+    monkeypatch.setattr(forwarder, "RELEASE_DELAY", 0)
+    lane = make_lane(FakeClient())
+
+    async def broken(chat_id, group):
+        raise RuntimeError("boom")
+
+    lane._forward_group = broken
+
+    async def scenario():
+        queue = asyncio.Queue()
+        batch = items(1, 2)
+        lane.in_flight = len(batch)
+        await queue.put((-1001, batch))
+        worker = asyncio.create_task(lane._worker(queue))
+        for _ in range(100):
+            if lane.engine.queue.calls:
+                break
+            await asyncio.sleep(0.01)
+        worker.cancel()
+        return lane.engine.queue.calls, lane.in_flight
+
+    assert asyncio.run(scenario()) == ([("release", [1, 2])], 0)
@@ -0,0 +1,105 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+from telethon.tl.types import Message, PeerChannel, PeerUser
+
+from handlers.database import DatabaseManager
+from handlers.dedup import KIND_EXACT, DuplicateMatch
+from handlers.keywords import ALL_CHATS, KeywordIndexer, count_terms, trending_score
+from test_migrations import _fetch
+from utils.entity_cache import ChatInfo, SenderInfo
+
+DATE = datetime(2026, 10, 1, 8, 30, tzinfo=timezone.utc)
+SENDER = SenderInfo(42, 'Alice', 'alice')
+
+
+def make_event(channel: int, message_id: int, text: str, date: datetime = DATE) -> SimpleNamespace:
+    message = Message(id=message_id, peer_id=PeerChannel(channel), date=date, message=text, from_id=PeerUser(42))
+    return SimpleNamespace(message=message, chat_id=message.chat_id, sender_id=message.sender_id)
+
+
+def test_placeholders_and_empty_texts_are_skipped():
+    assert count_terms([("2026-10-01 08:00:00", -1, "[图片]"), ("2026-10-01 08:00:00", -1, None)]) == {}
+
+
+def test_trending_score_favours_sudden_terms():
+    assert trending_score(10, 0, 1, 24) == 10
+    assert trending_score(10, 240, 1, 24) == 0
+    assert trending_score(20, 24, 1, 24) > trending_score(20, 240, 1, 24)
+
+
+def test_indexer_counts_each_message_once_per_term(tmp_path):
+    pytest.importorskip("jieba")
+    path = str(tmp_path / "messages.db")
+
+    async def scenario():
+        db = DatabaseManager(path)
+        indexer = KeywordIndexer(workers=1, batch_size=2)
+        try:
+            await db.init_db()
+            news, friends = ChatInfo(1001, 'Channel', 'News'), ChatInfo(1002, 'Channel', 'Friends')
+            await db.save_message(make_event(1001, 1, "价格 上涨，价格 上涨"), news, SENDER)
+            await db.save_message(make_event(1001, 2, "价格 暴跌"), news, SENDER)
+            await db.save_message(make_event(1002, 1, "价格 暴跌", DATE + timedelta(hours=1)), friends, SENDER)
+            # 转发到另一个会话的相同内容只按原始消息计一次
+            await db.save_message(
+                make_event(1002, 2, "价格 暴跌"), friends, SENDER,
+                duplicate=DuplicateMatch(-1000000001001, 2, KIND_EXACT, 0),
+            )
+            assert indexer.start()
+            processed = [await db.index_keywords(indexer) for _ in range(3)]
+            rows = await _fetch(
+                db._connection, "SELECT bucket, chat_id, count FROM term_hourly WHERE term = '价格' ORDER BY 1, 2"
+            )
+            totals = dict(await _fetch(
+                db._connection, f"SELECT term, SUM(count) FROM term_hourly WHERE chat_id = {ALL_CHATS} GROUP BY term"
+            ))
+            return processed, rows, totals
+        finally:
+            indexer.stop()
+            await db.close()
+
+    processed, rows, totals = asyncio.run(scenario())
+    assert processed == [2, 2, 0]
+    assert rows == [
+        ('2026-10-01 08:00:00', -1000000001001, 2),
+        ('2026-10-01 08:00:00', ALL_CHATS, 2),
+        ('2026-10-01 09:00:00', -1000000001002, 1),
+        ('2026-10-01 09:00:00', ALL_CHATS, 1),
+    ]
+    assert totals == {'价格': 3, '上涨': 1, '暴跌': 2}
+
+
+def test_prune_drops_expired_rows_and_old_long_tail_terms(tmp_path):
+    path = str(tmp_path / "messages.db")
+    now = datetime(2026, 10, 10, 12, 0)
+
+    async def scenario():
+        db = DatabaseManager(path)
+        indexer = KeywordIndexer(prune_after_days=2, prune_min_count=2, retention_days=5)
+        try:
+            await db.init_db()
+            await db._connection.executemany(
+                "INSERT INTO term_hourly (bucket, chat_id, term, count) VALUES (?, ?, ?, ?)",
+                [
+                    ('2026-10-01 00:00:00', ALL_CHATS, 'expired', 9),
+                    ('2026-10-07 00:00:00', -1, 'rare', 1),
+                    ('2026-10-07 00:00:00', -1, 'common', 5),
+                    ('2026-10-07 00:00:00', ALL_CHATS, 'rare', 1),
+                    ('2026-10-10 11:00:00', -1, 'recent', 1),
+                ],
+            )
+            await db._connection.commit()
+            deleted = await indexer.prune(db._connection, db._write_lock, now=now)
+            again = await indexer.prune(db._connection, db._write_lock, now=now)
+            rows = await _fetch(db._connection, "SELECT chat_id, term FROM term_hourly ORDER BY term")
+            return deleted, again, rows
+        finally:
+            await db.close()
+
+    deleted, again, rows = asyncio.run(scenario())
+    assert (deleted, again) == (2, 0)
+    # 全部会话的合计保留为热词基线，最近的长尾词等到 prune_after_days 之后再清理
+    assert rows == [(-1, 'common'), (ALL_CHATS, 'rare'), (-1, 'recent')]
@@ -0,0 +1,91 @@
+import asyncio
+from collections import Counter
+
+from utils.eventbus import MAX_DATAGRAM_SIZE, EventPublisher, start_subscriber
+from web.api.live import SUBSCRIBER_QUEUE_SIZE, LiveHub
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def drain(queue: asyncio.Queue) -> list:
+    events = []
+    while not queue.empty():
+        events.append(queue.get_nowait())
+    return events
+
+
+def test_events_cross_processes_as_datagrams():
+    async def scenario():
+        received = asyncio.Queue()
+        transport = await start_subscriber("127.0.0.1", 0, received.put_nowait)
+        port = transport.get_extra_info("sockname")[1]
+        publisher = EventPublisher("127.0.0.1", port)
+        publisher.publish({"type": "ignored"})
+        await publisher.start()
+        try:
+            publisher.publish({"type": "counters", "hourly": {"2026-10-01 10:00:00": 3}})
+            publisher.publish({"type": "messages", "text": "x" * MAX_DATAGRAM_SIZE})
+            event = await asyncio.wait_for(received.get(), 1)
+        finally:
+            publisher.close()
+            transport.close()
+        return event, publisher.sent, publisher.dropped
+
+    event, sent, dropped = run(scenario())
+    assert event == {"type": "counters", "hourly": {"2026-10-01 10:00:00": 3}}
+    assert (sent, dropped) == (1, 1)
+
+
+def test_slow_subscriber_gets_a_single_resync():
+    hub = LiveHub()
+    slow, fast = hub.subscribe(), hub.subscribe()
+    for i in range(SUBSCRIBER_QUEUE_SIZE + 1):
+        hub._on_event({"type": "messages", "n": i})
+        drain(fast)
+    assert drain(slow) == [{"type": "resync"}]
+    hub.unsubscribe(slow)
+    hub.unsubscribe(fast)
+    assert hub.subscriber_count == 0
+
+
+def test_counters_push_only_the_boards_that_changed():
+    hub = LiveHub()
+    hub._boards = {
+        "top_chats_7_days": Counter({-1001: 5}),
+        "top_chats_today": Counter({-1001: 2}),
+        "top_users_7_days": Counter({42: 4}),
+    }
+    hub._chat_titles = {-1001: "News"}
+    hub._sender_names = {42: "Alice"}
+    hub._last_top = {name: hub._top(name) for name in hub._boards}
+    queue = hub.subscribe()
+
+    # 私聊和未知发送者不进入排行榜，只推送小时计数
+    hub._on_event({
+        "type": "counters", "hourly": {"2026-10-01 10:00:00": 1},
+        "chats": [[7, "User", "Direct Message", 1]], "senders": [[0, "Unknown", 1]],
+    })
+    assert drain(queue) == [{"type": "counters", "hourly": {"2026-10-01 10:00:00": 1}}]
+
+    hub._on_event({
+        "type": "counters", "hourly": {"2026-10-01 10:00:00": 2},
+        "chats": [[-1002, "Group", "Friends", 6]], "senders": [],
+    })
+    counters, top = drain(queue)
+    assert counters["type"] == "counters"
+    assert set(top) == {"type", "top_chats_7_days", "top_chats_today"}
+    assert top["top_chats_7_days"] == [
+        {"chat_id": -1002, "chat_title": "Friends", "message_count": 6},
+        {"chat_id": -1001, "chat_title": "News", "message_count": 5},
+    ]
+
+
+def test_registered_handlers_run_without_subscribers():
+    hub = LiveHub()
+    seen = []
+    hub.on("metrics", seen.append)
+    hub._on_event({"type": "metrics", "text": "listentg_up 1"})
+    hub._on_event({"type": "counters", "hourly": {}})
+    assert seen == [{"type": "metrics", "text": "listentg_up 1"}]
@@ -0,0 +1,52 @@
+import json
+import logging
+import queue
+import sys
+
+from utils.logger import DroppingQueueHandler, JsonFormatter, MessageLogSampler
+
+
+def make_record(msg, *args, exc_info=None) -> logging.LogRecord:
+    return logging.LogRecord("handlers.forwarder", logging.INFO, __file__, 1, msg, args, exc_info)
+
+
+def test_full_queue_drops_instead_of_blocking():
+    handler = DroppingQueueHandler(queue.Queue(maxsize=2))
+    for i in range(5):
+        handler.handle(make_record("消息 %d", i))
+    assert handler.dropped == 3
+    # 参数已在入队时合并，输出线程不需要再访问原始参数
+    record = handler.queue.get_nowait()
+    assert (record.msg, record.args) == ("消息 0", None)
+
+
+def test_json_formatter_writes_one_object_per_line():
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record = make_record("转发 %s 条", 3, exc_info=sys.exc_info())
+    line = JsonFormatter().format(record)
+    entry = json.loads(line)
+    assert "\n" not in line
+    assert (entry["level"], entry["logger"], entry["message"]) == ("INFO", "handlers.forwarder", "转发 3 条")
+    assert "ValueError: boom" in entry["exc_info"]
+
+
+def test_sampler_rate_limits_and_reports_suppressed_lines(caplog):
+    sampler = MessageLogSampler(sample=1.0, rate=1.0)
+    with caplog.at_level(logging.INFO, logger="utils.logger"):
+        allowed = [sampler.allow() for _ in range(5)]
+        assert allowed == [True, False, False, False, False]
+        assert (sampler.suppressed, sampler.suppressed_total) == (4, 4)
+        # 令牌恢复后放行，并补一行说明省略了多少条
+        sampler._updated -= 1
+        assert sampler.allow()
+    assert "已省略 4 条" in caplog.text
+    assert (sampler.suppressed, sampler.suppressed_total) == (0, 4)
+
+
+def test_sampler_with_zero_sample_suppresses_everything():
+    sampler = MessageLogSampler(sample=0.0)
+    assert not any(sampler.allow() for _ in range(10))
+    sampler.configure(sample=1.0, rate=0.0)
+    assert all(sampler.allow() for _ in range(10))
@@ -0,0 +1,90 @@
+import asyncio
+
+from utils.metrics import Histogram, MetricsRegistry, _split, counter, gauge, histogram, render_prometheus
+from web.api import metrics as metrics_api
+from web.api.metrics import ListenerMetrics
+
+
+def test_histogram_percentiles_use_bucket_upper_bounds():
+    hist = Histogram(buckets=(1, 10, 100))
+    for value in (0.5, 5, 5, 50, 500):
+        hist.observe(value)
+    assert hist.counts == [1, 2, 1, 1]
+    assert (hist.percentile(0.5), hist.percentile(0.8), hist.percentile(1)) == (10, 100, 500)
+    assert Histogram().percentile(0.5) is None
+
+
+def test_render_prometheus_text_format():
+    hist = Histogram(buckets=(1, 10))
+    for value in (0.5, 5, 50):
+        hist.observe(value)
+    samples = [
+        counter("listentg_forwarded_total", "已转发", 3, target="主群"),
+        counter("listentg_forwarded_total", "已转发", 1.5, target='a"b'),
+        gauge("listentg_queue_depth", "深度", 2.0),
+        histogram("listentg_latency_seconds", "延迟", hist, scale=0.001),
+    ]
+    assert render_prometheus(samples, process="listener").splitlines() == [
+        "# HELP listentg_forwarded_total 已转发",
+        "# TYPE listentg_forwarded_total counter",
+        'listentg_forwarded_total{process="listener",target="主群"} 3',
+        'listentg_forwarded_total{process="listener",target="a\\"b"} 1.5',
+        "# HELP listentg_queue_depth 深度",
+        "# TYPE listentg_queue_depth gauge",
+        'listentg_queue_depth{process="listener"} 2',
+        "# HELP listentg_latency_seconds 延迟",
+        "# TYPE listentg_latency_seconds histogram",
+        'listentg_latency_seconds_bucket{process="listener",le="0.001"} 1',
+        'listentg_latency_seconds_bucket{process="listener",le="0.01"} 2',
+        'listentg_latency_seconds_bucket{process="listener",le="+Inf"} 3',
+        'listentg_latency_seconds_sum{process="listener"} 0.0555',
+        'listentg_latency_seconds_count{process="listener"} 3',
+    ]
+
+
+def test_registry_skips_failing_collectors():
+    registry = MetricsRegistry()
+
+    async def async_collector():
+        return [gauge("b", "b", 2)]
+
+    def broken():
+        raise RuntimeError("boom")
+
+    registry.register(lambda: [counter("a", "a", 1)])
+    registry.register(broken)
+    registry.register(async_collector)
+    assert [sample["name"] for sample in asyncio.run(registry.collect())] == ["a", "b"]
+
+
+def test_pushed_samples_are_split_and_reassembled():
+    samples = [gauge(f"listentg_metric_{i}", "x" * 50, i) for i in range(10)]
+    chunks = _split(samples, 300)
+    assert len(chunks) > 1 and [s for chunk in chunks for s in chunk] == samples
+
+    received = ListenerMetrics(interval=10)
+    events = [
+        {"type": "metrics", "pid": 7, "seq": 1, "part": part, "parts": len(chunks), "samples": chunk}
+        for part, chunk in enumerate(chunks)
+    ]
+    # 丢失了部分数据报的推送被放弃，下一次完整推送才生效
+    received.update(events[0])
+    received.update(dict(events[0], seq=2))
+    for event in events[1:]:
+        received.update(dict(event, seq=2))
+    assert (received.samples, received.updates) == (samples, 1)
+    assert received.is_fresh()
+
+
+def test_metrics_endpoint_merges_both_processes(monkeypatch):
+    listener = ListenerMetrics(interval=10)
+    monkeypatch.setattr(metrics_api, "listener_metrics", listener)
+    stale = asyncio.run(metrics_api.metrics())
+    listener.update({"type": "metrics", "pid": 7, "seq": 1, "samples": [counter("listentg_messages_total", "消息", 5)]})
+    fresh = asyncio.run(metrics_api.metrics())
+
+    assert stale.media_type == metrics_api.PROMETHEUS_CONTENT_TYPE
+    assert 'listentg_listener_up{process="web"} 0' in stale.body.decode()
+    assert "listentg_messages_total" not in stale.body.decode()
+    assert 'listentg_listener_up{process="web"} 1' in fresh.body.decode()
+    assert 'listentg_messages_total{process="listener"} 5' in fresh.body.decode()
@@ -0,0 +1,167 @@
+import asyncio
+import os
+
+import aiosqlite
+import pytest
+
+from handlers.migrations import LATEST_VERSION, get_version, migrate
+
+# 引入迁移之前（基线版本）的 messages 表结构
+BASELINE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    chat_type TEXT,
+    chat_title TEXT,
+    sender_id INTEGER,
+    sender_name TEXT,
+    sender_username TEXT,
+    text TEXT,
+    raw_text TEXT,
+    date TIMESTAMP NOT NULL,
+    is_reply BOOLEAN,
+    reply_to_message_id INTEGER
+)
+"""
+
+BASELINE_ROWS = [
+    # (message_id, chat_id, chat_type, chat_title, sender_id, sender_name, text, date)
+    (1, -1000000000001, 'Channel', 'News', 5, 'Alice', 'hello', '2026-10-01 10:05:00'),
+    (2, -1000000000001, 'Channel', 'News (renamed)', 6, 'Bob', 'world', '2026-10-01 10:40:00'),
+    (1, -42, 'Group', 'Friends', 5, 'Alice', 'hi', '2026-10-01 11:00:00'),
+    (3, -1000000000001, 'Channel', 'News (renamed)', None, None, 'anonymous', '2026-10-01 11:30:00'),
+]
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def _baseline_db(path, rows=BASELINE_ROWS):
+    conn = await aiosqlite.connect(path)
+    await conn.execute(BASELINE_SCHEMA)
+    await conn.executemany(
+        "INSERT INTO messages (message_id, chat_id, chat_type, chat_title, sender_id, sender_name, text, date) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+    await conn.commit()
+    return conn
+
+
+async def _fetch(conn, sql):
+    async with conn.execute(sql) as cursor:
+        return await cursor.fetchall()
+
+
+def test_baseline_database_migrates_to_latest(tmp_path):
+    async def scenario():
+        conn = await _baseline_db(str(tmp_path / "baseline.db"))
+        try:
+            assert await get_version(conn) == 0
+            assert await migrate(conn) == LATEST_VERSION
+            assert await get_version(conn) == LATEST_VERSION
+            tables = {row[0] for row in await _fetch(conn, "SELECT name FROM sqlite_master WHERE type = 'table'")}
+            assert {
+                'messages', 'meta', 'messages_fts', 'rollup_hourly', 'rollup_chat_hourly', 'rollup_sender_hourly',
+                'forward_queue', 'chats', 'users', 'backfill_checkpoints', 'term_hourly', 'message_duplicates',
+            } <= tables
+            assert await _fetch(conn, "SELECT bucket, message_count FROM rollup_hourly ORDER BY bucket") == [
+                ('2026-10-01 10:00:00', 2), ('2026-10-01 11:00:00', 2),
+            ]
+            assert await _fetch(conn, "SELECT bucket, chat_id, message_count FROM rollup_chat_hourly ORDER BY 1, 2") == [
+                ('2026-10-01 10:00:00', -1000000000001, 2),
+                ('2026-10-01 11:00:00', -1000000000001, 1),
+                ('2026-10-01 11:00:00', -42, 1),
+            ]
+            assert await _fetch(conn, "SELECT bucket, sender_id, message_count FROM rollup_sender_hourly ORDER BY 1, 2") == [
+                ('2026-10-01 10:00:00', 5, 1), ('2026-10-01 10:00:00', 6, 1),
+                ('2026-10-01 11:00:00', 0, 1), ('2026-10-01 11:00:00', 5, 1),
+            ]
+            # 维度表取每个会话、每个发送者最新一条消息中的元数据
+            assert await _fetch(conn, "SELECT chat_id, chat_type, chat_title FROM chats ORDER BY chat_id") == [
+                (-1000000000001, 'Channel', 'News (renamed)'), (-42, 'Group', 'Friends'),
+            ]
+            assert await _fetch(conn, "SELECT sender_id, sender_name FROM users ORDER BY sender_id") == [
+                (5, 'Alice'), (6, 'Bob'),
+            ]
+            meta = dict(await _fetch(conn, "SELECT key, value FROM meta"))
+            assert meta['fts_backfill_upto'] == '4' and meta['normalize_upto'] == '4'
+            assert 'rollup_rebuild_pending' in meta
+            # 再次执行不做任何事
+            assert await migrate(conn) == LATEST_VERSION
+        finally:
+            await conn.close()
+
+    run(scenario())
+
+
+def test_v4_creates_the_original_name_keyed_rollups(tmp_path):
+    async def scenario():
+        conn = await _baseline_db(str(tmp_path / "v4.db"))
+        try:
+            assert await migrate(conn, target_version=4) == 4
+            assert await _fetch(conn, "SELECT * FROM rollup_chat_hourly ORDER BY 1, 2, 3") == [
+                ('2026-10-01 10:00:00', 'Channel', 'News', 1),
+                ('2026-10-01 10:00:00', 'Channel', 'News (renamed)', 1),
+                ('2026-10-01 11:00:00', 'Channel', 'News (renamed)', 1),
+                ('2026-10-01 11:00:00', 'Group', 'Friends', 1),
+            ]
+            assert await _fetch(conn, "SELECT * FROM rollup_sender_hourly ORDER BY 1, 2") == [
+                ('2026-10-01 10:00:00', 'Alice', 1), ('2026-10-01 10:00:00', 'Bob', 1),
+                ('2026-10-01 11:00:00', 'Alice', 1), ('2026-10-01 11:00:00', 'Unknown', 1),
+            ]
+        finally:
+            await conn.close()
+
+    run(scenario())
+
+
+def test_empty_database_migrates_to_latest(tmp_path):
+    async def scenario():
+        async with aiosqlite.connect(str(tmp_path / "empty.db")) as conn:
+            assert await migrate(conn) == LATEST_VERSION
+
+    run(scenario())
+
+
+def test_v9_refuses_duplicates_and_rolls_back(tmp_path):
+    async def scenario():
+        conn = await _baseline_db(str(tmp_path / "duplicates.db"), BASELINE_ROWS + [BASELINE_ROWS[0]])
+        try:
+            with pytest.raises(RuntimeError, match="manage.py dedupe"):
+                await migrate(conn)
+            assert await get_version(conn) == 8
+            assert (await _fetch(conn, "SELECT COUNT(*) FROM messages"))[0][0] == len(BASELINE_ROWS) + 1
+        finally:
+            await conn.close()
+
+    run(scenario())
+
+
+def test_dedupe_backs_up_duplicates_before_v9(workdir):
+    from handlers.database import DB_PATH, DatabaseManager
+
+    async def scenario():
+        conn = await _baseline_db(DB_PATH, BASELINE_ROWS + [BASELINE_ROWS[0], BASELINE_ROWS[2]])
+        await conn.close()
+        manager = DatabaseManager()
+        try:
+            assert await manager.remove_duplicate_messages() == 2
+            assert await manager.remove_duplicate_messages() == 0
+            conn = manager._connection
+            assert await _fetch(conn, "SELECT id, message_id, chat_id FROM messages_duplicates_backup ORDER BY id") == [
+                (5, 1, -1000000000001), (6, 1, -42),
+            ]
+            assert await _fetch(conn, "SELECT bucket, message_count FROM rollup_hourly ORDER BY bucket") == [
+                ('2026-10-01 10:00:00', 2), ('2026-10-01 11:00:00', 2),
+            ]
+            assert await migrate(conn) == LATEST_VERSION
+        finally:
+            await manager.close()
+
+    run(scenario())
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(DB_PATH + suffix):
+            os.remove(DB_PATH + suffix)
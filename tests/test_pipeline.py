@@ -0,0 +1,134 @@
+import asyncio
+
+from factories import make_event, make_rule
+from handlers.pipeline import POLICY_DROP, IngestPipeline, MessageContext, Stage
+from handlers.rules import RuleEngine
+from utils.config import PIPELINE_STAGE_DEFAULTS
+from utils.entity_cache import ChatInfo
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_drop_policy_discards_when_the_queue_is_full():
+    async def handler(ctx):
+        return None
+
+    async def scenario():
+        stage = Stage("log", handler, workers=1, queue_size=1, policy=POLICY_DROP)
+        accepted = [await stage.submit(MessageContext(make_event(-1, message_id=i))) for i in range(3)]
+        return accepted, stage.dropped, stage.depth()
+
+    assert run(scenario()) == ([True, False, False], 2, 1)
+
+
+def test_block_policy_waits_for_the_worker():
+    seen = []
+
+    async def handler(ctx):
+        seen.append(ctx.event.message.id)
+
+    async def scenario():
+        stage = Stage("persist", handler, workers=1, queue_size=1)
+        await stage.submit(MessageContext(make_event(-1, message_id=1)))
+        blocked = asyncio.create_task(stage.submit(MessageContext(make_event(-1, message_id=2))))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+        stage.start()
+        await asyncio.wait_for(blocked, 1)
+        await stage.stop()
+        return stage.dropped
+
+    assert run(scenario()) == 0
+    assert seen == [1, 2]
+
+
+def test_each_chat_keeps_its_order_across_workers():
+    seen = {}
+
+    async def handler(ctx):
+        # 让不同消息的处理时间不同，打乱跨会话的完成顺序
+        await asyncio.sleep(0.001 * (ctx.event.message.id % 3))
+        seen.setdefault(ctx.event.chat_id, []).append(ctx.event.message.id)
+
+    async def scenario():
+        stage = Stage("filter", handler, workers=4, queue_size=100)
+        stage.start()
+        for message_id in range(30):
+            await stage.submit(MessageContext(make_event(-(message_id % 5) - 1, message_id=message_id)))
+        await stage.stop()
+
+    run(scenario())
+    assert all(ids == sorted(ids) for ids in seen.values()) and sum(map(len, seen.values())) == 30
+
+
+def test_errors_and_false_results_stop_the_message():
+    passed = []
+
+    async def handler(ctx):
+        if ctx.event.message.id == 1:
+            raise RuntimeError("boom")
+        return ctx.event.message.id != 2
+
+    async def downstream(ctx):
+        passed.append(ctx.event.message.id)
+
+    async def scenario():
+        stage = Stage("filter", handler)
+        sink = Stage("persist", downstream)
+        stage.then(sink)
+        for stage_ in (stage, sink):
+            stage_.start()
+        for message_id in (1, 2, 3):
+            await stage.submit(MessageContext(make_event(-1, message_id=message_id)))
+        await stage.stop()
+        await sink.stop()
+        return stage.stats()
+
+    stats = run(scenario())
+    assert passed == [3]
+    assert (stats["processed"], stats["errors"], stats["depth"]) == (2, 1, 0)
+    assert stats["latency_ms"]["count"] == 3
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.saved = []
+
+    async def save_message(self, event, chat, sender, duplicate):
+        self.saved.append(event.message.id)
+
+
+class FakeQueue:
+    def __init__(self):
+        self.items = []
+
+    async def put(self, chat_id, message_id, target):
+        self.items.append((chat_id, message_id, target))
+
+
+class FakeCache:
+    async def resolve(self, event):
+        return ChatInfo(event.chat_id, 'Channel', 'News'), None
+
+
+def test_pipeline_filters_persists_and_fans_out_before_stopping():
+    rules = RuleEngine([
+        make_rule('spam', keywords=['spam']),
+        make_rule('alerts', action='include', keywords=['alert'], targets=[10, 20]),
+    ], default_target=-1000000000100)
+    db, queue = FakeDatabase(), FakeQueue()
+    pipeline = IngestPipeline(db, queue, FakeCache(), rules, PIPELINE_STAGE_DEFAULTS)
+
+    async def scenario():
+        pipeline.start()
+        await pipeline.submit(make_event(-1001, "buy spam now", message_id=1))
+        await pipeline.submit(make_event(-1001, "alert: disk full", message_id=2))
+        await pipeline.submit(make_event(-1002, "hello", message_id=3))
+        await pipeline.stop()
+
+    run(scenario())
+    assert (pipeline.received, pipeline.excluded) == (3, 1)
+    assert sorted(db.saved) == [2, 3]
+    assert sorted(queue.items) == [(-1001, 2, 10), (-1001, 2, 20)]
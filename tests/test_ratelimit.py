@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+import pytest
+
+from utils.ratelimit import TokenBucket
+
+
+def test_burst_is_free_then_paced_by_rate():
+    async def scenario():
+        bucket = TokenBucket(rate=20, burst=2)
+        start = time.monotonic()
+        await bucket.acquire()
+        await bucket.acquire()
+        burst = time.monotonic() - start
+        await bucket.acquire()
+        await bucket.acquire()
+        return burst, time.monotonic() - start
+
+    burst, total = asyncio.run(scenario())
+    assert burst < 0.03
+    # 突发之后的两个令牌按 20 个/秒补充
+    assert total >= 0.09
+
+
+def test_penalize_halves_rate_down_to_the_floor_and_reward_recovers():
+    bucket = TokenBucket(rate=8, burst=1)
+    bucket.penalize(0)
+    assert bucket.rate == 4
+    for _ in range(10):
+        bucket.penalize(0)
+    assert bucket.rate == bucket.min_rate == 0.5
+    rates = []
+    for _ in range(20):
+        bucket.reward()
+        rates.append(bucket.rate)
+    # 每次成功恢复配置值的十分之一，不超过配置值
+    assert rates[:3] == pytest.approx([1.3, 2.1, 2.9])
+    assert rates[-1] == 8 and max(rates) == 8
+
+
+def test_penalize_pauses_acquire():
+    async def scenario():
+        bucket = TokenBucket(rate=1000, burst=5)
+        bucket.penalize(0.1)
+        start = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - start
+
+    assert asyncio.run(scenario()) >= 0.09
+
+
+def test_configure_resets_rate_and_caps_tokens():
+    bucket = TokenBucket(rate=10, burst=10)
+    bucket.penalize(0)
+    bucket.configure(rate=2, burst=3)
+    assert (bucket.rate, bucket.max_rate, bucket.burst, bucket.min_rate) == (2, 2, 3, 0.125)
+    assert bucket._tokens <= 3
@@ -0,0 +1,71 @@
+import asyncio
+
+from telethon.errors import FloodWaitError
+
+from factories import make_event
+from handlers.read_receipts import ReadReceiptAggregator
+
+
+class FakeClient:
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.sent = []
+
+    async def get_input_entity(self, chat_id):
+        return chat_id
+
+    async def send_read_acknowledge(self, entity, max_id, clear_mentions):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((entity, max_id))
+
+
+def test_marks_coalesce_to_one_request_per_chat():
+    client = FakeClient()
+    receipts = ReadReceiptAggregator(client)
+    for chat_id, message_id in [(-1001, 5), (-1001, 9), (-1001, 7), (-1002, 1)]:
+        receipts.mark(make_event(chat_id, message_id=message_id))
+
+    assert asyncio.run(receipts.flush()) == 0
+    assert sorted(client.sent) == [(-1002, 1), (-1001, 9)]
+    stats = receipts.stats()
+    assert (stats["marked"], stats["requests"], stats["pending_chats"]) == (4, 2, 0)
+
+
+def test_excluded_chats_accept_bare_and_marked_ids():
+    receipts = ReadReceiptAggregator(FakeClient(), exclude_chat_ids={1001, -1000000001002})
+    assert not receipts.mark(make_event(-1000000001001))
+    assert not receipts.mark(make_event(-1000000001002))
+    assert receipts.mark(make_event(-1000000001003))
+    assert receipts.stats()["pending_chats"] == 1
+
+
+def test_full_buffer_drops_new_chats_but_updates_known_ones():
+    receipts = ReadReceiptAggregator(FakeClient(), max_pending_chats=2)
+    assert receipts.mark(make_event(-1, message_id=1))
+    assert receipts.mark(make_event(-2, message_id=1))
+    # 缓冲区已满：唤醒发送任务，新会话的回执被丢弃，已有会话仍可推进
+    assert receipts._wakeup.is_set()
+    assert not receipts.mark(make_event(-3, message_id=1))
+    assert receipts.mark(make_event(-1, message_id=5))
+    assert receipts._pending == {-1: 5, -2: 1}
+    assert receipts.dropped == 1
+
+
+def test_flood_wait_keeps_unsent_receipts():
+    client = FakeClient([FloodWaitError(request=None, capture=30)])
+    receipts = ReadReceiptAggregator(client)
+    receipts.mark(make_event(-1, message_id=3))
+    receipts.mark(make_event(-2, message_id=4))
+
+    async def scenario():
+        flood_wait = await receipts.flush()
+        # 等待期间同一会话有更新的消息，以较大的 id 为准
+        receipts.mark(make_event(-1, message_id=2))
+        pending = dict(receipts._pending)
+        return flood_wait, pending, await receipts.flush()
+
+    flood_wait, pending, after = asyncio.run(scenario())
+    assert flood_wait == 30 and after == 0
+    assert pending == {-1: 3, -2: 4}
+    assert sorted(client.sent) == [(-2, 4), (-1, 3)]
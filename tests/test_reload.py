@@ -0,0 +1,54 @@
+import asyncio
+
+from conftest import CONFIG
+from utils.config import Config
+from utils.reload import ConfigReloader
+
+
+def write_config(path, extra: str = ""):
+    path.write_text(CONFIG + extra, encoding="utf-8")
+
+
+def test_reload_applies_changes_but_keeps_restart_required_settings(tmp_path):
+    path = tmp_path / "config.ini"
+    write_config(path, "rate = 2\nconcurrency = 1\n")
+    config = Config(str(path))
+    write_config(path, "rate = 5\nconcurrency = 4\n\n[logging]\nlevel = debug\n")
+
+    changed = config.reload()
+    assert changed == {"forwarding_rate", "log_level"}
+    assert (config.forwarding_rate, config.log_level) == (5.0, "DEBUG")
+    # 并发数需要重启才能生效
+    assert config.forwarding_concurrency == 1
+    assert config.config.getint("forwarding", "concurrency") == 4
+
+
+def test_invalid_config_keeps_current_settings_and_skips_subscribers(tmp_path):
+    path = tmp_path / "config.ini"
+    write_config(path, "rate = 2\n")
+    config = Config(str(path))
+    reloader = ConfigReloader(config, interval=0)
+    notified = []
+
+    async def subscriber(changed):
+        notified.append(changed)
+
+    async def failing(changed):
+        raise RuntimeError("boom")
+
+    reloader.subscribe(failing)
+    reloader.subscribe(subscriber)
+
+    async def scenario():
+        write_config(path, "rate = 0\n")
+        invalid = await reloader.reload()
+        write_config(path, "rate = 3\n")
+        valid = await reloader.reload()
+        unchanged = await reloader.reload()
+        return invalid, valid, unchanged
+
+    # 新配置无效时继续使用当前配置；订阅者出错不影响其他订阅者
+    assert asyncio.run(scenario()) == (False, True, True)
+    assert config.forwarding_rate == 3.0
+    assert notified == [{"forwarding_rate"}]
+    assert (reloader.reloads, reloader.failures) == (2, 1)
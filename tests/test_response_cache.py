@@ -0,0 +1,128 @@
+import asyncio
+import json
+
+import pytest
+from starlette.requests import Request
+
+from web.api import data
+from web.api.data import ResponseCache, _etag_matches
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def make_request(if_none_match=None) -> Request:
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers})
+
+
+def test_concurrent_requests_compute_once():
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"total": 3}
+
+    async def scenario():
+        cache = ResponseCache(ttl=60, max_entries=10)
+        results = await asyncio.gather(*(cache.get("dashboard", 7, compute) for _ in range(5)))
+        return cache, results
+
+    cache, results = run(scenario())
+    assert len(calls) == 1
+    assert len(set(results)) == 1 and json.loads(results[0][0]) == {"total": 3}
+    assert (cache.misses, cache.shared, cache.hits) == (1, 4, 0)
+
+
+def test_watermark_change_and_ttl_invalidate():
+    values = iter(range(100))
+
+    async def compute():
+        return next(values)
+
+    async def scenario():
+        cache = ResponseCache(ttl=0.2, max_entries=10)
+        first = await cache.get("k", 1, compute)
+        hit = await cache.get("k", 1, compute)
+        # 有新消息写入（水位线变化）时立即失效
+        moved = await cache.get("k", 2, compute)
+        await asyncio.sleep(0.25)
+        expired = await cache.get("k", 2, compute)
+        return first, hit, moved, expired, cache.stats()
+
+    first, hit, moved, expired, stats = run(scenario())
+    assert hit == first
+    assert [body for body, _ in (first, moved, expired)] == [b"0", b"1", b"2"]
+    assert first[1] != moved[1]
+    assert (stats["hits"], stats["misses"]) == (1, 3)
+
+
+def test_failure_is_shared_and_not_cached():
+    attempts = []
+
+    async def compute():
+        attempts.append(1)
+        await asyncio.sleep(0.01)
+        if len(attempts) == 1:
+            raise RuntimeError("database is locked")
+        return "ok"
+
+    async def scenario():
+        cache = ResponseCache(ttl=60, max_entries=10)
+        failed = await asyncio.gather(cache.get("k", 1, compute), cache.get("k", 1, compute), return_exceptions=True)
+        return failed, await cache.get("k", 1, compute)
+
+    failed, retried = run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in failed)
+    assert retried[0] == b'"ok"' and len(attempts) == 2
+
+
+def test_least_recently_used_entries_are_evicted():
+    async def compute():
+        return 1
+
+    async def scenario():
+        cache = ResponseCache(ttl=60, max_entries=2)
+        await cache.get("a", 1, compute)
+        await cache.get("b", 1, compute)
+        await cache.get("a", 1, compute)
+        await cache.get("c", 1, compute)
+        return list(cache._entries)
+
+    assert run(scenario()) == ["a", "c"]
+
+
+@pytest.mark.parametrize("header, matches", [
+    (None, False),
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"x", "abc"', True),
+    ("*", True),
+    ('"abd"', False),
+])
+def test_etag_matching(header, matches):
+    assert _etag_matches(make_request(header), '"abc"') is matches
+
+
+def test_cached_response_returns_304_for_current_etag(monkeypatch):
+    async def watermark():
+        return 1
+
+    async def compute():
+        return {"total": 3}
+
+    monkeypatch.setattr(data, "get_watermark", watermark)
+    monkeypatch.setattr(data, "response_cache", ResponseCache(ttl=60, max_entries=10))
+
+    async def scenario():
+        full = await data.cached_response(make_request(), "dashboard", compute)
+        etag = full.headers["etag"]
+        not_modified = await data.cached_response(make_request(etag), "dashboard", compute)
+        return full, not_modified
+
+    full, not_modified = run(scenario())
+    assert full.status_code == 200 and json.loads(full.body) == {"total": 3}
+    assert not_modified.status_code == 304 and not_modified.headers["etag"] == full.headers["etag"]
+    assert data.response_cache.not_modified == 1
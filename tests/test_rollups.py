@@ -0,0 +1,131 @@
+import asyncio
+import sqlite3
+from datetime import datetime
+
+import aiosqlite
+
+from handlers import rollups
+
+MESSAGES_TABLE = """
+CREATE TABLE messages (
+    id INTEGER PRIMARY KEY, message_id INTEGER, chat_id INTEGER, sender_id INTEGER, date TIMESTAMP NOT NULL
+)
+"""
+
+ROWS = [
+    # (message_id, chat_id, sender_id, date)
+    (1, -1001, 5, '2026-10-01 10:05:00'),
+    (2, -1001, 6, '2026-10-01 10:59:59'),
+    (3, -42, 5, '2026-10-01 11:00:00'),
+    (4, -1001, None, '2026-10-01 11:30:00+00:00'),
+]
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def _open() -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(":memory:")
+    await conn.execute(MESSAGES_TABLE)
+    await rollups.create_tables(conn)
+    return conn
+
+
+async def _insert(conn, rows) -> int:
+    """插入一批消息并按写入器的方式累加预聚合表，返回插入前的最大 id。"""
+    async with conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages") as cursor:
+        last_id = (await cursor.fetchone())[0]
+    await conn.executemany("INSERT INTO messages (message_id, chat_id, sender_id, date) VALUES (?, ?, ?, ?)", rows)
+    await rollups.apply_new_messages(conn, last_id)
+    await conn.commit()
+    return last_id
+
+
+async def _snapshot(conn) -> dict:
+    snapshot = {}
+    for table in rollups.ROLLUP_TABLES:
+        async with conn.execute(f"SELECT * FROM {table} ORDER BY 1, 2") as cursor:
+            snapshot[table] = await cursor.fetchall()
+    return snapshot
+
+
+EXPECTED = {
+    "rollup_hourly": [('2026-10-01 10:00:00', 2), ('2026-10-01 11:00:00', 2)],
+    "rollup_chat_hourly": [
+        ('2026-10-01 10:00:00', -1001, 2), ('2026-10-01 11:00:00', -1001, 1), ('2026-10-01 11:00:00', -42, 1),
+    ],
+    "rollup_sender_hourly": [
+        ('2026-10-01 10:00:00', 5, 1), ('2026-10-01 10:00:00', 6, 1),
+        ('2026-10-01 11:00:00', 0, 1), ('2026-10-01 11:00:00', 5, 1),
+    ],
+}
+
+
+def test_bucket_of():
+    assert rollups.bucket_of(datetime(2026, 10, 1, 23, 59, 59)) == '2026-10-01 23:00:00'
+
+
+def test_batches_accumulate_into_hourly_buckets():
+    async def scenario():
+        conn = await _open()
+        try:
+            await _insert(conn, ROWS[:1])
+            await _insert(conn, ROWS[1:3])
+            await _insert(conn, ROWS[3:])
+            return await _snapshot(conn)
+        finally:
+            await conn.close()
+
+    assert run(scenario()) == EXPECTED
+
+
+def test_remove_messages_subtracts_and_drops_empty_buckets():
+    async def scenario():
+        conn = await _open()
+        try:
+            await _insert(conn, ROWS)
+            await rollups.remove_messages(conn, "chat_id = ?", (-42,))
+            await conn.execute("DELETE FROM messages WHERE chat_id = ?", (-42,))
+            await conn.commit()
+            return await _snapshot(conn)
+        finally:
+            await conn.close()
+
+    snapshot = run(scenario())
+    assert snapshot["rollup_hourly"] == [('2026-10-01 10:00:00', 2), ('2026-10-01 11:00:00', 1)]
+    assert ('2026-10-01 11:00:00', -42, 1) not in snapshot["rollup_chat_hourly"]
+    assert snapshot["rollup_sender_hourly"] == [
+        ('2026-10-01 10:00:00', 5, 1), ('2026-10-01 10:00:00', 6, 1), ('2026-10-01 11:00:00', 0, 1),
+    ]
+
+
+def test_rebuild_in_chunks_matches_incremental_counts_and_includes_archives(tmp_path):
+    archive = str(tmp_path / "messages_2026_09.db")
+    with sqlite3.connect(archive) as conn:
+        conn.execute(MESSAGES_TABLE)
+        conn.execute("INSERT INTO messages VALUES (100, 9, -1001, 5, '2026-09-30 08:00:00')")
+
+    async def scenario():
+        conn = await _open()
+        try:
+            await _insert(conn, ROWS)
+            # 预聚合表与消息不一致时，重建以消息为准
+            await conn.execute("DELETE FROM rollup_hourly")
+            await conn.execute("UPDATE rollup_chat_hourly SET message_count = 99")
+            await conn.commit()
+            await rollups.rebuild(conn, chunk_size=1)
+            rebuilt = await _snapshot(conn)
+            await rollups.rebuild(conn, chunk_size=3, archives=[archive])
+            with_archive = await _snapshot(conn)
+            async with conn.execute("SELECT name FROM sqlite_master WHERE name LIKE '%_rebuild'") as cursor:
+                leftovers = await cursor.fetchall()
+            return rebuilt, with_archive, leftovers
+        finally:
+            await conn.close()
+
+    rebuilt, with_archive, leftovers = run(scenario())
+    assert rebuilt == EXPECTED
+    assert with_archive["rollup_hourly"] == [('2026-09-30 08:00:00', 1)] + EXPECTED["rollup_hourly"]
+    assert with_archive["rollup_chat_hourly"][0] == ('2026-09-30 08:00:00', -1001, 1)
+    assert leftovers == []
@@ -0,0 +1,151 @@
+from types import SimpleNamespace
+
+import pytest
+from telethon.tl.types import PeerChannel, PeerUser
+
+from conftest import CONFIG
+from factories import make_event, make_rule
+from handlers.rules import KeywordAutomaton, RuleEngine, forward_source
+from utils.config import Config, ConfigError
+
+DEFAULT_TARGET = -1000000000100
+
+
+def evaluate(definitions, event):
+    return RuleEngine(definitions, default_target=DEFAULT_TARGET).evaluate(event)
+
+
+def test_no_rules_forwards_to_default_target():
+    decision = evaluate([], make_event(-1000000000001, "hello"))
+    assert (decision.excluded, decision.targets, decision.rules) == (False, [DEFAULT_TARGET], [])
+
+
+def test_exclude_by_chat_and_sender():
+    rules = [
+        make_rule('chats', chat_ids={-1000000000001}),
+        make_rule('senders', sender_ids={42}),
+    ]
+    assert evaluate(rules, make_event(-1000000000001, "hi", sender_id=7)).excluded
+    assert evaluate(rules, make_event(-1000000000002, "hi", sender_id=42)).excluded
+    assert not evaluate(rules, make_event(-1000000000002, "hi", sender_id=7)).excluded
+
+
+def test_peer_types_are_not_confused():
+    """同一个数字分别作为用户、普通群组和频道时是不同的实体。"""
+    rules = [make_rule('group', chat_ids={-1234})]
+    assert evaluate(rules, make_event(-1234, "hi")).excluded
+    assert not evaluate(rules, make_event(-1000000001234, "hi")).excluded
+    assert not evaluate(rules, make_event(1234, "hi")).excluded
+
+
+def test_conditions_are_combined_with_and():
+    rules = [make_rule('ads', chat_ids={-1000000000001}, keywords=['promo'])]
+    assert evaluate(rules, make_event(-1000000000001, "big PROMO today")).excluded
+    assert not evaluate(rules, make_event(-1000000000001, "nothing here")).excluded
+    assert not evaluate(rules, make_event(-1000000000002, "big promo today")).excluded
+
+
+def test_regex_with_inline_flags():
+    rules = [
+        make_rule('spam', regexes=['(?i)spam', r'^\d+$']),
+        make_rule('multiline', chat_ids={-1000000000002}, regexes=['(?s)start.+end']),
+    ]
+    engine = RuleEngine(rules, default_target=DEFAULT_TARGET)
+    assert engine.evaluate(make_event(-1000000000001, "SPAM offer")).rules == ['spam']
+    assert engine.evaluate(make_event(-1000000000001, "12345")).rules == ['spam']
+    assert engine.evaluate(make_event(-1000000000002, "start\nend")).rules == ['multiline']
+    assert engine.evaluate(make_event(-1000000000001, "start\nend")).rules == []
+
+
+def test_forward_source_and_media():
+    rules = [make_rule('reposts', forward_from={-1000000000009}), make_rule('stickers', media={'sticker'})]
+    forwarded = make_event(-1000000000001, "x", fwd_from=SimpleNamespace(from_id=PeerChannel(9)))
+    assert evaluate(rules, forwarded).rules == ['reposts']
+    from_user = make_event(-1000000000001, "x", fwd_from=SimpleNamespace(from_id=PeerUser(9)))
+    assert evaluate(rules, from_user).rules == []
+    assert forward_source(from_user.message) == 9
+
+    sticker = make_event(-1000000000001, "")
+    sticker.message.media = object()
+    sticker.message.sticker = True
+    assert evaluate(rules, sticker).rules == ['stickers']
+
+
+def test_include_rules_route_to_targets():
+    rules = [
+        make_rule('news', action='include', keywords=['breaking'], targets=[10, 20]),
+        make_rule('vip', action='include', sender_ids={42}, targets=[20, 30]),
+        make_rule('fallback', action='include', chat_ids={-1000000000005}),
+    ]
+    decision = evaluate(rules, make_event(-1000000000001, "Breaking news", sender_id=42))
+    assert decision.targets == [10, 20, 30]
+    assert decision.rules == ['news', 'vip']
+    assert evaluate(rules, make_event(-1000000000005, "hi")).targets == [DEFAULT_TARGET]
+    # 存在 include 规则时，没有匹配任何规则的消息只入库、不转发
+    decision = evaluate(rules, make_event(-1000000000001, "hi"))
+    assert (decision.excluded, decision.targets) == (False, [])
+
+
+def test_exclude_wins_over_include():
+    rules = [
+        make_rule('news', action='include', keywords=['breaking'], targets=[10]),
+        make_rule('muted', sender_ids={7}),
+    ]
+    decision = evaluate(rules, make_event(-1000000000001, "breaking", sender_id=7))
+    assert (decision.excluded, decision.targets, decision.rules) == (True, [], ['news', 'muted'])
+
+
+def test_evaluate_message_uses_message_ids():
+    rules = [make_rule('muted', sender_ids={7})]
+    engine = RuleEngine(rules, default_target=DEFAULT_TARGET)
+    message = SimpleNamespace(chat_id=-1000000000001, sender_id=7, raw_text="hi", fwd_from=None, media=None)
+    assert engine.evaluate_message(message).excluded
+
+
+def test_keyword_automaton_finds_overlapping_keywords():
+    automaton = KeywordAutomaton(['he', 'she', 'his', 'hers'])
+    assert automaton.search('ushers') == {0, 1, 3}
+    assert automaton.search('nothing') == set()
+
+
+def test_config_validates_each_regex(tmp_path):
+    path = tmp_path / "config.ini"
+    path.write_text(CONFIG + "\n[rule.spam]\nregex =\n    (?i)spam\n    (?s)a.b\n", encoding="utf-8")
+    assert Config(str(path)).rules[0]['regexes'] == ['(?i)spam', '(?s)a.b']
+
+    path.write_text(CONFIG + "\n[rule.broken]\nregex = (unclosed\n", encoding="utf-8")
+    with pytest.raises(ConfigError):
+        Config(str(path))
+
+
+def test_legacy_filters_accept_bare_and_marked_ids(tmp_path):
+    path = tmp_path / "config.ini"
+    path.write_text(
+        CONFIG + "\n[filters]\nexclude_chat_ids = 1001, -1000000002002\nexclude_sender_ids = 42\n", encoding="utf-8"
+    )
+    engine = RuleEngine(Config(str(path)).rules, default_target=-1000000000100)
+    # 旧配置中的频道 id 不带 -100 前缀，升级后仍然要排除该频道
+    assert engine.evaluate(make_event(-1000000001001, "hi")).excluded
+    assert engine.evaluate(make_event(-1001, "hi")).excluded
+    assert engine.evaluate(make_event(1001, "hi")).excluded
+    assert engine.evaluate(make_event(-1000000002002, "hi")).excluded
+    assert not engine.evaluate(make_event(-2002, "hi")).excluded
+    assert engine.evaluate(make_event(-1000000003003, "hi", sender_id=42)).excluded
+    assert engine.evaluate(make_event(-1000000003003, "hi", sender_id=-1000000000042)).excluded
+    assert not engine.evaluate(make_event(-1000000003003, "hi", sender_id=43)).excluded
+
+
+def test_config_resolves_named_targets(tmp_path):
+    path = tmp_path / "config.ini"
+    path.write_text(CONFIG + "rate = 4\n\n[target.alerts]\nchat_id = -1000000000200\nburst = 3\n\n"
+                    "[rule.alerts]\naction = include\nkeywords = alert\ntargets = alerts, -1000000000300\n",
+                    encoding="utf-8")
+    config = Config(str(path))
+    assert config.forward_targets == {
+        -1000000000200: {'name': 'alerts', 'rate': 4.0, 'burst': 3.0, 'max_retries': 5},
+    }
+    assert config.rules[0]['targets'] == [-1000000000200, -1000000000300]
+
+    path.write_text(CONFIG + "\n[rule.alerts]\naction = include\ntargets = missing\n", encoding="utf-8")
+    with pytest.raises(ConfigError, match="missing"):
+        Config(str(path))
@@ -0,0 +1,63 @@
+import sqlite3
+
+import pytest
+
+from handlers.search import build_match_query, fts_tokens
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("hello world", '"hello" AND "world"'),
+    ('"hello world"', '"hello world"'),
+    ("hel*", '"hel"*'),
+    ("spam -ads", '("spam") NOT "ads"'),
+    ("中文搜索", '"中文 文搜 搜索"'),
+    ("中", '"中"*'),
+    ("abc中文", 'NEAR("abc" "中文", 1)'),
+    ('"中文"*', '"中文"*'),
+])
+def test_build_match_query(query, expected):
+    assert build_match_query(query) == expected
+
+
+@pytest.mark.parametrize("query", ["", "   ", "-only", '""'])
+def test_build_match_query_without_positive_terms(query):
+    assert build_match_query(query) is None
+
+
+def test_fts_tokens_splits_cjk_into_bigrams():
+    assert fts_tokens("你好世界 hello").split() == ["你好", "好世", "世界", "界", "hello"]
+    assert fts_tokens(None) == ""
+
+
+@pytest.fixture
+def fts():
+    conn = sqlite3.connect(":memory:")
+    conn.execute(
+        "CREATE VIRTUAL TABLE messages_fts USING fts5(body, content='', tokenize='unicode61 remove_diacritics 2')"
+    )
+    texts = ["今天天气很好", "明天会下雨", "hello world", "hello there", "天气预报 weather", "中"]
+    conn.executemany("INSERT INTO messages_fts (rowid, body) VALUES (?, ?)", [
+        (rowid, fts_tokens(text)) for rowid, text in enumerate(texts, 1)
+    ])
+    yield conn
+    conn.close()
+
+
+@pytest.mark.parametrize("query, rowids", [
+    ("天气", [1, 5]),
+    ("天气 预报", [5]),
+    ("天气 -预报", [1]),
+    ("hello", [3, 4]),
+    ('"hello world"', [3]),
+    ("wor*", [3]),
+    ("天", [1, 2, 5]),
+    ("中", [6]),
+    ('"unbalanced', []),
+    ("NEAR( AND OR", []),
+])
+def test_match_query_against_fts5(fts, query, rowids):
+    expression = build_match_query(query)
+    found = [row[0] for row in fts.execute(
+        "SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rowid", (expression,)
+    )]
+    assert found == rowids
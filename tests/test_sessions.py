@@ -0,0 +1,154 @@
+import asyncio
+import json
+import os
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from telethon.tl.types import (
+    Message, MessageFwdHeader, MessageMediaPhoto, MessageReplyHeader, PeerChannel, PeerUser, Photo,
+)
+
+from factories import make_rule
+from handlers import sessions
+from handlers.rules import RuleEngine, forward_source, media_kind
+from handlers.sessions import SessionWorker, _unpack_frame, decode_record, encode_frame, encode_record, read_frame
+from utils.entity_cache import ChatInfo, SenderInfo
+
+DATE = datetime(2026, 10, 1, 8, 30, 15, tzinfo=timezone.utc)
+
+
+def telethon_event(**kwargs) -> SimpleNamespace:
+    """用真实的 Telethon Message 构造一个新消息事件。"""
+    fields = dict(id=77, peer_id=PeerChannel(1001), date=DATE, message="hello world", from_id=PeerUser(42))
+    fields.update(kwargs)
+    message = Message(**fields)
+    return SimpleNamespace(chat_id=message.chat_id, sender_id=message.sender_id, message=message)
+
+
+def round_trip(event, chat, sender):
+    """经过与会话进程相同的 JSON 编码后还原。"""
+    record = json.loads(json.dumps(encode_record(event, chat, sender)))
+    return decode_record(record)
+
+
+def test_text_message_round_trip():
+    event = telethon_event(reply_to=MessageReplyHeader(reply_to_msg_id=70))
+    chat = ChatInfo(1001, 'Channel', 'News')
+    sender = SenderInfo(42, 'Alice B', 'alice')
+    decoded, decoded_chat, decoded_sender = round_trip(event, chat, sender)
+
+    message = decoded.message
+    assert (decoded.chat_id, decoded.sender_id) == (-1000000001001, 42)
+    assert (message.id, message.chat_id, message.sender_id) == (77, -1000000001001, 42)
+    assert (message.text, message.raw_text) == (event.message.text, event.message.raw_text)
+    assert message.date == DATE
+    assert (message.is_reply, message.reply_to_msg_id) == (True, 70)
+    assert message.fwd_from is None and not message.media
+    assert (decoded_chat.id, decoded_chat.type, decoded_chat.title) == (1001, 'Channel', 'News')
+    assert (decoded_sender.id, decoded_sender.name, decoded_sender.username) == (42, 'Alice B', 'alice')
+
+
+def test_identical_text_is_sent_once():
+    message = SimpleNamespace(
+        id=5, text="plain", raw_text="plain", date=DATE, is_reply=False, reply_to_msg_id=None,
+        media=None, fwd_from=None,
+    )
+    event = SimpleNamespace(chat_id=-1000000001001, sender_id=42, message=message)
+    record = encode_record(event, ChatInfo(1001, 'Channel', 'News'), None)
+    assert record[3] == "plain" and record[4] is None
+    decoded, _, _ = decode_record(record)
+    assert (decoded.message.text, decoded.message.raw_text) == ("plain", "plain")
+
+
+def test_media_forward_and_missing_sender_round_trip():
+    photo = MessageMediaPhoto(photo=Photo(id=1, access_hash=2, file_reference=b"", date=DATE, sizes=[], dc_id=1))
+    event = telethon_event(
+        message="", media=photo, from_id=None, fwd_from=MessageFwdHeader(date=DATE, from_id=PeerChannel(9)),
+    )
+    decoded, _, sender = round_trip(event, ChatInfo(1001, 'Channel', 'News'), None)
+    message = decoded.message
+    assert sender is None and decoded.sender_id is None
+    assert media_kind(message) == media_kind(event.message) == 'photo'
+    assert message.photo and not message.sticker
+    assert forward_source(message) == forward_source(event.message) == -1000000000009
+    assert (message.is_reply, message.reply_to_msg_id) == (False, None)
+
+
+def test_rules_decide_the_same_on_decoded_events():
+    engine = RuleEngine([
+        make_rule('reposts', forward_from={-1000000000009}),
+        make_rule('photos', action='include', media={'photo'}, targets=[10]),
+        make_rule('hello', action='include', keywords=['hello'], targets=[20]),
+    ], default_target=-1000000000100)
+    events = [
+        telethon_event(),
+        telethon_event(fwd_from=MessageFwdHeader(date=DATE, from_id=PeerChannel(9))),
+        telethon_event(message="", media=MessageMediaPhoto(
+            photo=Photo(id=1, access_hash=2, file_reference=b"", date=DATE, sizes=[], dc_id=1)
+        )),
+    ]
+    for event in events:
+        decoded, _, _ = round_trip(event, ChatInfo(1001, 'Channel', 'News'), None)
+        original, restored = engine.evaluate(event), engine.evaluate(decoded)
+        assert (restored.excluded, restored.targets, restored.rules) == (
+            original.excluded, original.targets, original.rules
+        )
+
+
+def test_frames_round_trip_through_a_stream():
+    event = telethon_event()
+    record = encode_record(event, ChatInfo(1001, 'Channel', '新闻'), None)
+
+    async def scenario():
+        reader = asyncio.StreamReader()
+        reader.feed_data(encode_frame({"session": "alpha", "pid": 1}) + encode_frame([3, [record, record]]))
+        reader.feed_eof()
+        hello = await read_frame(reader)
+        dropped, records = _unpack_frame(await read_frame(reader))
+        with pytest.raises(asyncio.IncompleteReadError):
+            await read_frame(reader)
+        return hello, dropped, records
+
+    hello, dropped, records = asyncio.run(scenario())
+    assert hello == {"session": "alpha", "pid": 1}
+    assert dropped == 3 and records == [record, record]
+
+
+@pytest.mark.parametrize("frame", [[1], 5, {"a": 1}, [0, "records"]])
+def test_malformed_frames_are_rejected(frame):
+    with pytest.raises(TypeError):
+        _unpack_frame(frame)
+
+
+def test_idle_worker_reconnects_when_the_supervisor_closes_the_connection(monkeypatch):
+    monkeypatch.setattr(sessions, "RECONNECT_DELAY", 0.01)
+
+    async def scenario():
+        connections = asyncio.Queue()
+
+        async def accept(reader, writer):
+            await connections.put((reader, writer))
+
+        server = await asyncio.start_server(accept, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        worker = SessionWorker("alpha", {"chats": []}, "127.0.0.1", port, 10, os.getppid())
+        task = asyncio.create_task(worker._send_loop())
+        try:
+            reader, writer = await asyncio.wait_for(connections.get(), 5)
+            await read_frame(reader)
+            # 队列为空时关闭连接，会话进程应当重连，而不是在已关闭的连接上空转
+            writer.close()
+            reader, writer = await asyncio.wait_for(connections.get(), 5)
+            hello = await read_frame(reader)
+            worker._queue.put_nowait(["record"])
+            frame = await asyncio.wait_for(read_frame(reader), 5)
+            writer.close()
+        finally:
+            task.cancel()
+            server.close()
+        return hello, frame, worker.sent
+
+    hello, frame, sent = asyncio.run(scenario())
+    assert hello["session"] == "alpha"
+    assert frame == [0, [["record"]]] and sent == 1
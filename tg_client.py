@@ -1,5 +1,5 @@
-import asyncio
 import logging
+from typing import Optional
 from telethon import TelegramClient
 from telethon.tl.functions.account import UpdateStatusRequest
 from utils.config import settings
@@ -8,40 +8,60 @@ logger = logging.getLogger(__name__)
 
 class ClientManager:
     """
-    管理 Telegram 客户端和消息队列。
+    管理 Telegram 客户端。
+
+    主进程使用 [telegram] 中配置的账号（会话文件 autotg_session）；
+    [session.<名称>] 中的其他会话在各自的进程中运行（见 handlers.sessions），参数省略时同样取自 [telegram]。
     """
-    def __init__(self):
+    def __init__(
+        self,
+        session: str = 'autotg_session',
+        api_id: Optional[int] = None,
+        api_hash: Optional[str] = None,
+        phone: Optional[str] = None,
+    ):
         """
         初始化客户端管理器。
+
+        :param session: Telethon 会话文件名。
         """
+        self.session = session
+        self.phone = phone or settings.phone
         self.client = TelegramClient(
-            'autotg_session', 
-            settings.api_id, 
-            settings.api_hash
+            session,
+            api_id or settings.api_id,
+            api_hash or settings.api_hash
         )
-        self.message_queue = asyncio.Queue()
-        logger.info("客户端管理器已初始化。")
+        logger.info(f"客户端管理器已初始化（会话 {session}）。")
 
     async def start(self):
         """
         启动 Telegram 客户端并设置为在线状态。
         """
         logger.info("正在启动客户端...")
-        await self.client.start(phone=settings.phone)
+        await self.client.start(phone=self.phone)
         await self.client(UpdateStatusRequest(offline=False))
         logger.info("客户端已启动并设置为在线状态。")
 
-    def get_client(self) -> TelegramClient:
+    async def connect_authorized(self) -> bool:
         """
-        获取 TelegramClient 实例。
+        连接并设置为在线状态，但不进行交互式登录（用于没有终端的会话进程）。
+
+        :return: 会话文件是否已经登录；未登录时需要先运行 python manage.py login --session <名称>。
         """
-        return self.client
+        await self.client.connect()
+        if not await self.client.is_user_authorized():
+            await self.client.disconnect()
+            return False
+        await self.client(UpdateStatusRequest(offline=False))
+        logger.info(f"会话 {self.session} 已连接并设置为在线状态。")
+        return True
 
-    def get_queue(self) -> asyncio.Queue:
+    def get_client(self) -> TelegramClient:
         """
-        获取消息队列实例。
+        获取 TelegramClient 实例。
         """
-        return self.message_queue
+        return self.client
 
     async def run_until_disconnected(self):
         """
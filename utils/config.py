@@ -1,6 +1,12 @@
 import configparser
 import logging
-from typing import Set, Optional
+import re
+from datetime import datetime, timezone
+from typing import Dict, List, Set, Optional, Tuple
+
+from telethon.tl.types import PeerChannel, PeerChat
+from telethon.utils import get_peer_id, resolve_id
+
 
 # 获取日志记录器
 logger = logging.getLogger(__name__)
@@ -9,6 +15,34 @@ class ConfigError(Exception):
     """自定义配置错误异常"""
     pass
 
+# 消息处理流水线各阶段的默认设置: (workers, queue_size, policy)
+PIPELINE_STAGE_DEFAULTS: Dict[str, Tuple[int, int, str]] = {
+    'filter': (4, 1000, 'block'),
+    'dedup': (1, 1000, 'block'),
+    'persist': (1, 1000, 'block'),
+    'log': (1, 1000, 'drop'),
+    'forward': (1, 1000, 'block'),
+}
+
+# 修改后需要重启才能生效的设置项，热加载时保留当前值
+RESTART_REQUIRED = {
+    'api_id', 'api_hash', 'phone',
+    'db_batch_size', 'db_flush_interval_ms', 'db_max_buffer',
+    'db_journal_mode', 'db_synchronous', 'db_temp_store', 'db_cache_size', 'db_mmap_size',
+    'db_busy_timeout_ms', 'db_read_pool_size',
+    'web_event_host', 'web_event_port',
+    'forwarding_concurrency', 'pipeline_stages', 'read_receipts_enabled',
+    'config_watch_interval_seconds', 'metrics_enabled', 'metrics_push_interval_seconds',
+    'archive_enabled', 'archive_directory', 'archive_interval_hours',
+    'backfill_on_start', 'backfill_concurrency',
+    'keywords_enabled', 'keywords_workers', 'keywords_stopwords_file', 'dedup_enabled',
+    'sessions', 'sessions_host', 'sessions_port', 'sessions_queue_size',
+    'log_format', 'log_file', 'log_max_bytes', 'log_backup_count', 'log_queue_size',
+}
+
+# 过滤规则中 media 条件可用的消息类型
+MEDIA_KINDS = {'text', 'photo', 'video', 'sticker', 'voice', 'audio', 'document', 'other'}
+
 class Config:
     """
     负责加载和管理来自 config.ini 的配置。
@@ -20,8 +54,13 @@ class Config:
         :param path: config.ini 文件的路径。
         :raises ConfigError: 当配置文件未找到、格式错误或缺少必要选项时。
         """
+        self.path = path
         self.config = configparser.ConfigParser()
-        if not self.config.read(path, encoding='utf-8'):
+        try:
+            found = self.config.read(path, encoding='utf-8')
+        except configparser.Error as e:
+            raise ConfigError(f"配置文件格式错误: {e}")
+        if not found:
             raise ConfigError(f"配置文件 '{path}' 未找到。")
         
         self._load_settings()
@@ -37,9 +76,194 @@ class Config:
             # --- 转发设置 ---
             self.target_group: int = self.config.getint('forwarding', 'target_group')
             self.forwarding_delay_seconds: float = self.config.getfloat('forwarding', 'forwarding_delay_seconds', fallback=2.0)
+            # 每秒最多发起的转发请求数；未配置时沿用 forwarding_delay_seconds 对应的速率
+            self.forwarding_rate: float = self.config.getfloat('forwarding', 'rate', fallback=1 / self.forwarding_delay_seconds if self.forwarding_delay_seconds > 0 else 1.0)
+            self.forwarding_burst: float = self.config.getfloat('forwarding', 'burst', fallback=1.0)
+            # 同时进行中的转发请求数（同一来源会话的消息始终按顺序转发）
+            self.forwarding_concurrency: int = self.config.getint('forwarding', 'concurrency', fallback=1)
+            # 同一来源会话的消息合并为一次 forward_messages 调用的最大条数（Telegram 上限 100）
+            self.forwarding_batch_size: int = min(self.config.getint('forwarding', 'batch_size', fallback=100), 100)
+            # 收集一批待转发消息时最多等待的毫秒数
+            self.forwarding_linger_ms: int = self.config.getint('forwarding', 'linger_ms', fallback=200)
+            self.forwarding_max_retries: int = self.config.getint('forwarding', 'max_retries', fallback=5)
+            # 已转发记录在持久化队列中保留的小时数，用于重启后去重
+            self.forwarding_retention_hours: float = self.config.getfloat('forwarding', 'retention_hours', fallback=24.0)
+            if self.forwarding_rate <= 0 or self.forwarding_concurrency <= 0 or self.forwarding_batch_size <= 0:
+                raise ValueError("[forwarding] 中的 rate、concurrency 和 batch_size 必须为正数")
+
+            # --- 热加载设置 ---
+            # 轮询 config.ini 修改时间的间隔，0 表示只在收到 SIGHUP 或管理接口请求时重新加载
+            self.config_watch_interval_seconds: float = self.config.getfloat('reload', 'watch_interval_seconds', fallback=5.0)
 
             # --- 日志设置 ---
             self.log_level: str = self.config.get('logging', 'level', fallback='INFO').upper()
+            # 输出格式：text（默认）或 json（每行一个 JSON 对象）
+            self.log_format: str = self._get_choice('logging', 'format', 'text', {'TEXT', 'JSON'}).lower()
+            # 同时写入的日志文件，为空时只输出到控制台；超过 max_bytes 后轮转，保留 backup_count 个旧文件
+            self.log_file: str = self.config.get('logging', 'file', fallback='')
+            self.log_max_bytes: int = self.config.getint('logging', 'max_bytes', fallback=10 * 1024 * 1024)
+            self.log_backup_count: int = self.config.getint('logging', 'backup_count', fallback=5)
+            # 待输出日志的队列上限，输出跟不上时丢弃新日志而不是阻塞事件循环
+            self.log_queue_size: int = self.config.getint('logging', 'queue_size', fallback=10000)
+            # 逐条消息日志（消息内容、排除、转发成功）的采样比例和每秒上限，0 表示不限
+            self.log_message_sample: float = self.config.getfloat('logging', 'message_sample', fallback=1.0)
+            self.log_message_rate: float = self.config.getfloat('logging', 'message_rate', fallback=0.0)
+            if self.log_max_bytes < 0 or self.log_backup_count < 0 or self.log_queue_size <= 0:
+                raise ValueError("[logging] 中的 max_bytes 和 backup_count 不能为负数，queue_size 必须为正数")
+            if not 0 <= self.log_message_sample <= 1 or self.log_message_rate < 0:
+                raise ValueError("[logging] message_sample 必须在 0 到 1 之间，message_rate 不能为负数")
+
+            # --- 数据库写入设置 ---
+            # 攒够 batch_size 条或等待 flush_interval_ms 毫秒后批量提交一次
+            self.db_batch_size: int = self.config.getint('database', 'batch_size', fallback=500)
+            self.db_flush_interval_ms: int = self.config.getint('database', 'flush_interval_ms', fallback=200)
+            # 写缓冲区上限，满了之后 save_message 会等待（背压）
+            self.db_max_buffer: int = self.config.getint('database', 'max_buffer', fallback=10000)
+            if self.db_batch_size <= 0 or self.db_flush_interval_ms <= 0 or self.db_max_buffer <= 0:
+                raise ValueError("[database] 中的 batch_size、flush_interval_ms 和 max_buffer 必须为正数")
+
+            # --- SQLite PRAGMA 设置 ---
+            self.db_journal_mode: str = self._get_choice('database', 'journal_mode', 'WAL', {'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'})
+            self.db_synchronous: str = self._get_choice('database', 'synchronous', 'NORMAL', {'OFF', 'NORMAL', 'FULL', 'EXTRA'})
+            self.db_temp_store: str = self._get_choice('database', 'temp_store', 'MEMORY', {'DEFAULT', 'FILE', 'MEMORY'})
+            # 负数表示以 KiB 为单位，默认 64 MiB
+            self.db_cache_size: int = self.config.getint('database', 'cache_size', fallback=-65536)
+            self.db_mmap_size: int = self.config.getint('database', 'mmap_size', fallback=268435456)
+            self.db_busy_timeout_ms: int = self.config.getint('database', 'busy_timeout_ms', fallback=5000)
+            # Web 进程中只读连接池的大小
+            self.db_read_pool_size: int = self.config.getint('database', 'read_pool_size', fallback=4)
+            if self.db_read_pool_size <= 0:
+                raise ValueError("[database] read_pool_size 必须为正数")
+
+            # --- Web 设置 ---
+            # 响应缓存的最长有效期；数据有更新时会提前失效
+            self.web_cache_ttl_seconds: float = self.config.getfloat('web', 'cache_ttl_seconds', fallback=30.0)
+            self.web_cache_max_entries: int = self.config.getint('web', 'cache_max_entries', fallback=256)
+            # 监听进程向 Web 进程推送实时事件所用的本机 UDP 地址
+            self.web_event_host: str = self.config.get('web', 'event_host', fallback='127.0.0.1')
+            self.web_event_port: int = self.config.getint('web', 'event_port', fallback=8765)
+            # 管理接口（如 POST /api/admin/reload）的访问令牌，为空时禁用管理接口
+            self.web_admin_token: str = self.config.get('web', 'admin_token', fallback='')
+
+            # --- 历史消息归档设置 ---
+            # 主库只保留最近 hot_months 个月的消息，更早的按月搬到 directory 中的独立文件
+            self.archive_enabled: bool = self.config.getboolean('archive', 'enabled', fallback=False)
+            self.archive_directory: str = self.config.get('archive', 'directory', fallback='archive')
+            self.archive_hot_months: int = self.config.getint('archive', 'hot_months', fallback=3)
+            # 归档分区保留的月数，0 表示永久保留；设置 export_dir 时过期分区移到该目录而不是删除
+            self.archive_retention_months: int = self.config.getint('archive', 'retention_months', fallback=0)
+            self.archive_export_dir: str = self.config.get('archive', 'export_dir', fallback='')
+            self.archive_interval_hours: float = self.config.getfloat('archive', 'interval_hours', fallback=24.0)
+            self.archive_chunk_size: int = self.config.getint('archive', 'chunk_size', fallback=50000)
+            if self.archive_hot_months < 1 or self.archive_retention_months < 0:
+                raise ValueError("[archive] hot_months 至少为 1，retention_months 不能为负数")
+            if self.archive_interval_hours <= 0 or self.archive_chunk_size <= 0:
+                raise ValueError("[archive] 中的 interval_hours 和 chunk_size 必须为正数")
+            if self.archive_retention_months and self.archive_retention_months < self.archive_hot_months:
+                raise ValueError("[archive] retention_months 不能小于 hot_months")
+
+            # --- 列式导出设置（python manage.py export） ---
+            self.export_directory: str = self.config.get('export', 'directory', fallback='exports')
+            self.export_format: str = self.config.get('export', 'format', fallback='parquet').lower()
+            self.export_compression: str = self.config.get('export', 'compression', fallback='zstd').lower()
+            self.export_batch_size: int = self.config.getint('export', 'batch_size', fallback=50000)
+            if self.export_format not in ('parquet', 'arrow'):
+                raise ValueError("[export] format 只能是 parquet 或 arrow")
+            if self.export_compression not in ('zstd', 'snappy', 'gzip', 'lz4', 'none'):
+                raise ValueError("[export] compression 只能是 zstd、snappy、gzip、lz4 或 none")
+            if self.export_batch_size <= 0:
+                raise ValueError("[export] batch_size 必须为正数")
+
+            # --- 历史回填设置（python manage.py backfill，或 on_start 时随监听程序启动） ---
+            # chats 为逗号分隔的会话 id 或用户名；since 为 YYYY-MM-DD，只回填这一天（UTC）之后的消息
+            self.backfill_chats: List = [int(item) if re.fullmatch(r'-?\d+', item) else item for item in self._get_list('backfill', 'chats')]
+            self.backfill_on_start: bool = self.config.getboolean('backfill', 'on_start', fallback=False)
+            self.backfill_concurrency: int = self.config.getint('backfill', 'concurrency', fallback=3)
+            # 所有会话共用的请求速率（每秒请求数）和突发上限，与转发共用账号的 FloodWait 配额
+            self.backfill_rate: float = self.config.getfloat('backfill', 'rate', fallback=1.0)
+            self.backfill_burst: float = self.config.getfloat('backfill', 'burst', fallback=3.0)
+            backfill_since_str = self.config.get('backfill', 'since', fallback='').strip()
+            self.backfill_since: Optional[datetime] = (
+                datetime.strptime(backfill_since_str, '%Y-%m-%d').replace(tzinfo=timezone.utc) if backfill_since_str else None
+            )
+            if self.backfill_concurrency <= 0 or self.backfill_rate <= 0 or self.backfill_burst < 1:
+                raise ValueError("[backfill] 中的 concurrency 和 rate 必须为正数，burst 至少为 1")
+
+            # --- 重复消息检测设置（相同或几乎相同的内容只转发一次） ---
+            self.dedup_enabled: bool = self.config.getboolean('dedup', 'enabled', fallback=True)
+            # 原始消息在索引中保留的秒数（从最后一次被命中算起）和条数上限
+            self.dedup_window_seconds: float = self.config.getfloat('dedup', 'window_seconds', fallback=21600.0)
+            self.dedup_max_entries: int = self.config.getint('dedup', 'max_entries', fallback=100000)
+            # 判定为近重复的最大 SimHash 汉明距离（64 位中），0 表示只识别完全相同的内容；
+            # 短文本改动几个字距离就有 4~7，无关文本的距离在 32 左右
+            self.dedup_max_distance: int = self.config.getint('dedup', 'max_distance', fallback=6)
+            # 规范化后短于这个长度的文本不参与检测
+            self.dedup_min_length: int = self.config.getint('dedup', 'min_length', fallback=20)
+            if self.dedup_window_seconds <= 0 or self.dedup_max_entries <= 0 or self.dedup_min_length <= 0:
+                raise ValueError("[dedup] 中的 window_seconds、max_entries 和 min_length 必须为正数")
+            if not 0 <= self.dedup_max_distance <= 15:
+                raise ValueError("[dedup] max_distance 必须在 0 到 15 之间")
+
+            # --- 关键词统计设置（jieba 分词，按小时累计词频） ---
+            self.keywords_enabled: bool = self.config.getboolean('keywords', 'enabled', fallback=True)
+            # 分词进程数；每批最多处理 batch_size 条消息，追上最新消息后每隔 interval_seconds 秒检查一次
+            self.keywords_workers: int = self.config.getint('keywords', 'workers', fallback=2)
+            self.keywords_batch_size: int = self.config.getint('keywords', 'batch_size', fallback=2000)
+            self.keywords_interval_seconds: float = self.config.getfloat('keywords', 'interval_seconds', fallback=5.0)
+            # 额外的停用词文件（每行一个词），与内置的停用词合并
+            self.keywords_stopwords_file: str = self.config.get('keywords', 'stopwords_file', fallback='')
+            # 超过 prune_after_days 天的按会话词频中，次数少于 prune_min_count 的长尾词被删除（全部会话的合计保留）；
+            # 超过 retention_days 天的词频全部删除
+            self.keywords_prune_after_days: int = self.config.getint('keywords', 'prune_after_days', fallback=2)
+            self.keywords_prune_min_count: int = self.config.getint('keywords', 'prune_min_count', fallback=2)
+            self.keywords_retention_days: int = self.config.getint('keywords', 'retention_days', fallback=30)
+            # 词云图片：中文字体文件路径（未配置时中文无法显示），以及缓存秒数
+            self.keywords_wordcloud_font: str = self.config.get('keywords', 'wordcloud_font', fallback='')
+            self.keywords_wordcloud_cache_seconds: float = self.config.getfloat('keywords', 'wordcloud_cache_seconds', fallback=600.0)
+            if self.keywords_workers <= 0 or self.keywords_batch_size <= 0 or self.keywords_interval_seconds <= 0:
+                raise ValueError("[keywords] 中的 workers、batch_size 和 interval_seconds 必须为正数")
+            if self.keywords_prune_after_days <= 0 or self.keywords_retention_days < self.keywords_prune_after_days:
+                raise ValueError("[keywords] prune_after_days 必须为正数，retention_days 不能小于 prune_after_days")
+            if self.keywords_wordcloud_cache_seconds <= 0:
+                raise ValueError("[keywords] wordcloud_cache_seconds 必须为正数")
+
+            # --- 指标设置 ---
+            # 监听进程每隔 push_interval_seconds 秒把指标推送给 Web 进程，由 /metrics 导出
+            self.metrics_enabled: bool = self.config.getboolean('metrics', 'enabled', fallback=True)
+            self.metrics_push_interval_seconds: float = self.config.getfloat('metrics', 'push_interval_seconds', fallback=5.0)
+            if self.metrics_push_interval_seconds <= 0:
+                raise ValueError("[metrics] push_interval_seconds 必须为正数")
+
+            # --- 实体缓存设置 ---
+            # 缓存的会话和发送者信息条数上限，以及每条信息的有效期
+            self.entity_cache_size: int = self.config.getint('cache', 'entity_cache_size', fallback=10000)
+            self.entity_cache_ttl_seconds: float = self.config.getfloat('cache', 'entity_ttl_seconds', fallback=3600.0)
+            if self.entity_cache_size <= 0 or self.entity_cache_ttl_seconds <= 0:
+                raise ValueError("[cache] 中的 entity_cache_size 和 entity_ttl_seconds 必须为正数")
+
+            # --- 消息处理流水线设置 ---
+            # 每个阶段可配置 <阶段>_workers、<阶段>_queue_size 和 <阶段>_policy（block 等待 / drop 丢弃）
+            self.pipeline_stages: Dict[str, Tuple[int, int, str]] = {}
+            for stage, (workers, queue_size, policy) in PIPELINE_STAGE_DEFAULTS.items():
+                stage_settings = (
+                    self.config.getint('pipeline', f'{stage}_workers', fallback=workers),
+                    self.config.getint('pipeline', f'{stage}_queue_size', fallback=queue_size),
+                    self._get_choice('pipeline', f'{stage}_policy', policy, {'BLOCK', 'DROP'}).lower(),
+                )
+                if stage_settings[0] <= 0 or stage_settings[1] <= 0:
+                    raise ValueError(f"[pipeline] 中的 {stage}_workers 和 {stage}_queue_size 必须为正数")
+                self.pipeline_stages[stage] = stage_settings
+
+            # --- 已读回执设置 ---
+            # 每隔 interval_seconds 秒为每个会话合并发送一次已读回执
+            self.read_receipts_enabled: bool = self.config.getboolean('read_receipts', 'enabled', fallback=True)
+            self.read_receipts_interval_seconds: float = self.config.getfloat('read_receipts', 'interval_seconds', fallback=5.0)
+            self.read_receipts_max_pending_chats: int = self.config.getint('read_receipts', 'max_pending_chats', fallback=10000)
+            if self.read_receipts_interval_seconds <= 0 or self.read_receipts_max_pending_chats <= 0:
+                raise ValueError("[read_receipts] 中的 interval_seconds 和 max_pending_chats 必须为正数")
+            # 不发送已读回执的会话
+            read_receipts_exclude_str = self.config.get('read_receipts', 'exclude_chat_ids', fallback='')
+            self.read_receipts_exclude_chat_ids: Set[int] = {int(id.strip()) for id in read_receipts_exclude_str.split(',') if id.strip()}
 
             # --- 过滤器设置 ---
             exclude_chat_ids_str = self.config.get('filters', 'exclude_chat_ids', fallback='')
@@ -48,11 +272,252 @@ class Config:
             exclude_sender_ids_str = self.config.get('filters', 'exclude_sender_ids', fallback='')
             self.exclude_sender_ids: Set[int] = {int(id.strip()) for id in exclude_sender_ids_str.split(',') if id.strip()}
 
+            # --- 多会话分片监听（[sessions] 和 [session.<名称>] 小节） ---
+            # 会话进程通过本机 TCP 连接把消息发给主进程；host/port 为主进程监听的地址
+            self.sessions_host: str = self.config.get('sessions', 'host', fallback='127.0.0.1')
+            self.sessions_port: int = self.config.getint('sessions', 'port', fallback=8766)
+            # 会话进程中等待发送的消息上限，与主进程的连接中断时超出的消息被丢弃
+            self.sessions_queue_size: int = self.config.getint('sessions', 'queue_size', fallback=10000)
+            # 会话进程退出后第一次重启前等待的秒数，连续失败时加倍，最多 max_restart_delay_seconds 秒
+            self.sessions_restart_delay_seconds: float = self.config.getfloat('sessions', 'restart_delay_seconds', fallback=1.0)
+            self.sessions_max_restart_delay_seconds: float = self.config.getfloat('sessions', 'max_restart_delay_seconds', fallback=60.0)
+            if self.sessions_queue_size <= 0 or self.sessions_restart_delay_seconds <= 0:
+                raise ValueError("[sessions] 中的 queue_size 和 restart_delay_seconds 必须为正数")
+            if self.sessions_max_restart_delay_seconds < self.sessions_restart_delay_seconds:
+                raise ValueError("[sessions] max_restart_delay_seconds 不能小于 restart_delay_seconds")
+            self.sessions: Dict[str, dict] = self._load_sessions()
+
+            # --- 转发目标（[target.<名称>] 小节） ---
+            self.forward_targets: Dict[int, dict] = self._load_targets()
+
+            # --- 过滤规则（[rule.<名称>] 小节） ---
+            self.rules: List[dict] = self._load_rules()
+
         except (configparser.NoSectionError, configparser.NoOptionError) as e:
             raise ConfigError(f"配置文件格式错误: {e}")
         except ValueError as e:
             raise ConfigError(f"配置文件中的值无效: {e}")
 
+    def reload(self) -> Set[str]:
+        """
+        重新读取并校验配置文件，成功后原地替换各设置项。
+
+        新配置完整解析并校验通过后才会替换，且替换过程中没有 await，
+        对事件循环中的其他协程来说是原子的。RESTART_REQUIRED 中的设置项保留当前值。
+
+        :return: 发生变化并已生效的设置项名称。
+        :raises ConfigError: 新配置无效时抛出，当前设置保持不变。
+        """
+        new = Config(self.path)
+        updates = {'config': new.config}
+        ignored = set()
+        for name, value in vars(new).items():
+            if name in ('config', 'path') or getattr(self, name, None) == value:
+                continue
+            if name in RESTART_REQUIRED:
+                ignored.add(name)
+            else:
+                updates[name] = value
+        if ignored:
+            logger.warning(f"以下设置项需要重启才能生效，本次未更新: {', '.join(sorted(ignored))}")
+        self.__dict__.update(updates)
+        return set(updates) - {'config'}
+
+    def _get_list(self, section: str, option: str) -> List[str]:
+        """读取以逗号或换行分隔的列表（不做 % 插值），忽略空项。"""
+        value = self.config.get(section, option, raw=True, fallback='')
+        return [item.strip() for item in re.split(r'[,\n]', value) if item.strip()]
+
+    def _get_id_set(self, section: str, option: str) -> Set[int]:
+        """读取以逗号或换行分隔的 id 列表。"""
+        return {int(item) for item in self._get_list(section, option)}
+
+    def _load_targets(self) -> Dict[int, dict]:
+        """
+        读取 [target.<名称>] 小节中的转发目标，返回 chat_id -> 目标设置。
+
+        每个目标有独立的转发队列和令牌桶，一个目标触发 FloodWait 或持续失败不会影响其他目标。
+
+        - chat_id：目标会话的 id（必填）。
+        - rate / burst / max_retries：该目标的限速和重试次数，省略时沿用 [forwarding] 中的值。
+
+        include 规则的 targets 中可以直接写目标名称。
+        未在这里配置的目标（包括 target_group）使用 [forwarding] 中的设置。
+        """
+        targets: Dict[int, dict] = {}
+        for section in self.config.sections():
+            if not section.startswith('target.'):
+                continue
+            name = section[len('target.'):]
+            chat_id = self.config.getint(section, 'chat_id')
+            if chat_id in targets:
+                raise ValueError(f"[{section}] chat_id {chat_id} 与 [target.{targets[chat_id]['name']}] 重复")
+            target = {
+                'name': name,
+                'rate': self.config.getfloat(section, 'rate', fallback=self.forwarding_rate),
+                'burst': self.config.getfloat(section, 'burst', fallback=self.forwarding_burst),
+                'max_retries': self.config.getint(section, 'max_retries', fallback=self.forwarding_max_retries),
+            }
+            if target['rate'] <= 0 or target['max_retries'] < 0:
+                raise ValueError(f"[{section}] rate 必须为正数，max_retries 不能为负数")
+            targets[chat_id] = target
+        return targets
+
+    def _load_sessions(self) -> Dict[str, dict]:
+        """
+        读取 [session.<名称>] 小节中的附加会话，返回名称 -> 会话设置。
+
+        每个会话在独立的进程中运行，只监听分配给它的会话，主进程的账号不再处理这些会话的消息。
+
+        - chats：分配给这个会话的频道或超级群组 id（必填，带 -100 前缀），一个会话只能分配给一个会话进程。
+          私聊和普通群组的消息 id 按账号编号，主账号无法转发或回填其他账号收到的这类消息，不能分片。
+        - session：Telethon 会话文件名，省略时为 listentg_<名称>；首次使用前需要运行
+          python manage.py login --session <名称> 登录。
+        - api_id / api_hash / phone：省略时沿用 [telegram] 中的值。
+        """
+        sessions: Dict[str, dict] = {}
+        # 会话 id -> 会话名称，用于检查重复分配
+        assigned: Dict[int, str] = {}
+        for section in self.config.sections():
+            if not section.startswith('session.'):
+                continue
+            name = section[len('session.'):]
+            chats = sorted(self._get_id_set(section, 'chats'))
+            if not chats:
+                raise ValueError(f"[{section}] chats 不能为空")
+            for chat_id in chats:
+                if resolve_id(chat_id)[1] is not PeerChannel:
+                    raise ValueError(
+                        f"[{section}] 会话 {chat_id} 不是频道或超级群组（需带 -100 前缀）："
+                        "私聊和普通群组的消息 id 按账号编号，不能分配给会话进程"
+                    )
+                if chat_id in assigned:
+                    raise ValueError(f"[{section}] 会话 {chat_id} 已经分配给 [session.{assigned[chat_id]}]")
+                assigned[chat_id] = name
+            session = self.config.get(section, 'session', fallback=f'listentg_{name}')
+            # Telethon 的会话文件不能被两个进程同时使用
+            if session == 'autotg_session' or any(options['session'] == session for options in sessions.values()):
+                raise ValueError(f"[{section}] session '{session}' 已被主进程或其他会话使用")
+            sessions[name] = {
+                'session': session,
+                'chats': chats,
+                'api_id': self.config.getint(section, 'api_id', fallback=self.api_id),
+                'api_hash': self.config.get(section, 'api_hash', fallback=self.api_hash),
+                'phone': self.config.get(section, 'phone', fallback=self.phone),
+            }
+        return sessions
+
+    def _resolve_target(self, section: str, value: str) -> int:
+        """把规则中的转发目标（会话 id 或 [target.<名称>] 的名称）解析为会话 id。"""
+        try:
+            return int(value)
+        except ValueError:
+            pass
+        for chat_id, target in self.forward_targets.items():
+            if target['name'] == value:
+                return chat_id
+        raise ValueError(f"[{section}] targets 中的 '{value}' 既不是会话 id，也没有对应的 [target.{value}] 小节")
+
+    def _load_rules(self) -> List[dict]:
+        """
+        读取 [rule.<名称>] 小节中的过滤规则。
+
+        每条规则的各个条件之间为“且”，同一条件内的多个值之间为“或”；没有任何条件的规则匹配所有消息。
+
+        - action：exclude（默认，匹配的消息不入库也不转发）或 include（匹配的消息转发到 targets）；
+          只要存在 include 规则，没有匹配任何 include 规则的消息只入库、不转发。
+        - chat_ids / sender_ids / forward_from：会话、发送者、转发来源的 id，按 Telethon 的写法区分类型：
+          用户为正数，普通群组为负数，频道和超级群组带 -100 前缀。
+        - keywords：关键词，不区分大小写，以逗号或换行分隔。
+        - regex：正则表达式，每行一个，任意一个匹配即可。
+        - media：消息类型，取值见 MEDIA_KINDS。
+        - targets：include 规则的转发目标（会话 id 或 [target.<名称>] 的名称），
+          省略时为 [forwarding] target_group；一条消息可以同时转发到多个目标。
+
+        [filters] 中旧的 exclude_chat_ids 和 exclude_sender_ids 会转换为两条 exclude 规则（见 _legacy_ids）。
+        """
+        rules = []
+        if self.exclude_chat_ids:
+            rules.append(self._make_rule('filters.exclude_chat_ids', chat_ids=self._legacy_ids(self.exclude_chat_ids)))
+        if self.exclude_sender_ids:
+            rules.append(self._make_rule(
+                'filters.exclude_sender_ids', sender_ids=self._legacy_ids(self.exclude_sender_ids)
+            ))
+
+        for section in self.config.sections():
+            if not section.startswith('rule.'):
+                continue
+            action = self._get_choice(section, 'action', 'exclude', {'INCLUDE', 'EXCLUDE'}).lower()
+            regexes = [
+                item.strip()
+                for item in self.config.get(section, 'regex', raw=True, fallback='').splitlines()
+                if item.strip()
+            ]
+            # 与 handlers.rules.Rule 一样逐个编译，每个正则可以有自己的 (?i) 等全局标志
+            for pattern in regexes:
+                try:
+                    re.compile(pattern)
+                except re.error as e:
+                    raise ConfigError(f"[{section}] regex '{pattern}' 无效: {e}")
+            media = {item.lower() for item in self._get_list(section, 'media')}
+            if media - MEDIA_KINDS:
+                raise ValueError(f"[{section}] media 只能是 {', '.join(sorted(MEDIA_KINDS))}")
+            targets = [self._resolve_target(section, item) for item in self._get_list(section, 'targets')]
+            if targets and action != 'include':
+                raise ValueError(f"[{section}] 只有 include 规则可以设置 targets")
+            rules.append(self._make_rule(
+                section[len('rule.'):],
+                action=action,
+                chat_ids=self._get_id_set(section, 'chat_ids'),
+                sender_ids=self._get_id_set(section, 'sender_ids'),
+                forward_from=self._get_id_set(section, 'forward_from'),
+                keywords=[item.lower() for item in self._get_list(section, 'keywords')],
+                regexes=regexes,
+                media=media,
+                targets=targets,
+            ))
+        return rules
+
+    @staticmethod
+    def _legacy_ids(ids: Set[int]) -> Set[int]:
+        """
+        把 [filters] 中的 id 转换为规则引擎使用的带类型 id。
+
+        旧版本用实体本身的 id（频道和群组不带 -100 前缀或负号）比较，也接受 Telethon 的带类型 id，
+        因此正数 id 同时对应用户、普通群组和频道三种写法，负数 id 原样保留。
+        """
+        marked = set()
+        for id in ids:
+            marked.add(id)
+            if id > 0:
+                marked.add(get_peer_id(PeerChat(id)))
+                marked.add(get_peer_id(PeerChannel(id)))
+        return marked
+
+    @staticmethod
+    def _make_rule(name: str, action: str = 'exclude', **conditions) -> dict:
+        """构造一条规则的定义，未给出的条件为空。"""
+        rule = {
+            'name': name,
+            'action': action,
+            'chat_ids': set(),
+            'sender_ids': set(),
+            'forward_from': set(),
+            'keywords': [],
+            'regexes': [],
+            'media': set(),
+            'targets': [],
+        }
+        rule.update(conditions)
+        return rule
+
+    def _get_choice(self, section: str, option: str, fallback: str, choices: Set[str]) -> str:
+        """读取一个只能取固定几个值之一的选项（不区分大小写）。"""
+        value = self.config.get(section, option, fallback=fallback).strip().upper()
+        if value not in choices:
+            raise ValueError(f"[{section}] {option} 必须是 {', '.join(sorted(choices))} 之一，当前为 '{value}'")
+        return value
+
 # 创建一个全局可用的配置实例
 try:
     settings = Config()
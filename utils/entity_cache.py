@@ -0,0 +1,213 @@
+"""
+会话和发送者信息的共享缓存。
+
+每条新消息原本要在消息处理、入库和格式化三处分别调用 get_chat / get_sender，
+Telethon 本地没有实体时会向 Telegram 发起请求。这里把解析结果（标题、类型、名字等）
+按 id 缓存在一个有上限的 LRU 中，每条消息只解析一次，三处共用同一份结果。
+
+缓存项在 ttl 秒后过期；群组改名时由 ChatAction 事件主动刷新。
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from telethon.tl.types import Channel, Chat, User
+
+from utils.config import settings
+from utils.metrics import counter, gauge, registry
+from utils.reload import config_reloader
+
+logger = logging.getLogger(__name__)
+
+
+class ChatInfo:
+    """
+    会话的元数据。
+
+    :param id: 实体本身的 id（频道和超级群组不带 -100 前缀）。
+    :param type: 'User'、'Group' 或 'Channel'，无法识别时为 None。
+    :param title: 群组或频道的标题，私聊为 'Direct Message'。
+    """
+    __slots__ = ("id", "type", "title")
+
+    def __init__(self, id: int, type: Optional[str], title: str):
+        self.id = id
+        self.type = type
+        self.title = title
+
+    @classmethod
+    def from_entity(cls, entity, fallback_id: int) -> "ChatInfo":
+        """从 Telethon 实体中提取会话信息。"""
+        chat_type = None
+        if isinstance(entity, User):
+            chat_type = 'User'
+        elif isinstance(entity, Chat):
+            chat_type = 'Group'
+        elif isinstance(entity, Channel):
+            chat_type = 'Channel'
+        return cls(
+            getattr(entity, 'id', fallback_id),
+            chat_type,
+            getattr(entity, 'title', None) or 'Direct Message',
+        )
+
+
+class SenderInfo:
+    """
+    发送者的元数据。
+
+    :param name: 名和姓拼接而成的显示名，没有时为 'Unknown'。
+    :param username: 用户名（不带 @），没有时为 None。
+    """
+    __slots__ = ("id", "name", "username")
+
+    def __init__(self, id: int, name: str, username: Optional[str]):
+        self.id = id
+        self.name = name
+        self.username = username
+
+    @classmethod
+    def from_entity(cls, entity, fallback_id: int) -> "SenderInfo":
+        """从 Telethon 实体中提取发送者信息。"""
+        first = getattr(entity, 'first_name', '') or ''
+        last = getattr(entity, 'last_name', '') or ''
+        return cls(
+            getattr(entity, 'id', fallback_id),
+            (first + ' ' + last).strip() or 'Unknown',
+            getattr(entity, 'username', None),
+        )
+
+
+class EntityCache:
+    """
+    有上限、带过期时间的 LRU 实体缓存。
+
+    会话和发送者分别以 event.chat_id 和 event.sender_id 为键。
+    """
+    def __init__(self, max_size: int = 10000, ttl_seconds: float = 3600.0):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        # 键 -> (过期时间, 信息)
+        self._entries: "OrderedDict[Tuple[str, int], Tuple[float, object]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # 本地没有实体、需要由 Telethon 解析（可能请求 Telegram）的次数
+        self.api_calls = 0
+        self.evictions = 0
+
+    def _get(self, key: Tuple[str, int]):
+        """取出未过期的缓存项并标记为最近使用，没有时返回 None。"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, info = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return info
+
+    def _put(self, key: Tuple[str, int], info):
+        """写入缓存项，超过上限时淘汰最久未使用的项。"""
+        self._entries[key] = (time.monotonic() + self.ttl, info)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_chat(self, event) -> ChatInfo:
+        """返回事件所在会话的信息。"""
+        key = ('chat', event.chat_id)
+        info = self._get(key)
+        if info is not None:
+            self.hits += 1
+            return info
+        self.misses += 1
+        # event.chat 只读取事件中已附带的实体，不会发起请求
+        entity = event.chat
+        if entity is None:
+            self.api_calls += 1
+            entity = await event.get_chat()
+        info = ChatInfo.from_entity(entity, event.chat_id)
+        self._put(key, info)
+        return info
+
+    async def get_sender(self, event) -> Optional[SenderInfo]:
+        """返回事件发送者的信息，没有发送者时返回 None。"""
+        if event.sender_id is None:
+            return None
+        key = ('sender', event.sender_id)
+        info = self._get(key)
+        if info is not None:
+            self.hits += 1
+            return info
+        self.misses += 1
+        entity = event.sender
+        if entity is None:
+            self.api_calls += 1
+            entity = await event.get_sender()
+        if entity is None:
+            return None
+        info = SenderInfo.from_entity(entity, event.sender_id)
+        self._put(key, info)
+        return info
+
+    async def resolve(self, event) -> Tuple[ChatInfo, Optional[SenderInfo]]:
+        """一次取得事件的会话和发送者信息。"""
+        return await self.get_chat(event), await self.get_sender(event)
+
+    def update_chat_title(self, chat_id: int, title: str):
+        """会话改名时刷新缓存中的标题。"""
+        info = self._get(('chat', chat_id))
+        if info is not None:
+            info.title = title
+            logger.info(f"会话 {chat_id} 的标题已更新为 '{title}'。")
+
+    def stats(self) -> dict:
+        """返回命中率和解析次数等统计信息。"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "api_calls": self.api_calls,
+            "evictions": self.evictions,
+        }
+
+    def collect_metrics(self) -> list:
+        """导出缓存的命中和解析指标。"""
+        return [
+            counter("listentg_entity_cache_hits_total", "实体缓存命中次数", self.hits),
+            counter("listentg_entity_cache_misses_total", "实体缓存未命中次数", self.misses),
+            counter("listentg_entity_cache_api_calls_total", "需要由 Telethon 解析实体的次数", self.api_calls),
+            counter("listentg_entity_cache_evictions_total", "实体缓存淘汰次数", self.evictions),
+            gauge("listentg_entity_cache_entries", "实体缓存当前条数", len(self._entries)),
+        ]
+
+    async def report_loop(self, interval: float = 60.0):
+        """定期输出缓存统计。"""
+        while True:
+            await asyncio.sleep(interval)
+            logger.info(f"实体缓存统计: {self.stats()}")
+
+
+# 创建一个全局的实体缓存实例
+entity_cache = EntityCache(
+    max_size=settings.entity_cache_size,
+    ttl_seconds=settings.entity_cache_ttl_seconds,
+)
+registry.register(entity_cache.collect_metrics)
+
+
+async def _apply_settings(changed):
+    """热加载后更新缓存上限和有效期（已缓存的项按原有效期过期）。"""
+    if not changed & {'entity_cache_size', 'entity_cache_ttl_seconds'}:
+        return
+    entity_cache.max_size = settings.entity_cache_size
+    entity_cache.ttl = settings.entity_cache_ttl_seconds
+
+config_reloader.subscribe(_apply_settings)
@@ -0,0 +1,105 @@
+"""
+进程间事件总线。
+
+监听进程和 Web 进程是两个独立的进程（见 main.run_web_server）。
+监听进程通过本机 UDP 数据报把事件（JSON）发给 Web 进程：
+
+- 发送是非阻塞的“发后即忘”，Web 进程没有运行时事件直接丢弃，不会影响监听进程；
+- 单个数据报大小受限，超过 MAX_DATAGRAM_SIZE 的事件会被丢弃，
+  接收方需要能通过定期全量同步来弥补丢失的事件。
+"""
+
+import asyncio
+import json
+import logging
+from typing import Callable, Optional
+
+from utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+# 本机 UDP 数据报的安全上限
+MAX_DATAGRAM_SIZE = 60000
+
+
+class EventPublisher:
+    """
+    把事件以 UDP 数据报的形式发送到 Web 进程。
+    """
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._transport: Optional[asyncio.DatagramTransport] = None
+        self.sent = 0
+        self.dropped = 0
+
+    async def start(self):
+        """创建 UDP 发送端。"""
+        if self._transport is None:
+            loop = asyncio.get_running_loop()
+            self._transport, _ = await loop.create_datagram_endpoint(
+                _SilentProtocol, remote_addr=(self.host, self.port)
+            )
+            logger.info(f"事件发布器已启动，目标 udp://{self.host}:{self.port}")
+
+    def publish(self, event: dict):
+        """发送一个事件；未启动、事件过大或发送失败时直接丢弃。"""
+        if self._transport is None:
+            return
+        data = json.dumps(event, ensure_ascii=False, default=str).encode()
+        if len(data) > MAX_DATAGRAM_SIZE:
+            self.dropped += 1
+            logger.warning(f"事件 {event.get('type')} 大小 {len(data)} 字节超过上限，已丢弃。")
+            return
+        try:
+            self._transport.sendto(data)
+            self.sent += 1
+        except OSError:
+            self.dropped += 1
+
+    def close(self):
+        """关闭发送端。"""
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+
+class _SilentProtocol(asyncio.DatagramProtocol):
+    """发送端协议：接收方不存在时系统会返回 ICMP 错误，忽略即可。"""
+    def error_received(self, exc: Exception):
+        logger.debug(f"事件发送失败（Web 进程可能未运行）: {exc}")
+
+
+class _SubscriberProtocol(asyncio.DatagramProtocol):
+    """接收端协议：解析 JSON 并交给回调处理。"""
+    def __init__(self, callback: Callable[[dict], None]):
+        self.callback = callback
+
+    def datagram_received(self, data: bytes, addr):
+        try:
+            event = json.loads(data)
+        except ValueError:
+            logger.warning(f"收到无法解析的事件数据报，来自 {addr}")
+            return
+        try:
+            self.callback(event)
+        except Exception as e:
+            logger.error(f"处理事件时出错: {e}", exc_info=True)
+
+
+async def start_subscriber(host: str, port: int, callback: Callable[[dict], None]) -> asyncio.DatagramTransport:
+    """
+    在 host:port 上接收事件，每收到一个事件调用一次 callback。
+
+    :return: UDP 传输对象，关闭它即可停止接收。
+    """
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: _SubscriberProtocol(callback), local_addr=(host, port)
+    )
+    logger.info(f"事件订阅端已启动，监听 udp://{host}:{port}")
+    return transport
+
+
+# 创建一个全局的事件发布器实例（由监听进程使用）
+event_publisher = EventPublisher(settings.web_event_host, settings.web_event_port)
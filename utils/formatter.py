@@ -1,11 +1,16 @@
 import pytz
 from telethon.tl.types import Message
 from typing import Optional
+from utils.entity_cache import ChatInfo, SenderInfo, entity_cache
 
 # 北京时区
 BEIJING_TZ = pytz.timezone('Asia/Shanghai')
 
-async def format_message(event: "Message") -> Optional[str]:
+async def format_message(
+    event: "Message",
+    chat: Optional[ChatInfo] = None,
+    sender: Optional[SenderInfo] = None,
+) -> Optional[str]:
     """
     格式化 Telethon 消息事件为可读字符串。
 
@@ -16,6 +21,8 @@ async def format_message(event: "Message") -> Optional[str]:
     支持处理私聊、群组消息和回复。
 
     :param event: Telethon 的消息事件对象。
+    :param chat: 已解析的会话信息，省略时从实体缓存中获取。
+    :param sender: 已解析的发送者信息，省略时从实体缓存中获取。
     :return: 格式化后的字符串，或 None。
     """
     message_content = event.text.strip() if event.text else ""
@@ -42,21 +49,19 @@ async def format_message(event: "Message") -> Optional[str]:
     # 时间转换：UTC → 北京时间
     beijing_time = event.date.astimezone(BEIJING_TZ).strftime('%Y-%m-%d %H:%M:%S')
 
-    # 获取 sender 信息
-    sender = await event.get_sender()
+    # 获取会话和发送者信息
+    if chat is None:
+        chat, sender = await entity_cache.resolve(event)
+
     username = 'Unknown'
     nickname = 'Unknown'
     if sender:
         username = f"@{sender.username}" if sender.username else "NoUsername"
-        first = getattr(sender, 'first_name', '') or ''
-        last = getattr(sender, 'last_name', '') or ''
-        nickname = (first + ' ' + last).strip() or 'Unknown'
+        nickname = sender.name
 
-    sender_id = getattr(sender, 'id', 'Unknown ID')
+    sender_id = sender.id if sender else 'Unknown ID'
 
-    # 获取 chat 信息
-    chat = await event.get_chat()
-    chat_title = getattr(chat, 'title', None) or 'Direct Message'
+    chat_title = chat.title
     chat_id = event.chat_id
 
     # 回复消息提示
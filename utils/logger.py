@@ -1,35 +1,212 @@
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import random
 import sys
+import threading
+import time
+from typing import Optional
 from utils.config import settings
+from utils.metrics import counter, registry
+from utils.reload import config_reloader
+
+# 输出日志的后台线程，setup_logging 创建，stop_logging 停止
+_listener: Optional[logging.handlers.QueueListener] = None
+# 创建 _listener 的进程；fork 出的子进程中没有这个线程，需要重新创建
+_listener_pid: Optional[int] = None
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    把日志记录放入有界队列的处理器，队列满时丢弃并计数，从不阻塞调用方。
+    """
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """只合并消息参数；格式化（包括异常堆栈）交给输出线程完成。"""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行 JSON，便于日志采集系统解析。"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class MessageLogSampler:
+    """
+    逐条消息日志的采样和限速。
+
+    每条消息都会产生的日志行（消息内容、被排除、转发成功）在输出前先调用 allow：
+    按 sample 的比例随机采样，再用令牌桶限制每秒最多 rate 行（0 表示不限）。
+    被省略的行只计数，下次放行时补一行说明省略了多少条。
+    """
+    def __init__(self, sample: float = 1.0, rate: float = 0.0):
+        self._lock = threading.Lock()
+        self.suppressed = 0
+        self.suppressed_total = 0
+        self.configure(sample, rate)
+
+    def configure(self, sample: float, rate: float):
+        """设置（或在运行中修改）采样比例和每秒上限。"""
+        with self._lock:
+            self.sample = sample
+            self.rate = rate
+            self._tokens = max(rate, 1.0)
+            self._updated = time.monotonic()
+
+    def allow(self) -> bool:
+        """返回这一行逐条消息日志是否应该输出。"""
+        with self._lock:
+            allowed = self.sample >= 1 or random.random() < self.sample
+            if allowed and self.rate > 0:
+                now = time.monotonic()
+                self._tokens = min(max(self.rate, 1.0), self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                allowed = self._tokens >= 1
+                if allowed:
+                    self._tokens -= 1
+            if not allowed:
+                self.suppressed += 1
+                self.suppressed_total += 1
+                return False
+            suppressed, self.suppressed = self.suppressed, 0
+        if suppressed:
+            logging.getLogger(__name__).info(f"已省略 {suppressed} 条逐条消息日志（采样/限速）。")
+        return True
+
+
+# 创建一个全局的逐条消息日志采样器实例
+message_log_sampler = MessageLogSampler(settings.log_message_sample, settings.log_message_rate)
+
+
+def message_log_enabled(logger: logging.Logger, level: int = logging.INFO) -> bool:
+    """
+    判断一行逐条消息日志是否需要输出：级别未启用或被采样/限速省略时返回 False。
+
+    调用方应先检查它，再格式化消息内容，被省略的行不产生任何格式化开销。
+    """
+    return logger.isEnabledFor(level) and message_log_sampler.allow()
+
 
 def setup_logging():
     """
     配置全局日志记录。
-    
+
     - 设置日志级别。
-    - 定义日志格式。
-    - 将日志输出到控制台。
+    - 定义日志格式（文本或 JSON）。
+    - 将日志输出到控制台，并可选地写入按大小轮转的日志文件。
+    - 记录日志的协程只把记录放入有界队列，由后台线程负责格式化和输出，
+      控制台或磁盘变慢不会阻塞事件循环；队列满时丢弃新日志。
     """
+    global _listener, _listener_pid
     log_level = getattr(logging, settings.log_level, logging.INFO)
-    
+
     # 创建一个格式化器
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
-    
+    if settings.log_format == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        )
+
     # 创建一个处理器，用于输出到控制台
     stream_handler = logging.StreamHandler(sys.stdout)
     stream_handler.setLevel(log_level)
     stream_handler.setFormatter(formatter)
-    
+    handlers = [stream_handler]
+
+    # 可选的日志文件，按大小轮转
+    if settings.log_file:
+        file_handler = logging.handlers.RotatingFileHandler(
+            settings.log_file,
+            maxBytes=settings.log_max_bytes,
+            backupCount=settings.log_backup_count,
+            encoding='utf-8',
+        )
+        file_handler.setLevel(log_level)
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
+
+    # 重复调用时先停止本进程中旧的输出线程
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+    log_queue = queue.Queue(maxsize=settings.log_queue_size)
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener_pid = os.getpid()
+    _listener.start()
+
     # 获取根日志记录器并添加处理器
     root_logger = logging.getLogger()
     root_logger.setLevel(log_level)
-    
+
     # 清除任何可能存在的旧处理器，避免日志重复输出
     if root_logger.hasHandlers():
         root_logger.handlers.clear()
-        
-    root_logger.addHandler(stream_handler)
-    
-    logging.info(f"日志系统已配置，级别为: {settings.log_level}") 
\ No newline at end of file
+
+    root_logger.addHandler(DroppingQueueHandler(log_queue))
+
+    logging.info(f"日志系统已配置，级别为: {settings.log_level}，格式: {settings.log_format}")
+
+def stop_logging():
+    """输出队列中剩余的日志并停止后台线程。"""
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+    _listener = None
+
+atexit.register(stop_logging)
+
+def dropped_log_records() -> int:
+    """返回因队列已满而丢弃的日志条数。"""
+    return sum(getattr(handler, 'dropped', 0) for handler in logging.getLogger().handlers)
+
+def collect_metrics() -> list:
+    """导出日志丢弃和逐条消息日志省略的计数。"""
+    return [
+        counter("listentg_log_records_dropped_total", "日志队列已满而丢弃的日志条数", dropped_log_records()),
+        counter("listentg_log_messages_suppressed_total", "被采样或限速省略的逐条消息日志数", message_log_sampler.suppressed_total),
+    ]
+
+registry.register(collect_metrics)
+
+async def apply_log_level(changed):
+    """热加载后按新配置调整日志级别和逐条消息日志的采样设置。"""
+    if changed & {'log_message_sample', 'log_message_rate'}:
+        message_log_sampler.configure(settings.log_message_sample, settings.log_message_rate)
+    if 'log_level' not in changed:
+        return
+    log_level = getattr(logging, settings.log_level, logging.INFO)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(log_level)
+    handlers = list(root_logger.handlers)
+    if _listener is not None:
+        handlers.extend(_listener.handlers)
+    for handler in handlers:
+        handler.setLevel(log_level)
+    logging.info(f"日志级别已调整为: {settings.log_level}")
+
+config_reloader.subscribe(apply_log_level)
@@ -0,0 +1,223 @@
+"""
+轻量的运行时指标。
+
+各组件继续用自己的计数器和 Histogram 记录数据，只在导出时通过注册到 MetricsRegistry 的
+采集函数（collector）转换为指标样本，记录路径上没有额外开销：
+
+- counter / gauge / histogram 构造单个样本（可 JSON 序列化的 dict）；
+- 监听进程定期把全部样本通过事件总线推送给 Web 进程（见 MetricsRegistry.publish_loop），
+  Web 进程在 /metrics 中合并两个进程的样本，按 Prometheus 文本格式输出（见 render_prometheus）。
+"""
+
+import asyncio
+import bisect
+import inspect
+import itertools
+import json
+import logging
+import os
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Union
+
+logger = logging.getLogger(__name__)
+
+# 推送指标时每个数据报中样本的大致字节上限（低于事件总线的 MAX_DATAGRAM_SIZE）
+PUBLISH_CHUNK_BYTES = 32000
+
+# 默认的延迟分桶上界（毫秒），大致按 2 倍递增
+DEFAULT_LATENCY_BUCKETS_MS = (
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000,
+)
+# 批大小的默认分桶上界
+DEFAULT_SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# 从入队到转发完成等较长延迟的分桶上界（秒）
+DEFAULT_DELAY_BUCKETS_S = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900, 1800, 3600)
+
+
+class Histogram:
+    """
+    固定分桶的直方图，用于统计延迟分布。
+
+    记录一个值只需一次二分查找，内存占用与记录次数无关；
+    分位数按所在分桶的上界估算。
+    """
+    def __init__(self, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS_MS):
+        self.buckets: List[float] = sorted(buckets)
+        # 最后一个计数对应超过最大上界的值
+        self.counts: List[int] = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        """记录一个值。"""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q: float) -> Optional[float]:
+        """估算第 q 分位数（0 < q <= 1），没有数据时返回 None。"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self) -> dict:
+        """返回计数、平均值和常用分位数。"""
+        return {
+            "count": self.count,
+            "avg": self.sum / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+
+Sample = dict
+Collector = Callable[[], Union[Iterable[Sample], Awaitable[Iterable[Sample]]]]
+
+
+def counter(name: str, help: str, value: float, **labels) -> Sample:
+    """构造一个单调递增的计数器样本。"""
+    return {"name": name, "type": "counter", "help": help, "labels": labels, "value": value}
+
+
+def gauge(name: str, help: str, value: float, **labels) -> Sample:
+    """构造一个当前值样本。"""
+    return {"name": name, "type": "gauge", "help": help, "labels": labels, "value": value}
+
+
+def histogram(name: str, help: str, hist: Histogram, scale: float = 1.0, **labels) -> Sample:
+    """
+    构造一个直方图样本。
+
+    :param scale: 分桶上界和总和的换算系数，例如毫秒直方图以秒导出时为 0.001。
+    """
+    return {
+        "name": name,
+        "type": "histogram",
+        "help": help,
+        "labels": labels,
+        "buckets": [round(bound * scale, 9) for bound in hist.buckets],
+        "counts": list(hist.counts),
+        "sum": hist.sum * scale,
+        "count": hist.count,
+    }
+
+
+class MetricsRegistry:
+    """
+    指标采集函数的注册表。
+
+    采集函数返回样本列表（可以是协程函数），collect 时依次调用；
+    某个采集函数出错时只跳过它的样本。
+    """
+    def __init__(self):
+        self._collectors: List[Collector] = []
+
+    def register(self, collector: Collector):
+        """注册一个采集函数。"""
+        self._collectors.append(collector)
+
+    async def collect(self) -> List[Sample]:
+        """调用所有采集函数，返回全部样本。"""
+        samples: List[Sample] = []
+        for collector in self._collectors:
+            try:
+                result = collector()
+                if inspect.isawaitable(result):
+                    result = await result
+                samples.extend(result)
+            except Exception as e:
+                logger.error(f"采集指标时出错: {e}", exc_info=True)
+        return samples
+
+    async def publish_loop(self, publisher, interval: float):
+        """
+        定期采集全部样本，通过事件总线推送给 Web 进程。
+
+        样本按大小拆成若干个数据报，同一次推送的数据报有相同的 seq，
+        接收方收齐 parts 个之后再替换旧的样本（见 web.api.metrics.ListenerMetrics）。
+        """
+        pid = os.getpid()
+        for seq in itertools.count(1):
+            await asyncio.sleep(interval)
+            chunks = _split(await self.collect(), PUBLISH_CHUNK_BYTES)
+            for part, chunk in enumerate(chunks):
+                publisher.publish({
+                    "type": "metrics", "pid": pid, "seq": seq, "part": part, "parts": len(chunks), "samples": chunk,
+                })
+
+
+def _split(samples: List[Sample], max_bytes: int) -> List[List[Sample]]:
+    """把样本按序列化后的大小拆分，每组不超过 max_bytes（单个样本超过时独占一组）。"""
+    chunks: List[List[Sample]] = [[]]
+    size = 0
+    for sample in samples:
+        sample_size = len(json.dumps(sample, ensure_ascii=False).encode())
+        if chunks[-1] and size + sample_size > max_bytes:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(sample)
+        size += sample_size
+    return chunks
+
+
+def _format_labels(labels: Dict[str, object]) -> str:
+    """把标签格式化为 {a="1",b="2"}，没有标签时返回空字符串。"""
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels.items():
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{key}="{escaped}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format_value(value: float) -> str:
+    """按 Prometheus 文本格式输出数值。"""
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render_prometheus(samples: Iterable[Sample], **extra_labels) -> str:
+    """
+    把样本按 Prometheus 文本格式（0.0.4）输出，同名样本归入同一个指标族。
+
+    :param extra_labels: 附加到每个样本上的标签，例如 process="listener"。
+    """
+    families: Dict[str, List[Sample]] = {}
+    for sample in samples:
+        families.setdefault(sample["name"], []).append(sample)
+
+    lines: List[str] = []
+    for name, family in families.items():
+        lines.append(f"# HELP {name} {family[0]['help']}")
+        lines.append(f"# TYPE {name} {family[0]['type']}")
+        for sample in family:
+            labels = {**extra_labels, **sample["labels"]}
+            if sample["type"] != "histogram":
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(sample['value'])}")
+                continue
+            cumulative = 0
+            for bound, count in zip(sample["buckets"] + [float("inf")], sample["counts"]):
+                cumulative += count
+                bucket_labels = _format_labels({**labels, "le": _format_value(float(bound))})
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(sample['sum'])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {sample['count']}")
+    return "\n".join(lines) + "\n"
+
+
+# 创建一个全局的指标注册表实例（由监听进程使用，Web 进程有自己的注册表）
+registry = MetricsRegistry()
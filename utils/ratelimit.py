@@ -0,0 +1,64 @@
+import asyncio
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    自适应的令牌桶限速器。
+
+    - 以 rate 个/秒的速度补充令牌，最多积攒 burst 个。
+    - acquire 按调用顺序（FIFO）排队等待令牌。
+    - 遇到 Telegram 的 FloodWait 时调用 penalize：暂停发放令牌指定的秒数，并把速率减半；
+      之后每次成功调用 reward，速率逐步恢复到配置值（AIMD）。
+    """
+    def __init__(self, rate: float, burst: float = 1.0, min_rate: Optional[float] = None):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self.configure(rate, burst, min_rate)
+
+    def configure(self, rate: float, burst: float = 1.0, min_rate: Optional[float] = None):
+        """设置（或在运行中修改）配置的速率和突发量，当前速率同时重置为新的配置值。"""
+        # 已流逝的时间按旧速率补充令牌
+        self._refill(time.monotonic())
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.min_rate = min_rate if min_rate is not None else rate / 16
+        self._tokens = min(self._tokens, self.burst)
+
+    def _refill(self, now: float):
+        """按流逝的时间补充令牌。"""
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float = 1.0):
+        """等待并取走 tokens 个令牌。"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def penalize(self, seconds: float):
+        """收到 FloodWait：暂停 seconds 秒，清空令牌并把速率减半。"""
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0.0
+        self._updated = now
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def reward(self):
+        """一次调用成功：把速率向配置值恢复一小步。"""
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
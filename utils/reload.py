@@ -0,0 +1,111 @@
+"""
+配置热加载。
+
+config.ini 发生变化（轮询修改时间）、进程收到 SIGHUP，或 Web 管理接口请求时，
+重新读取并校验配置，校验通过后原地更新全局的 settings（见 Config.reload），
+再依次通知订阅者根据变化的设置项重建自己的状态，例如重新编译过滤规则、调整转发速率。
+新配置无效时只记录错误，继续使用当前配置。
+"""
+
+import asyncio
+import logging
+import os
+import signal
+from typing import Awaitable, Callable, List, Optional, Set
+
+from utils.config import Config, ConfigError, settings
+
+logger = logging.getLogger(__name__)
+
+# 订阅者：接收发生变化的设置项名称
+Subscriber = Callable[[Set[str]], Awaitable[None]]
+
+
+class ConfigReloader:
+    """
+    监视配置文件并在变化时热加载。
+
+    :param config: 要更新的配置实例。
+    :param interval: 轮询配置文件修改时间的间隔（秒），0 表示不轮询。
+    """
+    def __init__(self, config: Config, interval: float = 5.0):
+        self.config = config
+        self.interval = interval
+        self._subscribers: List[Subscriber] = []
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._mtime = self._read_mtime()
+        self.reloads = 0
+        self.failures = 0
+
+    def subscribe(self, callback: Subscriber):
+        """注册一个订阅者，每次热加载成功后以变化的设置项名称调用。"""
+        self._subscribers.append(callback)
+
+    def start(self):
+        """开始轮询配置文件，并在支持的平台上响应 SIGHUP。"""
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._watch())
+        if hasattr(signal, 'SIGHUP'):
+            try:
+                asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.request_reload)
+            except (NotImplementedError, RuntimeError):
+                pass
+        logger.info(f"配置热加载已启用（轮询间隔 {self.interval} 秒）。")
+
+    def stop(self):
+        """停止轮询。"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def request_reload(self):
+        """在事件循环中安排一次热加载（供信号处理器调用）。"""
+        logger.info("收到热加载请求。")
+        asyncio.ensure_future(self.reload())
+
+    async def reload(self) -> bool:
+        """
+        重新加载配置并通知订阅者。
+
+        :return: 新配置是否有效并已生效。
+        """
+        async with self._lock:
+            self._mtime = self._read_mtime()
+            try:
+                changed = self.config.reload()
+            except ConfigError as e:
+                self.failures += 1
+                logger.error(f"新配置无效，继续使用当前配置: {e}")
+                return False
+            self.reloads += 1
+            if not changed:
+                logger.info("配置已重新加载，没有需要更新的设置项。")
+                return True
+            logger.info(f"配置已重新加载，更新的设置项: {', '.join(sorted(changed))}")
+            for callback in self._subscribers:
+                try:
+                    await callback(changed)
+                except Exception as e:
+                    logger.error(f"应用新配置时出错: {e}", exc_info=True)
+            return True
+
+    def _read_mtime(self) -> Optional[float]:
+        """读取配置文件的修改时间，文件不存在时返回 None。"""
+        try:
+            return os.stat(self.config.path).st_mtime
+        except OSError:
+            return None
+
+    async def _watch(self):
+        """定期检查配置文件的修改时间。"""
+        while True:
+            await asyncio.sleep(self.interval)
+            mtime = self._read_mtime()
+            if mtime is not None and mtime != self._mtime:
+                logger.info(f"检测到配置文件 {self.config.path} 已修改。")
+                await self.reload()
+
+
+# 创建一个全局的配置热加载实例
+config_reloader = ConfigReloader(settings, interval=settings.config_watch_interval_seconds)
@@ -0,0 +1,59 @@
+import hmac
+import logging
+import os
+import signal
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException
+
+from utils.config import settings
+from utils.logger import apply_log_level
+from utils.reload import ConfigReloader
+from web.api.data import response_cache
+
+# 创建API路由器
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+# 监听进程启动 Web 进程时通过该环境变量传入自己的 pid
+LISTENER_PID_ENV = "LISTENTG_LISTENER_PID"
+
+def check_admin_token(token: Optional[str]):
+    """校验管理接口的访问令牌；未配置 [web] admin_token 时管理接口不可用。"""
+    if not settings.web_admin_token:
+        raise HTTPException(status_code=404, detail="管理接口未启用")
+    if not token or not hmac.compare_digest(token, settings.web_admin_token):
+        raise HTTPException(status_code=403, detail="访问令牌无效")
+
+async def _apply_settings(changed):
+    """热加载后更新 Web 进程中的响应缓存参数。"""
+    response_cache.ttl = settings.web_cache_ttl_seconds
+    response_cache.max_entries = settings.web_cache_max_entries
+
+# 创建一个 Web 进程自己的配置热加载实例：Web 进程导入的 handlers 模块会向全局的 config_reloader
+# 注册监听进程的订阅者（归档、词频统计等），管理接口只通知与 Web 进程有关的订阅者
+web_reloader = ConfigReloader(settings, interval=0)
+web_reloader.subscribe(apply_log_level)
+web_reloader.subscribe(_apply_settings)
+
+@router.post("/api/admin/reload")
+async def reload_config(x_admin_token: Optional[str] = Header(None)):
+    """
+    重新加载 config.ini。
+
+    先在 Web 进程中校验并加载新配置，校验通过后向监听进程发送 SIGHUP，
+    由监听进程自行热加载（过滤规则、转发速率等）。
+    """
+    check_admin_token(x_admin_token)
+    if not await web_reloader.reload():
+        raise HTTPException(status_code=422, detail="新配置无效，已保留当前配置，详见日志")
+
+    listener_signaled = False
+    listener_pid = os.environ.get(LISTENER_PID_ENV)
+    if listener_pid and hasattr(signal, "SIGHUP"):
+        try:
+            os.kill(int(listener_pid), signal.SIGHUP)
+            listener_signaled = True
+        except (OSError, ValueError) as e:
+            logger.error(f"无法通知监听进程重新加载配置: {e}")
+    return {"reloaded": True, "listener_signaled": listener_signaled}
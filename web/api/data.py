@@ -1,8 +1,23 @@
 import asyncio
-from datetime import datetime, timedelta
+import base64
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 import aiosqlite
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import StreamingResponse
+from handlers.archive import ArchiveReader, DATE_FORMAT, message_archive
+from handlers.database import DB_PATH, ReadConnectionPool
+from handlers.dimensions import lookup
+from handlers.keywords import ALL_CHATS, render_wordcloud, trending_score
+from handlers.rollups import bucket_of
+from handlers.search import build_match_query
+from utils.config import settings
 
 # 调整时区，北京时间 = UTC+8
 TIMEZONE_OFFSET = timedelta(hours=8)
@@ -10,35 +25,146 @@ TIMEZONE_OFFSET = timedelta(hours=8)
 # 创建API路由器
 router = APIRouter()
 logger = logging.getLogger(__name__)
-DB_PATH = 'listentg_messages.db'
 
-async def get_db_connection():
-    """ 创建并返回一个数据库连接 """
+# Web 进程共享的只读连接池，连接在进程生命周期内复用
+read_pool = ReadConnectionPool(DB_PATH, size=settings.db_read_pool_size)
+# 归档分区的只读连接，按需打开
+archive_reader = ArchiveReader(message_archive)
+
+async def query_db(query: str, params: tuple = (), pool: Optional[ReadConnectionPool] = None):
+    """ 从只读连接池（默认为主库的连接池）借用连接执行查询并返回所有结果 """
     try:
-        return await aiosqlite.connect(DB_PATH)
+        async with (pool or read_pool).acquire() as conn:
+            try:
+                async with conn.execute(query, params) as cursor:
+                    return await cursor.fetchall()
+            except aiosqlite.Error as e:
+                logger.error(f"数据库查询失败: {e} | Query: {query}")
+                return []
     except aiosqlite.Error as e:
         logger.error(f"无法连接到数据库: {e}")
         raise HTTPException(status_code=500, detail="数据库连接失败")
 
-async def query_db(query: str, params: tuple = ()):
-    """ 执行数据库查询并返回所有结果 """
-    conn = await get_db_connection()
-    try:
-        conn.row_factory = aiosqlite.Row
-        async with conn.cursor() as cursor:
-            await cursor.execute(query, params)
-            return await cursor.fetchall()
-    except aiosqlite.Error as e:
-        logger.error(f"数据库查询失败: {e} | Query: {query}")
-        return []
-    finally:
-        await conn.close()
-        
+
+class ResponseCache:
+    """
+    仪表盘 API 的响应缓存。
+
+    - 每个缓存项记录生成时 messages 表的最大 rowid（水位线），
+      水位线变化说明有新消息写入，缓存项立即失效；否则最多保留 ttl 秒
+      （时间窗口会随时间滑动，即使没有新消息也需要定期刷新）。
+    - 同一个键的并发请求只计算一次（single-flight），其余请求等待并共享结果。
+    - 缓存的是已序列化的 JSON（或 encode 生成的其他格式）和对应的 ETag，命中时无需重新编码。
+    """
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> (水位线, 过期时间, JSON 字节, ETag)
+        self._entries: "OrderedDict[str, Tuple[int, float, bytes, str]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.not_modified = 0
+
+    async def get(
+        self, key: str, watermark: int, compute: Callable[[], Awaitable], encode: Optional[Callable] = None,
+    ) -> Tuple[bytes, str]:
+        """
+        返回 key 对应的 (JSON 字节, ETag)，缓存失效时调用 compute 重新计算。
+
+        :param encode: 把 compute 的结果转换为字节，默认编码为 JSON。
+        """
+        entry = self._entries.get(key)
+        if entry and entry[0] == watermark and entry[1] > time.monotonic():
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[2], entry[3]
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.shared += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            payload = await compute()
+            if encode is not None:
+                body = await encode(payload)
+            else:
+                body = json.dumps(jsonable_encoder(payload), ensure_ascii=False).encode()
+            etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+            self._entries[key] = (watermark, time.monotonic() + self.ttl, body, etag)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            future.set_result((body, etag))
+            return body, etag
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 避免没有其他等待者时出现“异常未被获取”的警告
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    def stats(self) -> dict:
+        """返回缓存命中统计。"""
+        lookups = self.hits + self.misses + self.shared
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "not_modified": self.not_modified,
+            "hit_ratio": (self.hits + self.shared) / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+        }
+
+response_cache = ResponseCache(settings.web_cache_ttl_seconds, settings.web_cache_max_entries)
+
+async def get_watermark() -> int:
+    """ 返回 messages 表当前的最大 rowid，用作缓存失效的依据 """
+    rows = await query_db("SELECT COALESCE(MAX(id), 0) AS max_id FROM messages")
+    return rows[0]["max_id"] if rows else 0
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """ 判断请求的 If-None-Match 是否包含当前 ETag """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return etag in candidates or "*" in candidates
+
+async def cached_response(request: Request, key: str, compute: Callable[[], Awaitable]) -> Response:
+    """ 通过响应缓存生成 JSON 响应，ETag 未变化时返回 304 """
+    body, etag = await response_cache.get(key, await get_watermark(), compute)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request, etag):
+        response_cache.not_modified += 1
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 @router.get("/api/dashboard-data")
-async def get_dashboard_data():
+async def get_dashboard_data(request: Request):
     """
     一个端点，聚合所有仪表盘所需的数据。
     """
+    return await cached_response(request, "dashboard", build_dashboard_data)
+
+@router.get("/api/cache-stats")
+async def get_cache_stats():
+    """ 返回响应缓存的命中统计 """
+    return response_cache.stats()
+
+async def build_dashboard_data():
+    """
+    并行执行仪表盘的各个查询并组装结果。
+    """
     # 在单个响应中并行获取所有数据
     results = await asyncio.gather(
         get_top_chats_last_7_days(),
@@ -55,90 +181,573 @@ async def get_dashboard_data():
         "top_users_7_days": results[2],
         "top_chats_today": results[3],
         "hourly_activity_30_days": results[4],
-        "search_results": results[5]
+        "search_results": results[5]["results"]
     }
 
+# 按会话 id 汇总时间窗口内的消息数，只为群组和频道查出标题
+TOP_CHATS_QUERY = """
+    SELECT r.chat_id, c.chat_title, r.message_count
+    FROM (
+        SELECT chat_id, SUM(message_count) AS message_count
+        FROM rollup_chat_hourly
+        WHERE bucket >= ?
+        GROUP BY chat_id
+    ) r
+    JOIN chats c ON c.chat_id = r.chat_id
+    WHERE c.chat_type IN ('Group', 'Channel')
+    ORDER BY r.message_count DESC
+    LIMIT ?;
+"""
+
+# 按发送者 id 汇总时间窗口内的消息数，跳过未知发送者
+TOP_USERS_QUERY = """
+    SELECT r.sender_id, u.sender_name, r.message_count
+    FROM (
+        SELECT sender_id, SUM(message_count) AS message_count
+        FROM rollup_sender_hourly
+        WHERE bucket >= ? AND sender_id != 0
+        GROUP BY sender_id
+    ) r
+    LEFT JOIN users u ON u.sender_id = r.sender_id
+    WHERE COALESCE(u.sender_name, 'Unknown') != 'Unknown'
+    ORDER BY r.message_count DESC
+    LIMIT ?;
+"""
+
 async def get_top_chats_last_7_days():
     """ 获取过去7天内消息最多的群组 """
     seven_days_ago = datetime.utcnow() - timedelta(days=7)
-    query = """
-        SELECT chat_title, COUNT(*) as message_count
-        FROM messages
-        WHERE date >= ? AND chat_type IN ('Group', 'Channel')
-        GROUP BY chat_title
-        ORDER BY message_count DESC
-        LIMIT 10;
-    """
-    return await query_db(query, (seven_days_ago,))
+    return await query_db(TOP_CHATS_QUERY, (bucket_of(seven_days_ago), 10))
 
 async def get_hourly_activity_last_30_days():
     """ 获取过去30天每小时的消息频率 (考虑北京时间) """
     thirty_days_ago = datetime.utcnow() - timedelta(days=30)
     query = """
         SELECT
-            STRFTIME('%Y-%m-%d', date) as day,
-            STRFTIME('%H', date, '+8 hours') as hour,
-            COUNT(*) as message_count
-        FROM messages
-        WHERE date >= ?
-        GROUP BY day, hour;
+            STRFTIME('%Y-%m-%d', bucket) as day,
+            STRFTIME('%H', bucket, '+8 hours') as hour,
+            message_count
+        FROM rollup_hourly
+        WHERE bucket >= ?;
     """
-    return await query_db(query, (thirty_days_ago,))
+    return await query_db(query, (bucket_of(thirty_days_ago),))
 
 async def get_total_messages_last_7_days():
     """ 获取过去7天每天的总消息数 """
-    seven_days_ago = datetime.utcnow().date() - timedelta(days=7)
+    seven_days_ago = datetime.combine(datetime.utcnow().date() - timedelta(days=7), datetime.min.time())
     query = """
-        SELECT STRFTIME('%Y-%m-%d', date) as day, COUNT(*) as message_count
-        FROM messages
-        WHERE date >= ?
+        SELECT STRFTIME('%Y-%m-%d', bucket) as day, SUM(message_count) as message_count
+        FROM rollup_hourly
+        WHERE bucket >= ?
         GROUP BY day
         ORDER BY day;
     """
-    return await query_db(query, (seven_days_ago,))
+    return await query_db(query, (bucket_of(seven_days_ago),))
     
 async def get_top_users_last_7_days():
     """ 获取过去7天内消息最多的用户 """
     seven_days_ago = datetime.utcnow() - timedelta(days=7)
-    query = """
-        SELECT sender_name, COUNT(*) as message_count
-        FROM messages
-        WHERE sender_name IS NOT 'Unknown'
-        AND date >= ?
-        GROUP BY sender_name
-        ORDER BY message_count DESC
-        LIMIT 10;
-    """
-    return await query_db(query, (seven_days_ago,))
+    return await query_db(TOP_USERS_QUERY, (bucket_of(seven_days_ago), 10))
 
 async def get_top_chats_today():
     """ 获取当天消息最多的群组 """
-    today_start = datetime.utcnow().date()
-    query = """
-        SELECT chat_title, COUNT(*) as message_count
-        FROM messages
-        WHERE date >= ? AND chat_type IN ('Group', 'Channel')
-        GROUP BY chat_title
-        ORDER BY message_count DESC
-        LIMIT 10;
-    """
-    return await query_db(query, (today_start,))
+    today_start = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+    return await query_db(TOP_CHATS_QUERY, (bucket_of(today_start), 10))
 
 @router.get("/api/search")
-async def search_messages_endpoint(q: str = ""):
-    """ 根据关键词模糊搜索消息 """
-    return await search_messages(q)
+async def search_messages_endpoint(
+    request: Request,
+    q: str = "",
+    chat_id: Optional[int] = None,
+    sender_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    order: str = Query("date", pattern="^(date|rank)$"),
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    collapse: bool = False,
+):
+    """
+    全文搜索消息。
+
+    - q: 关键词，支持 "短语"、前缀* 和 -排除词。
+    - chat_id / sender_id: 只搜索指定会话或发送者。
+    - since / until: 只搜索 [since, until) 内的消息（UTC），归档分区只打开有重叠的月份。
+    - order: date 按时间倒序，rank 按相关度排序。
+    - cursor: 上一页返回的 next_cursor，用于翻页。
+    - collapse: 为 true 时折叠重复的消息（见 _collapse_duplicates），一页可能少于 limit 条。
+    """
+    since, until = _to_utc(since), _to_utc(until)
+    key = "search:" + json.dumps(
+        [q, chat_id, sender_id, since and str(since), until and str(until), order, cursor, limit, collapse],
+        ensure_ascii=False,
+    )
+    return await cached_response(
+        request, key, lambda: search_messages(q, chat_id, sender_id, order, cursor, limit, since, until, collapse)
+    )
+
+def _to_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """ 把带时区的时间转换为不带时区的 UTC 时间（数据库中的时间均为 UTC） """
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+async def _collapse_duplicates(rows: List[dict]) -> List[dict]:
+    """
+    折叠重复的消息：去掉 message_duplicates 中记录为重复的消息，其余消息附上重复副本的数量 duplicates。
+
+    重复关系只记录在主库中；翻页游标仍按折叠前的最后一行计算，不会漏掉消息。
+    """
+    if not rows:
+        return rows
+    keys = [(row["chat_id"], row["message_id"]) for row in rows]
+    values = ", ".join(["(?, ?)"] * len(keys))
+    params = tuple(value for key in keys for value in key)
+    duplicates = {
+        (row[0], row[1]) for row in await query_db(
+            f"SELECT chat_id, message_id FROM message_duplicates WHERE (chat_id, message_id) IN (VALUES {values})",
+            params,
+        )
+    }
+    counts = {
+        (row[0], row[1]): row[2] for row in await query_db(
+            "SELECT original_chat_id, original_message_id, COUNT(*) FROM message_duplicates "
+            f"WHERE (original_chat_id, original_message_id) IN (VALUES {values}) "
+            "GROUP BY original_chat_id, original_message_id",
+            params,
+        )
+    }
+    collapsed = []
+    for row, key in zip(rows, keys):
+        if key in duplicates:
+            continue
+        row["duplicates"] = counts.get(key, 0)
+        collapsed.append(row)
+    return collapsed
+
+async def _with_names(rows: List[dict]) -> List[dict]:
+    """
+    从维度表填入会话标题和发送者名字（messages 中只保存 id）。
+
+    维度表中没有的 id（例如只出现在较早归档分区中的会话）保留行中原有的值。
+    """
+    if not rows:
+        return rows
+    try:
+        async with read_pool.acquire() as conn:
+            chats, users = await lookup(
+                conn, (row["chat_id"] for row in rows), (row["sender_id"] for row in rows)
+            )
+    except aiosqlite.Error as e:
+        logger.error(f"查询会话和发送者名字失败: {e}")
+        return rows
+    for row in rows:
+        chat = chats.get(row["chat_id"])
+        if chat:
+            if "chat_type" in row:
+                row["chat_type"] = chat[0]
+            row["chat_title"] = chat[1]
+        user = users.get(row["sender_id"])
+        if user:
+            row["sender_name"] = user[0]
+            if "sender_username" in row:
+                row["sender_username"] = user[1]
+    return rows
+
+def _message_sources(since: Optional[datetime], until: Optional[datetime]) -> List[ReadConnectionPool]:
+    """ 主库和与 [since, until) 有重叠的归档分区的只读连接池，按时间从新到旧排列 """
+    return [read_pool] + [archive_reader.pool(p) for p in message_archive.partitions_for(since, until)]
+
+def _cursor_bound(until: Optional[datetime], cursor_values: list) -> Optional[datetime]:
+    """ 按时间倒序翻页时，比游标更新的归档分区中不会有下一页的消息，把查询的分区范围收窄到游标之前 """
+    try:
+        bound = datetime.strptime(str(cursor_values[0])[:19], DATE_FORMAT) + timedelta(seconds=1)
+    except ValueError:
+        return until
+    return bound if until is None else min(until, bound)
+
+def _encode_cursor(values: list) -> str:
+    """ 把游标值编码为不透明字符串 """
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def _decode_cursor(cursor: str) -> list:
+    """ 解析客户端传回的游标 """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+    if not isinstance(values, list) or len(values) != 2:
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+    return values
 
-async def search_messages(query: str):
-    """ 实际执行消息搜索的函数 """
-    if not query:
+async def search_messages(
+    query: str,
+    chat_id: Optional[int] = None,
+    sender_id: Optional[int] = None,
+    order: str = "date",
+    cursor: Optional[str] = None,
+    limit: int = 20,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    collapse: bool = False,
+):
+    """
+    实际执行消息搜索的函数，使用 FTS5 索引并按 (date, id) 或 (rank, id) 键集分页。
+
+    先查主库，再查与 [since, until) 有重叠的归档分区（见 handlers.archive），每个分区执行同样的查询：
+    按时间排序时分区之间的日期互不重叠，从新到旧依次查询，凑满 limit 条即停止；
+    按相关度排序时每个分区各取 limit 条，再按 (rank, id) 合并。
+    """
+    match = build_match_query(query) if query else None
+    if not match:
+        return {"results": [], "next_cursor": None}
+
+    conditions = ["f.messages_fts MATCH ?"]
+    params: list = [match]
+    if chat_id is not None:
+        conditions.append("m.chat_id = ?")
+        params.append(chat_id)
+    if sender_id is not None:
+        conditions.append("m.sender_id = ?")
+        params.append(sender_id)
+    if since is not None:
+        conditions.append("m.date >= ?")
+        params.append(since.strftime(DATE_FORMAT))
+    if until is not None:
+        conditions.append("m.date < ?")
+        params.append(until.strftime(DATE_FORMAT))
+
+    if order == "rank":
+        sort_key = "f.rank"
+        if cursor:
+            conditions.append("(f.rank, m.id) > (?, ?)")
+            params.extend(_decode_cursor(cursor))
+        order_by = "f.rank, m.id"
+    else:
+        sort_key = "m.date"
+        if cursor:
+            cursor_values = _decode_cursor(cursor)
+            conditions.append("(m.date, m.id) < (?, ?)")
+            params.extend(cursor_values)
+            until = _cursor_bound(until, cursor_values)
+        order_by = "m.date DESC, m.id DESC"
+
+    search_query = f"""
+        SELECT m.id, m.message_id, m.chat_id, m.chat_title, m.sender_id, m.sender_name, m.text, m.date,
+               {sort_key} AS sort_key
+        FROM messages_fts f
+        JOIN messages m ON m.id = f.rowid
+        WHERE {' AND '.join(conditions)}
+        ORDER BY {order_by}
+        LIMIT ?;
+    """
+    pools = _message_sources(since, until)
+    rows: List[aiosqlite.Row] = []
+    for pool in pools:
+        if order == "rank":
+            rows.extend(await query_db(search_query, tuple(params) + (limit,), pool))
+        else:
+            rows.extend(await query_db(search_query, tuple(params) + (limit - len(rows),), pool))
+            if len(rows) >= limit:
+                break
+    if order == "rank" and len(pools) > 1:
+        rows = sorted(rows, key=lambda row: (row["sort_key"], row["id"]))[:limit]
+
+    next_cursor = None
+    if len(rows) == limit:
+        last = rows[-1]
+        next_cursor = _encode_cursor([last["sort_key"], last["id"]])
+    results = [{key: row[key] for key in row.keys() if key != "sort_key"} for row in rows]
+    if collapse:
+        results = await _collapse_duplicates(results)
+    return {"results": await _with_names(results), "next_cursor": next_cursor}
+
+# 浏览接口返回的消息字段
+MESSAGE_FIELDS = (
+    "m.id, m.message_id, m.chat_id, m.chat_type, m.chat_title, m.sender_id, m.sender_name, "
+    "m.sender_username, m.text, m.date, m.is_reply, m.reply_to_message_id"
+)
+# NDJSON 流每次从数据库读取的行数
+STREAM_PAGE_SIZE = 1000
+
+async def browse_messages(
+    chat_id: Optional[int] = None,
+    sender_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    after: Optional[list] = None,
+    limit: int = 100,
+    collapse: bool = False,
+) -> Tuple[List[dict], Optional[list]]:
+    """
+    按时间倒序列出消息，按 (date, id) 键集分页。
+
+    使用 (chat_id, date) 或 (sender_id, date) 索引（只按时间范围时使用 date 开头的索引），
+    翻页的代价与页码无关；主库查完后依次查询更早的归档分区，凑满 limit 条即停止。
+    会话标题和发送者名字在凑满一页后从维度表中查出。
+
+    :param after: 上一页最后一条消息的 [date, id]，None 表示第一页。
+    :param collapse: 折叠重复的消息（见 _collapse_duplicates），一页可能少于 limit 条。
+    :return: (本页的行, 下一页的游标值)，没有下一页时游标值为 None。
+    """
+    conditions: List[str] = []
+    params: list = []
+    if chat_id is not None:
+        conditions.append("m.chat_id = ?")
+        params.append(chat_id)
+    if sender_id is not None:
+        conditions.append("m.sender_id = ?")
+        params.append(sender_id)
+    if since is not None:
+        conditions.append("m.date >= ?")
+        params.append(since.strftime(DATE_FORMAT))
+    if until is not None:
+        conditions.append("m.date < ?")
+        params.append(until.strftime(DATE_FORMAT))
+    if after:
+        conditions.append("(m.date, m.id) < (?, ?)")
+        params.extend(after)
+        until = _cursor_bound(until, after)
+
+    browse_query = f"""
+        SELECT {MESSAGE_FIELDS}
+        FROM messages m
+        WHERE {' AND '.join(conditions) or '1'}
+        ORDER BY m.date DESC, m.id DESC
+        LIMIT ?;
+    """
+    rows: List[aiosqlite.Row] = []
+    for pool in _message_sources(since, until):
+        rows.extend(await query_db(browse_query, tuple(params) + (limit - len(rows),), pool))
+        if len(rows) >= limit:
+            break
+    next_values = [rows[-1]["date"], rows[-1]["id"]] if len(rows) == limit else None
+    results = [dict(row) for row in rows]
+    if collapse:
+        results = await _collapse_duplicates(results)
+    return await _with_names(results), next_values
+
+@router.get("/api/messages")
+async def list_messages_endpoint(
+    request: Request,
+    chat_id: Optional[int] = None,
+    sender_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    collapse: bool = False,
+):
+    """
+    按会话、发送者和时间范围浏览消息，按时间倒序分页。
+
+    - chat_id / sender_id: 只列出指定会话或发送者的消息。
+    - since / until: 只列出 [since, until) 内的消息（UTC）。
+    - cursor: 上一页返回的 next_cursor，用于翻页。
+    - collapse: 为 true 时折叠重复的消息，每条消息附上重复副本的数量，一页可能少于 limit 条。
+    """
+    since, until = _to_utc(since), _to_utc(until)
+    key = "messages:" + json.dumps(
+        [chat_id, sender_id, since and str(since), until and str(until), cursor, limit, collapse], ensure_ascii=False
+    )
+
+    async def compute():
+        rows, next_values = await browse_messages(
+            chat_id, sender_id, since, until, _decode_cursor(cursor) if cursor else None, limit, collapse
+        )
+        return {
+            "results": rows,
+            "next_cursor": _encode_cursor(next_values) if next_values else None,
+        }
+
+    return await cached_response(request, key, compute)
+
+@router.get("/api/messages/stream")
+async def stream_messages_endpoint(
+    chat_id: Optional[int] = None,
+    sender_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    collapse: bool = False,
+):
+    """
+    以 NDJSON（每行一条消息的 JSON）流式返回满足条件的全部消息，按时间倒序。
+
+    服务器每次只读取 STREAM_PAGE_SIZE 行并立即发送，读完一页就归还数据库连接，
+    不会在内存中保存整个结果集，也不会长时间占用只读连接池。
+    参数与 /api/messages 相同，limit 为返回的总条数上限（默认不限）。
+    """
+    since, until = _to_utc(since), _to_utc(until)
+    after = _decode_cursor(cursor) if cursor else None
+
+    async def generate():
+        sent = 0
+        current = after
+        while limit is None or sent < limit:
+            page_size = STREAM_PAGE_SIZE if limit is None else min(STREAM_PAGE_SIZE, limit - sent)
+            rows, current = await browse_messages(chat_id, sender_id, since, until, current, page_size, collapse)
+            if rows:
+                yield "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows).encode()
+                sent += len(rows)
+            if current is None:
+                break
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+# 时间窗口内被重复发送最多的内容：每条原始消息的副本数和涉及的会话数
+TOP_DUPLICATES_QUERY = """
+    SELECT d.original_chat_id AS chat_id, d.original_message_id AS message_id,
+           COUNT(*) AS copies, COUNT(DISTINCT d.chat_id) AS chats, MAX(d.date) AS last_seen,
+           m.sender_id, m.text, m.date
+    FROM message_duplicates d
+    LEFT JOIN messages m ON m.chat_id = d.original_chat_id AND m.message_id = d.original_message_id
+    WHERE d.date >= ?
+    GROUP BY d.original_chat_id, d.original_message_id
+    ORDER BY copies DESC
+    LIMIT ?;
+"""
+
+@router.get("/api/duplicates")
+async def duplicates_endpoint(
+    request: Request,
+    hours: int = Query(24, ge=1, le=24 * 30),
+    limit: int = Query(20, ge=1, le=200),
+):
+    """ 过去 hours 小时内被重复发送最多的内容（原始消息、副本数和涉及的会话数） """
+    async def compute():
+        since = datetime.utcnow() - timedelta(hours=hours)
+        rows = await query_db(TOP_DUPLICATES_QUERY, (since.strftime(DATE_FORMAT), limit))
+        return {"hours": hours, "results": await _with_names([dict(row) for row in rows])}
+
+    return await cached_response(request, f"duplicates:{hours}:{limit}", compute)
+
+
+# 时间窗口内出现次数最多的词（chat_id 为 0 时是全部会话的合计）
+TOP_TERMS_QUERY = """
+    SELECT term, SUM(count) AS count
+    FROM term_hourly
+    WHERE chat_id = ? AND bucket >= ?
+    GROUP BY term
+    ORDER BY count DESC
+    LIMIT ?;
+"""
+# 参与热词评分的候选词数量（按当前窗口的次数取前 N 个）
+TRENDING_CANDIDATES = 500
+# 参与热词评分的词在当前窗口中至少出现的次数
+TRENDING_MIN_COUNT = 3
+# 词云使用的词数
+WORDCLOUD_TERMS = 200
+# Web 进程启动后预先生成并定期刷新的词云窗口（小时）
+WORDCLOUD_PRESET_HOURS = (24, 168)
+
+# 词云图片的缓存：按固定的时间周期失效（见 _wordcloud_period），不随新消息失效
+wordcloud_cache = ResponseCache(settings.keywords_wordcloud_cache_seconds * 2, 64)
+
+async def get_top_terms(hours: int, chat_id: Optional[int], limit: int) -> List[dict]:
+    """ 获取过去 hours 小时内（指定会话或全部会话）出现次数最多的词 """
+    since = datetime.utcnow() - timedelta(hours=hours)
+    rows = await query_db(TOP_TERMS_QUERY, (chat_id or ALL_CHATS, bucket_of(since), limit))
+    return [dict(row) for row in rows]
+
+async def get_trending_terms(hours: int, baseline_hours: int, chat_id: Optional[int], limit: int) -> List[dict]:
+    """
+    获取过去 hours 小时内的热词：与之前 baseline_hours 小时的基线相比，出现次数上升最显著的词。
+    """
+    now = datetime.utcnow()
+    start = bucket_of(now - timedelta(hours=hours))
+    baseline_start = bucket_of(now - timedelta(hours=hours + baseline_hours))
+    chat = chat_id or ALL_CHATS
+    candidates = [
+        dict(row) for row in await query_db(TOP_TERMS_QUERY, (chat, start, TRENDING_CANDIDATES))
+        if row["count"] >= TRENDING_MIN_COUNT
+    ]
+    if not candidates:
         return []
-    
-    search_query = """
-        SELECT chat_title, sender_name, text, date
-        FROM messages
-        WHERE text LIKE ?
-        ORDER BY date DESC
-        LIMIT 20;
-    """
-    return await query_db(search_query, (f'%{query}%',)) 
\ No newline at end of file
+    placeholders = ", ".join("?" * len(candidates))
+    baseline_rows = await query_db(
+        f"SELECT term, SUM(count) AS count FROM term_hourly "
+        f"WHERE chat_id = ? AND bucket >= ? AND bucket < ? AND term IN ({placeholders}) GROUP BY term",
+        (chat, baseline_start, start) + tuple(row["term"] for row in candidates),
+    )
+    baseline = {row["term"]: row["count"] for row in baseline_rows}
+    for row in candidates:
+        row["baseline"] = baseline.get(row["term"], 0)
+        row["score"] = round(trending_score(row["count"], row["baseline"], hours, baseline_hours), 3)
+    candidates.sort(key=lambda row: row["score"], reverse=True)
+    return candidates[:limit]
+
+@router.get("/api/keywords")
+async def keywords_endpoint(
+    request: Request,
+    hours: int = Query(24, ge=1, le=24 * 30),
+    chat_id: Optional[int] = None,
+    trending: bool = False,
+    baseline_hours: int = Query(168, ge=1, le=24 * 30),
+    limit: int = Query(50, ge=1, le=500),
+):
+    """
+    关键词统计。
+
+    - hours: 时间窗口（小时）。
+    - chat_id: 只统计指定会话，默认为全部会话。
+    - trending: 为 true 时按热度得分排序（与之前 baseline_hours 小时相比的上升幅度），否则按出现次数排序。
+    """
+    key = "keywords:" + json.dumps([hours, chat_id, trending, baseline_hours, limit])
+
+    async def compute():
+        if trending:
+            terms = await get_trending_terms(hours, baseline_hours, chat_id, limit)
+        else:
+            terms = await get_top_terms(hours, chat_id, limit)
+        return {"hours": hours, "chat_id": chat_id, "trending": trending, "terms": terms}
+
+    return await cached_response(request, key, compute)
+
+def _wordcloud_period() -> int:
+    """ 当前的词云缓存周期，作为词云缓存的水位线，每 wordcloud_cache_seconds 秒变化一次 """
+    return int(time.time() // settings.keywords_wordcloud_cache_seconds)
+
+async def build_wordcloud(hours: int, chat_id: Optional[int]) -> Tuple[bytes, str]:
+    """ 生成（或从缓存中取出）时间窗口内的词云 PNG 图片和 ETag """
+    async def compute():
+        return await get_top_terms(hours, chat_id, WORDCLOUD_TERMS)
+
+    async def encode(terms: List[dict]) -> bytes:
+        if not terms:
+            raise HTTPException(status_code=404, detail="时间窗口内没有关键词")
+        frequencies = {row["term"]: row["count"] for row in terms}
+        try:
+            return await asyncio.to_thread(render_wordcloud, frequencies, settings.keywords_wordcloud_font)
+        except RuntimeError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+
+    # 水位线取缓存周期：词云每个周期重新绘制一次，不会因每条新消息重新绘制
+    return await wordcloud_cache.get(f"wordcloud:{hours}:{chat_id}", _wordcloud_period(), compute, encode)
+
+@router.get("/api/keywords/wordcloud.png")
+async def wordcloud_endpoint(
+    request: Request,
+    hours: int = Query(24, ge=1, le=24 * 30),
+    chat_id: Optional[int] = None,
+):
+    """ 时间窗口内的关键词词云（PNG），按窗口缓存 """
+    body, etag = await build_wordcloud(hours, chat_id)
+    headers = {"ETag": etag, "Cache-Control": f"max-age={int(settings.keywords_wordcloud_cache_seconds)}"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="image/png", headers=headers)
+
+async def wordcloud_refresh_loop():
+    """ 在每个缓存周期开始时预先生成常用窗口（全部会话）的词云 """
+    while True:
+        for hours in WORDCLOUD_PRESET_HOURS:
+            try:
+                await build_wordcloud(hours, None)
+            except HTTPException:
+                pass
+            except Exception as e:
+                logger.error(f"生成 {hours} 小时的词云失败: {e}", exc_info=True)
+        interval = settings.keywords_wordcloud_cache_seconds
+        await asyncio.sleep(interval - time.time() % interval + 1)
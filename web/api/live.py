@@ -0,0 +1,223 @@
+import asyncio
+import json
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Set
+
+from fastapi import APIRouter, Request
+from starlette.responses import StreamingResponse
+
+from handlers.rollups import bucket_of
+from utils.config import settings
+from utils.eventbus import start_subscriber
+from web.api.data import TOP_CHATS_QUERY, TOP_USERS_QUERY, query_db
+
+# 创建API路由器
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+# 每个订阅者最多积压的事件数，超过后丢弃积压并通知客户端全量刷新
+SUBSCRIBER_QUEUE_SIZE = 100
+# 没有事件时发送注释行的间隔，防止代理断开空闲连接
+KEEPALIVE_SECONDS = 15
+# 排行榜与数据库重新同步的间隔（时间窗口会随时间滑动）
+RESYNC_SECONDS = 60
+TOP_N = 10
+
+class LiveHub:
+    """
+    实时事件中心。
+
+    - 从监听进程接收计数增量和新消息事件，转发给所有 SSE 订阅者。
+    - 维护三个排行榜的完整计数，应用增量后只推送发生变化的前 N 名。
+    - 定期从预聚合表重新同步排行榜，修正窗口滑动和丢失的事件。
+    - 其他类型的事件（如 metrics）交给通过 on 注册的处理函数。
+    """
+    def __init__(self):
+        self._handlers: Dict[str, Callable[[dict], None]] = {}
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._transport: Optional[asyncio.DatagramTransport] = None
+        self._resync_task: Optional[asyncio.Task] = None
+        # 排行榜名称 -> 会话或发送者 id 到消息数的完整计数
+        self._boards: Dict[str, Counter] = {}
+        # 排行榜中出现过的 id 对应的名字
+        self._chat_titles: Dict[int, str] = {}
+        self._sender_names: Dict[int, str] = {}
+        self._last_top: Dict[str, List[dict]] = {}
+
+    async def start(self):
+        """开始接收监听进程的事件。"""
+        try:
+            self._transport = await start_subscriber(
+                settings.web_event_host, settings.web_event_port, self._on_event
+            )
+        except OSError as e:
+            logger.error(f"无法监听实时事件端口，仪表盘将退回轮询模式: {e}")
+            return
+        self._resync_task = asyncio.create_task(self._resync_loop())
+
+    async def stop(self):
+        """停止接收事件。"""
+        if self._resync_task:
+            self._resync_task.cancel()
+            self._resync_task = None
+        if self._transport:
+            self._transport.close()
+            self._transport = None
+
+    def on(self, event_type: str, handler: Callable[[dict], None]):
+        """注册一种事件的处理函数，无论是否有 SSE 订阅者都会调用。"""
+        self._handlers[event_type] = handler
+
+    def subscribe(self) -> asyncio.Queue:
+        """注册一个订阅者，返回其事件队列。"""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        """注销订阅者。"""
+        self._subscribers.discard(queue)
+
+    @property
+    def subscriber_count(self) -> int:
+        """当前的订阅者数量。"""
+        return len(self._subscribers)
+
+    async def ensure_loaded(self):
+        """第一个订阅者连接时加载排行榜。"""
+        if not self._boards:
+            await self._load_boards()
+            self._last_top = {name: self._top(name) for name in self._boards}
+
+    def _broadcast(self, event: dict):
+        """把事件放入每个订阅者的队列；积压过多的订阅者改为收到一次全量刷新通知。"""
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"type": "resync"})
+
+    def _on_event(self, event: dict):
+        """处理监听进程发来的事件。"""
+        handler = self._handlers.get(event.get("type"))
+        if handler is not None:
+            handler(event)
+            return
+        if not self._subscribers:
+            return
+        if event.get("type") == "counters":
+            self._broadcast({"type": "counters", "hourly": event.get("hourly", {})})
+            self._apply_counters(event)
+        elif event.get("type") == "messages":
+            self._broadcast(event)
+
+    def _apply_counters(self, event: dict):
+        """把计数增量应用到排行榜，推送发生变化的前 N 名。"""
+        if not self._boards:
+            return
+        for chat_id, chat_type, chat_title, count in event.get("chats", []):
+            if chat_type in ("Group", "Channel"):
+                self._chat_titles[chat_id] = chat_title
+                self._boards["top_chats_7_days"][chat_id] += count
+                self._boards["top_chats_today"][chat_id] += count
+        for sender_id, sender_name, count in event.get("senders", []):
+            if sender_id and sender_name != "Unknown":
+                self._sender_names[sender_id] = sender_name
+                self._boards["top_users_7_days"][sender_id] += count
+        self._push_changed_top()
+
+    def _top(self, name: str) -> List[dict]:
+        """返回排行榜的前 N 名，格式与 /api/dashboard-data 中的一致。"""
+        top = self._boards[name].most_common(TOP_N)
+        if name == "top_users_7_days":
+            return [
+                {"sender_id": key, "sender_name": self._sender_names.get(key), "message_count": count}
+                for key, count in top
+            ]
+        return [
+            {"chat_id": key, "chat_title": self._chat_titles.get(key), "message_count": count}
+            for key, count in top
+        ]
+
+    def _push_changed_top(self):
+        """计算各排行榜的前 N 名，只推送与上次不同的部分。"""
+        changed = {}
+        for name in self._boards:
+            top = self._top(name)
+            if top != self._last_top.get(name):
+                self._last_top[name] = top
+                changed[name] = top
+        if changed:
+            self._broadcast({"type": "top", **changed})
+
+    async def _load_boards(self):
+        """从预聚合表加载排行榜的完整计数。"""
+        now = datetime.utcnow()
+        seven_days_ago = bucket_of(now - timedelta(days=7))
+        today_start = bucket_of(datetime.combine(now.date(), datetime.min.time()))
+        # LIMIT -1 表示不限条数，排行榜需要完整的计数
+        chats_7_days, chats_today, users_7_days = await asyncio.gather(
+            query_db(TOP_CHATS_QUERY, (seven_days_ago, -1)),
+            query_db(TOP_CHATS_QUERY, (today_start, -1)),
+            query_db(TOP_USERS_QUERY, (seven_days_ago, -1)),
+        )
+        self._chat_titles = {row[0]: row[1] for row in chats_7_days}
+        self._sender_names = {row[0]: row[1] for row in users_7_days}
+        self._boards = {
+            "top_chats_7_days": Counter({row[0]: row[2] for row in chats_7_days}),
+            "top_chats_today": Counter({row[0]: row[2] for row in chats_today}),
+            "top_users_7_days": Counter({row[0]: row[2] for row in users_7_days}),
+        }
+
+    async def _resync_loop(self):
+        """有订阅者时定期从数据库重新同步排行榜。"""
+        while True:
+            if self._subscribers:
+                try:
+                    await self._load_boards()
+                    self._push_changed_top()
+                except Exception as e:
+                    logger.error(f"同步排行榜失败: {e}", exc_info=True)
+            else:
+                self._boards = {}
+                self._last_top = {}
+            await asyncio.sleep(RESYNC_SECONDS)
+
+# 创建一个全局的实时事件中心实例
+hub = LiveHub()
+
+@router.get("/api/stream")
+async def stream_events(request: Request):
+    """
+    Server-Sent Events 端点，推送仪表盘的增量更新：
+
+    - counters：各小时桶的新增消息数（用于总数折线图和热力图）。
+    - top：发生变化的排行榜前 N 名。
+    - messages：最新写入的消息。
+    - resync：事件积压被丢弃，客户端应重新获取完整数据。
+    """
+    await hub.ensure_loaded()
+    queue = hub.subscribe()
+
+    async def event_source():
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+        finally:
+            hub.unsubscribe(queue)
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,104 @@
+import logging
+import time
+from typing import Dict, List, Optional
+
+from fastapi import APIRouter
+from starlette.responses import Response
+
+from utils.config import settings
+from utils.metrics import MetricsRegistry, counter, gauge, render_prometheus
+from web.api.data import read_pool, response_cache
+from web.api.live import hub
+
+# 创建API路由器
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# 超过这么多个推送间隔没有收到监听进程的指标，就认为它已停止
+STALE_INTERVALS = 3
+
+
+class ListenerMetrics:
+    """
+    监听进程最近一次推送的指标样本。
+
+    监听进程和 Web 进程是两个独立的进程，监听进程定期通过事件总线推送全部样本
+    （见 utils.metrics.MetricsRegistry.publish_loop），这里只保留最新的一份。
+    一次推送可能拆成多个数据报，收齐后才替换；丢失了部分数据报的推送直接放弃，等下一次。
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples: List[dict] = []
+        self.pid: Optional[int] = None
+        self.received_at: Optional[float] = None
+        self.updates = 0
+        # 正在接收的推送：(pid, seq) 和已收到的部分
+        self._pending_key = None
+        self._parts: Dict[int, List[dict]] = {}
+
+    def update(self, event: dict):
+        """处理一个 metrics 事件（一次推送中的一个数据报）。"""
+        key = (event.get("pid"), event.get("seq"))
+        if key != self._pending_key:
+            self._pending_key = key
+            self._parts = {}
+        self._parts[event.get("part", 0)] = event.get("samples", [])
+        parts = event.get("parts", 1)
+        if len(self._parts) < parts:
+            return
+        self.samples = [sample for part in range(parts) for sample in self._parts.get(part, [])]
+        self.pid = event.get("pid")
+        self.received_at = time.monotonic()
+        self.updates += 1
+        self._parts = {}
+
+    def age(self) -> Optional[float]:
+        """距离上次收到指标的秒数，从未收到时返回 None。"""
+        return None if self.received_at is None else time.monotonic() - self.received_at
+
+    def is_fresh(self) -> bool:
+        """最近是否收到过监听进程的指标。"""
+        age = self.age()
+        return age is not None and age <= self.interval * STALE_INTERVALS
+
+
+# 创建一个全局的监听进程指标实例，并接收事件总线上的 metrics 事件
+listener_metrics = ListenerMetrics(settings.metrics_push_interval_seconds)
+hub.on("metrics", listener_metrics.update)
+
+
+def collect_web_metrics() -> list:
+    """导出 Web 进程自身的指标。"""
+    cache = response_cache.stats()
+    age = listener_metrics.age()
+    return [
+        gauge("listentg_listener_up", "最近是否收到监听进程推送的指标", 1 if listener_metrics.is_fresh() else 0),
+        gauge("listentg_listener_metrics_age_seconds", "距离上次收到监听进程指标的秒数", age if age is not None else -1),
+        counter("listentg_web_cache_hits_total", "响应缓存命中次数", cache["hits"]),
+        counter("listentg_web_cache_misses_total", "响应缓存未命中次数", cache["misses"]),
+        counter("listentg_web_cache_shared_total", "与进行中的相同请求共享结果的次数", cache["shared"]),
+        counter("listentg_web_not_modified_total", "返回 304 的次数", cache["not_modified"]),
+        gauge("listentg_web_cache_entries", "响应缓存当前条数", cache["entries"]),
+        gauge("listentg_web_read_connections", "已打开的只读数据库连接数", read_pool.opened),
+        gauge("listentg_web_sse_subscribers", "实时事件流的订阅者数", hub.subscriber_count),
+    ]
+
+
+# 创建 Web 进程的指标注册表（与监听进程的 utils.metrics.registry 相互独立）
+web_registry = MetricsRegistry()
+web_registry.register(collect_web_metrics)
+
+
+@router.get("/metrics")
+async def metrics():
+    """
+    以 Prometheus 文本格式导出指标。
+
+    监听进程的样本带 process="listener" 标签，Web 进程的样本带 process="web" 标签；
+    监听进程超过一段时间没有推送时只导出 Web 进程的样本，listentg_listener_up 为 0。
+    """
+    body = render_prometheus(await web_registry.collect(), process="web")
+    if listener_metrics.is_fresh():
+        body += render_prometheus(listener_metrics.samples, process="listener")
+    return Response(content=body, media_type=PROMETHEUS_CONTENT_TYPE)
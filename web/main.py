@@ -1,19 +1,42 @@
 
+import asyncio
+from contextlib import asynccontextmanager
 import uvicorn
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from starlette.responses import FileResponse
+from web.api import admin as api_admin
 from web.api import data as api_data
+from web.api import live as api_live
+from web.api import metrics as api_metrics
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    应用生命周期：启动时开始接收监听进程的实时事件并预先生成词云，
+    退出时关闭事件接收、只读连接池和归档分区的连接。
+    """
+    await api_live.hub.start()
+    wordcloud_task = asyncio.create_task(api_data.wordcloud_refresh_loop())
+    yield
+    wordcloud_task.cancel()
+    await api_live.hub.stop()
+    await api_data.read_pool.close()
+    await api_data.archive_reader.close()
 
 # 创建 FastAPI 应用实例
 app = FastAPI(
     title="ListenTG WebUI",
     description="一个用于 ListenTG 的 Web 数据仪表盘。",
-    version="0.1.0"
+    version="0.1.0",
+    lifespan=lifespan
 )
 
 # 包含 API 路由器
 app.include_router(api_data.router)
+app.include_router(api_live.router)
+app.include_router(api_admin.router)
+app.include_router(api_metrics.router)
 
 # 挂载静态文件目录
 app.mount("/static", StaticFiles(directory="web/static"), name="static")
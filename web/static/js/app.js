@@ -6,7 +6,14 @@ document.addEventListener("DOMContentLoaded", () => {
       const loading = ref(true);
       const searchQuery = ref("");
       const searchResults = ref([]);
+      const liveMessages = ref([]);
       const chartInstances = reactive({});
+      // 最近一次获取的完整仪表盘数据，实时增量会在此基础上更新
+      let dashboard = null;
+      let pollTimer = null;
+      const POLL_INTERVAL = 5000; // 实时推送不可用时的轮询间隔
+      const RESYNC_INTERVAL = 5 * 60 * 1000; // 即使有实时推送，也定期全量同步一次
+      const LIVE_MESSAGES_LIMIT = 20;
       const TIMEZONE_OFFSET = 8 * 60 * 60 * 1000; // 8 hours for Beijing Time
 
       // ECharts option templates
@@ -56,13 +63,8 @@ document.addEventListener("DOMContentLoaded", () => {
       const fetchData = async () => {
         try {
           const response = await fetch("/api/dashboard-data");
-          const data = await response.json();
-
-          updateTopChats7Days(data.top_chats_7_days);
-          updateTotalMessages7Days(data.total_messages_7_days);
-          updateTopUsers7Days(data.top_users_7_days);
-          updateTopChatsToday(data.top_chats_today);
-          updateHourlyActivityHeatmap(data.hourly_activity_30_days);
+          dashboard = await response.json();
+          renderDashboard();
         } catch (error) {
           console.error("Failed to fetch dashboard data:", error);
         } finally {
@@ -82,6 +84,94 @@ document.addEventListener("DOMContentLoaded", () => {
         }
       };
 
+      const renderDashboard = () => {
+        updateTopChats7Days(dashboard.top_chats_7_days);
+        updateTotalMessages7Days(dashboard.total_messages_7_days);
+        updateTopUsers7Days(dashboard.top_users_7_days);
+        updateTopChatsToday(dashboard.top_chats_today);
+        updateHourlyActivityHeatmap(dashboard.hourly_activity_30_days);
+      };
+
+      // 应用服务端推送的小时计数增量（bucket 为 UTC 小时，热力图使用北京时间小时）
+      const applyCounters = (hourly) => {
+        if (!dashboard) return;
+        Object.entries(hourly).forEach(([bucket, count]) => {
+          const day = bucket.substring(0, 10);
+          const hour = String((parseInt(bucket.substring(11, 13), 10) + 8) % 24).padStart(2, "0");
+
+          const total = dashboard.total_messages_7_days.find((item) => item.day === day);
+          if (total) {
+            total.message_count += count;
+          } else {
+            dashboard.total_messages_7_days.push({ day, message_count: count });
+          }
+
+          const cell = dashboard.hourly_activity_30_days.find(
+            (item) => item.day === day && item.hour === hour
+          );
+          if (cell) {
+            cell.message_count += count;
+          } else {
+            dashboard.hourly_activity_30_days.push({ day, hour, message_count: count });
+          }
+        });
+        updateTotalMessages7Days(dashboard.total_messages_7_days);
+        updateHourlyActivityHeatmap(dashboard.hourly_activity_30_days);
+      };
+
+      // 应用服务端推送的排行榜变化
+      const applyTop = (changes) => {
+        if (!dashboard) return;
+        if (changes.top_chats_7_days) {
+          dashboard.top_chats_7_days = changes.top_chats_7_days;
+          updateTopChats7Days(dashboard.top_chats_7_days);
+        }
+        if (changes.top_chats_today) {
+          dashboard.top_chats_today = changes.top_chats_today;
+          updateTopChatsToday(dashboard.top_chats_today);
+        }
+        if (changes.top_users_7_days) {
+          dashboard.top_users_7_days = changes.top_users_7_days;
+          updateTopUsers7Days(dashboard.top_users_7_days);
+        }
+      };
+
+      const startPolling = () => {
+        if (!pollTimer) {
+          pollTimer = setInterval(fetchData, POLL_INTERVAL);
+        }
+      };
+
+      const stopPolling = () => {
+        if (pollTimer) {
+          clearInterval(pollTimer);
+          pollTimer = null;
+        }
+      };
+
+      // 订阅服务端推送；连接不可用时退回轮询
+      const connectStream = () => {
+        if (!window.EventSource) {
+          startPolling();
+          return;
+        }
+        const source = new EventSource("/api/stream");
+        source.addEventListener("open", () => {
+          stopPolling();
+          fetchData(); // (重新)连接后全量同步一次，弥补断线期间的变化
+        });
+        source.addEventListener("error", () => {
+          startPolling();
+        });
+        source.addEventListener("counters", (e) => applyCounters(JSON.parse(e.data).hourly));
+        source.addEventListener("top", (e) => applyTop(JSON.parse(e.data)));
+        source.addEventListener("messages", (e) => {
+          const messages = JSON.parse(e.data).messages.reverse();
+          liveMessages.value = messages.concat(liveMessages.value).slice(0, LIVE_MESSAGES_LIMIT);
+        });
+        source.addEventListener("resync", () => fetchData());
+      };
+
       const initCharts = () => {
         chartInstances.topChats7Days = echarts.init(
           document.getElementById("top-chats-7-days")
@@ -316,7 +406,8 @@ document.addEventListener("DOMContentLoaded", () => {
             const response = await fetch(
               `/api/search?q=${encodeURIComponent(searchQuery.value)}`
             );
-            searchResults.value = await response.json();
+            const data = await response.json();
+            searchResults.value = data.results;
           } else {
             searchResults.value = [];
           }
@@ -326,7 +417,8 @@ document.addEventListener("DOMContentLoaded", () => {
       onMounted(() => {
         initCharts();
         fetchData(); // Initial fetch
-        setInterval(fetchData, 5000); // Poll every 5 seconds
+        connectStream(); // 实时推送，失败时退回每 5 秒轮询
+        setInterval(fetchData, RESYNC_INTERVAL);
 
         window.addEventListener("resize", () => {
           Object.values(chartInstances).forEach((chart) => chart.resize());
@@ -337,6 +429,7 @@ document.addEventListener("DOMContentLoaded", () => {
         searchQuery,
         searchResults,
         searchMessages,
+        liveMessages,
         formatDate,
       };
     },